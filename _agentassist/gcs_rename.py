@@ -0,0 +1,523 @@
+"""Renames or moves GCS objects that match a pattern, concurrently.
+
+Replaces rename-json-to-txt.py, which ran one `gsutil mv` process per object.
+Objects are listed lazily, page by page, and every object is copied with a
+server side rewrite by a pool of threads, each with its own client. The
+sources of finished copies are deleted in batch requests of up to
+`--batch_size` deletes.
+
+The source pattern may contain one `*`, which matches any part of a name,
+including slashes. The part it matched replaces the `*` of the destination.
+A destination that ends with `/` keeps the names relative to the part of the
+source before the `*`.
+
+Examples:
+
+    # What rename-json-to-txt.py did.
+    python3 gcs_rename.py 'gs://insights-temp/question-*.json' \
+        'gs://insights-temp/question-*.txt'
+    # Moves a prefix to another bucket, and shows what would be moved first.
+    python3 gcs_rename.py 'gs://agentassist-data/_temp/*' gs://archive/2021/ \
+        --dry_run
+
+Moved objects usually no longer match the source pattern, so running the same
+command again after a failure only moves what is left. When they do, e.g. from
+gs://b/data/* to gs://b/data/old/*, the objects a run moved are not moved
+again in the same run. With `--journal`, the names of moved objects, and of
+their copies that match the source pattern, are also appended to a file, and
+skipped when listed again, which makes resuming safe in that case too. A
+source pattern that matches no object is an error.
+`--benchmark` compares this with one process per object on a GCS emulator.
+"""
+
+import argparse
+import concurrent.futures
+import os
+import re
+import subprocess
+import sys
+import threading
+import time
+
+from google.api_core import exceptions
+from google.cloud import storage
+import requests
+
+# Errors that fail one object, which is retried when the tool runs again.
+_OBJECT_ERRORS = (exceptions.GoogleAPICallError,
+                  requests.exceptions.RequestException)
+_MAX_REPORTED_ERRORS = 10
+
+_thread_local = threading.local()
+
+
+def _get_client(project=None):
+    """Returns a client for the calling thread, created on first use."""
+    client = getattr(_thread_local, 'client', None)
+    if client is None:
+        if os.environ.get('STORAGE_EMULATOR_HOST'):
+            from google.auth.credentials import AnonymousCredentials
+            client = storage.Client(project=project or 'emulator',
+                                    credentials=AnonymousCredentials())
+        else:
+            client = storage.Client(project=project)
+        _thread_local.client = client
+    return client
+
+
+def parse_uri(uri):
+    """Splits a gs:// uri into a bucket and an object name."""
+    if not uri.startswith('gs://'):
+        raise ValueError('Expected a gs:// uri, got `{}`.'.format(uri))
+    bucket, _, name = uri[len('gs://'):].partition('/')
+    if not bucket:
+        raise ValueError('No bucket in `{}`.'.format(uri))
+    return bucket, name
+
+
+class Renamer:
+    """Maps the names that match a source pattern to destination names."""
+
+    def __init__(self, source, destination):
+        """Parses the patterns.
+
+        Args:
+            source: A gs:// uri with at most one `*`.
+            destination: A gs:// uri with at most one `*`, or ending with `/`.
+
+        Raises:
+            ValueError: If the patterns are invalid.
+        """
+        self.source_bucket, source_name = parse_uri(source)
+        self.destination_bucket, destination_name = parse_uri(destination)
+        if source_name.count('*') > 1 or destination_name.count('*') > 1:
+            raise ValueError('Patterns may contain at most one `*`.')
+        self.prefix, star, self._suffix = source_name.partition('*')
+        if destination_name.endswith('/') or not destination_name:
+            if '*' in destination_name:
+                raise ValueError('A destination ending with `/` may not '
+                                 'contain `*`.')
+            self._destination = destination_name + '*'
+            # Keeps the name after the prefix, including the suffix.
+            self._keep_suffix = True
+        else:
+            if star and '*' not in destination_name:
+                raise ValueError('The destination needs a `*` for the `*` of '
+                                 'the source.')
+            self._destination = destination_name
+            self._keep_suffix = False
+        if not star:
+            # An exact name.
+            self._pattern = None
+        else:
+            self._pattern = re.compile(
+                re.escape(self.prefix) + '(.*)' + re.escape(self._suffix) +
+                r'\Z', re.DOTALL)
+        self._exact = None if star else source_name
+        # Whether moved objects may match the source pattern again, e.g. from
+        # gs://b/data/* to gs://b/data/old/*. Their names are then skipped
+        # when they are listed, see `move`.
+        self.chains = (self.source_bucket == self.destination_bucket and
+                       self._may_match_source(self._destination))
+
+    def _may_match_source(self, destination):
+        """Returns whether a name of a destination pattern may be a source."""
+        if '*' not in destination:
+            return self.map(destination) is not None
+        prefix, _, suffix = destination.partition('*')
+        if self._pattern is None:
+            return (self._exact.startswith(prefix) and
+                    self._exact[len(prefix):].endswith(suffix))
+        return ((prefix.startswith(self.prefix) or
+                 self.prefix.startswith(prefix)) and
+                (suffix.endswith(self._suffix) or
+                 self._suffix.endswith(suffix)))
+
+    def map(self, name):
+        """Returns the destination name of a source name, or None."""
+        if self._pattern is None:
+            if name != self._exact:
+                return None
+            if self._keep_suffix:
+                return self._destination.replace(
+                    '*', name.rpartition('/')[2])
+            return self._destination
+        match = self._pattern.match(name)
+        if not match:
+            return None
+        if self._keep_suffix:
+            return self._destination.replace('*', name[len(self.prefix):])
+        return self._destination.replace('*', match.group(1))
+
+
+class Journal:
+    """Records the names of moved objects in a file, to skip them later."""
+
+    def __init__(self, path):
+        self._done = set()
+        if os.path.exists(path):
+            with open(path) as f:
+                self._done.update(line.rstrip('\n') for line in f)
+        self._file = open(path, 'a')
+        self._lock = threading.Lock()
+
+    def __contains__(self, name):
+        return name in self._done
+
+    def __len__(self):
+        return len(self._done)
+
+    def add(self, names):
+        with self._lock:
+            for name in names:
+                self._file.write(name + '\n')
+            self._file.flush()
+            self._done.update(names)
+
+    def close(self):
+        self._file.close()
+
+
+class Stats:
+    """Counts the objects and bytes moved. Thread-safe."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.listed = 0
+        self.skipped = 0
+        self.copied = 0
+        self.moved = 0
+        self.bytes = 0
+        self.num_failed = 0
+        # The first errors, as (name, exception) tuples.
+        self.failed = []
+
+    def add_failed(self, failed):
+        """Counts failed objects. Must be called with `lock` held."""
+        self.num_failed += len(failed)
+        self.failed.extend(failed[:max(0, _MAX_REPORTED_ERRORS -
+                                       len(self.failed))])
+
+
+def _copy(renamer, source, destination_name):
+    """Rewrites a source object to its destination, in as many calls as needed."""
+    client = _get_client()
+    source_blob = client.bucket(renamer.source_bucket).blob(
+        source.name, generation=source.generation)
+    destination = client.bucket(renamer.destination_bucket).blob(
+        destination_name)
+    token, unused_rewritten, unused_size = destination.rewrite(source_blob)
+    while token:
+        token, unused_rewritten, unused_size = destination.rewrite(
+            source_blob, token=token)
+
+
+def _delete(bucket_name, sources, batch_size):
+    """Deletes objects in batches, and one at a time where a batch failed.
+
+    Returns:
+        A list of (source, exception) tuples for the objects that could not be
+        deleted.
+    """
+    client = _get_client()
+    bucket = client.bucket(bucket_name)
+    failed = []
+    for start in range(0, len(sources), max(1, batch_size)):
+        chunk = sources[start:start + max(1, batch_size)]
+        if len(chunk) > 1:
+            batch = client.batch()
+            if os.environ.get('STORAGE_EMULATOR_HOST'):
+                # Batches are sent to storage.googleapis.com otherwise.
+                batch.API_BASE_URL = os.environ['STORAGE_EMULATOR_HOST']
+            try:
+                with batch:
+                    for source in chunk:
+                        bucket.delete_blob(source.name,
+                                           generation=source.generation)
+                continue
+            except _OBJECT_ERRORS:
+                # A batch only reports its first error, so the deletes are
+                # retried one at a time.
+                pass
+        for source in chunk:
+            try:
+                bucket.delete_blob(source.name, generation=source.generation)
+            except exceptions.NotFound:
+                pass
+            except _OBJECT_ERRORS as e:
+                failed.append((source, e))
+    return failed
+
+
+def _move_chunk(renamer, chunk, batch_size, stats, journal, copy_only):
+    """Copies a chunk of (source, destination name) pairs, then deletes them."""
+    copied = []
+    copies = []
+    copy_failed = []
+    for source, destination_name in chunk:
+        try:
+            _copy(renamer, source, destination_name)
+            copied.append(source)
+            copies.append(destination_name)
+        except _OBJECT_ERRORS as e:
+            copy_failed.append((source.name, e))
+    if journal is not None and renamer.chains:
+        # Skips the copies when a later run lists them as sources.
+        journal.add(copies)
+    with stats.lock:
+        stats.add_failed(copy_failed)
+        stats.copied += len(copied)
+        stats.bytes += sum(source.size or 0 for source in copied)
+    if copy_only:
+        if journal is not None:
+            journal.add([source.name for source in copied])
+        return
+    failed = _delete(renamer.source_bucket, copied, batch_size)
+    failed_names = set(source.name for source, _ in failed)
+    moved = [source for source in copied if source.name not in failed_names]
+    if journal is not None:
+        journal.add([source.name for source in moved])
+    with stats.lock:
+        stats.moved += len(moved)
+        stats.add_failed([(source.name, e) for source, e in failed])
+
+
+def move(source, destination, concurrency=16, batch_size=100, dry_run=False,
+         journal=None, copy_only=False, max_items=None, quiet=False):
+    """Moves the objects that match a source pattern.
+
+    Args:
+        source: The source pattern, see `Renamer`.
+        destination: The destination pattern.
+        concurrency: The number of threads that copy and delete objects.
+        batch_size: The number of objects a thread copies before deleting
+            their sources in one batch request. 1 deletes every source right
+            after its copy.
+        dry_run: Only print what would be moved.
+        journal: A `Journal` of objects that were moved already, or None.
+        copy_only: Copy objects without deleting their sources.
+        max_items: Stop after this many objects. None for no limit.
+        quiet: Do not print progress.
+
+    Returns:
+        The `Stats` of the move.
+    """
+    renamer = Renamer(source, destination)
+    stats = Stats()
+    client = _get_client()
+    # Fetches only the fields that are needed, a page at a time.
+    blobs = client.list_blobs(
+        renamer.source_bucket, prefix=renamer.prefix,
+        fields='items(name,generation,size),nextPageToken')
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=concurrency)
+    pending = set()
+    chunk = []
+    # The destinations of this run, if they may be listed as sources.
+    created = set()
+    start = last_progress = time.time()
+    try:
+        for blob in blobs:
+            destination_name = renamer.map(blob.name)
+            if destination_name is None or blob.name in created:
+                continue
+            stats.listed += 1
+            if journal is not None and blob.name in journal:
+                stats.skipped += 1
+                continue
+            if dry_run:
+                print('Would move gs://{}/{} to gs://{}/{}'.format(
+                    renamer.source_bucket, blob.name,
+                    renamer.destination_bucket, destination_name))
+            else:
+                chunk.append((blob, destination_name))
+                if renamer.chains:
+                    created.add(destination_name)
+                if len(chunk) >= batch_size:
+                    pending.add(executor.submit(_move_chunk, renamer, chunk,
+                                                batch_size, stats, journal,
+                                                copy_only))
+                    chunk = []
+                # Bounds the listed objects that are held in memory.
+                if len(pending) >= concurrency * 2:
+                    done, pending = concurrent.futures.wait(
+                        pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                    for future in done:
+                        future.result()
+                    if not quiet and time.time() - last_progress >= 10:
+                        last_progress = time.time()
+                        _print_progress(stats, start)
+            if max_items and stats.listed >= max_items:
+                break
+        if chunk:
+            pending.add(executor.submit(_move_chunk, renamer, chunk, batch_size,
+                                        stats, journal, copy_only))
+        for future in concurrent.futures.as_completed(pending):
+            future.result()
+    finally:
+        executor.shutdown()
+    return stats
+
+
+def _print_progress(stats, start):
+    elapsed = time.time() - start
+    print('Copied {} objects, {:.1f} objects/s, {} failed.'.format(
+        stats.copied, stats.copied / elapsed if elapsed else 0,
+        stats.num_failed), file=sys.stderr)
+
+
+# Benchmark
+
+_LEGACY_MOVE = """
+import sys
+from google.auth.credentials import AnonymousCredentials
+from google.cloud import storage
+client = storage.Client(project='emulator', credentials=AnonymousCredentials())
+bucket = client.bucket(sys.argv[1])
+bucket.rename_blob(bucket.blob(sys.argv[2]), sys.argv[3])
+"""
+
+
+def _create_objects(bucket_name, prefix, count, size, concurrency):
+    data = os.urandom(size)
+
+    def create(i):
+        blob = _get_client().bucket(bucket_name).blob(
+            '{}question-{:06d}.json'.format(prefix, i))
+        for attempt in range(3):
+            try:
+                blob.upload_from_string(data)
+                return
+            except requests.exceptions.ConnectionError:
+                # The emulator resets connections when it is busy.
+                if attempt == 2:
+                    raise
+                time.sleep(0.5)
+
+    with concurrent.futures.ThreadPoolExecutor(concurrency) as executor:
+        list(executor.map(create, range(count)))
+
+
+def _benchmark(args):
+    if not os.environ.get('STORAGE_EMULATOR_HOST'):
+        sys.exit('Error: --benchmark runs against a GCS emulator, set '
+                 'STORAGE_EMULATOR_HOST, e.g. to http://localhost:9023.')
+    bucket = args.benchmark_bucket
+    try:
+        _get_client().create_bucket(bucket)
+    except exceptions.Conflict:
+        pass
+    print('Moving {} objects of {} bytes on the emulator at {}.'.format(
+        args.benchmark, args.benchmark_object_bytes,
+        os.environ['STORAGE_EMULATOR_HOST']))
+    print('{:<28} {:>9} {:>10}'.format('variant', 'seconds', 'objects/s'))
+
+    legacy = min(args.benchmark, args.benchmark_legacy)
+    if legacy:
+        prefix = 'legacy/'
+        _create_objects(bucket, prefix, legacy, args.benchmark_object_bytes, 4)
+        start = time.time()
+        for i in range(legacy):
+            name = '{}question-{:06d}'.format(prefix, i)
+            subprocess.check_call([sys.executable, '-c', _LEGACY_MOVE, bucket,
+                                   name + '.json', name + '.txt'])
+        elapsed = time.time() - start
+        print('{:<28} {:>9.1f} {:>10.1f}'.format(
+            'process per object ({})'.format(legacy), elapsed,
+            legacy / elapsed))
+
+    for concurrency, batch_size in ((1, 1), (1, args.batch_size),
+                                    (args.concurrency, 1),
+                                    (args.concurrency, args.batch_size)):
+        prefix = 'c{}-b{}/'.format(concurrency, batch_size)
+        _create_objects(bucket, prefix, args.benchmark,
+                        args.benchmark_object_bytes, 4)
+        start = time.time()
+        stats = move('gs://{}/{}question-*.json'.format(bucket, prefix),
+                     'gs://{}/{}question-*.txt'.format(bucket, prefix),
+                     concurrency=concurrency, batch_size=batch_size, quiet=True)
+        elapsed = time.time() - start
+        if stats.moved != args.benchmark or stats.num_failed:
+            sys.exit('Error: moved {} of {} objects, {} failed.'.format(
+                stats.moved, args.benchmark, stats.num_failed))
+        print('{:<28} {:>9.1f} {:>10.1f}'.format(
+            'threads {}, batch {}'.format(concurrency, batch_size), elapsed,
+            stats.moved / elapsed))
+
+
+def _parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('source', nargs='?',
+                        help='The objects to move, e.g. gs://bucket/dir/*.json.')
+    parser.add_argument('destination', nargs='?',
+                        help='Where to move them, e.g. gs://bucket/dir/*.txt.')
+    parser.add_argument('--dry_run', action='store_true',
+                        help='Only print what would be moved.')
+    parser.add_argument('--copy_only', action='store_true',
+                        help='Copy the objects without deleting the sources.')
+    parser.add_argument('--concurrency', type=int, default=16,
+                        help='The number of objects moved at the same time.')
+    parser.add_argument(
+        '--batch_size', type=int, default=100,
+        help='The number of source objects deleted in one batch request.')
+    parser.add_argument(
+        '--journal',
+        help='A file that the names of moved objects are appended to. '
+        'Objects that are in it already are skipped.')
+    parser.add_argument('--max_items', type=int,
+                        help='Stop after this many objects.')
+    parser.add_argument('--project', help='The project to bill.')
+    parser.add_argument(
+        '--benchmark', type=int, metavar='N',
+        help='Instead of moving, create N objects on the GCS emulator at '
+        'STORAGE_EMULATOR_HOST and time moving them.')
+    parser.add_argument('--benchmark_legacy', type=int, default=100,
+                        help='How many objects to move with one process each '
+                        'in the benchmark.')
+    parser.add_argument('--benchmark_object_bytes', type=int, default=1024)
+    parser.add_argument('--benchmark_bucket', default='rename-bench')
+    args = parser.parse_args()
+    if not args.benchmark and not (args.source and args.destination):
+        parser.error('a source and destination, or --benchmark, are required')
+    return args
+
+
+def main():
+    args = _parse_args()
+    if args.project:
+        _get_client(args.project)
+    if args.benchmark:
+        _benchmark(args)
+        return
+    journal = Journal(args.journal) if args.journal else None
+    start = time.time()
+    try:
+        stats = move(args.source, args.destination,
+                     concurrency=args.concurrency, batch_size=args.batch_size,
+                     dry_run=args.dry_run, journal=journal,
+                     copy_only=args.copy_only, max_items=args.max_items)
+    except ValueError as e:
+        sys.exit('Error: {}'.format(e))
+    finally:
+        if journal is not None:
+            journal.close()
+    elapsed = time.time() - start
+    if not stats.listed:
+        sys.exit('Error: no objects match `{}`.'.format(args.source))
+    for name, e in stats.failed:
+        print('Error moving `{}`: {}'.format(name, e), file=sys.stderr)
+    if stats.num_failed > len(stats.failed):
+        print('... and {} more errors.'.format(
+            stats.num_failed - len(stats.failed)), file=sys.stderr)
+    if args.dry_run:
+        print('Would move {} objects.'.format(stats.listed - stats.skipped))
+        return
+    print('{} {} objects ({:.1f} MB) in {:.1f}s, skipped {}, {} failed.'.format(
+        'Copied' if args.copy_only else 'Moved',
+        stats.copied if args.copy_only else stats.moved, stats.bytes / 1e6,
+        elapsed, stats.skipped, stats.num_failed))
+    if stats.num_failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
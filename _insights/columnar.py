@@ -0,0 +1,1042 @@
+"""Converts Dialogflow interaction logs to Parquet or Arrow files.
+
+Logs like `bq_import.json` store numbers as strings, e.g. `"SENTIMENT_SCORE":
+"0.10000000149011612"`, empty strings for missing values, and dicts as
+strings: JSON when the chat analytics webhook wrote them, Python literals with
+single quotes when the data generation scripts did. This converts them to
+typed columns, with the types of a BigQuery schema such as `bq_schema.json`,
+so that analytics tools and BigQuery load jobs read compact columnar files
+instead of large JSON.
+
+Input is parsed incrementally like in `ndjson.py`, so JSON arrays, NDJSON,
+gzipped files and stdin are accepted in constant memory. Batches of records are
+converted in worker processes. By default the string encoded dicts, such as
+`RESPONSE_MESSAGES`, stay strings, as the schema requires, but are rewritten as
+JSON, so that BigQuery's JSON functions can read them. With `--nested parsed`,
+they become lists of structs and maps instead. Low cardinality strings, such as
+`PLATFORM`, `LANGUAGE_CODE` and the intent names, are dictionary encoded.
+
+This needs `pyarrow` (`pip install pyarrow`).
+
+Examples:
+
+    python3 columnar.py ../bq_import.json -o bq_import.parquet
+    gunzip -c export.json.gz | python3 columnar.py - \
+        --shard_dir shards --processes 8
+    bq load --source_format=PARQUET dataset.table 'shards/*.parquet'
+    python3 columnar.py --benchmark_mb 1024 --processes 4
+"""
+
+import argparse
+import ast
+import datetime
+import functools
+import json
+import multiprocessing
+import os
+import queue
+import re
+import resource
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+import ndjson
+
+FORMAT_PARQUET = 'parquet'
+FORMAT_ARROW = 'arrow'
+FORMATS = (FORMAT_PARQUET, FORMAT_ARROW)
+
+# String encoded dicts are rewritten as JSON strings, or parsed into nested
+# columns.
+NESTED_JSON = 'json'
+NESTED_PARSED = 'parsed'
+NESTED = (NESTED_JSON, NESTED_PARSED)
+
+# Invalid records either stop the conversion or are left out. Unlike NDJSON,
+# typed columns cannot keep them.
+ON_INVALID = (ndjson.ON_INVALID_ERROR, ndjson.ON_INVALID_SKIP)
+
+DEFAULT_SCHEMA = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..',
+                              'bq_schema.json')
+DEFAULT_DICTIONARY_FIELDS = ('PLATFORM', 'LANGUAGE_CODE',
+                             'INTENT_DETECTION_DISPLAYNAME',
+                             'INTENT_DETECTION_NAME')
+DEFAULT_NESTED_FIELDS = ('RESPONSE_MESSAGES', 'INTENT_DETECTION_PARAMETERS')
+DEFAULT_ROW_GROUP_RECORDS = 128 * 1024
+DEFAULT_MAX_SHARD_RECORDS = 4 * 1024 * 1024
+# Parquet columns are compressed with snappy by default, and Arrow streams,
+# which are usually memory mapped, not at all.
+DEFAULT_PARQUET_COMPRESSION = 'snappy'
+_ARROW_COMPRESSIONS = (None, 'lz4', 'zstd')
+
+_MAX_REPORTED_ERRORS = 10
+_EPOCH_ORDINAL = datetime.date(1970, 1, 1).toordinal()
+_TIMESTAMP = re.compile(
+    r'(\d{4})-(\d{1,2})-(\d{1,2})'
+    r'(?:[T ](\d{1,2}):(\d{1,2})(?::(\d{1,2})(?:\.(\d{1,9}))?)?)?'
+    r' ?(Z|UTC|[+-]\d{1,2}(?::?\d{2})?)?$')
+_BOOLEANS = {'true': True, 'false': False}
+_ENCODER = json.JSONEncoder(ensure_ascii=False, separators=(',', ':'))
+# Marks nested strings that could not be parsed.
+_UNPARSED = object()
+# Distinct nested strings that are parsed once per process. Logs repeat the
+# same responses for every match of an intent.
+_NESTED_CACHE_SIZE = 16 * 1024
+
+
+def _require_pyarrow():
+    if pyarrow is None:
+        raise ImportError('Writing Parquet or Arrow files needs pyarrow: '
+                          '`pip install pyarrow`.')
+
+
+class Stats(ndjson.Stats):
+    """Counts what a conversion read and wrote, like `ndjson.Stats`, and the
+    nested strings that could not be parsed and were kept as they are.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.unparsed = 0
+
+    def add(self, other):
+        super().add(other)
+        self.unparsed += other.unparsed
+
+
+# Value conversion
+
+def parse_timestamp(value):
+    """Returns the microseconds since the epoch of a BigQuery TIMESTAMP value.
+
+    Args:
+        value: A string such as `2021-09-22T12:54:39.505Z` or `2021-09-22
+            12:54:39 UTC`, with an optional offset, or seconds since the epoch.
+
+    Raises:
+        ValueError: If the value is not a timestamp.
+    """
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return int(round(value * 1000000))
+    if not isinstance(value, str):
+        raise ValueError('not a timestamp')
+    match = _TIMESTAMP.match(value)
+    if not match:
+        raise ValueError('not a timestamp')
+    year, month, day, hour, minute, second, fraction, zone = match.groups()
+    hour, minute, second = int(hour or 0), int(minute or 0), int(second or 0)
+    if hour > 23 or minute > 59 or second > 59:
+        raise ValueError('time out of range')
+    days = datetime.date(int(year), int(month),
+                         int(day)).toordinal() - _EPOCH_ORDINAL
+    seconds = days * 86400 + hour * 3600 + minute * 60 + second
+    if zone and zone not in ('Z', 'UTC'):
+        digits = zone[1:].replace(':', '')
+        offset = (int(digits) * 3600 if len(digits) <= 2 else
+                  int(digits[:-2]) * 3600 + int(digits[-2:]) * 60)
+        seconds -= offset if zone[0] == '+' else -offset
+    micros = int(fraction[:6].ljust(6, '0')) if fraction else 0
+    return seconds * 1000000 + micros
+
+
+def parse_nested(value):
+    """Parses a dict or list that was stored as a string.
+
+    Args:
+        value: JSON, or a Python literal with single quotes, `True` and `None`,
+            as written by the data generation scripts.
+
+    Returns:
+        The parsed value, or None for an empty string.
+
+    Raises:
+        ValueError: If the value is neither.
+    """
+    value = value.strip()
+    if not value:
+        return None
+    try:
+        return json.loads(value)
+    except ValueError:
+        pass
+    try:
+        return ast.literal_eval(value)
+    except (ValueError, SyntaxError, MemoryError, RecursionError):
+        raise ValueError('not JSON or a Python literal') from None
+
+
+def _to_string(value):
+    if isinstance(value, str):
+        return value
+    if isinstance(value, (dict, list)):
+        return _ENCODER.encode(value)
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    return str(value)
+
+
+def _to_float(value):
+    if isinstance(value, bool):
+        raise ValueError('a boolean')
+    if isinstance(value, str):
+        value = value.strip()
+        if not value:
+            return None
+    return float(value)
+
+
+def _to_integer(value):
+    if isinstance(value, bool) or isinstance(value, float):
+        raise ValueError('not an integer')
+    if isinstance(value, str):
+        value = value.strip()
+        if not value:
+            return None
+    return int(value)
+
+
+def _to_boolean(value):
+    if isinstance(value, bool):
+        return value
+    if isinstance(value, str):
+        if not value.strip():
+            return None
+        return _BOOLEANS[value.strip().lower()]
+    raise ValueError('not a boolean')
+
+
+def _to_timestamp(value):
+    if isinstance(value, str) and not value.strip():
+        return None
+    return parse_timestamp(value)
+
+
+def _nested_to_json(parse, on_unparsed):
+    """Rewrites nested strings as JSON.
+
+    The column stays a STRING, so values that are neither JSON nor a Python
+    literal, such as those with unescaped quotes, are kept as they are, and
+    `on_unparsed` is called for each.
+    """
+    @functools.lru_cache(maxsize=_NESTED_CACHE_SIZE)
+    def encode(value):
+        try:
+            parsed = parse(value)
+        except ValueError:
+            return _UNPARSED
+        return None if parsed is None else _ENCODER.encode(parsed)
+
+    def convert(value):
+        if not isinstance(value, str):
+            return _ENCODER.encode(value)
+        encoded = encode(value)
+        if encoded is _UNPARSED:
+            on_unparsed()
+            return value
+        return encoded
+    return convert
+
+
+def _response_messages(parse):
+    """Converts `RESPONSE_MESSAGES` to a list of message structs.
+
+    Every message has its platform, its kind, e.g. `text` or `payload`, the
+    lines of a text message and the JSON of any other kind of message.
+    """
+    def convert(value):
+        messages = parse(value) if isinstance(value, str) else value
+        if messages is None:
+            return None
+        if isinstance(messages, dict):
+            messages = [messages]
+        rows = []
+        for message in messages:
+            if not isinstance(message, dict):
+                raise ValueError('a message is not an object')
+            kind = message.get('message') or next(
+                (key for key in message if key != 'platform'), None)
+            content = message.get(kind) if kind else None
+            text = None
+            other = None
+            if kind == 'text' and isinstance(content, dict):
+                text = [_to_string(line) for line in content.get('text') or ()]
+            elif content is not None:
+                other = _ENCODER.encode(content)
+            rows.append({
+                'platform': message.get('platform'),
+                'message': kind,
+                'text': text,
+                'json': other,
+            })
+        return rows
+    return convert
+
+
+def _parameters(parse):
+    """Converts `INTENT_DETECTION_PARAMETERS` to (name, value) pairs.
+
+    Values that are not strings are kept as JSON.
+    """
+    def convert(value):
+        parameters = parse(value) if isinstance(value, str) else value
+        if parameters is None:
+            return None
+        if not isinstance(parameters, dict):
+            raise ValueError('not an object')
+        return [(str(name), item if isinstance(item, str) else
+                 _ENCODER.encode(item))
+                for name, item in parameters.items()]
+    return convert
+
+
+def _arrow_type(field_type, name):
+    types = {
+        'STRING': pyarrow.string,
+        'BYTES': pyarrow.string,
+        'GEOGRAPHY': pyarrow.string,
+        'JSON': pyarrow.string,
+        'INTEGER': pyarrow.int64,
+        'INT64': pyarrow.int64,
+        'FLOAT': pyarrow.float64,
+        'FLOAT64': pyarrow.float64,
+        'BOOLEAN': pyarrow.bool_,
+        'BOOL': pyarrow.bool_,
+        'TIMESTAMP': lambda: pyarrow.timestamp('us', tz='UTC'),
+    }
+    if field_type not in types:
+        raise ValueError('Unsupported type `{}` of field `{}`.'.format(
+            field_type, name))
+    return types[field_type]()
+
+
+_CONVERTERS = {
+    'STRING': _to_string,
+    'BYTES': _to_string,
+    'GEOGRAPHY': _to_string,
+    'JSON': _to_string,
+    'INTEGER': _to_integer,
+    'INT64': _to_integer,
+    'FLOAT': _to_float,
+    'FLOAT64': _to_float,
+    'BOOLEAN': _to_boolean,
+    'BOOL': _to_boolean,
+    'TIMESTAMP': _to_timestamp,
+}
+
+
+class _Column:
+    """How the values of one field are converted and stored."""
+
+    def __init__(self, name, field_type, arrow_type, convert, required,
+                 dictionary):
+        self.name = name
+        self.field_type = field_type
+        self.arrow_type = arrow_type
+        self.convert = convert
+        self.required = required
+        self.dictionary = dictionary
+
+    def field(self):
+        arrow_type = self.arrow_type
+        if self.dictionary:
+            arrow_type = pyarrow.dictionary(pyarrow.int32(), arrow_type)
+        return pyarrow.field(self.name, arrow_type, nullable=not self.required)
+
+    def array(self, values):
+        array = pyarrow.array(values, type=self.arrow_type)
+        return array.dictionary_encode() if self.dictionary else array
+
+
+def _compile_columns(fields, dictionary_fields, nested_fields, nested,
+                     on_unparsed=lambda: None):
+    # A cache per process, shared by the nested fields. Parsed values are
+    # only read, so they can be shared by records.
+    parse = functools.lru_cache(maxsize=_NESTED_CACHE_SIZE)(parse_nested)
+    columns = []
+    for field in fields:
+        name = field['name']
+        field_type = field.get('type', 'STRING').upper()
+        mode = field.get('mode', 'NULLABLE').upper()
+        if mode == 'REPEATED' or field_type in ('RECORD', 'STRUCT'):
+            raise ValueError('Unsupported {} field `{}`.'.format(
+                mode if mode == 'REPEATED' else field_type, name))
+        arrow_type = _arrow_type(field_type, name)
+        convert = _CONVERTERS[field_type]
+        if name in nested_fields and field_type == 'STRING':
+            if nested == NESTED_JSON:
+                convert = _nested_to_json(parse_nested, on_unparsed)
+            elif name == 'INTENT_DETECTION_PARAMETERS':
+                arrow_type = pyarrow.map_(pyarrow.string(), pyarrow.string())
+                convert = _parameters(parse)
+            else:
+                arrow_type = pyarrow.list_(pyarrow.struct([
+                    ('platform', pyarrow.string()),
+                    ('message', pyarrow.string()),
+                    ('text', pyarrow.list_(pyarrow.string())),
+                    ('json', pyarrow.string()),
+                ]))
+                convert = _response_messages(parse)
+        columns.append(_Column(
+            name, field_type, arrow_type, convert, mode == 'REQUIRED',
+            name in dictionary_fields and field_type == 'STRING' and
+            name not in nested_fields))
+    return columns
+
+
+def arrow_schema(fields, dictionary_fields=DEFAULT_DICTIONARY_FIELDS,
+                 nested_fields=DEFAULT_NESTED_FIELDS, nested=NESTED_JSON):
+    """Returns the Arrow schema of the columns of a BigQuery schema.
+
+    Args:
+        fields: The fields of the schema, as in `bq_schema.json`.
+        dictionary_fields: The STRING fields to dictionary encode.
+        nested_fields: The STRING fields that hold string encoded dicts or
+            lists.
+        nested: `json` to keep nested fields as JSON strings, or `parsed` for
+            lists of structs and maps.
+
+    Raises:
+        ValueError: If the schema has fields of unsupported types.
+    """
+    _require_pyarrow()
+    return pyarrow.schema([
+        column.field() for column in _compile_columns(
+            fields, dictionary_fields, nested_fields, nested)
+    ])
+
+
+class _Converter:
+    """Converts records to record batches, one batch at a time."""
+
+    def __init__(self, options):
+        self.stats = Stats()
+        self._columns = _compile_columns(
+            options['schema'], options['dictionary_fields'],
+            options['nested_fields'], options['nested'], self._count_unparsed)
+        self._names = frozenset(column.name for column in self._columns)
+        self.schema = pyarrow.schema(
+            [column.field() for column in self._columns])
+
+    def _count_unparsed(self):
+        self.stats.unparsed += 1
+
+    def _convert_record(self, record):
+        if not isinstance(record, dict):
+            raise ValueError('expected an object, got {}'.format(
+                type(record).__name__))
+        if not self._names.issuperset(record):
+            raise ValueError('unknown fields {}'.format(', '.join(
+                sorted(record.keys() - self._names))))
+        row = []
+        get = record.get
+        for column in self._columns:
+            value = get(column.name)
+            if value is not None:
+                try:
+                    value = column.convert(value)
+                except (ValueError, TypeError, KeyError, OverflowError):
+                    raise ValueError('{} is not a valid {}: {}'.format(
+                        column.name, column.field_type,
+                        json.dumps(value)[:80])) from None
+            if value is None and column.required:
+                raise ValueError('missing required field {}'.format(
+                    column.name))
+            row.append(value)
+        return row
+
+    def convert(self, values, first_index):
+        """Returns a record batch of the valid records, and whether all were."""
+        rows = []
+        valid = True
+        for i, value in enumerate(values):
+            try:
+                rows.append(self._convert_record(value))
+            except ValueError as e:
+                valid = False
+                self.stats.invalid += 1
+                if len(self.stats.errors) < _MAX_REPORTED_ERRORS:
+                    self.stats.errors.append((first_index + i, str(e)))
+        self.stats.records += len(values)
+        arrays = [
+            column.array([row[i] for row in rows])
+            for i, column in enumerate(self._columns)
+        ]
+        return pyarrow.RecordBatch.from_arrays(arrays,
+                                               schema=self.schema), valid
+
+
+# Writing
+
+class _Writer:
+    """Writes record batches to one file, in row groups of a minimum size."""
+
+    def __init__(self, output, schema, output_format, compression,
+                 row_group_records):
+        if output == '-':
+            output = sys.stdout.buffer
+        self.path = output if isinstance(output, str) else None
+        self._schema = schema
+        self._row_group_records = row_group_records
+        self._pending = []
+        self._pending_records = 0
+        self.records = 0
+        if output_format == FORMAT_PARQUET:
+            self._writer = pyarrow.parquet.ParquetWriter(
+                output, schema, compression=compression)
+        else:
+            # The stream format, since every batch has its own dictionaries.
+            self._sink = (pyarrow.OSFile(output, 'wb') if self.path else
+                          pyarrow.PythonFile(output, mode='w'))
+            self._writer = pyarrow.ipc.new_stream(
+                self._sink, schema,
+                options=pyarrow.ipc.IpcWriteOptions(compression=compression))
+        self._format = output_format
+
+    def write(self, batch):
+        if not batch.num_rows:
+            return
+        self._pending.append(batch)
+        self._pending_records += batch.num_rows
+        self.records += batch.num_rows
+        if self._pending_records >= self._row_group_records:
+            self._flush()
+
+    def _flush(self):
+        if not self._pending:
+            return
+        if self._format == FORMAT_PARQUET:
+            self._writer.write_table(
+                pyarrow.Table.from_batches(self._pending, schema=self._schema),
+                row_group_size=self._pending_records)
+        else:
+            for batch in self._pending:
+                self._writer.write_batch(batch)
+        self._pending = []
+        self._pending_records = 0
+
+    def close(self):
+        """Closes the file, and returns its size if it has a path."""
+        self._flush()
+        self._writer.close()
+        if self._format == FORMAT_ARROW and self.path:
+            self._sink.close()
+        return os.path.getsize(self.path) if self.path else 0
+
+
+class _ShardWriter:
+    """Writes record batches to numbered files of at most `max_records`."""
+
+    def __init__(self, directory, prefix, max_records, options):
+        self._directory = directory
+        self._prefix = prefix
+        self._max_records = max_records
+        self._options = options
+        self._writer = None
+        self.paths = []
+        self.bytes_written = 0
+
+    def write(self, batch, schema):
+        start = 0
+        while start < batch.num_rows:
+            if self._writer is None:
+                path = os.path.join(self._directory, '{}-{:05d}.{}'.format(
+                    self._prefix, len(self.paths), self._options['format']))
+                self._writer = _Writer(path, schema, self._options['format'],
+                                       self._options['compression'],
+                                       self._options['row_group_records'])
+                self.paths.append(path)
+            length = min(batch.num_rows - start,
+                         self._max_records - self._writer.records)
+            self._writer.write(batch.slice(start, length))
+            start += length
+            if self._writer.records >= self._max_records:
+                self.close()
+
+    def close(self):
+        if self._writer is not None:
+            self.bytes_written += self._writer.close()
+            self._writer = None
+
+
+def _worker(worker_index, batches, results, options):
+    """Converts batches of record texts in a worker process.
+
+    Writes its own shards if `shard_dir` is set, and otherwise sends the
+    record batches back in `results`, to be written in order.
+    """
+    converter = _Converter(options)
+    writer = None
+    if options['shard_dir']:
+        writer = _ShardWriter(
+            options['shard_dir'],
+            '{}-{:03d}'.format(options['shard_prefix'], worker_index),
+            options['max_shard_records'], options)
+    failure = None
+    while True:
+        batch = batches.get()
+        if batch is None:
+            break
+        if failure:
+            continue
+        batch_index, first_index, texts = batch
+        try:
+            records, valid = converter.convert(
+                [json.loads(text) for text in texts], first_index)
+            if writer:
+                writer.write(records, converter.schema)
+                records = None
+            results.put(('batch', batch_index, records, valid))
+        except Exception as e:  # pylint: disable=broad-except
+            # Drains the remaining batches, so that the reader does not block.
+            failure = '{}: {}'.format(type(e).__name__, e)
+            results.put(('failed', batch_index, failure, False))
+    if writer:
+        writer.close()
+        converter.stats.shards = writer.paths
+        converter.stats.bytes_written = writer.bytes_written
+    # As a dict, since the class of a spawned `__main__` can't be unpickled.
+    results.put(('done', worker_index, vars(converter.stats), None))
+
+
+def convert(source, output=None, shard_dir=None, schema=None,
+            output_format=FORMAT_PARQUET,
+            dictionary_fields=DEFAULT_DICTIONARY_FIELDS,
+            nested_fields=DEFAULT_NESTED_FIELDS, nested=NESTED_JSON,
+            on_invalid=ndjson.ON_INVALID_ERROR, processes=1,
+            compression=None, row_group_records=DEFAULT_ROW_GROUP_RECORDS,
+            max_shard_records=DEFAULT_MAX_SHARD_RECORDS, shard_prefix='part',
+            batch_chars=ndjson.DEFAULT_BATCH_CHARS):
+    """Converts a JSON array or NDJSON file of log records to columnar files.
+
+    Args:
+        source: A path, `-` for stdin, or a binary file object. Gzip input is
+            detected automatically.
+        output: A path, `-` for stdout, or a binary file object, to write all
+            records to, in order. Ignored if `shard_dir` is set.
+        shard_dir: A directory to write files of at most `max_shard_records`
+            to. With several processes, every process writes its own files,
+            and records are not in input order.
+        schema: The fields of a BigQuery schema, e.g. from
+            `ndjson.load_schema`. None for `bq_schema.json`.
+        output_format: `parquet`, or `arrow` for an Arrow IPC stream.
+        dictionary_fields: The STRING fields to dictionary encode.
+        nested_fields: The STRING fields that hold string encoded dicts or
+            lists.
+        nested: `json` to rewrite nested fields as JSON strings, which keeps
+            the files loadable into a table of `schema`, or `parsed` for lists
+            of structs and maps. Strings that cannot be parsed are kept as is
+            with `json`, and make their record invalid with `parsed`.
+        on_invalid: `error` to stop at the first invalid record, or `skip` to
+            leave invalid records out. Either way, they are counted.
+        processes: The number of processes to convert and write records with.
+            The calling process always parses the input.
+        compression: The compression codec, e.g. `snappy`, `zstd` or `none`.
+            None for snappy in Parquet and none in Arrow streams, which only
+            support `lz4` and `zstd`.
+        row_group_records: The minimum number of records in a Parquet row group
+            or written to an Arrow stream at a time.
+        max_shard_records: The maximum number of records in a shard.
+        shard_prefix: The start of the names of the shards.
+        batch_chars: The approximate amount of input sent to a process at a
+            time.
+
+    Returns:
+        The `Stats` of the conversion.
+
+    Raises:
+        ImportError: If pyarrow is not installed.
+        ValueError: If the input is not valid JSON, or a record is invalid and
+            `on_invalid` is `error`.
+    """
+    _require_pyarrow()
+    if on_invalid not in ON_INVALID:
+        raise ValueError('Unknown on_invalid `{}`: expected one of {}.'.format(
+            on_invalid, ON_INVALID))
+    if output_format not in FORMATS:
+        raise ValueError('Unknown format `{}`: expected one of {}.'.format(
+            output_format, FORMATS))
+    if nested not in NESTED:
+        raise ValueError('Unknown nested `{}`: expected one of {}.'.format(
+            nested, NESTED))
+    if compression is None and output_format == FORMAT_PARQUET:
+        compression = DEFAULT_PARQUET_COMPRESSION
+    elif compression == 'none':
+        compression = None
+    if output_format == FORMAT_ARROW and compression not in _ARROW_COMPRESSIONS:
+        raise ValueError('Arrow streams support lz4 and zstd compression, not '
+                         '`{}`.'.format(compression))
+    if shard_dir:
+        os.makedirs(shard_dir, exist_ok=True)
+    elif output is None:
+        raise ValueError('Either an output or a shard directory is required.')
+    options = {
+        'schema': ndjson.load_schema(DEFAULT_SCHEMA) if schema is None else
+                  schema,
+        'dictionary_fields': frozenset(dictionary_fields),
+        'nested_fields': frozenset(nested_fields),
+        'nested': nested,
+        'format': output_format,
+        'compression': compression,
+        'row_group_records': row_group_records,
+        'shard_dir': shard_dir,
+        'shard_prefix': shard_prefix,
+        'max_shard_records': max_shard_records,
+    }
+    # Fails early on unsupported schemas.
+    arrow_schema(options['schema'], dictionary_fields, nested_fields, nested)
+    stream = ndjson.open_input(source)
+    owned = isinstance(source, str) and source != '-'
+    try:
+        if processes > 1:
+            return _convert_in_processes(stream, output, options, on_invalid,
+                                         processes, batch_chars)
+        return _convert_in_process(stream, output, options, on_invalid,
+                                   batch_chars)
+    finally:
+        if owned:
+            stream.close()
+        else:
+            # Leaves the caller's file, or stdin, open.
+            stream.detach()
+
+
+def _raise_invalid(stats):
+    index, message = stats.errors[0]
+    raise ValueError('Record {} is invalid: {}'.format(index, message))
+
+
+def _open_writer(output, schema, options):
+    return _Writer(output, schema, options['format'], options['compression'],
+                   options['row_group_records'])
+
+
+def _convert_in_process(stream, output, options, on_invalid, batch_chars):
+    converter = _Converter(options)
+    stats = converter.stats
+    if options['shard_dir']:
+        shards = _ShardWriter(options['shard_dir'], options['shard_prefix'],
+                              options['max_shard_records'], options)
+        writer = None
+    else:
+        shards = None
+        writer = _open_writer(output, converter.schema, options)
+
+    def write(values):
+        records, valid = converter.convert(values, stats.records)
+        if not valid and on_invalid == ndjson.ON_INVALID_ERROR:
+            _raise_invalid(stats)
+        if shards:
+            shards.write(records, converter.schema)
+        else:
+            writer.write(records)
+
+    values = []
+    chars = 0
+    try:
+        for value, text in ndjson.iter_values(stream):
+            values.append(value)
+            chars += len(text)
+            if chars < batch_chars:
+                continue
+            stats.chars_read += chars
+            write(values)
+            values = []
+            chars = 0
+        stats.chars_read += chars
+        write(values)
+    finally:
+        if shards:
+            shards.close()
+            stats.shards = shards.paths
+            stats.bytes_written = shards.bytes_written
+        else:
+            stats.bytes_written = writer.close()
+    return stats
+
+
+def _convert_in_processes(stream, output, options, on_invalid, processes,
+                          batch_chars):
+    # Spawned rather than forked, so that the workers don't inherit the
+    # parser's buffers.
+    context = multiprocessing.get_context('spawn')
+    # Bounded, so that memory use stays constant if the workers fall behind.
+    batches = context.Queue(maxsize=processes * 4)
+    results = context.Queue()
+    workers = [
+        context.Process(target=_worker, args=(i, batches, results, options),
+                        daemon=True)
+        for i in range(processes)
+    ]
+    for worker in workers:
+        worker.start()
+
+    stats = Stats()
+    stop = threading.Event()
+    failures = []
+    writer = None
+    if not options['shard_dir']:
+        writer = _open_writer(
+            output,
+            arrow_schema(options['schema'], options['dictionary_fields'],
+                         options['nested_fields'], options['nested']),
+            options)
+
+    def collect():
+        """Writes batches in order, and collects the stats of the workers."""
+        pending = {}
+        next_batch = 0
+        done = set()
+        while len(done) < processes:
+            try:
+                kind, index, data, valid = results.get(timeout=1)
+            except queue.Empty:
+                for i, worker in enumerate(workers):
+                    if worker.exitcode and i not in done:
+                        failures.append('exit code {}'.format(worker.exitcode))
+                        stop.set()
+                        done.add(i)
+                continue
+            if kind == 'done':
+                worker_stats = Stats()
+                vars(worker_stats).update(data)
+                stats.add(worker_stats)
+                done.add(index)
+                continue
+            if kind == 'failed':
+                failures.append(data)
+                stop.set()
+                continue
+            if not valid and on_invalid == ndjson.ON_INVALID_ERROR:
+                stop.set()
+            if not writer:
+                continue
+            pending[index] = data
+            while next_batch in pending:
+                data = pending.pop(next_batch)
+                if not stop.is_set():
+                    writer.write(data)
+                next_batch += 1
+
+    collector = threading.Thread(target=collect)
+    collector.start()
+    batch_index = 0
+    first_index = 0
+    texts = []
+    chars = 0
+    try:
+        for unused_value, text in ndjson.iter_values(stream):
+            if stop.is_set():
+                break
+            texts.append(text)
+            chars += len(text)
+            if chars < batch_chars:
+                continue
+            _put(batches, (batch_index, first_index, texts), workers, stop)
+            stats.chars_read += chars
+            batch_index += 1
+            first_index += len(texts)
+            texts = []
+            chars = 0
+        if texts and not stop.is_set():
+            _put(batches, (batch_index, first_index, texts), workers, stop)
+            stats.chars_read += chars
+    finally:
+        for unused_worker in workers:
+            _put(batches, None, workers)
+        collector.join()
+        for worker in workers:
+            worker.join()
+        if writer:
+            stats.bytes_written += writer.close()
+    if failures:
+        # Batches that no worker read would otherwise block the exit.
+        batches.cancel_join_thread()
+        raise RuntimeError('A worker failed: {}'.format(failures[0]))
+    stats.errors.sort()
+    if stats.invalid and on_invalid == ndjson.ON_INVALID_ERROR:
+        _raise_invalid(stats)
+    stats.shards.sort()
+    return stats
+
+
+def _put(batches, batch, workers, stop=None):
+    """Queues a batch, unless the conversion stopped or all workers died."""
+    while not (stop and stop.is_set()):
+        try:
+            batches.put(batch, timeout=0.1)
+            return
+        except queue.Full:
+            if not any(worker.is_alive() for worker in workers):
+                return
+
+
+# Benchmark
+
+def _peak_rss_mb(who):
+    # Kilobytes on Linux.
+    return resource.getrusage(who).ru_maxrss / 1024.0
+
+
+def _benchmark(args):
+    directory = tempfile.mkdtemp(prefix='columnar-bench-')
+    try:
+        path = os.path.join(directory, 'input.json')
+        start = time.time()
+        count = ndjson.write_synthetic_input(
+            path, args.benchmark_mb * 1024 * 1024)
+        size = os.path.getsize(path)
+        print('Generated {} records, {:.0f} MB, in {:.1f}s.'.format(
+            count, size / 1e6, time.time() - start))
+        schema = ndjson.load_schema(args.schema)
+        # The NDJSON that a JSON load job would read instead.
+        start = time.time()
+        ndjson_path = os.path.join(directory, 'out.ndjson.gz')
+        ndjson.convert(path, output=ndjson_path, compress=True)
+        print('{:<8} {:<10} {:>9} {:>8} {:>9} {:>10}'.format(
+            'output', 'processes', 'seconds', 'MB/s', 'records/s',
+            'output MB'))
+        elapsed = time.time() - start
+        print('{:<8} {:<10} {:>9.1f} {:>8.1f} {:>9.0f} {:>10.1f}'.format(
+            'ndjson', 1, elapsed, size / 1e6 / elapsed, count / elapsed,
+            os.path.getsize(ndjson_path) / 1e6))
+        os.remove(ndjson_path)
+        for output_format in FORMATS:
+            for num_processes in sorted({1, args.processes}):
+                out_dir = os.path.join(directory, 'out')
+                start = time.time()
+                stats = convert(
+                    path, shard_dir=out_dir, schema=schema,
+                    output_format=output_format, nested=args.nested,
+                    processes=num_processes,
+                    row_group_records=args.row_group_records)
+                elapsed = time.time() - start
+                print('{:<8} {:<10} {:>9.1f} {:>8.1f} {:>9.0f} {:>10.1f}'.format(
+                    output_format, num_processes, elapsed,
+                    size / 1e6 / elapsed, stats.records / elapsed,
+                    stats.bytes_written / 1e6))
+                shutil.rmtree(out_dir, ignore_errors=True)
+        print('Peak memory: {:.0f} MB in this process, {:.0f} MB in a '
+              'worker.'.format(_peak_rss_mb(resource.RUSAGE_SELF),
+                               _peak_rss_mb(resource.RUSAGE_CHILDREN)))
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+def _parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument(
+        'input', nargs='?',
+        help='The JSON array or NDJSON file to convert, optionally gzipped, or '
+        '`-` for stdin.')
+    parser.add_argument(
+        '-o', '--output',
+        help='The file to write, or `-` for stdout.')
+    parser.add_argument(
+        '--shard_dir',
+        help='Write numbered files to this directory instead of one output.')
+    parser.add_argument(
+        '--max_shard_records', type=int, default=DEFAULT_MAX_SHARD_RECORDS,
+        help='The maximum number of records in a shard.')
+    parser.add_argument('--shard_prefix', default='part',
+                        help='The start of the names of the shards.')
+    parser.add_argument(
+        '--format', choices=FORMATS, default=FORMAT_PARQUET,
+        help='Write Parquet, or an Arrow IPC stream.')
+    parser.add_argument(
+        '--schema', default=DEFAULT_SCHEMA,
+        help='The BigQuery schema that sets the column types (default '
+        '`bq_schema.json`).')
+    parser.add_argument(
+        '--nested', choices=NESTED, default=NESTED_JSON,
+        help='Rewrite string encoded dicts as JSON strings, or parse them into '
+        'lists of structs and maps. Parsed columns no longer match the '
+        'schema. Strings that cannot be parsed are kept as is with `json`, '
+        'and make their record invalid with `parsed`.')
+    parser.add_argument(
+        '--nested_fields', default=','.join(DEFAULT_NESTED_FIELDS),
+        help='The comma separated fields that hold string encoded dicts.')
+    parser.add_argument(
+        '--dictionary_fields', default=','.join(DEFAULT_DICTIONARY_FIELDS),
+        help='The comma separated fields to dictionary encode.')
+    parser.add_argument(
+        '--compression',
+        help='The compression codec, e.g. `snappy`, `zstd` or `none`. By '
+        'default, snappy for Parquet and none for Arrow, which supports `lz4` '
+        'and `zstd`.')
+    parser.add_argument(
+        '--row_group_records', type=int, default=DEFAULT_ROW_GROUP_RECORDS,
+        help='The minimum number of records in a Parquet row group.')
+    parser.add_argument(
+        '--on_invalid', choices=ON_INVALID, default=ndjson.ON_INVALID_ERROR,
+        help='Whether to stop at or skip records that do not match the '
+        'schema.')
+    parser.add_argument(
+        '--processes', type=int, default=1,
+        help='The number of processes that convert and write records. With '
+        'shards, every process writes its own, so records are not in input '
+        'order.')
+    parser.add_argument(
+        '--benchmark_mb', type=int,
+        help='Instead of converting, measure the throughput and output size on '
+        'a synthetic array of this many MB, with 1 and `--processes` '
+        'processes.')
+    args = parser.parse_args()
+    if not args.input and not args.benchmark_mb:
+        parser.error('an input, or --benchmark_mb, is required')
+    if args.input and not args.output and not args.shard_dir:
+        parser.error('-o/--output or --shard_dir is required')
+    return args
+
+
+def _split(value):
+    return tuple(name.strip() for name in value.split(',') if name.strip())
+
+
+def main():
+    args = _parse_args()
+    try:
+        _require_pyarrow()
+    except ImportError as e:
+        sys.exit('Error: {}'.format(e))
+    if args.benchmark_mb:
+        _benchmark(args)
+        return
+    start = time.time()
+    try:
+        stats = convert(
+            args.input, output=args.output, shard_dir=args.shard_dir,
+            schema=ndjson.load_schema(args.schema), output_format=args.format,
+            dictionary_fields=_split(args.dictionary_fields),
+            nested_fields=_split(args.nested_fields), nested=args.nested,
+            on_invalid=args.on_invalid, processes=args.processes,
+            compression=args.compression,
+            row_group_records=args.row_group_records,
+            max_shard_records=args.max_shard_records,
+            shard_prefix=args.shard_prefix)
+    except ValueError as e:
+        sys.exit('Error: {}'.format(e))
+    elapsed = time.time() - start
+    for index, message in stats.errors:
+        print('Invalid record {}: {}'.format(index, message), file=sys.stderr)
+    print('Converted {} records ({} invalid), {:.1f} MB of JSON in {:.1f}s, to '
+          '{:.1f} MB{}.'.format(stats.records, stats.invalid,
+                                stats.chars_read / 1e6, elapsed,
+                                stats.bytes_written / 1e6,
+                                ' in {} shards'.format(len(stats.shards))
+                                if stats.shards else ''), file=sys.stderr)
+    if stats.unparsed:
+        print('Kept {} nested strings that are neither JSON nor Python '
+              'literals as they are.'.format(stats.unparsed), file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
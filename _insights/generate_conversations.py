@@ -0,0 +1,724 @@
+"""Generates synthetic chat conversations in the Insights `entries` format.
+
+The scripts in `data-generation` write a few thousand conversations, one file
+at a time. To load test an import, this generates millions of them, from the
+flows in `example.json` and `gmortgages-*.json`, on all cores. Every
+conversation follows one of the flows, with its own names, dropped, added and
+filler turns, occasionally a handoff to a second agent, and timestamps spread
+over `--days` days. PII, such as email addresses, card numbers and street
+addresses, can be added to customer turns to test redaction.
+
+A conversation only depends on the seed and its index, so the same command
+writes the same conversations with any number of processes, and
+`--start_index` continues where an earlier run stopped.
+
+Conversations are written as one file each, as the import tool reads them,
+as NDJSON shards with one conversation per line, or uploaded to a bucket, e.g.
+of a local GCS emulator with `STORAGE_EMULATOR_HOST` set.
+
+Examples:
+
+    python3 generate_conversations.py --count 1000000 \
+        --output_dir _temp/conversations
+    python3 generate_conversations.py --count 10000000 --layout ndjson \
+        --gzip --output_dir _temp/shards --pii_rate 0.05
+    STORAGE_EMULATOR_HOST=http://localhost:9023 \
+        python3 generate_conversations.py --count 100000 \
+        --gcs_uri gs://insights-data/load-test/
+    python3 generate_conversations.py --benchmark --count 200000
+"""
+
+import argparse
+import collections
+import concurrent.futures
+import datetime
+import glob
+import gzip
+import hashlib
+import json
+import multiprocessing
+import os
+import random
+import re
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+LAYOUT_FILES = 'files'
+LAYOUT_NDJSON = 'ndjson'
+LAYOUTS = (LAYOUT_FILES, LAYOUT_NDJSON)
+
+AGENT = 'AGENT'
+CUSTOMER = 'CUSTOMER'
+
+# The info types of the PII that is added, as in DLP.
+EMAIL_ADDRESS = 'EMAIL_ADDRESS'
+CREDIT_CARD_NUMBER = 'CREDIT_CARD_NUMBER'
+PHONE_NUMBER = 'PHONE_NUMBER'
+DATE_OF_BIRTH = 'DATE_OF_BIRTH'
+STREET_ADDRESS = 'STREET_ADDRESS'
+PII_TYPES = (EMAIL_ADDRESS, CREDIT_CARD_NUMBER, PHONE_NUMBER, DATE_OF_BIRTH,
+             STREET_ADDRESS)
+
+_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_FLOWS = [os.path.join(_DIRECTORY, 'example.json')] + sorted(
+    glob.glob(os.path.join(_DIRECTORY, 'gmortgages-*.json')))
+DEFAULT_NAMES = os.path.join(_DIRECTORY, 'data-generation', 'lib', 'names.js')
+DEFAULT_SHARD_SIZE = 10000
+DEFAULT_START_DATE = '2021-09-01'
+
+# The user ids of the roles. A second agent takes over after a handoff.
+_CUSTOMER_ID = 1
+_AGENT_ID = 2
+_SECOND_AGENT_ID = 3
+# The names in the flows, and whose names they are.
+_PLACEHOLDER = re.compile(r'\[NAME\]|\b(?:John|Jane|Lee)\b')
+_PLACEHOLDER_ROLES = {'John': AGENT}
+_NAME = re.compile(r"'([A-Z][A-Za-z-]*)'")
+_FALLBACK_NAMES = ('Alex', 'Sam', 'Maria', 'Noah', 'Priya', 'Chen', 'Fatima',
+                   'Lucas', 'Emma', 'Kofi')
+_FILLERS = {
+    CUSTOMER: ('Okay.', 'Hmm, let me think.', 'Sorry, can you repeat that?',
+               'Thanks.', 'One second please.', 'Got it.'),
+    AGENT: ('Are you still there?', 'Take your time.',
+            'Let me check that for you.', 'Thanks for waiting.',
+            'Is there anything else I can help you with?'),
+}
+_HANDOFF = 'Let me transfer you to a colleague who can help you with that.'
+_HANDOFF_GREETING = 'Hi {}, this is {}. I will take it from here.'
+# Characters per second that customers type and agents send.
+_CHARS_PER_SEC = {CUSTOMER: 5.0, AGENT: 25.0}
+
+_PII_SENTENCES = {
+    EMAIL_ADDRESS: ('My email address is {}.', 'You can email me at {}.'),
+    CREDIT_CARD_NUMBER: ('My card number is {}.', 'I paid with card {}.'),
+    PHONE_NUMBER: ('You can call me at {}.', 'My phone number is {}.'),
+    DATE_OF_BIRTH: ('My date of birth is {}.', 'I was born on {}.'),
+    STREET_ADDRESS: ('I live at {}.', 'My address is {}.'),
+}
+_EMAIL_DOMAINS = ('gmail.com', 'outlook.com', 'yahoo.com', 'example.com')
+_MONTHS = ('January', 'February', 'March', 'April', 'May', 'June', 'July',
+           'August', 'September', 'October', 'November', 'December')
+_STREETS = ('Oak', 'Maple', 'Main', 'Cedar', 'Pine Hill', 'Sunset', 'Lake',
+            'Mill Creek', 'Washington', 'Park')
+_STREET_SUFFIXES = ('Street', 'Avenue', 'Road', 'Lane', 'Drive', 'Boulevard',
+                    'Court')
+
+_ENCODER = json.JSONEncoder(ensure_ascii=False, separators=(',', ':'))
+
+Flow = collections.namedtuple('Flow', 'name categories turns')
+
+
+def load_flows(paths):
+    """Loads conversations in the `entries` format to generate others from.
+
+    Args:
+        paths: JSON files such as `example.json`.
+
+    Returns:
+        A list of `Flow`s, with the categories of the file, if any, and the
+        (role, text) of its entries in order. Entries without text are left
+        out.
+    """
+    flows = []
+    for path in paths:
+        with open(path, encoding='utf-8') as f:
+            conversation = json.load(f)
+        turns = [(entry['role'], entry['text'])
+                 for entry in conversation['entries'] if entry.get('text')]
+        if turns:
+            flows.append(Flow(os.path.basename(path),
+                              conversation.get('categories'), turns))
+    if not flows:
+        raise ValueError('No flows with entries in {}.'.format(
+            ', '.join(paths)))
+    return flows
+
+
+def load_names(path):
+    """Returns the first names of `data-generation/lib/names.js`.
+
+    Falls back on a few names if the file does not exist.
+    """
+    if not path or not os.path.exists(path):
+        return list(_FALLBACK_NAMES)
+    with open(path, encoding='utf-8') as f:
+        names = _NAME.findall(f.read())
+    return names or list(_FALLBACK_NAMES)
+
+
+def _exchanges(flows):
+    """Returns the customer turns of the flows with the agent's reply."""
+    exchanges = []
+    for flow in flows:
+        for (role, text), (next_role, reply) in zip(flow.turns,
+                                                    flow.turns[1:]):
+            if role == CUSTOMER and next_role == AGENT:
+                exchanges.append(((role, text), (next_role, reply)))
+    return exchanges
+
+
+# PII
+
+def _luhn_check_digit(digits):
+    total = 0
+    for i, digit in enumerate(reversed(digits)):
+        value = int(digit)
+        if i % 2 == 0:
+            value *= 2
+            if value > 9:
+                value -= 9
+        total += value
+    return str((10 - total % 10) % 10)
+
+
+def _card_number(rng):
+    digits = '4' + ''.join(str(rng.randrange(10)) for _ in range(14))
+    digits += _luhn_check_digit(digits)
+    separator = rng.choice(('', ' ', '-'))
+    return separator.join(digits[i:i + 4] for i in range(0, 16, 4))
+
+
+def _phone_number(rng):
+    area, exchange, line = (rng.randint(201, 989), rng.randint(200, 999),
+                            rng.randrange(10000))
+    return rng.choice(('({:03d}) {:03d}-{:04d}', '{:03d}-{:03d}-{:04d}',
+                       '+1 {:03d} {:03d} {:04d}')).format(area, exchange, line)
+
+
+def _date_of_birth(rng):
+    year, month, day = rng.randint(1940, 2003), rng.randint(1, 12), rng.randint(
+        1, 28)
+    return rng.choice(('{1:02d}/{2:02d}/{0}', '{3} {2}, {0}',
+                       '{0}-{1:02d}-{2:02d}')).format(year, month, day,
+                                                      _MONTHS[month - 1])
+
+
+def _pii(rng, info_type, name):
+    if info_type == EMAIL_ADDRESS:
+        return '{}{}@{}'.format(name.lower(), rng.randrange(100),
+                                rng.choice(_EMAIL_DOMAINS))
+    if info_type == CREDIT_CARD_NUMBER:
+        return _card_number(rng)
+    if info_type == PHONE_NUMBER:
+        return _phone_number(rng)
+    if info_type == DATE_OF_BIRTH:
+        return _date_of_birth(rng)
+    return '{} {} {}'.format(rng.randint(1, 9999), rng.choice(_STREETS),
+                             rng.choice(_STREET_SUFFIXES))
+
+
+# Generation
+
+class Generator:
+    """Builds varied conversations from flows.
+
+    Every conversation has its own random generator, seeded with the seed and
+    its index, so it is the same whichever process builds it.
+    """
+
+    def __init__(self, flows, names, seed=0, start_date=DEFAULT_START_DATE,
+                 days=30, drop_rate=0.1, filler_rate=0.1,
+                 max_extra_exchanges=3, handoff_rate=0.1, pii_rate=0.0,
+                 relative_timestamps=False):
+        """Initializes the generator.
+
+        Args:
+            flows: The `Flow`s to follow, e.g. from `load_flows`.
+            names: The first names to give customers and agents.
+            seed: The seed of all random choices.
+            start_date: The first day that conversations start on, as
+                `YYYY-MM-DD` in UTC.
+            days: The number of days that conversations start in.
+            drop_rate: The share of turns after the first that are left out.
+            filler_rate: The share of turns that are followed by a short
+                filler turn, such as `Okay.`.
+            max_extra_exchanges: The most customer questions with agent
+                answers, taken from any flow, that are added to a conversation.
+            handoff_rate: The share of conversations that a second agent takes
+                over.
+            pii_rate: The share of customer turns that get a sentence with PII.
+            relative_timestamps: Whether entries start at 0, like in
+                `example.json`, instead of at their time since the epoch.
+        """
+        self._flows = flows
+        self._exchanges = _exchanges(flows)
+        # The texts with names to replace, so that others are not searched.
+        self._named_texts = frozenset(
+            text for flow in flows for _, text in flow.turns
+            if _PLACEHOLDER.search(text))
+        self._names = names
+        self._seed = seed
+        start = datetime.datetime.strptime(start_date, '%Y-%m-%d').replace(
+            tzinfo=datetime.timezone.utc)
+        self._start_usec = int(start.timestamp()) * 1000000
+        self._range_usec = days * 86400 * 1000000
+        self._drop_rate = drop_rate
+        self._filler_rate = filler_rate
+        self._max_extra_exchanges = max_extra_exchanges
+        self._handoff_rate = handoff_rate
+        self._pii_rate = pii_rate
+        self._relative_timestamps = relative_timestamps
+
+    def conversation(self, index):
+        """Builds a conversation.
+
+        Args:
+            index: The number of the conversation.
+
+        Returns:
+            The conversation, with `entries` and the categories of its flow,
+            and a `collections.Counter` of the PII types it contains.
+        """
+        rng = random.Random('{}:{}'.format(self._seed, index))
+        flow = rng.choice(self._flows)
+        customer = rng.choice(self._names)
+        agent = rng.choice(self._names)
+
+        turns = [flow.turns[0]] + [
+            turn for turn in flow.turns[1:] if rng.random() >= self._drop_rate
+        ]
+        if self._exchanges:
+            for _ in range(rng.randint(0, self._max_extra_exchanges)):
+                # After the greeting, and before the goodbye.
+                position = rng.randint(min(2, len(turns)), max(
+                    min(2, len(turns)), len(turns) - 1))
+                turns[position:position] = list(rng.choice(self._exchanges))
+        varied = []
+        for turn in turns:
+            varied.append(turn)
+            if rng.random() < self._filler_rate:
+                role = rng.choice((CUSTOMER, AGENT))
+                varied.append((role, rng.choice(_FILLERS[role])))
+
+        def name(match):
+            return agent if _PLACEHOLDER_ROLES.get(
+                match.group()) == AGENT else customer
+
+        handoff = None
+        agent_turns = [i for i, (role, _) in enumerate(varied) if role == AGENT]
+        if len(agent_turns) > 2 and rng.random() < self._handoff_rate:
+            handoff = rng.choice(agent_turns[1:-1])
+        pii = collections.Counter()
+        entries = []
+        time_usec = (0 if self._relative_timestamps else
+                     self._start_usec + rng.randrange(self._range_usec))
+        user_id = _AGENT_ID
+        for i, (role, text) in enumerate(varied):
+            if text in self._named_texts:
+                text = _PLACEHOLDER.sub(name, text)
+            extra = []
+            if i == handoff:
+                second_agent = rng.choice(self._names)
+                extra = [(AGENT, _HANDOFF, user_id),
+                         (AGENT, _HANDOFF_GREETING.format(
+                             customer, second_agent), _SECOND_AGENT_ID)]
+                user_id = _SECOND_AGENT_ID
+            if role == CUSTOMER and rng.random() < self._pii_rate:
+                info_type = rng.choice(PII_TYPES)
+                text += ' ' + rng.choice(_PII_SENTENCES[info_type]).format(
+                    _pii(rng, info_type, customer))
+                pii[info_type] += 1
+            for extra_role, extra_text, extra_user_id in extra:
+                time_usec = self._next_time(rng, time_usec, extra_role,
+                                            extra_text, entries)
+                entries.append(_entry(extra_text, extra_user_id, time_usec,
+                                      extra_role))
+            time_usec = self._next_time(rng, time_usec, role, text, entries)
+            entries.append(_entry(
+                text, _CUSTOMER_ID if role == CUSTOMER else user_id, time_usec,
+                role))
+
+        conversation = {}
+        if flow.categories:
+            conversation['categories'] = flow.categories
+        conversation['entries'] = entries
+        return conversation, pii
+
+    @staticmethod
+    def _next_time(rng, time_usec, role, text, entries):
+        """Returns the start of a turn, after a pause and the time to type it."""
+        if not entries:
+            return time_usec
+        pause = rng.lognormvariate(0.5, 0.6)
+        typing = len(text) / _CHARS_PER_SEC.get(role, _CHARS_PER_SEC[AGENT])
+        return time_usec + int((pause + typing) * 1000000)
+
+
+def _entry(text, user_id, time_usec, role):
+    return {
+        'text': text,
+        'user_id': user_id,
+        'start_timestamp_usec': time_usec,
+        'role': role,
+    }
+
+
+def object_name(prefix, index):
+    """Returns the file or object name of a conversation."""
+    return '{}conversation-{:09d}.json'.format(prefix, index)
+
+
+# Output
+
+class _GcsUploader:
+    """Uploads conversations to a bucket from a pool of threads."""
+
+    def __init__(self, gcs_uri, threads):
+        bucket, _, prefix = gcs_uri[len('gs://'):].partition('/')
+        if prefix and not prefix.endswith('/'):
+            prefix += '/'
+        self.bucket = bucket
+        self.prefix = prefix
+        self._local = threading.local()
+        self._executor = concurrent.futures.ThreadPoolExecutor(threads)
+        # Bounds the conversations in memory if uploads fall behind.
+        self._slots = threading.BoundedSemaphore(threads * 4)
+
+    def _client(self):
+        if not hasattr(self._local, 'client'):
+            # Imported here, since uploading is optional, and the storage
+            # library reads the emulator host when it is imported.
+            from google.cloud import storage  # pylint: disable=import-outside-toplevel
+            if os.environ.get('STORAGE_EMULATOR_HOST'):
+                import google.auth.credentials  # pylint: disable=import-outside-toplevel
+                self._local.client = storage.Client(
+                    project='load-test',
+                    credentials=google.auth.credentials.AnonymousCredentials())
+            else:
+                self._local.client = storage.Client()
+        return self._local.client
+
+    def _upload(self, name, data):
+        try:
+            self._client().bucket(self.bucket).blob(name).upload_from_string(
+                data, content_type='application/json')
+        finally:
+            self._slots.release()
+
+    def upload(self, name, data):
+        """Queues an upload, and returns its future."""
+        self._slots.acquire()
+        return self._executor.submit(self._upload, name, data)
+
+    def close(self):
+        self._executor.shutdown()
+
+
+# The generator and uploader of a worker process.
+_state = {}
+
+
+def _init_worker(options):
+    _state['generator'] = Generator(
+        load_flows(options['flows']), load_names(options['names']),
+        **options['generator'])
+    _state['options'] = options
+    if options['gcs_uri']:
+        _state['uploader'] = _GcsUploader(options['gcs_uri'],
+                                          options['upload_threads'])
+
+
+def _generate_shard(shard):
+    """Generates the conversations of one shard, and returns its stats.
+
+    Args:
+        shard: (shard index, first conversation index, count).
+    """
+    shard_index, first, count = shard
+    options = _state['options']
+    generator = _state['generator']
+    stats = {'conversations': 0, 'entries': 0, 'bytes': 0, 'pii': {}}
+    pii = collections.Counter()
+    uploader = _state.get('uploader')
+    out = None
+    uploads = []
+    if not uploader and options['layout'] == LAYOUT_NDJSON:
+        path = os.path.join(options['output_dir'], 'part-{:05d}.ndjson{}'.format(
+            shard_index, '.gz' if options['gzip'] else ''))
+        out = (gzip.open(path, 'wb', compresslevel=6) if options['gzip'] else
+               open(path, 'wb'))
+    elif not uploader:
+        directory = os.path.join(options['output_dir'],
+                                 'part-{:05d}'.format(shard_index))
+        os.makedirs(directory, exist_ok=True)
+    try:
+        for index in range(first, first + count):
+            conversation, conversation_pii = generator.conversation(index)
+            data = _ENCODER.encode(conversation).encode('utf-8')
+            if uploader:
+                uploads.append(uploader.upload(
+                    object_name(uploader.prefix, index), data))
+            elif out:
+                out.write(data + b'\n')
+            else:
+                with open(os.path.join(directory, object_name('', index)),
+                          'wb') as f:
+                    f.write(data)
+            stats['conversations'] += 1
+            stats['entries'] += len(conversation['entries'])
+            stats['bytes'] += len(data)
+            pii.update(conversation_pii)
+        for upload in uploads:
+            upload.result()
+    finally:
+        if out:
+            out.close()
+    stats['pii'] = dict(pii)
+    return stats
+
+
+def generate(count, output_dir=None, gcs_uri=None, layout=LAYOUT_FILES,
+             compress=False, start_index=0, shard_size=DEFAULT_SHARD_SIZE,
+             processes=None, flows=None, names=DEFAULT_NAMES,
+             upload_threads=16, **generator_options):
+    """Generates conversations in parallel.
+
+    Args:
+        count: The number of conversations.
+        output_dir: The directory to write to, with a subdirectory of files or
+            an NDJSON file for every `shard_size` conversations.
+        gcs_uri: A `gs://bucket/prefix` to upload conversations to instead, one
+            object each. Set `STORAGE_EMULATOR_HOST` to use an emulator.
+        layout: `files`, one JSON file per conversation, or `ndjson`, one
+            conversation per line. Ignored for uploads.
+        compress: Whether to gzip NDJSON files.
+        start_index: The index of the first conversation.
+        shard_size: The number of conversations in a shard, the unit of work
+            of a process.
+        processes: The number of processes. None for one per CPU.
+        flows: The paths of the flows to follow. None for `example.json` and
+            `gmortgages-*.json`.
+        names: The path of the first names, `data-generation/lib/names.js`.
+        upload_threads: The number of concurrent uploads per process.
+        **generator_options: The arguments of `Generator`, such as `seed` and
+            `pii_rate`.
+
+    Returns:
+        A dict of the number of conversations, entries and bytes, and the
+        number of every PII type added.
+
+    Raises:
+        ValueError: If neither an output directory nor a GCS URI is given, or
+            no flow has entries.
+    """
+    if gcs_uri:
+        if not gcs_uri.startswith('gs://'):
+            raise ValueError('Expected a gs:// URI, got `{}`.'.format(gcs_uri))
+    elif output_dir:
+        os.makedirs(output_dir, exist_ok=True)
+    else:
+        raise ValueError('Either an output directory or a GCS URI is '
+                         'required.')
+    if layout not in LAYOUTS:
+        raise ValueError('Unknown layout `{}`: expected one of {}.'.format(
+            layout, LAYOUTS))
+    options = {
+        'flows': flows or DEFAULT_FLOWS,
+        'names': names,
+        'generator': generator_options,
+        'output_dir': output_dir,
+        'gcs_uri': gcs_uri,
+        'layout': layout,
+        'gzip': compress,
+        'upload_threads': upload_threads,
+    }
+    # Fails early on flows that cannot be read.
+    load_flows(options['flows'])
+    # Shards are numbered from the first conversation, so that a run with a
+    # start index adds shards instead of overwriting them.
+    shards = []
+    index = start_index
+    while index < start_index + count:
+        shard_count = min(shard_size - index % shard_size,
+                          start_index + count - index)
+        shards.append((index // shard_size, index, shard_count))
+        index += shard_count
+    totals = {'conversations': 0, 'entries': 0, 'bytes': 0, 'pii': {}}
+    pii = collections.Counter()
+    processes = max(1, min(processes or os.cpu_count() or 1, len(shards)))
+    if processes == 1:
+        _init_worker(options)
+        results = map(_generate_shard, shards)
+    else:
+        # Spawned rather than forked, so that the workers don't inherit the
+        # caller's threads and clients.
+        pool = multiprocessing.get_context('spawn').Pool(
+            processes, initializer=_init_worker, initargs=(options,))
+        results = pool.imap_unordered(_generate_shard, shards)
+    try:
+        for stats in results:
+            for key in ('conversations', 'entries', 'bytes'):
+                totals[key] += stats[key]
+            pii.update(stats['pii'])
+    finally:
+        if processes > 1:
+            pool.terminate()
+            pool.join()
+        elif 'uploader' in _state:
+            _state.pop('uploader').close()
+    totals['pii'] = dict(pii)
+    return totals
+
+
+# Benchmark
+
+def _digest(directory):
+    """Returns a hash of the files under a directory, in name order."""
+    digest = hashlib.sha256()
+    for root, dirs, files in os.walk(directory):
+        dirs.sort()
+        for name in sorted(files):
+            with open(os.path.join(root, name), 'rb') as f:
+                digest.update(f.read())
+    return digest.hexdigest()
+
+
+def _benchmark(args, generator_options):
+    directory = tempfile.mkdtemp(prefix='conversations-bench-')
+    try:
+        print('{:<7} {:<10} {:>8} {:>16} {:>6}'.format(
+            'layout', 'processes', 'seconds', 'conversations/s', 'MB/s'))
+        for layout in LAYOUTS:
+            digests = set()
+            for processes in sorted({1, args.processes or os.cpu_count()}):
+                out_dir = os.path.join(directory, '{}-{}'.format(
+                    layout, processes))
+                start = time.time()
+                totals = generate(args.count, output_dir=out_dir,
+                                  layout=layout, compress=args.gzip,
+                                  shard_size=args.shard_size,
+                                  processes=processes,
+                                  flows=args.flows, names=args.names,
+                                  **generator_options)
+                elapsed = time.time() - start
+                print('{:<7} {:<10} {:>8.1f} {:>16.0f} {:>6.1f}'.format(
+                    layout, processes, elapsed,
+                    totals['conversations'] / elapsed,
+                    totals['bytes'] / 1e6 / elapsed))
+                digests.add(_digest(out_dir))
+                shutil.rmtree(out_dir, ignore_errors=True)
+            print('The output of every process count is {}.'.format(
+                'the same' if len(digests) == 1 else 'NOT the same'))
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+def _parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--count', type=int, required=True,
+                        help='The number of conversations to generate.')
+    parser.add_argument(
+        '--output_dir',
+        help='The directory to write conversations to.')
+    parser.add_argument(
+        '--gcs_uri',
+        help='Upload conversations to this `gs://bucket/prefix` instead, e.g. '
+        'of the GCS emulator at `STORAGE_EMULATOR_HOST`. Requires the '
+        '`google-cloud-storage` package.')
+    parser.add_argument(
+        '--layout', choices=LAYOUTS, default=LAYOUT_FILES,
+        help='One JSON file per conversation, in a directory per shard, or an '
+        'NDJSON file per shard.')
+    parser.add_argument('--gzip', action='store_true',
+                        help='Compress NDJSON shards with gzip.')
+    parser.add_argument(
+        '--shard_size', type=int, default=DEFAULT_SHARD_SIZE,
+        help='The number of conversations in a shard.')
+    parser.add_argument(
+        '--start_index', type=int, default=0,
+        help='The index of the first conversation, e.g. the count of an '
+        'earlier run to add new conversations.')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='The seed that all random choices depend on.')
+    parser.add_argument(
+        '--processes', type=int,
+        help='The number of processes (default: one per CPU).')
+    parser.add_argument(
+        '--upload_threads', type=int, default=16,
+        help='The number of concurrent uploads per process.')
+    parser.add_argument(
+        '--flows', nargs='+', default=DEFAULT_FLOWS,
+        help='The conversations to follow (default: `example.json` and '
+        '`gmortgages-*.json`).')
+    parser.add_argument('--names', default=DEFAULT_NAMES,
+                        help='The JavaScript file of first names to use.')
+    parser.add_argument(
+        '--start_date', default=DEFAULT_START_DATE,
+        help='The first day, as YYYY-MM-DD in UTC, that conversations start '
+        'on.')
+    parser.add_argument('--days', type=int, default=30,
+                        help='The number of days that conversations start in.')
+    parser.add_argument(
+        '--relative_timestamps', action='store_true',
+        help='Start every conversation at 0, like `example.json`.')
+    parser.add_argument('--drop_rate', type=float, default=0.1,
+                        help='The share of turns that are left out.')
+    parser.add_argument(
+        '--filler_rate', type=float, default=0.1,
+        help='The share of turns that are followed by a short filler turn.')
+    parser.add_argument(
+        '--max_extra_exchanges', type=int, default=3,
+        help='The most questions and answers from other flows to add to a '
+        'conversation.')
+    parser.add_argument(
+        '--handoff_rate', type=float, default=0.1,
+        help='The share of conversations that a second agent takes over.')
+    parser.add_argument(
+        '--pii_rate', type=float, default=0.0,
+        help='The share of customer turns that get an email address, card '
+        'number, phone number, date of birth or street address.')
+    parser.add_argument(
+        '--benchmark', action='store_true',
+        help='Instead of writing to --output_dir, measure the throughput of '
+        'both layouts with 1 and --processes processes, and check that their '
+        'output is the same.')
+    args = parser.parse_args()
+    if not args.benchmark and not args.output_dir and not args.gcs_uri:
+        parser.error('--output_dir or --gcs_uri is required')
+    return args
+
+
+def main():
+    args = _parse_args()
+    generator_options = {
+        'seed': args.seed,
+        'start_date': args.start_date,
+        'days': args.days,
+        'drop_rate': args.drop_rate,
+        'filler_rate': args.filler_rate,
+        'max_extra_exchanges': args.max_extra_exchanges,
+        'handoff_rate': args.handoff_rate,
+        'pii_rate': args.pii_rate,
+        'relative_timestamps': args.relative_timestamps,
+    }
+    if args.benchmark:
+        _benchmark(args, generator_options)
+        return
+    start = time.time()
+    try:
+        totals = generate(
+            args.count, output_dir=args.output_dir, gcs_uri=args.gcs_uri,
+            layout=args.layout, compress=args.gzip,
+            start_index=args.start_index, shard_size=args.shard_size,
+            processes=args.processes, flows=args.flows, names=args.names,
+            upload_threads=args.upload_threads, **generator_options)
+    except ValueError as e:
+        sys.exit('Error: {}'.format(e))
+    elapsed = time.time() - start
+    print('Generated {} conversations with {} entries, {:.1f} MB, in {:.1f}s '
+          '({:.0f} conversations/s).'.format(
+              totals['conversations'], totals['entries'], totals['bytes'] / 1e6,
+              elapsed, totals['conversations'] / elapsed if elapsed else 0),
+          file=sys.stderr)
+    if totals['pii']:
+        print('Added PII: {}.'.format(', '.join(
+            '{} {}'.format(number, info_type)
+            for info_type, number in sorted(totals['pii'].items()))),
+              file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
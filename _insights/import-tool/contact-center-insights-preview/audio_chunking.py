@@ -0,0 +1,468 @@
+# Lint as: python3
+"""Splits long recordings into segments that are transcribed concurrently.
+
+Every audio file used to be one long running recognize operation, so a
+90 minute call waited for Speech-to-text to work through all 90 minutes. For
+16 bit PCM WAV and FLAC files, the file is instead split into segments of at
+most a few minutes, each sent as inline content in its own operation, and the
+segment transcripts are stitched back into one response.
+
+Segments end at the quietest point near their target length, so that words
+are rarely cut, and overlap their neighbours by a little so that a cut word is
+still recognized in full by one of them. Files are read through mmap and never
+decoded into Python objects: WAV loudness is measured with `audioop` on
+windows of the mapped file, and FLAC loudness is estimated from the size of
+every frame, since quiet frames compress best.
+"""
+
+import bisect
+import collections
+import mmap
+import struct
+
+try:
+  import audioop  # pylint: disable=deprecated-module
+except ImportError:
+  # Removed in Python 3.13. WAV files are then split at their target lengths.
+  audioop = None
+
+# The encodings of the files that can be split, as in `audio_probe.AudioInfo`.
+SUPPORTED_ENCODINGS = ('LINEAR16', 'FLAC')
+
+# The largest inline content Speech-to-text accepts in a request.
+MAX_CONTENT_BYTES = 10 * 1000 * 1000
+
+# The length of the windows whose loudness is compared in WAV files.
+_WINDOW_SECS = 0.05
+_WAVE_FORMAT_PCM = 1
+_WAVE_FORMAT_EXTENSIBLE = 0xFFFE
+_STREAMINFO_BYTES = 34
+_FLAC_BLOCK_SIZES = {1: 192, 2: 576, 3: 1152, 4: 2304, 5: 4608}
+
+
+class Segment(
+    collections.namedtuple(
+        'Segment', [
+            'start', 'keep_start', 'keep_end', 'end', 'sample_rate',
+            'first_byte', 'end_byte'
+        ])):
+  """A part of a recording, in samples from the start of the recording.
+
+  The segment covers [start, end), and its transcript is kept for words that
+  start in [keep_start, keep_end). The kept ranges of the segments of a file
+  cover it without overlap. Its audio is in bytes [first_byte, end_byte) of
+  the file.
+  """
+  __slots__ = ()
+
+  @property
+  def offset_secs(self):
+    return self.start / float(self.sample_rate)
+
+  @property
+  def duration_secs(self):
+    return (self.end - self.start) / float(self.sample_rate)
+
+
+class _WavAudio(object):
+  """The 16 bit PCM samples of a WAV file, in its data chunk."""
+
+  def __init__(self, data, fmt_position, data_position, data_size):
+    (unused_format, self.channels, self.sample_rate, unused_byte_rate,
+     self.block_align, self.bits) = struct.unpack_from('<HHIIHH', data,
+                                                       fmt_position)
+    self._data = data
+    self._start = data_position
+    # Streamed files may record a size of zero or more than was written.
+    self._end = min(len(data), data_position + data_size) if data_size else len(
+        data)
+    self.total_samples = (self._end - self._start) // self.block_align
+
+  def OffsetOf(self, sample):
+    """Returns the byte offset of a sample."""
+    return self._start + sample * self.block_align
+
+  def SampleAt(self, offset):
+    """Returns the last sample that starts at or before a byte offset."""
+    return max(0, (offset - self._start) // self.block_align)
+
+  def FindQuietest(self, start, end):
+    """Returns the middle sample of the quietest window in [start, end)."""
+    window = max(1, int(self.sample_rate * _WINDOW_SECS))
+    if not audioop or end - start < window:
+      return end
+    view = memoryview(self._data)
+    best, best_rms = end, None
+    for window_start in range(start, end - window + 1, window):
+      rms = audioop.rms(
+          view[self.OffsetOf(window_start):self.OffsetOf(window_start +
+                                                         window)], 2)
+      if best_rms is None or rms < best_rms:
+        best, best_rms = window_start + window // 2, rms
+    view.release()
+    return best
+
+  def Header(self, num_samples):
+    """Returns the header of a WAV file with the given number of samples."""
+    size = num_samples * self.block_align
+    return (b'RIFF' + struct.pack('<I', 36 + size) + b'WAVE' + b'fmt ' +
+            struct.pack('<IHHIIHH', 16, _WAVE_FORMAT_PCM, self.channels,
+                        self.sample_rate, self.sample_rate * self.block_align,
+                        self.block_align, self.bits) + b'data' +
+            struct.pack('<I', size))
+
+  def Content(self, segment):
+    return self.Header(segment.end - segment.start) + self._data[
+        segment.first_byte:segment.end_byte]
+
+
+def _Crc8(data):
+  """Returns the CRC-8 of FLAC frame headers, polynomial 0x07."""
+  crc = 0
+  for byte in data:
+    crc ^= byte
+    for _ in range(8):
+      crc = ((crc << 1) ^ 0x07 if crc & 0x80 else crc << 1) & 0xFF
+  return crc
+
+
+def _ParseFlacFrameHeader(data, position, fixed_block_size):
+  """Parses a FLAC frame header.
+
+  Args:
+    data: The file.
+    position: Where the header may start.
+    fixed_block_size: The block size of fixed block size streams.
+
+  Returns:
+    A tuple of the first sample and the block size of the frame, or None if
+    there is no valid frame header at the position.
+  """
+  header = data[position:position + 16]
+  if (len(header) < 6 or header[0] != 0xFF or header[1] & 0xFE != 0xF8 or
+      header[3] & 0x01):
+    return None
+  variable = header[1] & 0x01
+  block_code, rate_code = header[2] >> 4, header[2] & 0x0F
+  if block_code == 0 or rate_code == 0x0F or header[3] >> 4 >= 11:
+    return None
+  # The frame or sample number is UTF-8 coded, in 1 to 7 bytes.
+  first = header[4]
+  length = 1
+  if first >= 0x80:
+    # The number of leading ones is the number of bytes.
+    length = 0
+    while length < 8 and first & (0x80 >> length):
+      length += 1
+    if not 2 <= length <= 7:
+      return None
+  number = first & (0x7F >> length) if length > 1 else first
+  for byte in header[5:4 + length]:
+    if byte & 0xC0 != 0x80:
+      return None
+    number = (number << 6) | (byte & 0x3F)
+  cursor = 4 + length
+  if block_code == 6:
+    block_size = header[cursor] + 1
+    cursor += 1
+  elif block_code == 7:
+    block_size = (header[cursor] << 8 | header[cursor + 1]) + 1
+    cursor += 2
+  elif block_code in _FLAC_BLOCK_SIZES:
+    block_size = _FLAC_BLOCK_SIZES[block_code]
+  else:
+    block_size = 256 << (block_code - 8)
+  cursor += {12: 1, 13: 2, 14: 2}.get(rate_code, 0)
+  if cursor >= len(header) or _Crc8(header[:cursor]) != header[cursor]:
+    return None
+  first_sample = number if variable else number * fixed_block_size
+  return first_sample, block_size
+
+
+class _FlacAudio(object):
+  """The frames of a FLAC file.
+
+  Frames are found by their sync code and checked by the CRC of their header
+  and by the continuity of their sample numbers, without decoding them.
+  """
+
+  def __init__(self, data, marker_position):
+    streaminfo = marker_position + 8
+    (min_block_size,) = struct.unpack_from('>H', data, streaminfo)
+    fields = data[streaminfo + 10:streaminfo + 14]
+    self.sample_rate = (fields[0] << 12) | (fields[1] << 4) | (fields[2] >> 4)
+    position = marker_position + 4
+    while True:
+      block_header = data[position]
+      length = int.from_bytes(data[position + 1:position + 4], 'big')
+      position += 4 + length
+      if block_header & 0x80:
+        break
+    self._data = data
+    self._marker_position = marker_position
+    self._first_frame = position
+    self._min_block_size = min_block_size
+    # The byte offsets and first samples of the frames, and their sizes in
+    # bytes per sample. Found on first use, as reading planned segments does
+    # not need them.
+    self._offsets = None
+    self._total_samples = 0
+
+  @property
+  def total_samples(self):
+    self._Index()
+    return self._total_samples
+
+  def _Index(self):
+    """Finds the frames, unless they were found already."""
+    if self._offsets is not None:
+      return
+    data = self._data
+    position = self._first_frame
+    min_block_size = self._min_block_size
+    self._offsets = []
+    self._samples = []
+    self._bytes_per_sample = []
+    next_sample = None
+    base_sample = None
+    while position < len(data):
+      parsed = _ParseFlacFrameHeader(data, position, min_block_size)
+      if parsed is None or (next_sample is not None and
+                            parsed[0] != next_sample):
+        # A false sync code in the previous frame's data; keep looking.
+        position = data.find(b'\xff', position + 1)
+        if position < 0:
+          break
+        continue
+      first_sample, block_size = parsed
+      if base_sample is None:
+        base_sample = first_sample
+      if self._offsets:
+        self._bytes_per_sample.append(
+            (position - self._offsets[-1]) / float(block_size))
+      self._offsets.append(position)
+      self._samples.append(first_sample - base_sample)
+      next_sample = first_sample + block_size
+      position = data.find(b'\xff', position + 2)
+      if position < 0:
+        break
+    if self._offsets:
+      self._bytes_per_sample.append(
+          (len(data) - self._offsets[-1]) /
+          float(next_sample - base_sample - self._samples[-1]))
+      self._total_samples = next_sample - base_sample
+
+  def OffsetOf(self, sample):
+    """Returns the byte offset of the frame that starts at or before a sample.
+    """
+    self._Index()
+    if sample >= self._total_samples:
+      return len(self._data)
+    return self._offsets[bisect.bisect_right(self._samples, sample) - 1]
+
+  def SampleAt(self, offset):
+    """Returns the first sample of the last frame at or before an offset."""
+    self._Index()
+    if offset >= len(self._data):
+      return self._total_samples
+    index = bisect.bisect_right(self._offsets, offset) - 1
+    return self._samples[max(0, index)]
+
+  def FindQuietest(self, start, end):
+    """Returns the first sample of the frame in (start, end] that compresses
+    best, or `end` if there is none."""
+    self._Index()
+    first = bisect.bisect_right(self._samples, start)
+    last = bisect.bisect_right(self._samples, end)
+    if first >= last:
+      return end
+    index = min(range(first, last), key=lambda i: self._bytes_per_sample[i])
+    return self._samples[index]
+
+  def Header(self, unused_num_samples):
+    """Returns the metadata blocks, with an unknown length and MD5.
+
+    The frames of a segment keep their sample numbers, which decoders accept
+    like those of a stream that was joined in the middle.
+    """
+    header = bytearray(
+        self._data[self._marker_position:self._first_frame])
+    # The low 4 bits of byte 13 and bytes 14 to 17 of STREAMINFO are the total
+    # number of samples, and bytes 18 to 33 the MD5 of the audio.
+    header[8 + 13] &= 0xF0
+    header[8 + 14:8 + _STREAMINFO_BYTES] = bytes(_STREAMINFO_BYTES - 14)
+    return bytes(header)
+
+  def Content(self, segment):
+    return self.Header(segment.end - segment.start) + self._data[
+        segment.first_byte:segment.end_byte]
+
+
+def _OpenAudio(data):
+  """Returns the audio of a 16 bit PCM WAV or FLAC file, or None."""
+  if data[:4] == b'RIFF' and data[8:12] == b'WAVE':
+    position = 12
+    fmt_position = None
+    while position + 8 <= len(data):
+      chunk_id = data[position:position + 4]
+      (chunk_size,) = struct.unpack_from('<I', data, position + 4)
+      if chunk_id == b'fmt ':
+        fmt_position = position + 8
+        (audio_format,) = struct.unpack_from('<H', data, fmt_position)
+        (bits,) = struct.unpack_from('<H', data, fmt_position + 14)
+        if audio_format == _WAVE_FORMAT_EXTENSIBLE:
+          (audio_format,) = struct.unpack_from('<H', data, fmt_position + 24)
+        if audio_format != _WAVE_FORMAT_PCM or bits != 16:
+          return None
+      elif chunk_id == b'data':
+        if fmt_position is None:
+          return None
+        return _WavAudio(data, fmt_position, position + 8, chunk_size)
+      # Chunks are padded to an even size.
+      position += 8 + chunk_size + (chunk_size & 1)
+    return None
+  position = 0
+  if data[:3] == b'ID3' and len(data) >= 10:
+    size = 0
+    for byte in data[6:10]:
+      size = (size << 7) | (byte & 0x7F)
+    position = 10 + size
+  if data[position:position + 4] == b'fLaC':
+    return _FlacAudio(data, position)
+  return None
+
+
+def _Plan(audio, segment_secs, overlap_secs, search_secs, max_bytes):
+  rate = audio.sample_rate
+  segment_samples = int(segment_secs * rate)
+  overlap = int(overlap_secs * rate)
+  search = int(search_secs * rate)
+  header_bytes = len(audio.Header(0))
+  total = audio.total_samples
+  if total <= segment_samples:
+    return []
+  segments = []
+  keep_start = 0
+  while keep_start < total:
+    # Starts on a frame boundary, so the segment offset is exact.
+    start = audio.SampleAt(audio.OffsetOf(max(0, keep_start - overlap)))
+    # Stays within the content limit, with room for the overlap at the end.
+    limit = audio.SampleAt(audio.OffsetOf(start) + max_bytes - header_bytes)
+    if limit < total:
+      limit -= overlap
+    target = min(keep_start + segment_samples, limit)
+    if target >= total:
+      keep_end = total
+    else:
+      keep_end = audio.FindQuietest(max(keep_start, target - search), target)
+      if keep_end <= keep_start:
+        # No frame boundary within the limit, e.g. for huge FLAC frames.
+        keep_end = max(target, keep_start + 1)
+    end = min(total, keep_end + overlap)
+    if end < total:
+      # Ends on a frame boundary, so the content holds whole frames.
+      end = audio.SampleAt(audio.OffsetOf(end))
+      end = max(end, keep_end)
+    segments.append(
+        Segment(start, keep_start, keep_end, end, rate, audio.OffsetOf(start),
+                audio.OffsetOf(end)))
+    keep_start = keep_end
+  return segments
+
+
+def PlanSegments(path, segment_secs, overlap_secs=1.0, search_secs=10.0,
+                 max_bytes=MAX_CONTENT_BYTES):
+  """Splits a local audio file into segments at quiet points.
+
+  Args:
+    path: The local file, a 16 bit PCM WAV or FLAC file.
+    segment_secs: The longest segment to transcribe, without the overlap.
+    overlap_secs: How much audio every segment shares with its neighbours.
+    search_secs: How far before its target end a segment may end, to end at a
+      quiet point.
+    max_bytes: The largest segment content, including the file header.
+
+  Returns:
+    The `Segment`s, in order. Empty if the file is in another format or not
+    longer than `segment_secs`, and should be transcribed whole.
+  """
+  with open(path, 'rb') as f:
+    try:
+      with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        audio = _OpenAudio(data)
+        if not audio:
+          return []
+        return _Plan(audio, segment_secs, overlap_secs, search_secs, max_bytes)
+    except ValueError:
+      # Empty files cannot be mapped.
+      return []
+
+
+def ReadSegment(path, segment):
+  """Returns a segment as a file of its own, for inline recognize content.
+
+  Args:
+    path: The local file that was passed to `PlanSegments`.
+    segment: One of the planned `Segment`s.
+  """
+  with open(path, 'rb') as f:
+    with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+      return _OpenAudio(data).Content(segment)
+
+
+def GetDurationSecs(data):
+  """Returns the duration of a WAV or FLAC file in memory, or None."""
+  audio = _OpenAudio(data)
+  return audio.total_samples / float(audio.sample_rate) if audio else None
+
+
+def StitchResponses(segments, responses):
+  """Joins the transcripts of the segments of a file into one.
+
+  Words are moved to their time in the whole file, and only the words that
+  start in the kept range of their segment are kept, so words in overlaps
+  are not repeated. Results keep their channel tags, and are ordered by the
+  time of their first word. Needs word time offsets.
+
+  Args:
+    segments: The `Segment`s of the file.
+    responses: The `LongRunningRecognizeResponse` of every segment.
+
+  Returns:
+    The `LongRunningRecognizeResponse` of the whole file.
+  """
+  stitched = type(responses[0])()
+  kept = []
+  for index, (segment, response) in enumerate(zip(segments, responses)):
+    offset_nanos = segment.start * 10**9 // segment.sample_rate
+    keep_start_nanos = segment.keep_start * 10**9 // segment.sample_rate
+    keep_end_nanos = segment.keep_end * 10**9 // segment.sample_rate
+    last = index == len(segments) - 1
+    for result in response.results:
+      if not result.alternatives:
+        continue
+      words = []
+      for word in result.alternatives[0].words:
+        start_nanos = word.start_time.ToNanoseconds() + offset_nanos
+        if start_nanos >= keep_start_nanos and (last or
+                                                start_nanos < keep_end_nanos):
+          words.append(word)
+      if words:
+        kept.append((words[0].start_time.ToNanoseconds() + offset_nanos,
+                     len(kept), offset_nanos, result, words))
+  kept.sort(key=lambda entry: entry[:2])
+  for unused_start, unused_order, offset_nanos, result, words in kept:
+    stitched_result = stitched.results.add()
+    stitched_result.channel_tag = result.channel_tag
+    stitched_result.language_code = result.language_code
+    alternative = stitched_result.alternatives.add()
+    alternative.confidence = result.alternatives[0].confidence
+    for word in words:
+      stitched_word = alternative.words.add()
+      stitched_word.CopyFrom(word)
+      stitched_word.start_time.FromNanoseconds(
+          word.start_time.ToNanoseconds() + offset_nanos)
+      stitched_word.end_time.FromNanoseconds(word.end_time.ToNanoseconds() +
+                                             offset_nanos)
+    alternative.transcript = ' '.join(word.word for word in words)
+  return stitched
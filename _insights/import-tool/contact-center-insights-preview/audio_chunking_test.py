@@ -0,0 +1,105 @@
+# Lint as: python3
+"""Tests for the stitching of segment transcripts in audio_chunking.py.
+
+Run with `python3 -m pytest audio_chunking_test.py`.
+"""
+
+import sys
+
+from google.cloud import speech_v1p1beta1
+import pytest
+
+import audio_chunking
+
+_SAMPLE_RATE = 8000
+
+
+def _Segment(start_secs, keep_start_secs, keep_end_secs, end_secs):
+  return audio_chunking.Segment(
+      int(start_secs * _SAMPLE_RATE), int(keep_start_secs * _SAMPLE_RATE),
+      int(keep_end_secs * _SAMPLE_RATE), int(end_secs * _SAMPLE_RATE),
+      _SAMPLE_RATE, 0, 0)
+
+
+def _Response(*results):
+  """Returns a response with a result per (channel, words) pair.
+
+  Words are (word, start secs, end secs) in the time of their segment.
+  """
+  response = speech_v1p1beta1.types.LongRunningRecognizeResponse()
+  for channel_tag, words in results:
+    result = response.results.add()
+    result.channel_tag = channel_tag
+    result.language_code = 'en-us'
+    alternative = result.alternatives.add()
+    alternative.confidence = 0.9
+    for text, start_secs, end_secs in words:
+      word = alternative.words.add()
+      word.word = text
+      word.start_time.FromNanoseconds(int(start_secs * 10**9))
+      word.end_time.FromNanoseconds(int(end_secs * 10**9))
+    alternative.transcript = ' '.join(text for text, _, _ in words)
+  return response
+
+
+def _Words(response):
+  """Returns (channel, word, start secs, end secs) for every word, in order."""
+  return [(result.channel_tag, word.word, word.start_time.ToNanoseconds() / 1e9,
+           word.end_time.ToNanoseconds() / 1e9)
+          for result in response.results
+          for word in result.alternatives[0].words]
+
+
+# Two segments of a 20 second call, split at 10 s with 1 s of overlap on
+# either side.
+_SEGMENTS = [_Segment(0, 0, 10, 11), _Segment(9, 10, 20, 20)]
+
+
+def testStitchKeepsWordsThatStraddleTheOverlapOnce():
+  # `across` starts at 9.8 s and ends after the split, and `after` starts at
+  # 10.2 s. Both are in the overlap, so both segments transcribed them.
+  first = _Response(
+      (1, [('before', 9.0, 9.5), ('across', 9.8, 10.3), ('after', 10.2, 10.6)]))
+  second = _Response(
+      (1, [('before', 0.0, 0.5), ('across', 0.8, 1.3), ('after', 1.2, 1.6),
+           ('end', 5.0, 5.5)]))
+  stitched = audio_chunking.StitchResponses(_SEGMENTS, [first, second])
+  assert _Words(stitched) == [
+      (1, 'before', 9.0, 9.5),
+      (1, 'across', 9.8, 10.3),
+      (1, 'after', 10.2, 10.6),
+      (1, 'end', 14.0, 14.5),
+  ]
+  assert [result.alternatives[0].transcript for result in stitched.results] == [
+      'before across', 'after end']
+
+
+def testStitchKeepsChannelsAndOrdersResultsByTime():
+  first = _Response(
+      (2, [('agent', 1.0, 1.5), ('hello', 1.5, 2.0)]),
+      (1, [('customer', 0.5, 1.0)]),
+      (2, [('late', 10.5, 10.9)]))
+  second = _Response(
+      (1, [('bye', 3.0, 3.5)]),
+      (2, [('late', 1.5, 1.9), ('again', 2.0, 2.5)]))
+  stitched = audio_chunking.StitchResponses(_SEGMENTS, [first, second])
+  assert _Words(stitched) == [
+      (1, 'customer', 0.5, 1.0),
+      (2, 'agent', 1.0, 1.5),
+      (2, 'hello', 1.5, 2.0),
+      (2, 'late', 10.5, 10.9),
+      (2, 'again', 11.0, 11.5),
+      (1, 'bye', 12.0, 12.5),
+  ]
+  assert all(result.language_code == 'en-us' for result in stitched.results)
+
+
+def testStitchKeepsWordsAfterTheKeptRangeOfTheLastSegment():
+  segments = [_Segment(0, 0, 10, 11), _Segment(9, 10, 19.5, 20)]
+  stitched = audio_chunking.StitchResponses(
+      segments, [_Response(), _Response((1, [('last', 10.7, 11.0)]))])
+  assert _Words(stitched) == [(1, 'last', 19.7, 20.0)]
+
+
+if __name__ == '__main__':
+  sys.exit(pytest.main([__file__]))
@@ -0,0 +1,225 @@
+# Lint as: python3
+"""Detects the encoding, sample rate and channels of audio files.
+
+The import tool used to transcribe every file with the same `--encoding` and
+`--sample_rate_hertz`, and as two channels. A file that did not match failed
+only when its long running recognize operation finished, minutes later.
+Instead, only the first bytes of every file are read, with a ranged GCS read
+or mmap for local files, and WAV, FLAC and Ogg Opus headers are parsed to
+build the recognition config of each file. Files in formats that
+Speech-to-text cannot decode are rejected before any operation is started.
+"""
+
+import collections
+import json
+import mmap
+import struct
+import threading
+
+import result_cache
+
+# The audio properties that the recognition config depends on. The encoding is
+# one of the names accepted by `--encoding`.
+AudioInfo = collections.namedtuple(
+    'AudioInfo',
+    ['container', 'encoding', 'sample_rate_hertz', 'audio_channel_count'])
+
+# Enough for the headers of the supported formats, including WAV files with
+# metadata chunks before the format chunk and FLAC files with ID3 tags.
+DEFAULT_HEADER_BYTES = 16 * 1024
+
+# Sample rates that Speech-to-text accepts for Ogg Opus.
+_OPUS_SAMPLE_RATES = (8000, 12000, 16000, 24000, 48000)
+_WAVE_FORMAT_PCM = 1
+_WAVE_FORMAT_MULAW = 7
+_WAVE_FORMAT_EXTENSIBLE = 0xFFFE
+# Changes when parsing changes, so that cached results are probed again.
+_PROBE_VERSION = 1
+
+
+class UnsupportedAudioError(ValueError):
+  """Raised for audio in a format that Speech-to-text cannot transcribe."""
+
+
+def _ProbeWav(data):
+  """Parses the format chunk of a RIFF WAVE header."""
+  position = 12
+  while position + 8 <= len(data):
+    chunk_id = data[position:position + 4]
+    chunk_size, = struct.unpack_from('<I', data, position + 4)
+    if chunk_id == b'fmt ':
+      if position + 24 > len(data):
+        return None
+      (audio_format, channels, sample_rate, unused_byte_rate,
+       unused_block_align, bits) = struct.unpack_from('<HHIIHH', data,
+                                                       position + 8)
+      if audio_format == _WAVE_FORMAT_EXTENSIBLE and position + 34 <= len(data):
+        # The format code is the start of the sub-format GUID.
+        audio_format, = struct.unpack_from('<H', data, position + 32)
+      if audio_format == _WAVE_FORMAT_PCM and bits == 16:
+        encoding = 'LINEAR16'
+      elif audio_format == _WAVE_FORMAT_MULAW and bits == 8:
+        encoding = 'MULAW'
+      else:
+        raise UnsupportedAudioError(
+            'WAV format `{}` with `{}` bits per sample is not supported: '
+            'expected 16 bit PCM or 8 bit mu-law.'.format(audio_format, bits))
+      return AudioInfo('WAV', encoding, sample_rate, channels)
+    if chunk_id == b'data':
+      break
+    # Chunks are padded to an even size.
+    position += 8 + chunk_size + (chunk_size & 1)
+  return None
+
+
+def _ProbeFlac(data, position):
+  """Parses the STREAMINFO block that follows the `fLaC` marker."""
+  # The marker and the block header are 4 bytes each, and the fields are 10
+  # bytes into the block.
+  fields = data[position + 18:position + 22]
+  if len(fields) < 4 or data[position + 4] & 0x7F != 0:
+    return None
+  sample_rate = (fields[0] << 12) | (fields[1] << 4) | (fields[2] >> 4)
+  channels = ((fields[2] >> 1) & 0x7) + 1
+  bits = (((fields[2] & 0x1) << 4) | (fields[3] >> 4)) + 1
+  if bits not in (16, 24):
+    raise UnsupportedAudioError(
+        'FLAC with `{}` bits per sample is not supported: expected 16 or '
+        '24.'.format(bits))
+  return AudioInfo('FLAC', 'FLAC', sample_rate, channels)
+
+
+def _ProbeOgg(data):
+  """Parses the codec header in the first page of an Ogg stream."""
+  if len(data) < 27:
+    return None
+  payload = 27 + data[26]
+  if data[payload:payload + 8] == b'OpusHead':
+    if payload + 16 > len(data):
+      return None
+    channels = data[payload + 9]
+    sample_rate, = struct.unpack_from('<I', data, payload + 12)
+    # Opus always decodes at 48 kHz. The header records the original rate.
+    if sample_rate not in _OPUS_SAMPLE_RATES:
+      sample_rate = 48000
+    return AudioInfo('OGG', 'OGG_OPUS', sample_rate, channels)
+  for marker, codec in ((b'\x01vorbis', 'Vorbis'), (b'Speex   ', 'Speex'),
+                        (b'\x7fFLAC', 'FLAC')):
+    if data[payload:payload + len(marker)] == marker:
+      raise UnsupportedAudioError(
+          'Ogg {} is not supported: expected Ogg Opus.'.format(codec))
+  return None
+
+
+def ProbeHeader(data):
+  """Detects the audio properties from the first bytes of a file.
+
+  Args:
+    data: The first bytes of the file, e.g. `DEFAULT_HEADER_BYTES` of them.
+
+  Returns:
+    An `AudioInfo`, or None if the format is not recognized or the header is
+    cut off. Other formats, such as MP3 or AMR, may still be transcribed with
+    an explicit encoding.
+
+  Raises:
+    UnsupportedAudioError: If the file is WAV, FLAC or Ogg, but in an encoding
+      that Speech-to-text does not support.
+  """
+  data = bytes(data)
+  if data[:4] == b'RIFF' and data[8:12] == b'WAVE':
+    return _ProbeWav(data)
+  position = 0
+  if data[:3] == b'ID3' and len(data) >= 10:
+    # Skips an ID3v2 tag, whose size is stored in 7 bits per byte.
+    size = 0
+    for byte in data[6:10]:
+      size = (size << 7) | (byte & 0x7F)
+    position = 10 + size
+  if data[position:position + 4] == b'fLaC':
+    return _ProbeFlac(data, position)
+  if data[:4] == b'OggS':
+    return _ProbeOgg(data)
+  return None
+
+
+def ReadFileHeader(path, header_bytes=DEFAULT_HEADER_BYTES):
+  """Reads the first bytes of a local file through mmap."""
+  with open(path, 'rb') as f:
+    try:
+      with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+        return mapped[:header_bytes]
+    except ValueError:
+      # Empty files cannot be mapped.
+      return b''
+
+
+class Prober(object):
+  """Probes audio files in GCS, or their local copies.
+
+  Results are cached by content hash if a `result_cache.ResultCache` is given.
+  Thread-safe.
+  """
+
+  def __init__(self, get_storage_client, cache=None,
+               header_bytes=DEFAULT_HEADER_BYTES):
+    """Initializes the prober.
+
+    Args:
+      get_storage_client: Returns the `google.cloud.storage.Client` to use in
+        the calling thread.
+      cache: A `result_cache.ResultCache` for results, or None.
+      header_bytes: The number of bytes to read from the start of every file.
+    """
+    self._get_storage_client = get_storage_client
+    self._cache = cache
+    self._header_bytes = header_bytes
+    self._lock = threading.Lock()
+    self.files_read = 0
+    self.bytes_read = 0
+
+  def Probe(self, uri, content_hash=None, local_path=None):
+    """Returns the `AudioInfo` of a file, or None if it is not recognized.
+
+    Args:
+      uri: The `gs://` uri of the file.
+      content_hash: The md5 or crc32c hash of the file, if known.
+      local_path: A local copy of the file, which is read instead of GCS.
+
+    Raises:
+      UnsupportedAudioError: As `ProbeHeader`.
+      google.api_core.exceptions.GoogleAPICallError: If reading from GCS
+        failed.
+    """
+    cache_key = None
+    if self._cache and content_hash:
+      cache_key = result_cache.MakeKey('probe', content_hash,
+                                       [_PROBE_VERSION, self._header_bytes])
+      cached = self._cache.Get('probe', cache_key)
+      if cached is not None:
+        value = json.loads(cached.decode('utf-8'))
+        if 'error' in value:
+          raise UnsupportedAudioError(value['error'])
+        return AudioInfo(**value['info']) if value['info'] else None
+
+    if local_path:
+      data = ReadFileHeader(local_path, self._header_bytes)
+    else:
+      bucket, _, name = uri[len('gs://'):].partition('/')
+      data = self._get_storage_client().bucket(bucket).blob(
+          name).download_as_string(start=0, end=self._header_bytes - 1)
+    with self._lock:
+      self.files_read += 1
+      self.bytes_read += len(data)
+    try:
+      info = ProbeHeader(data)
+    except UnsupportedAudioError as e:
+      if cache_key:
+        self._cache.Put('probe', cache_key,
+                        json.dumps({'error': str(e)}).encode('utf-8'))
+      raise
+    if cache_key:
+      self._cache.Put(
+          'probe', cache_key,
+          json.dumps({'info': info and info._asdict()}).encode('utf-8'))
+    return info
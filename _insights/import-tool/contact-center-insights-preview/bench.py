@@ -0,0 +1,1602 @@
+# Lint as: python3
+"""Benchmarks for import_conversations.py against local fake services.
+
+Example:
+  python3 bench.py transcript_import --num_items 500 --workers 1,4,16
+"""
+
+import _thread
+import argparse
+import contextlib
+import copy
+import io
+import json
+import os
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import audio_probe
+import fake_services
+import import_conversations
+import local_upload
+import metrics
+import pii_filter
+import rate_limiter
+import requests
+import result_cache
+import sharding
+import transcript_writer
+import watch
+
+
+def _ParseInts(value):
+  return [int(v) for v in value.split(',') if v]
+
+
+def _Quiet():
+  """Hides the per-item progress output of the import tool."""
+  return contextlib.redirect_stdout(io.StringIO())
+
+
+def _UseFakeCredentials():
+  """Avoids calls to GCP for credentials and OAuth tokens."""
+  import_conversations._CREDENTIAL_PROVIDERS[None] = (  # pylint: disable=protected-access
+      import_conversations._CredentialProvider(  # pylint: disable=protected-access
+          fake_services.FakeCredentials()))
+
+
+def _BenchTranscriptImport(pargs):
+  """Measures conversation creation throughput by worker count."""
+  _UseFakeCredentials()
+  transcript_uris = [
+      'gs://bench-bucket/transcript-{}.json'.format(i)
+      for i in range(pargs.num_items)
+  ]
+  print('workers  conversations  seconds  conversations/s')
+  with fake_services.FakeInsightsServer(
+      latency_secs=pargs.latency_ms / 1000.0) as fake:
+    for num_workers in pargs.workers:
+      start = time.time()
+      with _Quiet():
+        names = import_conversations._ImportConversationsFromTranscript(  # pylint: disable=protected-access
+            transcript_uris, 'bench-project', 2, fake.endpoint, 'v1', False,
+            None, None, num_workers, pargs.rate)
+      elapsed = time.time() - start
+      print('{:>7}  {:>13}  {:>7.2f}  {:>15.1f}'.format(
+          num_workers, len(names), elapsed, len(names) / elapsed))
+  print('OAuth token refreshes: {}'.format(
+      import_conversations._GetTokenRefreshCount()))  # pylint: disable=protected-access
+
+
+def _TimePerItem(fn, num_items):
+  start = time.time()
+  for _ in range(num_items):
+    fn()
+  return (time.time() - start) / num_items
+
+
+def _BenchClientOverhead(pargs):
+  """Measures per-item client overhead with and without client reuse."""
+  _UseFakeCredentials()
+  clients = import_conversations._CLIENTS  # pylint: disable=protected-access
+  rows = [
+      ('storage client', lambda: import_conversations._BuildStorageClient(  # pylint: disable=protected-access
+          'bench-project', None),
+       lambda: clients.GetStorageClient('bench-project', None)),
+      ('speech client', lambda: import_conversations._BuildSpeechClient(  # pylint: disable=protected-access
+          None, None),
+       lambda: clients.GetSpeechClient(None)),
+      ('dlp client', lambda: import_conversations._BuildDlpClient(  # pylint: disable=protected-access
+          'bench-project', None),
+       lambda: clients.GetDlpClient('bench-project', None)),
+  ]
+
+  with fake_services.FakeInsightsServer() as fake:
+    url = '{}/v1/projects/bench-project/locations/us-central1/conversations'.format(
+        fake.endpoint)
+    body = {'data_source': {'gcs_source': {'transcript_uri': 'gs://b/o'}}}
+    rows.append(('insights request', lambda: requests.post(url, json=body),
+                 lambda: clients.GetInsightsSession().post(url, json=body)))
+
+    print('{:<18}  {:>14}  {:>14}'.format('per item', 'new (ms)',
+                                          'reused (ms)'))
+    for name, build, reuse in rows:
+      new_secs = _TimePerItem(build, pargs.num_items)
+      reused_secs = _TimePerItem(reuse, pargs.num_items)
+      print('{:<18}  {:>14.3f}  {:>14.3f}'.format(name, new_secs * 1000,
+                                                  reused_secs * 1000))
+  print('The fake Insights server uses plain HTTP, so the TLS handshake that '
+        'reuse also saves is not included.')
+
+
+def _PeakRssMb():
+  # ru_maxrss is in KiB on Linux.
+  return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def _UploadTranscriptWithTempFile(transcript_response, bucket,
+                                  transcript_file_name, storage_client):
+  """The upload path used before transcripts were uploaded from memory."""
+  tmp_file = os.path.join(tempfile.gettempdir(),
+                          'tmp-{}-{}'.format(bucket, transcript_file_name))
+  f = open(tmp_file, 'w')
+  f.write(str(transcript_response))
+  f.close()
+  storage_client.bucket(bucket).blob(transcript_file_name).upload_from_filename(
+      tmp_file)
+  os.remove(tmp_file)
+
+
+def _RunTranscriptUpload(pargs):
+  """Uploads one synthetic transcript in this process and prints stats."""
+  response = fake_services.SyntheticTranscriptResponse(pargs.hours * 3600)
+  fake = fake_services.FakeStorageClient(keep_data=False)
+  import_conversations._CLIENTS.SetFactory('storage', lambda *unused: fake)  # pylint: disable=protected-access
+  rss_before = _PeakRssMb()
+  start = time.time()
+  for i in range(pargs.repeats):
+    name = 'transcript-{}.txt'.format(i)
+    if pargs.variant == 'temp_file':
+      _UploadTranscriptWithTempFile(response, 'bench-bucket', name, fake)
+    else:
+      chunk_size = 256 * 1024 if pargs.variant == 'chunked' else None
+      import_conversations._UploadTranscript(  # pylint: disable=protected-access
+          response, 'bench-bucket', name, 'bench-project', None, chunk_size)
+  print(json.dumps({
+      'seconds': (time.time() - start) / pargs.repeats,
+      'bytes': fake.bytes_uploaded // pargs.repeats,
+      'rss_before_mb': rss_before,
+      'rss_peak_mb': _PeakRssMb(),
+  }))
+
+
+def _BenchTranscriptUpload(pargs):
+  """Compares the temp file upload path with uploads from memory."""
+  if pargs.variant:
+    _RunTranscriptUpload(pargs)
+    return
+  print('hours  variant      MiB  ms/upload  peak RSS over baseline (MiB)')
+  for hours in pargs.hours_list:
+    for variant in ('temp_file', 'in_memory', 'chunked'):
+      # Every variant runs in a fresh process, since peak RSS never decreases.
+      output = subprocess.check_output([
+          sys.executable, __file__, 'transcript_upload', '--variant', variant,
+          '--hours', str(hours), '--repeats', str(pargs.repeats)
+      ])
+      stats = json.loads(output.decode('utf-8').splitlines()[-1])
+      print('{:>5}  {:<9}  {:>6.1f}  {:>9.1f}  {:>28.1f}'.format(
+          hours, variant, stats['bytes'] / 1024.0 / 1024.0,
+          stats['seconds'] * 1000,
+          stats['rss_peak_mb'] - stats['rss_before_mb']))
+
+
+def _BenchTranscriptFormat(pargs):
+  """Compares the size and write time of the transcript formats."""
+  print('hours  format     MiB  MiB/hour  seconds/hour')
+  for hours in pargs.hours_list:
+    response = fake_services.SyntheticTranscriptResponse(hours * 3600)
+    variants = [('str', lambda out: out.write(str(response).encode('utf-8')))]
+    for transcript_format in transcript_writer.FORMATS:
+      variants.append(
+          (transcript_format, lambda out, f=transcript_format: transcript_writer
+           .WriteTranscript(response, out, f)))
+    for name, write in variants:
+      start = time.time()
+      for _ in range(pargs.repeats):
+        out = io.BytesIO()
+        write(out)
+      elapsed = (time.time() - start) / pargs.repeats
+      mib = out.tell() / 1024.0 / 1024.0
+      print('{:>5}  {:<7}  {:>6.2f}  {:>8.2f}  {:>12.2f}'.format(
+          hours, name, mib, mib / hours, elapsed / hours))
+
+
+def _BenchAnalyze(pargs):
+  """Measures how long analyzing conversations takes."""
+  _UseFakeCredentials()
+  conversation_names = [
+      'projects/bench-project/locations/us-central1/conversations/{}'.format(i)
+      for i in range(pargs.num_items)
+  ]
+  with fake_services.FakeInsightsServer(
+      latency_secs=pargs.latency_ms / 1000.0,
+      analysis_secs=(pargs.min_analysis_secs, pargs.max_analysis_secs),
+      analysis_failure_rate=pargs.failure_rate) as fake:
+    start = time.time()
+    with _Quiet():
+      results = import_conversations._AnalyzeConversations(  # pylint: disable=protected-access
+          conversation_names, fake.endpoint, 'v1', None, pargs.workers,
+          pargs.rate, pargs.max_wait_secs, poll_initial_secs=0.5,
+          poll_max_secs=pargs.max_analysis_secs / 4.0)
+    elapsed = time.time() - start
+    slowest = max(done_time for done_time, _ in fake.operations.values())
+    polls = fake.request_counts.get('GET operations', 0)
+  states = {}
+  for result in results:
+    states[result.state] = states.get(result.state, 0) + 1
+  print('Analyzed {} conversations in {:.1f}s; the slowest analysis finished '
+        '{:.1f}s after the start.'.format(len(results), elapsed,
+                                          slowest - start))
+  print('Polls: {} ({:.1f} per analysis). Results: {}'.format(
+      polls, polls / float(len(results)), states))
+  print('The sleep-based loop needed at least {}s for the same work.'.format(
+      3 * pargs.num_items + 5))
+
+
+class _Tail(io.TextIOBase):
+  """Keeps only the end of the text written to it, in constant memory."""
+
+  def __init__(self, max_chars=64 * 1024):
+    super(_Tail, self).__init__()
+    self._max_chars = max_chars
+    self._text = ''
+
+  def writable(self):
+    return True
+
+  def write(self, text):
+    self._text = (self._text + text)[-self._max_chars:]
+    return len(text)
+
+  def getvalue(self):
+    return self._text
+
+
+def _BenchPipeline(pargs):
+  """Runs the audio import pipeline end to end against fakes of all services.
+
+  The fakes draw latencies from `--latency_ms`, throttle beyond `--quota` and
+  fail `--error_rate` of the requests, so retries and rate limiters are part of
+  the measurement. Memory stays flat in the fakes and in the output, so the
+  run scales to millions of items.
+  """
+  _UseFakeCredentials()
+  clients = import_conversations._CLIENTS  # pylint: disable=protected-access
+  transcribe_secs = (pargs.min_transcribe_secs, pargs.max_transcribe_secs)
+  faults = dict(error_rate=pargs.error_rate, quota_rate=pargs.quota)
+  speech = fake_services.FakeSpeechClient(
+      transcribe_secs=transcribe_secs, call_secs=pargs.call_secs,
+      latency_secs=pargs.latency_ms, **faults)
+  dlp = fake_services.FakeDlpClient(latency_secs=pargs.latency_ms, **faults)
+  storage = fake_services.FakeStorageClient(
+      keep_data=False, upload_latency_secs=pargs.latency_ms, **faults)
+  clients.SetFactory('speech', lambda *unused: speech)
+  clients.SetFactory('dlp', lambda *unused: dlp)
+  clients.SetFactory('storage', lambda *unused: storage)
+  # Keeps retry backoff in proportion to the fake latencies.
+  import_conversations._RETRY_POLICY.max_secs = 2.0  # pylint: disable=protected-access
+  import_conversations._CREATE_RETRY_POLICY.max_secs = 2.0  # pylint: disable=protected-access
+  audio_uris = ('gs://bench-bucket/audio-{}.flac'.format(i)
+                for i in range(pargs.num_items))
+  limits = import_conversations._PipelineLimits(  # pylint: disable=protected-access
+      transcribe_concurrency=pargs.concurrency,
+      speech_rate=pargs.rate,
+      redact_concurrency=pargs.concurrency,
+      upload_concurrency=pargs.concurrency,
+      create_concurrency=pargs.concurrency,
+      insights_rate=pargs.rate,
+      analyze_concurrency=pargs.concurrency,
+      analysis_rate=pargs.rate,
+      analysis_max_wait_secs=300,
+      poll_initial_secs=0.25,
+      poll_max_secs=2.0)
+
+  with fake_services.FakeInsightsServer(
+      latency_secs=pargs.latency_ms, analysis_secs=transcribe_secs,
+      keep_requests=False, **faults) as fake:
+    output = _Tail()
+    start = time.time()
+    with contextlib.redirect_stdout(output):
+      names, results = import_conversations._ImportConversationsFromAudio(  # pylint: disable=protected-access
+          audio_uris, 'FLAC', 'en-US', 0, 'bench-project', 'bench-bucket',
+          fake.endpoint, 'v1', True, None, None, None, True, limits)
+    elapsed = time.time() - start
+  # The stats table is the last thing the pipeline prints.
+  lines = output.getvalue().splitlines()
+  print('\n'.join(lines[lines.index(
+      next(l for l in lines if l.startswith('stage '))):]))
+  print('Imported and analyzed {} of {} audio files in {:.1f}s ({:.1f}/s), '
+        'peak RSS {:.1f} MiB.'.format(
+            len(results), pargs.num_items, elapsed, len(results) / elapsed,
+            _PeakRssMb()))
+  print('Created {} conversations, uploaded {:.1f} MiB of transcripts.'.format(
+      len(names), storage.bytes_uploaded / 1024.0 / 1024.0))
+  print('Injected errors (throttled): Speech {} ({}), DLP {} ({}), GCS {} ({}), '
+        'Insights {} ({}).'.format(
+            speech.faults.errors, speech.faults.throttled, dlp.faults.errors,
+            dlp.faults.throttled, storage.faults.errors,
+            storage.faults.throttled,
+            sum(v for k, v in fake.request_counts.items()
+                if k.startswith('failed ')),
+            sum(v for k, v in fake.request_counts.items()
+                if k.startswith('throttled '))))
+  print('The sequential loop needed at least {}s to schedule the same '
+        'transcriptions.'.format(2 * pargs.num_items))
+  print(import_conversations._METRICS.FormatSummary())  # pylint: disable=protected-access
+
+
+def _BenchQuota(pargs):
+  """Creates conversations against a fake Insights that enforces a quota."""
+  _UseFakeCredentials()
+  ic = import_conversations
+  transcript_uris = [
+      'gs://bench-bucket/transcript-{}.json'.format(i)
+      for i in range(pargs.num_items)
+  ]
+  get_limiter = ic._GetLimiter  # pylint: disable=protected-access
+  retry_policy = ic._CREATE_RETRY_POLICY  # pylint: disable=protected-access
+  variants = (
+      # The token bucket at a fixed rate, without retries.
+      ('fixed, no retry', pargs.rate, 1, False),
+      ('adaptive', pargs.rate, 5, True),
+  )
+  print('Quota {:.0f}/s, {} workers, starting at {}/s.'.format(
+      pargs.quota, pargs.workers, pargs.rate or 'unlimited '))
+  print('variant          retry-after  created  lost  throttled  seconds  '
+        'conversations/s  lowest rate')
+  for retry_after in (None, pargs.retry_after_secs):
+    for name, rate, max_attempts, adaptive in variants:
+      retry_policy.max_attempts = max_attempts
+      if adaptive:
+        ic._GetLimiter = get_limiter  # pylint: disable=protected-access
+      else:
+        ic._GetLimiter = lambda unused_quota, r: rate_limiter.TokenBucket(r)  # pylint: disable=protected-access
+      ic._LIMITERS.clear()  # pylint: disable=protected-access
+      with fake_services.FakeInsightsServer(
+          latency_secs=pargs.latency_ms / 1000.0, quota_rate=pargs.quota,
+          retry_after_secs=retry_after) as fake:
+        start = time.time()
+        with _Quiet():
+          names = ic._ImportConversationsFromTranscript(  # pylint: disable=protected-access
+              transcript_uris, 'bench-project', 1, fake.endpoint, 'v1', False,
+              None, None, pargs.workers, rate)
+        elapsed = time.time() - start
+      limiter = ic._LIMITERS.get('insights')  # pylint: disable=protected-access
+      print('{:<15}  {:>11}  {:>7}  {:>4}  {:>9}  {:>7.1f}  {:>15.1f}  '
+            '{:>11}'.format(
+                name, retry_after if retry_after is not None else '-',
+                len(names), pargs.num_items - len(names),
+                fake.request_counts.get('throttled conversations', 0),
+                elapsed, len(names) / elapsed,
+                '{:.1f}/s'.format(limiter.min_rate_seen) if limiter else '-'))
+  ic._GetLimiter = get_limiter  # pylint: disable=protected-access
+  retry_policy.max_attempts = 5
+
+
+def _RunShard(pargs):
+  """Imports one shard of the audio files in this process, against fakes.
+
+  Speech, DLP and Storage are faked in the process. Insights is the fake
+  server at `--endpoint`, shared by all shards.
+  """
+  _UseFakeCredentials()
+  clients = import_conversations._CLIENTS  # pylint: disable=protected-access
+  speech = fake_services.FakeSpeechClient(
+      transcribe_secs=(pargs.min_transcribe_secs, pargs.max_transcribe_secs),
+      call_secs=pargs.call_secs, latency_secs=pargs.latency_ms / 1000.0)
+  dlp = fake_services.FakeDlpClient(latency_secs=pargs.latency_ms / 1000.0)
+  storage = fake_services.FakeStorageClient(keep_data=False)
+  clients.SetFactory('speech', lambda *unused: speech)
+  clients.SetFactory('dlp', lambda *unused: dlp)
+  clients.SetFactory('storage', lambda *unused: storage)
+  audio_uris = sharding.FilterShard(
+      ('gs://bench-bucket/audio-{}.flac'.format(i)
+       for i in range(pargs.num_items)), pargs.num_shards, pargs.shard_index)
+  limits = import_conversations._PipelineLimits(  # pylint: disable=protected-access
+      transcribe_concurrency=pargs.concurrency,
+      speech_rate=pargs.rate,
+      redact_concurrency=pargs.concurrency,
+      upload_concurrency=pargs.concurrency,
+      create_concurrency=pargs.concurrency,
+      insights_rate=pargs.rate,
+      analyze_concurrency=pargs.concurrency,
+      analysis_rate=pargs.rate,
+      analysis_max_wait_secs=300,
+      poll_initial_secs=0.25,
+      poll_max_secs=2.0)
+  with _Quiet():
+    names, results = import_conversations._ImportConversationsFromAudio(  # pylint: disable=protected-access
+        audio_uris, 'FLAC', 'en-US', 0, 'bench-project', 'bench-bucket',
+        pargs.endpoint, 'v1', True, None, None, None, True, limits)
+  sharding.WriteResults(
+      sharding.GetShardPath(pargs.results_file, pargs.shard_index,
+                            pargs.num_shards), pargs.shard_index,
+      pargs.num_shards, names, results,
+      import_conversations._METRICS.Summary())  # pylint: disable=protected-access
+
+
+def _BenchShards(pargs):
+  """Measures how imports scale with the number of shard processes."""
+  if pargs.endpoint:
+    _RunShard(pargs)
+    return
+  results_dir = tempfile.mkdtemp(prefix='bench-shards-')
+  print('Importing {} audio files, concurrency {} per process, on {} '
+        'CPUs.'.format(pargs.num_items, pargs.concurrency, os.cpu_count()))
+  print('processes  conversations  duplicates  missing  seconds  '
+        'conversations/s  speedup')
+  base_rate = None
+  for num_shards in pargs.processes:
+    with fake_services.FakeInsightsServer(
+        latency_secs=pargs.latency_ms / 1000.0,
+        analysis_secs=(pargs.min_transcribe_secs,
+                       pargs.max_transcribe_secs)) as fake:
+      results_file = os.path.join(results_dir,
+                                  'results-{}.json'.format(num_shards))
+      argv = [
+          __file__, 'shards', '--endpoint', fake.endpoint, '--results_file',
+          results_file, '--num_items', str(pargs.num_items), '--concurrency',
+          str(pargs.concurrency), '--rate', str(pargs.rate), '--latency_ms',
+          str(pargs.latency_ms),
+          '--min_transcribe_secs', str(pargs.min_transcribe_secs),
+          '--max_transcribe_secs', str(pargs.max_transcribe_secs),
+          '--call_secs', str(pargs.call_secs)
+      ]
+      start = time.time()
+      with _Quiet():
+        exit_codes = sharding.LaunchLocal(argv, num_shards, '--processes')
+      elapsed = time.time() - start
+      if any(exit_codes):
+        print('Error: shards exited with {}.'.format(exit_codes))
+        continue
+      merged = sharding.MergeResults([
+          sharding.GetShardPath(results_file, i, num_shards)
+          for i in range(num_shards)
+      ])
+      sources = [
+          json.dumps(request, sort_keys=True)
+          for request in fake.conversations.values()
+      ]
+    created = len(merged['conversation_names'])
+    rate = created / elapsed
+    base_rate = base_rate or rate
+    print('{:>9}  {:>13}  {:>10}  {:>7}  {:>7.1f}  {:>15.1f}  {:>6.2f}x'.format(
+        num_shards, created, len(sources) - len(set(sources)),
+        pargs.num_items - created, elapsed, rate, rate / base_rate))
+
+
+def _BenchBulk(pargs):
+  """Compares per-conversation requests with bulk ingest and bulk analyze."""
+  _UseFakeCredentials()
+  ic = import_conversations
+  transcript_uris = [
+      'gs://bench-bucket/chats/transcript-{:06d}.json'.format(i)
+      for i in range(pargs.num_items)
+  ]
+
+  def _IngestSources(gcs_uri):
+    return [uri for uri in transcript_uris if uri.startswith(gcs_uri)]
+
+  def _PerItem(fake):
+    names = ic._ImportConversationsFromTranscript(  # pylint: disable=protected-access
+        transcript_uris, 'bench-project', 2, fake.endpoint, 'v1', False, None,
+        None, pargs.workers, pargs.rate)
+    return names, ic._AnalyzeConversations(  # pylint: disable=protected-access
+        names, fake.endpoint, 'v1', None, pargs.workers, pargs.rate,
+        poll_initial_secs=0.5, poll_max_secs=2.0)
+
+  def _Bulk(fake):
+    return ic._ImportConversationsInBulk(  # pylint: disable=protected-access
+        'gs://bench-bucket/chats/', 'bench-project', 2, fake.endpoint, 'v1',
+        None, None, poll_initial_secs=0.5, poll_max_secs=2.0)
+
+  print('{} chat transcripts, {} workers at {}/s for per-conversation '
+        'requests.'.format(pargs.num_items, pargs.workers, pargs.rate))
+  print('mode          conversations  succeeded  requests  seconds')
+  for name, run in (('per item', _PerItem), ('bulk', _Bulk)):
+    ic._LIMITERS.clear()  # pylint: disable=protected-access
+    with fake_services.FakeInsightsServer(
+        latency_secs=pargs.latency_ms / 1000.0,
+        analysis_secs=(pargs.min_analysis_secs, pargs.max_analysis_secs),
+        analysis_failure_rate=pargs.failure_rate,
+        ingest_sources=_IngestSources,
+        bulk_secs_per_item=pargs.bulk_ms_per_item / 1000.0) as fake:
+      start = time.time()
+      with _Quiet():
+        names, results = run(fake)
+      elapsed = time.time() - start
+    print('{:<12}  {:>13}  {:>9}  {:>8}  {:>7.1f}'.format(
+        name, len(names),
+        sum(1 for result in results
+            if result.state == ic._ANALYSIS_SUCCEEDED),  # pylint: disable=protected-access
+        sum(count for kind, count in fake.request_counts.items()
+            if not kind.startswith(('throttled ', 'failed '))), elapsed))
+
+
+def _BenchMetrics(pargs):
+  """Measures the cost of recording a call in the metrics."""
+  registry = metrics.Registry()
+
+  def _Calls(num_calls):
+    for _ in range(num_calls):
+      with registry.Call('bench', 'noop') as call:
+        call.AddBytes(100, 100)
+
+  def _Loop(num_calls):
+    for _ in range(num_calls):
+      pass
+
+  print('threads  ns/call  calls/s')
+  for num_threads in pargs.threads:
+    per_thread = pargs.num_calls // num_threads
+    elapsed = {}
+    for name, fn in (('loop', _Loop), ('call', _Calls)):
+      threads = [
+          threading.Thread(target=fn, args=(per_thread,))
+          for _ in range(num_threads)
+      ]
+      start = time.perf_counter()
+      for thread in threads:
+        thread.start()
+      for thread in threads:
+        thread.join()
+      elapsed[name] = time.perf_counter() - start
+    num_calls = per_thread * num_threads
+    print('{:>7}  {:>7.0f}  {:>7.0f}'.format(
+        num_threads, (elapsed['call'] - elapsed['loop']) / num_calls * 1e9,
+        num_calls / elapsed['call']))
+  exporter = metrics.Exporter(registry, port=0)
+  try:
+    start = time.perf_counter()
+    for _ in range(100):
+      requests.get('http://localhost:{}/metrics'.format(exporter.port))
+    print('Scrape: {:.2f} ms.'.format(
+        (time.perf_counter() - start) / 100 * 1000))
+  finally:
+    exporter.Close()
+
+
+def _GetGcsUrisAsList(storage_client, bucket):
+  """The listing used before uris were yielded as pages arrive."""
+  uris = []
+  for blob in storage_client.list_blobs(bucket):
+    if not blob.name.endswith('/'):
+      uris.append('gs://{}/{}'.format(bucket, blob.name))
+  return uris
+
+
+def _RunListing(pargs):
+  """Lists a fake bucket in this process and prints stats."""
+  fake = fake_services.FakeStorageClient(
+      list_latency_secs=pargs.page_latency_ms / 1000.0)
+  fake.AddSyntheticObjects('bench-bucket', pargs.num_objects,
+                           'calls/call-{:08d}.wav')
+  import_conversations._CLIENTS.SetFactory('storage', lambda *unused: fake)  # pylint: disable=protected-access
+  rss_before = _PeakRssMb()
+  start = time.time()
+  first_item_secs = None
+  num_items = 0
+  if pargs.variant == 'list':
+    uris = _GetGcsUrisAsList(fake, 'bench-bucket')
+    first_item_secs = time.time() - start
+    num_items = len(uris)
+  else:
+    max_items = pargs.max_items if pargs.variant == 'max_items' else None
+    start_offset = None
+    if pargs.variant == 'start_offset':
+      start_offset = 'calls/call-{:08d}'.format(pargs.num_objects // 2)
+    for _ in import_conversations._GetGcsUris(  # pylint: disable=protected-access
+        'bench-bucket', 'bench-project', None, start_offset=start_offset,
+        max_items=max_items):
+      if first_item_secs is None:
+        first_item_secs = time.time() - start
+      num_items += 1
+  print(json.dumps({
+      'items': num_items,
+      'first_item_secs': first_item_secs,
+      'seconds': time.time() - start,
+      'rss_peak_mb': _PeakRssMb() - rss_before,
+  }))
+
+
+def _BenchListing(pargs):
+  """Compares listing a bucket into a list with streaming the listing."""
+  if pargs.variant:
+    _RunListing(pargs)
+    return
+  print('variant         items  first item (s)  total (s)  '
+        'peak RSS over baseline (MiB)')
+  for variant in ('list', 'stream', 'start_offset', 'max_items'):
+    # Every variant runs in a fresh process, since peak RSS never decreases.
+    output = subprocess.check_output([
+        sys.executable, __file__, 'listing', '--variant', variant,
+        '--num_objects', str(pargs.num_objects), '--page_latency_ms',
+        str(pargs.page_latency_ms), '--max_items', str(pargs.max_items)
+    ])
+    stats = json.loads(output.decode('utf-8').splitlines()[-1])
+    print('{:<12}  {:>8}  {:>14.3f}  {:>9.1f}  {:>28.1f}'.format(
+        variant, stats['items'], stats['first_item_secs'], stats['seconds'],
+        stats['rss_peak_mb']))
+
+
+class _CrashingStorageClient(fake_services.FakeStorageClient):
+  """Interrupts the import like Ctrl-C after a number of uploads."""
+
+  def __init__(self, crash_after):
+    super(_CrashingStorageClient, self).__init__(keep_data=False)
+    self._crash_after = crash_after
+
+  def Store(self, *args):
+    super(_CrashingStorageClient, self).Store(*args)
+    if len(self.objects) == self._crash_after:
+      _thread.interrupt_main()
+
+
+def _BenchResume(pargs):
+  """Interrupts an audio import halfway, then resumes it from the checkpoint."""
+  _UseFakeCredentials()
+  clients = import_conversations._CLIENTS  # pylint: disable=protected-access
+  speech = fake_services.FakeSpeechClient(transcribe_secs=(0.2, 1.0))
+  dlp = fake_services.FakeDlpClient()
+  clients.SetFactory('speech', lambda *unused: speech)
+  clients.SetFactory('dlp', lambda *unused: dlp)
+  audio_uris = [
+      'gs://bench-bucket/audio-{}.flac'.format(i) for i in range(pargs.num_items)
+  ]
+  limits = import_conversations._PipelineLimits(  # pylint: disable=protected-access
+      speech_rate=0, insights_rate=0, analysis_rate=0, poll_initial_secs=0.2,
+      poll_max_secs=1.0)
+  db_path = os.path.join(tempfile.mkdtemp(), 'checkpoint.db')
+
+  with fake_services.FakeInsightsServer(analysis_secs=(0.2, 1.0)) as fake:
+
+    def _Import(resume, storage):
+      clients.SetFactory('storage', lambda *unused: storage)
+      checkpoint = import_conversations.checkpoint_lib.Checkpoint(
+          db_path, resume)
+      start = time.time()
+      try:
+        with _Quiet():
+          import_conversations._ImportConversationsFromAudio(  # pylint: disable=protected-access
+              audio_uris, 'FLAC', 'en-US', 0, 'bench-project', 'bench-bucket',
+              fake.endpoint, 'v1', True, None, None, None, True, limits,
+              checkpoint)
+      except KeyboardInterrupt:
+        print('Interrupted after {:.1f}s.'.format(time.time() - start))
+      else:
+        print('Finished after {:.1f}s.'.format(time.time() - start))
+      checkpoint.Close()
+      with import_conversations.checkpoint_lib.Checkpoint(
+          db_path, resume=True) as reader:
+        print('  checkpoint: {}'.format(reader.CountByState()))
+      print('  transcriptions: {}, conversations: {}, analyses: {}'.format(
+          speech.requests, len(fake.conversations),
+          fake.request_counts.get('POST analyses', 0)))
+
+    _Import(False, _CrashingStorageClient(pargs.num_items // 2))
+    _Import(True, fake_services.FakeStorageClient(keep_data=False))
+  print('Restarting without the checkpoint would have transcribed, created '
+        'and analyzed all {} files again.'.format(pargs.num_items))
+
+
+def _BenchCache(pargs):
+  """Imports the same audio files twice, with a cold and a warm cache."""
+  _UseFakeCredentials()
+  clients = import_conversations._CLIENTS  # pylint: disable=protected-access
+  speech = fake_services.FakeSpeechClient(
+      transcribe_secs=(pargs.min_transcribe_secs, pargs.max_transcribe_secs),
+      call_secs=pargs.call_secs)
+  dlp = fake_services.FakeDlpClient(latency_secs=0.2)
+  storage = fake_services.FakeStorageClient(keep_data=False)
+  storage.AddSyntheticObjects('bench-audio', pargs.num_items,
+                              'audio-{:06d}.flac')
+  clients.SetFactory('speech', lambda *unused: speech)
+  clients.SetFactory('dlp', lambda *unused: dlp)
+  clients.SetFactory('storage', lambda *unused: storage)
+  limits = import_conversations._PipelineLimits(  # pylint: disable=protected-access
+      speech_rate=0, insights_rate=0, analysis_rate=0, poll_initial_secs=0.2,
+      poll_max_secs=1.0)
+  cache_dir = tempfile.mkdtemp()
+
+  print('run   agent    seconds  transcriptions  dlp requests  hit rates')
+  with fake_services.FakeInsightsServer(analysis_secs=0.2) as fake:
+    for run, agent_id in enumerate(('agent-1', 'agent-2'), 1):
+      cache = import_conversations.result_cache.ResultCache(
+          [import_conversations.result_cache.DiskCache(cache_dir, 1024**3)])
+      speech_before, dlp_before = speech.requests, dlp.requests
+      start = time.time()
+      with _Quiet():
+        import_conversations._ImportConversationsFromAudio(  # pylint: disable=protected-access
+            import_conversations._GetGcsObjects(  # pylint: disable=protected-access
+                'bench-audio', 'bench-project', None),
+            'FLAC', 'en-US', 0, 'bench-project', 'bench-bucket', fake.endpoint,
+            'v1', True, agent_id, None, None, True, limits, None, cache)
+      stats = cache.GetStats()
+      print('{:>3}  {:<7}  {:>7.1f}  {:>14}  {:>12}  {}'.format(
+          run, agent_id, time.time() - start, speech.requests - speech_before,
+          dlp.requests - dlp_before, ', '.join(
+              '{} {:.0%}'.format(namespace, hits / float(hits + misses))
+              for namespace, (hits, misses) in sorted(stats.items()))))
+
+
+def _RedactWholeResponse(transcript_response, project_id):
+  """The redaction used before only transcripts were sent to DLP."""
+  dlp = import_conversations._CLIENTS.GetDlpClient(project_id, None)  # pylint: disable=protected-access
+  inspect_config, deidentify_config = (
+      import_conversations._GetRedactionConfigs())  # pylint: disable=protected-access
+  response = dlp.deidentify_content(
+      dlp.project_path(project_id),
+      inspect_config=inspect_config,
+      deidentify_config=deidentify_config,
+      item={'value': str(transcript_response)})
+  return response.item.value
+
+
+def _SyntheticTranscriptWithPii(call_secs, seed, pii_rate=0.02):
+  """Returns a synthetic transcript where some words are emails or phones."""
+  response = fake_services.SyntheticTranscriptResponse(call_secs, seed=seed)
+  rng = random.Random(seed)
+  for result in response.results:
+    alternative = result.alternatives[0]
+    for word in alternative.words:
+      if rng.random() < pii_rate:
+        word.word = rng.choice(('jane.doe@example.com', '555-867-5309'))
+    alternative.transcript = ' '.join(word.word for word in alternative.words)
+  return response
+
+
+def _BenchRedaction(pargs):
+  """Compares whole-response redaction with batched transcript redaction."""
+  dlp = fake_services.FakeDlpClient(
+      latency_secs=pargs.latency_ms / 1000.0,
+      bytes_per_sec=pargs.dlp_mb_per_sec * 1024 * 1024)
+  import_conversations._CLIENTS.SetFactory('dlp', lambda *unused: dlp)  # pylint: disable=protected-access
+  responses = [
+      _SyntheticTranscriptWithPii(pargs.call_secs, seed)
+      for seed in range(pargs.num_items)
+  ]
+  variants = (
+      ('whole_response', lambda r: _RedactWholeResponse(r, 'bench-project')),
+      ('batched', lambda r: import_conversations._Redact(  # pylint: disable=protected-access
+          r, 'bench-project', None)),
+  )
+  print('variant         requests  MiB sent  seconds  conversations/s')
+  for name, redact in variants:
+    # Batched redaction changes the responses in place.
+    inputs = [copy.deepcopy(response) for response in responses]
+    requests_before, bytes_before = dlp.requests, dlp.bytes_inspected
+    start = time.time()
+    redacted = dict(
+        import_conversations._RunConcurrently(  # pylint: disable=protected-access
+            lambda item: (item[0], redact(item[1])), enumerate(inputs),
+            pargs.workers))
+    elapsed = time.time() - start
+    print('{:<14}  {:>8}  {:>8.2f}  {:>7.2f}  {:>15.1f}'.format(
+        name, dlp.requests - requests_before,
+        (dlp.bytes_inspected - bytes_before) / 1024.0 / 1024.0, elapsed,
+        len(responses) / elapsed))
+
+  masked_words = 0
+  for i, original in enumerate(responses):
+    for result, original_result in zip(redacted[i].results, original.results):
+      words = result.alternatives[0].words
+      original_words = original_result.alternatives[0].words
+      assert len(words) == len(original_words)
+      for word, original_word in zip(words, original_words):
+        assert word.start_time == original_word.start_time
+        assert word.end_time == original_word.end_time
+        assert '@' not in word.word and '867' not in word.word
+        masked_words += word.word != original_word.word
+  print('Batched redaction kept every word time offset and masked {} PII '
+        'words.'.format(masked_words))
+
+
+def _BenchPii(pargs):
+  """Measures local PII scanning, and the DLP requests that it avoids."""
+  responses = [
+      _SyntheticTranscriptWithPii(pargs.call_secs, seed, pargs.pii_rate)
+      for seed in range(pargs.num_items)
+  ]
+  texts = [
+      alternative.transcript
+      for response in responses
+      for result in response.results
+      for alternative in result.alternatives
+  ]
+  mb = sum(len(text) for text in texts) / 1024.0 / 1024.0
+  print('Scanning {:.1f} MB in {} utterances on {} CPUs.'.format(
+      mb, len(texts), os.cpu_count()))
+  print('processes  in use  seconds    MB/s  utterances with candidates')
+  for processes in pargs.processes:
+    scanner = pii_filter.Scanner(processes)
+    # Starts the worker processes before timing.
+    scanner.FindAll(texts)
+    start = time.time()
+    matches = scanner.FindAll(texts)
+    elapsed = time.time() - start
+    scanner.Close()
+    print('{:>9}  {:>6}  {:>7.2f}  {:>6.1f}  {:>26}'.format(
+        processes, scanner.processes, elapsed, mb / elapsed,
+        sum(1 for m in matches if m)))
+  # One conversation at a time, as the import tool scans them.
+  scanner = pii_filter.Scanner(max(pargs.processes))
+  start = time.time()
+  for response in responses:
+    scanner.FindAll([
+        result.alternatives[0].transcript for result in response.results])
+  elapsed = time.time() - start
+  scanner.Close()
+  print('Per conversation, {} processes: {:.2f}s, {:.1f} MB/s.'.format(
+      scanner.processes, elapsed, mb / elapsed))
+
+  dlp = fake_services.FakeDlpClient(
+      latency_secs=pargs.latency_ms / 1000.0,
+      bytes_per_sec=pargs.dlp_mb_per_sec * 1024 * 1024)
+  import_conversations._CLIENTS.SetFactory('dlp', lambda *unused: dlp)  # pylint: disable=protected-access
+  print('Requests and MiB avoided are compared with the `dlp` mode, which has '
+        'no prefilter.')
+  print('mode       requests  avoided  MiB sent  avoided  seconds  '
+        'conversations/s')
+  baseline = None
+  for mode in ('dlp', 'prefilter', 'local'):
+    scanner = pii_filter.Scanner(1)
+    inputs = [copy.deepcopy(response) for response in responses]
+    requests_before, bytes_before = dlp.requests, dlp.bytes_inspected
+    start = time.time()
+    redacted = list(
+        import_conversations._RunConcurrently(  # pylint: disable=protected-access
+            lambda r: import_conversations._Redact(  # pylint: disable=protected-access
+                r, 'bench-project', None, pii_scanner=scanner,
+                redact_mode=mode), inputs, pargs.workers))
+    elapsed = time.time() - start
+    for response in redacted:
+      for result in response.results:
+        transcript = result.alternatives[0].transcript
+        assert '@' not in transcript and '867' not in transcript
+    sent = (dlp.requests - requests_before,
+            (dlp.bytes_inspected - bytes_before) / 1024.0 / 1024.0)
+    baseline = baseline or sent
+    print('{:<9}  {:>8}  {:>7}  {:>8.2f}  {:>7.2f}  {:>7.2f}  {:>15.1f}'.format(
+        mode, sent[0], baseline[0] - sent[0], sent[1], baseline[1] - sent[1],
+        elapsed, len(responses) / elapsed))
+    if mode != 'dlp':
+      print(scanner.FormatStats(mode == 'prefilter'))
+
+
+# Audio formats of the probe benchmark, as `SyntheticAudioFile` arguments.
+_PROBE_FORMATS = (
+    ('WAV', {}),
+    ('WAV_MULAW', {'bits_per_sample': 8}),
+    ('FLAC', {'sample_rate_hertz': 16000, 'channels': 1}),
+    ('OGG_OPUS', {'sample_rate_hertz': 48000}),
+    ('OGG_VORBIS', {}),
+    ('MP3', {}),
+)
+
+
+def _ProbeAll(prober, objects, concurrency):
+  """Probes objects and returns the count of every detected encoding."""
+
+  def _Probe(gcs_object):
+    try:
+      info = prober.Probe(gcs_object.uri, gcs_object.md5_hash)
+    except audio_probe.UnsupportedAudioError:
+      return 'unsupported'
+    return info.encoding if info else 'unrecognized'
+
+  counts = {}
+  for encoding in import_conversations._RunConcurrently(  # pylint: disable=protected-access
+      _Probe, objects, concurrency):
+    counts[encoding] = counts.get(encoding, 0) + 1
+  return counts
+
+
+def _BenchProbe(pargs):
+  """Measures audio header probing in GCS, with and without a cache."""
+  storage = fake_services.FakeStorageClient(
+      download_latency_secs=pargs.latency_ms / 1000.0)
+  files = [
+      fake_services.SyntheticAudioFile(
+          container, size=pargs.file_kb * 1024, **kwargs)
+      for container, kwargs in _PROBE_FORMATS
+  ]
+  objects = []
+  for i in range(pargs.num_items):
+    name = 'call-{:06d}'.format(i)
+    # Objects share the bytes of their format, to keep memory flat.
+    storage.Store('bench-audio', name, files[i % len(files)],
+                  pargs.file_kb * 1024, name)
+    objects.append(
+        import_conversations.gcs_listing.GcsObject(
+            'gs://bench-audio/' + name, name, pargs.file_kb * 1024, name, None,
+            None, None))
+  total_mib = pargs.num_items * pargs.file_kb / 1024.0
+
+  print('{} objects of {} KiB, {} ms per read.'.format(
+      pargs.num_items, pargs.file_kb, pargs.latency_ms))
+  print('concurrency  cache  seconds  files/s  MiB read  of MiB')
+  cache = result_cache.ResultCache(
+      [result_cache.DiskCache(tempfile.mkdtemp(), 1024**3)])
+  runs = [(concurrency, None) for concurrency in pargs.concurrency]
+  runs += [(pargs.concurrency[-1], cache)] * 2
+  for concurrency, run_cache in runs:
+    prober = audio_probe.Prober(lambda: storage, run_cache)
+    bytes_before = storage.bytes_downloaded
+    start = time.time()
+    counts = _ProbeAll(prober, objects, concurrency)
+    elapsed = time.time() - start
+    print('{:>11}  {:<5}  {:>7.2f}  {:>7.0f}  {:>8.1f}  {:>6.0f}'.format(
+        concurrency, 'yes' if run_cache else 'no', elapsed,
+        pargs.num_items / elapsed,
+        (storage.bytes_downloaded - bytes_before) / 1024.0 / 1024.0,
+        total_mib))
+  print('Detected: {}'.format(', '.join(
+      '{} {}'.format(encoding, count)
+      for encoding, count in sorted(counts.items()))))
+
+  directory = tempfile.mkdtemp()
+  paths = []
+  for i in range(min(pargs.num_items, 1000)):
+    path = os.path.join(directory, 'call-{:06d}'.format(i))
+    with open(path, 'wb') as f:
+      f.write(files[i % len(files)])
+    paths.append(path)
+  start = time.time()
+  for path in paths:
+    try:
+      audio_probe.ProbeHeader(audio_probe.ReadFileHeader(path))
+    except audio_probe.UnsupportedAudioError:
+      pass
+  elapsed = time.time() - start
+  print('Local files through mmap: {:.0f} files/s.'.format(
+      len(paths) / elapsed))
+
+
+def _MakeLocalAudioDir(pargs):
+  """Writes small and large synthetic recordings to a temporary directory."""
+  directory = tempfile.mkdtemp()
+  os.makedirs(os.path.join(directory, 'calls'))
+  sizes = ([pargs.file_mb] * pargs.num_files +
+           [pargs.large_file_mb] * pargs.num_large_files)
+  for i, size_mb in enumerate(sizes):
+    with open(os.path.join(directory, 'calls', 'call-{:05d}.wav'.format(i)),
+              'wb') as f:
+      f.write(
+          fake_services.SyntheticAudioFile('WAV', size=size_mb * 1024 * 1024))
+  return directory
+
+
+def _GetUploadClient(pargs):
+  """Returns a function that returns the storage client of a thread."""
+  if not pargs.emulator_host:
+    fake = fake_services.FakeStorageClient(
+        keep_data=False,
+        upload_bytes_per_sec=pargs.stream_mb_per_sec * 1024 * 1024)
+    return lambda: fake
+  # Imported here, since the storage library reads the emulator host when
+  # it is imported.
+  import google.auth.credentials  # pylint: disable=g-import-not-at-top
+  from google.cloud import storage  # pylint: disable=g-import-not-at-top
+  local = threading.local()
+
+  def _GetClient():
+    if not hasattr(local, 'client'):
+      local.client = storage.Client(
+          project='bench-project',
+          credentials=google.auth.credentials.AnonymousCredentials())
+    return local.client
+
+  return _GetClient
+
+
+def _RunLocalUpload(pargs):
+  """Uploads the local directory once in this process and prints stats."""
+  get_client = _GetUploadClient(pargs)
+  files = list(local_upload.ListLocalFiles(pargs.directory))
+  start = time.time()
+  if pargs.variant == 'sequential':
+    for local_file in files:
+      get_client().bucket(pargs.bucket).blob(
+          local_file.name).upload_from_filename(local_file.path)
+  else:
+    uploader = local_upload.Uploader(
+        get_client, pargs.bucket, prefix=pargs.variant + '/',
+        composite_threshold=(pargs.composite_threshold_mb * 1024 * 1024
+                             if pargs.variant == 'composite' else 0),
+        part_size=pargs.part_mb * 1024 * 1024,
+        part_workers=pargs.concurrency)
+    list(
+        import_conversations._RunConcurrently(  # pylint: disable=protected-access
+            uploader.Upload, files, pargs.concurrency))
+    uploader.Close()
+  print(json.dumps({
+      'seconds': time.time() - start,
+      'bytes': sum(local_file.size for local_file in files),
+  }))
+
+
+def _TimeFirstTranscription(pargs, directory):
+  """Imports the local directory against fakes.
+
+  Returns:
+    The seconds until the first transcription was requested and until the
+    last upload completed.
+  """
+  _UseFakeCredentials()
+  storage = fake_services.FakeStorageClient(
+      keep_data=False,
+      upload_bytes_per_sec=pargs.stream_mb_per_sec * 1024 * 1024)
+  speech = fake_services.FakeSpeechClient(transcribe_secs=(0.1, 0.2),
+                                          call_secs=60)
+  request_times = []
+  recognize = speech.long_running_recognize
+
+  def _Recognize(*args, **kwargs):
+    request_times.append(time.time())
+    return recognize(*args, **kwargs)
+
+  speech.long_running_recognize = _Recognize
+  clients = import_conversations._CLIENTS  # pylint: disable=protected-access
+  clients.SetFactory('storage', lambda *unused: storage)
+  clients.SetFactory('speech', lambda *unused: speech)
+  uploader = local_upload.Uploader(
+      lambda: storage, 'bench-bucket',
+      composite_threshold=pargs.composite_threshold_mb * 1024 * 1024,
+      part_size=pargs.part_mb * 1024 * 1024, part_workers=pargs.concurrency)
+  upload = uploader.Upload
+  upload_times = []
+
+  def _Upload(local_file):
+    result = upload(local_file)
+    upload_times.append(time.time())
+    return result
+
+  uploader.Upload = _Upload
+  limits = import_conversations._PipelineLimits(  # pylint: disable=protected-access
+      speech_rate=1000, insights_rate=1000, poll_initial_secs=0.05,
+      poll_max_secs=0.1, audio_upload_concurrency=pargs.concurrency)
+  with fake_services.FakeInsightsServer() as fake, _Quiet():
+    start = time.time()
+    import_conversations._ImportConversationsFromAudio(  # pylint: disable=protected-access
+        local_upload.ListLocalFiles(directory), 'LINEAR16', 'en-US', 0,
+        'bench-project', 'bench-bucket', fake.endpoint, 'v1', False, None,
+        None, None, False, limits, uploader=uploader)
+  uploader.Close()
+  return min(request_times) - start, max(upload_times) - start
+
+
+def _BenchLocalUpload(pargs):
+  """Compares sequential uploads of a local directory with parallel ones."""
+  if pargs.variant:
+    _RunLocalUpload(pargs)
+    return
+  directory = _MakeLocalAudioDir(pargs)
+  total_mib = (pargs.num_files * pargs.file_mb +
+               pargs.num_large_files * pargs.large_file_mb)
+  env = dict(os.environ)
+  if pargs.emulator_host:
+    env['STORAGE_EMULATOR_HOST'] = pargs.emulator_host
+    target = 'the GCS emulator at {}'.format(pargs.emulator_host)
+  else:
+    target = 'the fake GCS, at {} MiB/s per upload stream'.format(
+        pargs.stream_mb_per_sec)
+  print('Uploading {} MiB in {} files to {}.'.format(
+      total_mib, pargs.num_files + pargs.num_large_files, target))
+  print('variant     seconds   MiB/s')
+  for variant in ('sequential', 'parallel', 'composite'):
+    # Every variant runs in a fresh process, with a fresh storage client.
+    output = subprocess.check_output([
+        sys.executable, __file__, 'local_upload', '--variant', variant,
+        '--directory', directory, '--bucket', pargs.bucket, '--concurrency',
+        str(pargs.concurrency), '--composite_threshold_mb',
+        str(pargs.composite_threshold_mb), '--part_mb', str(pargs.part_mb),
+        '--stream_mb_per_sec', str(pargs.stream_mb_per_sec)
+    ] + (['--emulator_host', pargs.emulator_host]
+         if pargs.emulator_host else []), env=env)
+    stats = json.loads(output.decode('utf-8').splitlines()[-1])
+    print('{:<10}  {:>7.2f}  {:>6.1f}'.format(
+        variant, stats['seconds'],
+        stats['bytes'] / 1024.0 / 1024.0 / stats['seconds']))
+
+  first_secs, last_upload_secs = _TimeFirstTranscription(pargs, directory)
+  print('In the import pipeline, the first transcription started after '
+        '{:.2f}s, and the last upload finished after {:.2f}s.'.format(
+            first_secs, last_upload_secs))
+
+
+def _CheckStitched(response, duration_secs):
+  """Returns the words, the words out of order and the longest gap in secs."""
+  starts = [
+      word.start_time.seconds + word.start_time.nanos / 1e9
+      for result in response.results
+      for word in result.alternatives[0].words
+  ]
+  out_of_order = sum(1 for a, b in zip(starts, starts[1:]) if b < a)
+  gap = max(b - a for a, b in zip([0.0] + starts, starts + [duration_secs]))
+  return len(starts), out_of_order, gap
+
+
+def _BenchChunking(pargs):
+  """Compares transcribing long recordings whole and in parallel segments."""
+  _UseFakeCredentials()
+  directory = tempfile.mkdtemp()
+  duration_secs = pargs.minutes * 60
+  print('{} minute recordings, transcribed at {} times real time.'.format(
+      pargs.minutes, pargs.realtime_factor))
+  print('container  segments  plan secs  mode       seconds  words  '
+        'out of order  max gap secs')
+  for container in pargs.containers.split(','):
+    path = os.path.join(directory, 'call.' + container.lower())
+    fake_services.WriteSyntheticCall(path, container, duration_secs)
+    start = time.time()
+    segments = import_conversations.audio_chunking.PlanSegments(
+        path, pargs.segment_secs, pargs.overlap_secs)
+    plan_secs = time.time() - start
+    for segment_secs in (0, pargs.segment_secs):
+      storage = fake_services.FakeStorageClient(keep_data=False)
+      speech = fake_services.FakeSpeechClient(
+          realtime_factor=pargs.realtime_factor,
+          audio_secs=lambda unused_uri: duration_secs)
+      clients = import_conversations._CLIENTS  # pylint: disable=protected-access
+      clients.SetFactory('storage', lambda *unused: storage)
+      clients.SetFactory('speech', lambda *unused: speech)
+      transcripts = []
+      upload_transcript = import_conversations._UploadTranscript  # pylint: disable=protected-access
+
+      def _UploadTranscript(transcript_response, *args):
+        transcripts.append((time.time(), transcript_response))
+        return upload_transcript(transcript_response, *args)
+
+      import_conversations._UploadTranscript = _UploadTranscript  # pylint: disable=protected-access
+      uploader = local_upload.Uploader(lambda: storage, 'bench-bucket')
+      limits = import_conversations._PipelineLimits(  # pylint: disable=protected-access
+          speech_rate=1000, insights_rate=1000, poll_initial_secs=0.05,
+          poll_max_secs=0.5)
+      try:
+        with fake_services.FakeInsightsServer() as fake, _Quiet():
+          start = time.time()
+          import_conversations._ImportConversationsFromAudio(  # pylint: disable=protected-access
+              local_upload.ListLocalFiles(directory,
+                                          suffixes=['.' + container.lower()]),
+              'LINEAR16', 'en-US', 0, 'bench-project', 'bench-bucket',
+              fake.endpoint, 'v1', False, None, None, None, False, limits,
+              prober=audio_probe.Prober(lambda: storage), uploader=uploader,
+              segment_secs=segment_secs,
+              segment_overlap_secs=pargs.overlap_secs)
+      finally:
+        import_conversations._UploadTranscript = upload_transcript  # pylint: disable=protected-access
+        uploader.Close()
+      done_time, response = transcripts[0]
+      words, out_of_order, gap = _CheckStitched(response, duration_secs)
+      print('{:<9}  {:>8}  {:>9.3f}  {:<9}  {:>7.1f}  {:>5}  {:>12}  {:>12.1f}'
+            .format(container, len(segments) if segment_secs else 1,
+                    plan_secs, 'segmented' if segment_secs else 'whole',
+                    done_time - start, words, out_of_order, gap))
+    os.remove(path)
+
+
+def _UploadNewObjects(storage, bucket, num_objects, interval_secs, data,
+                      upload_times):
+  """Uploads objects whose names start with their upload time, at a rate."""
+  for i in range(num_objects):
+    name = 'calls/{:.6f}-{:05d}.wav'.format(time.time(), i)
+    upload_times['gs://{}/{}'.format(bucket, name)] = time.time()
+    storage.Store(bucket, name, data, len(data), name)
+    time.sleep(interval_secs)
+
+
+def _BenchWatch(pargs):
+  """Measures how soon watchers import new objects, and what they list."""
+  _UseFakeCredentials()
+  data = fake_services.SyntheticAudioFile('WAV', size=16 * 1024)
+  print('{} new objects, one every {} s, in a bucket of {} objects.'.format(
+      pargs.num_items, pargs.upload_interval_secs, pargs.existing_objects))
+  print('watcher          conversations  p50 secs  p99 secs  max secs  '
+        'listings  objects listed  duplicates')
+  for variant in ('pubsub', 'polling', 'polling_sorted'):
+    subscriber = fake_services.FakeSubscriberClient(
+        duplicate_rate=pargs.duplicate_rate)
+    storage = fake_services.FakeStorageClient(
+        list_page_size=1000, notifications=subscriber)
+    storage.AddSyntheticObjects('bench-audio', pargs.existing_objects,
+                                'calls/0-{:08d}.wav')
+    speech = fake_services.FakeSpeechClient(transcribe_secs=(0.1, 0.3))
+    clients = import_conversations._CLIENTS  # pylint: disable=protected-access
+    clients.SetFactory('storage', lambda *unused: storage)
+    clients.SetFactory('speech', lambda *unused: speech)
+    if variant == 'pubsub':
+      watcher = watch.PubSubWatcher(subscriber, 'bench-subscription',
+                                    'bench-audio', pull_timeout_secs=1.0)
+    else:
+      # Sorted names start after the existing objects, as with
+      # `--start_offset` set to a name from the start of the watch.
+      watcher = watch.PollingWatcher(
+          lambda: storage, 'bench-audio',
+          interval_secs=pargs.interval_secs,
+          sorted_names=variant == 'polling_sorted',
+          start_offset='calls/{:.6f}'.format(time.time()))
+    upload_times = {}
+    import_times = {}
+    create = import_conversations._CreateInsightsConversation  # pylint: disable=protected-access
+
+    def _Create(insights_endpoint, api_version, project_id, audio_uri, *args):
+      conversation_name = create(insights_endpoint, api_version, project_id,
+                                 audio_uri, *args)
+      import_times[audio_uri] = time.time()
+      return conversation_name
+
+    import_conversations._CreateInsightsConversation = _Create  # pylint: disable=protected-access
+    uploads = threading.Thread(
+        target=_UploadNewObjects,
+        args=(storage, 'bench-audio', pargs.num_items,
+              pargs.upload_interval_secs, data, upload_times))
+    limits = import_conversations._PipelineLimits(  # pylint: disable=protected-access
+        speech_rate=1000, insights_rate=1000, poll_initial_secs=0.05,
+        poll_max_secs=0.1, source_batch_size=1)
+    try:
+      with fake_services.FakeInsightsServer() as fake, _Quiet():
+        uploads.start()
+        conversation_names, _ = import_conversations._ImportConversationsFromAudio(  # pylint: disable=protected-access
+            watcher.Watch(pargs.num_items), 'LINEAR16', 'en-US', 0,
+            'bench-project', 'bench-bucket', fake.endpoint, 'v1', False, None,
+            None, None, False, limits)
+        uploads.join()
+    finally:
+      import_conversations._CreateInsightsConversation = create  # pylint: disable=protected-access
+    latencies = sorted(import_times[uri] - upload_times[uri]
+                       for uri in import_times)
+    if variant == 'pubsub':
+      listings, listed = 0, 0
+      duplicates = watcher.duplicates
+    else:
+      listings, listed = watcher.listings, watcher.objects_listed
+      duplicates = 0
+    print('{:<15}  {:>13}  {:>8.2f}  {:>8.2f}  {:>8.2f}  {:>8}  {:>14}  {:>10}'
+          .format(variant, len(conversation_names),
+                  latencies[len(latencies) // 2],
+                  latencies[int(len(latencies) * 0.99)], latencies[-1],
+                  listings, listed, duplicates))
+
+
+def _ParseArgs():
+  """Parse script arguments."""
+  parser = argparse.ArgumentParser()
+  subparsers = parser.add_subparsers(dest='benchmark')
+  subparsers.required = True
+
+  transcript_import = subparsers.add_parser(
+      'transcript_import',
+      help=('Conversation creation throughput against a fake Insights '
+            'server, by number of workers.'))
+  transcript_import.add_argument('--num_items', default=200, type=int)
+  transcript_import.add_argument(
+      '--latency_ms',
+      default=50,
+      type=float,
+      help=('Latency of each fake Insights request.'))
+  transcript_import.add_argument(
+      '--workers', default='1,2,4,8,16', type=_ParseInts)
+  transcript_import.add_argument(
+      '--rate',
+      default=0,
+      type=rate_limiter.ParseRate,
+      help=('Client-side rate limit. Zero disables it.'))
+  transcript_import.set_defaults(run=_BenchTranscriptImport)
+
+  client_overhead = subparsers.add_parser(
+      'client_overhead',
+      help=('Per-item overhead of building clients and connections for every '
+            'request, compared to reusing them.'))
+  client_overhead.add_argument('--num_items', default=100, type=int)
+  client_overhead.set_defaults(run=_BenchClientOverhead)
+
+  transcript_upload = subparsers.add_parser(
+      'transcript_upload',
+      help=('Wall time and peak memory of transcript uploads through a temp '
+            'file and from memory, for synthetic multi-hour transcripts. '
+            'Encoding takes most of the time, so the variants take about as '
+            'long; uploads from memory differ in writing no files.'))
+  transcript_upload.add_argument(
+      '--hours_list',
+      default='1,4,8',
+      type=_ParseInts,
+      help=('Lengths of the transcribed calls, in hours.'))
+  transcript_upload.add_argument('--repeats', default=5, type=int)
+  # Used by the benchmark to run a single measurement in a child process.
+  transcript_upload.add_argument(
+      '--variant', choices=('temp_file', 'in_memory', 'chunked'),
+      help=argparse.SUPPRESS)
+  transcript_upload.add_argument('--hours', type=int, help=argparse.SUPPRESS)
+  transcript_upload.set_defaults(run=_BenchTranscriptUpload)
+
+  analyze = subparsers.add_parser(
+      'analyze',
+      help=('Wall time and number of polls to analyze conversations with a '
+            'fake Insights server.'))
+  analyze.add_argument('--num_items', default=200, type=int)
+  analyze.add_argument('--workers', default=16, type=int)
+  analyze.add_argument('--rate', default=0, type=rate_limiter.ParseRate)
+  analyze.add_argument('--latency_ms', default=20, type=float)
+  analyze.add_argument('--min_analysis_secs', default=2.0, type=float)
+  analyze.add_argument('--max_analysis_secs', default=20.0, type=float)
+  analyze.add_argument('--failure_rate', default=0.05, type=float)
+  analyze.add_argument('--max_wait_secs', default=300, type=int)
+  analyze.set_defaults(run=_BenchAnalyze)
+
+  pipeline = subparsers.add_parser(
+      'pipeline',
+      help=('Per-stage throughput, p50 and p99 latency and peak memory of the '
+            'audio import pipeline against fake Speech, DLP, Storage and '
+            'Insights, with injected latencies, quotas and errors. Scales to '
+            'millions of items, e.g. `--num_items 1000000 --concurrency 200 '
+            '--min_transcribe_secs 0.05 --max_transcribe_secs 0.2`.'))
+  pipeline.add_argument('--num_items', default=500, type=int)
+  pipeline.add_argument(
+      '--concurrency',
+      default=20,
+      type=int,
+      help=('Concurrency of every stage.'))
+  pipeline.add_argument('--rate', default=0, type=rate_limiter.ParseRate)
+  pipeline.add_argument(
+      '--latency_ms',
+      default='20',
+      type=fake_services.ParseLatency,
+      help=('Latency of every request to a fake: `20`, `10-50` for a uniform '
+            'range, or `20:200` for a log-normal distribution with a p50 of '
+            '20 ms and a p99 of 200 ms.'))
+  pipeline.add_argument(
+      '--quota',
+      default=0,
+      type=float,
+      help=('Requests per second every fake accepts before it throttles. '
+            'Default 0, no quota.'))
+  pipeline.add_argument(
+      '--error_rate',
+      default=0.0,
+      type=float,
+      help=('Share of requests to every fake that fail with status 503.'))
+  pipeline.add_argument('--min_transcribe_secs', default=0.5, type=float)
+  pipeline.add_argument('--max_transcribe_secs', default=3.0, type=float)
+  pipeline.add_argument(
+      '--call_secs',
+      default=300,
+      type=int,
+      help=('Length of every transcribed call.'))
+  pipeline.set_defaults(run=_BenchPipeline)
+
+  quota = subparsers.add_parser(
+      'quota',
+      help=('Conversations created and lost, and throughput, against a fake '
+            'Insights that throttles requests beyond a quota, with a fixed '
+            'rate and with the adaptive rate limiter and retries.'))
+  quota.add_argument('--num_items', default=1000, type=int)
+  quota.add_argument('--workers', default=16, type=int)
+  quota.add_argument(
+      '--quota',
+      default=50,
+      type=float,
+      help=('Create conversation requests per second the fake accepts.'))
+  quota.add_argument(
+      '--rate',
+      default=0,
+      type=rate_limiter.ParseRate,
+      help=('Rate the client starts at. Default 0, unlimited.'))
+  quota.add_argument('--latency_ms', default=20, type=float)
+  quota.add_argument('--retry_after_secs', default=1, type=int)
+  quota.set_defaults(run=_BenchQuota)
+
+  shards = subparsers.add_parser(
+      'shards',
+      help=('Throughput of the audio import pipeline split between 1 to N '
+            'local shard processes, against one fake Insights server, and '
+            'whether any conversation was created twice or not at all.'))
+  shards.add_argument('--num_items', default=400, type=int)
+  shards.add_argument('--processes', default='1,2,4', type=_ParseInts)
+  shards.add_argument(
+      '--concurrency',
+      default=10,
+      type=int,
+      help=('Concurrency of every stage, in every process.'))
+  shards.add_argument(
+      '--rate',
+      default=0,
+      type=rate_limiter.ParseRate,
+      help=('Rate of every service, in every process. Default 0, unlimited.'))
+  shards.add_argument('--latency_ms', default=20, type=float)
+  shards.add_argument('--min_transcribe_secs', default=0.5, type=float)
+  shards.add_argument('--max_transcribe_secs', default=3.0, type=float)
+  shards.add_argument('--call_secs', default=300, type=int)
+  # Set by `LaunchLocal` and the benchmark, for the shard processes.
+  shards.add_argument('--endpoint', help=argparse.SUPPRESS)
+  shards.add_argument('--results_file', help=argparse.SUPPRESS)
+  shards.add_argument('--num_shards', default=1, type=int,
+                      help=argparse.SUPPRESS)
+  shards.add_argument('--shard_index', default=0, type=int,
+                      help=argparse.SUPPRESS)
+  shards.set_defaults(run=_BenchShards)
+
+  bulk = subparsers.add_parser(
+      'bulk',
+      help=('Requests and wall time of importing and analyzing chat '
+            'transcripts one conversation at a time, and with one bulk ingest '
+            'and one bulk analyze request, against a fake Insights.'))
+  bulk.add_argument('--num_items', default=1000, type=int)
+  bulk.add_argument('--workers', default=16, type=int)
+  bulk.add_argument(
+      '--rate',
+      default='50/s',
+      type=rate_limiter.ParseRate,
+      help=('Rate of per-conversation create and analyze requests.'))
+  bulk.add_argument('--latency_ms', default=20, type=float)
+  bulk.add_argument('--min_analysis_secs', default=2.0, type=float)
+  bulk.add_argument('--max_analysis_secs', default=10.0, type=float)
+  bulk.add_argument('--failure_rate', default=0.01, type=float)
+  bulk.add_argument(
+      '--bulk_ms_per_item',
+      default=1.0,
+      type=float,
+      help=('Time bulk operations take per conversation in the fake.'))
+  bulk.set_defaults(run=_BenchBulk)
+
+  metrics_parser = subparsers.add_parser(
+      'metrics',
+      help=('Overhead of recording a remote call in the metrics, by number '
+            'of threads, and time to scrape the metrics over HTTP.'))
+  metrics_parser.add_argument('--num_calls', default=1000000, type=int)
+  metrics_parser.add_argument('--threads', default='1,8,32', type=_ParseInts)
+  metrics_parser.set_defaults(run=_BenchMetrics)
+
+  listing = subparsers.add_parser(
+      'listing',
+      help=('Time to first item, total time and peak memory of listing a '
+            'fake bucket with a million objects.'))
+  listing.add_argument('--num_objects', default=1000000, type=int)
+  listing.add_argument(
+      '--page_latency_ms',
+      default=5,
+      type=float,
+      help=('Latency of each page of 1000 objects.'))
+  listing.add_argument('--max_items', default=1000, type=int)
+  # Used by the benchmark to run a single measurement in a child process.
+  listing.add_argument(
+      '--variant', choices=('list', 'stream', 'start_offset', 'max_items'),
+      help=argparse.SUPPRESS)
+  listing.set_defaults(run=_BenchListing)
+
+  resume = subparsers.add_parser(
+      'resume',
+      help=('Interrupts an audio import against fakes halfway, then resumes '
+            'it and counts the repeated work.'))
+  resume.add_argument('--num_items', default=200, type=int)
+  resume.set_defaults(run=_BenchResume)
+
+  cache = subparsers.add_parser(
+      'cache',
+      help=('Imports the same audio files twice with a different agent ID, '
+            'and counts the Speech-to-text and DLP calls the cache avoids.'))
+  cache.add_argument('--num_items', default=100, type=int)
+  cache.add_argument('--min_transcribe_secs', default=1.0, type=float)
+  cache.add_argument('--max_transcribe_secs', default=5.0, type=float)
+  cache.add_argument('--call_secs', default=300, type=int)
+  cache.set_defaults(run=_BenchCache)
+
+  redaction = subparsers.add_parser(
+      'redaction',
+      help=('DLP requests, bytes and throughput of whole-response redaction '
+            'and of batched transcript redaction, against a DLP stub.'))
+  redaction.add_argument('--num_items', default=200, type=int)
+  redaction.add_argument('--workers', default=8, type=int)
+  redaction.add_argument('--call_secs', default=600, type=int)
+  redaction.add_argument('--latency_ms', default=50, type=float)
+  redaction.add_argument(
+      '--dlp_mb_per_sec',
+      default=4.0,
+      type=float,
+      help=('Inspection speed of the DLP stub.'))
+  redaction.set_defaults(run=_BenchRedaction)
+
+  transcript_format = subparsers.add_parser(
+      'transcript_format',
+      help=('Bytes and write time per hour of audio of every transcript '
+            'format, and of str() of the response.'))
+  transcript_format.add_argument(
+      '--hours_list', default='1,4', type=_ParseInts)
+  transcript_format.add_argument('--repeats', default=3, type=int)
+  transcript_format.set_defaults(run=_BenchTranscriptFormat)
+
+  probe = subparsers.add_parser(
+      'probe',
+      help=('Audio header probing throughput over fake GCS objects, by '
+            'concurrency, and with a cache.'))
+  probe.add_argument('--num_items', default=5000, type=int)
+  probe.add_argument('--file_kb', default=1024, type=int)
+  probe.add_argument('--latency_ms', default=20, type=float)
+  probe.add_argument('--concurrency', default='1,8,32', type=_ParseInts)
+  probe.set_defaults(run=_BenchProbe)
+
+  local_upload_parser = subparsers.add_parser(
+      'local_upload',
+      help=('Upload throughput of a local directory of recordings: '
+            'sequential, parallel, and parallel with composite uploads.'))
+  local_upload_parser.add_argument('--num_files', default=200, type=int)
+  local_upload_parser.add_argument('--file_mb', default=1, type=int)
+  local_upload_parser.add_argument('--num_large_files', default=2, type=int)
+  local_upload_parser.add_argument('--large_file_mb', default=200, type=int)
+  local_upload_parser.add_argument('--concurrency', default=16, type=int)
+  local_upload_parser.add_argument(
+      '--composite_threshold_mb', default=150, type=int)
+  local_upload_parser.add_argument('--part_mb', default=32, type=int)
+  local_upload_parser.add_argument(
+      '--stream_mb_per_sec',
+      default=50,
+      type=int,
+      help=('Bandwidth of every upload to the fake GCS.'))
+  local_upload_parser.add_argument(
+      '--emulator_host',
+      help=('Upload to a GCS emulator at this address instead of the fake, '
+            'e.g. `http://localhost:9023` for `gcp-storage-emulator start '
+            '--port 9023 --default-bucket bench-bucket`.'))
+  local_upload_parser.add_argument('--bucket', default='bench-bucket')
+  local_upload_parser.add_argument('--directory', help=argparse.SUPPRESS)
+  local_upload_parser.add_argument(
+      '--variant',
+      choices=('sequential', 'parallel', 'composite'),
+      help=argparse.SUPPRESS)
+  local_upload_parser.set_defaults(run=_BenchLocalUpload)
+
+  chunking = subparsers.add_parser(
+      'chunking',
+      help=('Time to transcript of a long WAV and FLAC recording, transcribed '
+            'whole and in parallel segments by a fake Speech-to-text.'))
+  chunking.add_argument('--minutes', default=60, type=int)
+  chunking.add_argument('--containers', default='WAV,FLAC')
+  chunking.add_argument('--segment_secs', default=120, type=float)
+  chunking.add_argument('--overlap_secs', default=1.0, type=float)
+  chunking.add_argument(
+      '--realtime_factor',
+      default=60,
+      type=float,
+      help=('How many times faster than real time the fake transcribes.'))
+  chunking.set_defaults(run=_BenchChunking)
+
+  watch_parser = subparsers.add_parser(
+      'watch',
+      help=('Seconds from upload to created conversation of new objects, and '
+            'the objects listed, for Pub/Sub notifications and polling.'))
+  watch_parser.add_argument('--num_items', default=100, type=int)
+  watch_parser.add_argument('--upload_interval_secs', default=0.05, type=float)
+  watch_parser.add_argument('--existing_objects', default=100000, type=int)
+  watch_parser.add_argument(
+      '--interval_secs',
+      default=1.0,
+      type=float,
+      help=('Seconds between the listings of the polling watchers.'))
+  watch_parser.add_argument(
+      '--duplicate_rate',
+      default=0.05,
+      type=float,
+      help=('Share of notifications that are delivered twice.'))
+  watch_parser.set_defaults(run=_BenchWatch)
+
+  pii = subparsers.add_parser(
+      'pii',
+      help=('Local PII scanning throughput by number of processes, and DLP '
+            'requests of the `dlp`, `prefilter` and `local` redact modes.'))
+  pii.add_argument('--num_items', default=200, type=int)
+  pii.add_argument('--workers', default=8, type=int)
+  pii.add_argument('--call_secs', default=600, type=int)
+  pii.add_argument(
+      '--pii_rate',
+      default=0.005,
+      type=float,
+      help=('Share of words that are emails or phone numbers.'))
+  pii.add_argument('--processes', default='1,2,4', type=_ParseInts)
+  pii.add_argument('--latency_ms', default=50, type=float)
+  pii.add_argument('--dlp_mb_per_sec', default=4.0, type=float)
+  pii.set_defaults(run=_BenchPii)
+
+  return parser.parse_args()
+
+
+def main():
+  pargs = _ParseArgs()
+  pargs.run(pargs)
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,225 @@
+# Lint as: python3
+"""A SQLite checkpoint of how far every source file got through an import.
+
+With a checkpoint, an interrupted import can be resumed without transcribing
+audio again or creating duplicate conversations: `--resume` skips finished
+steps, and continues transcription and analysis operations that were still
+running by their operation names.
+
+Updates are queued and written in batches by a single writer thread, so
+workers never wait on the database. Lookups by source uri use the primary key
+and stay fast with millions of rows.
+"""
+
+import collections
+import queue
+import sqlite3
+import threading
+import time
+
+# The states of a source file, in the order it goes through them.
+PENDING = 'PENDING'
+TRANSCRIBING = 'TRANSCRIBING'
+TRANSCRIBED = 'TRANSCRIBED'
+REDACTED = 'REDACTED'
+UPLOADED = 'UPLOADED'
+CREATED = 'CREATED'
+ANALYZING = 'ANALYZING'
+DONE = 'DONE'
+
+# Columns besides the source uri, state, error and update time.
+_FIELDS = ('transcribe_operation', 'transcript_uri', 'conversation_name',
+           'analysis_operation', 'analysis_state')
+
+# The checkpointed progress of one source file.
+Record = collections.namedtuple(
+    'Record', ('source_uri', 'state') + _FIELDS + ('error',))
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS items (
+  source_uri TEXT PRIMARY KEY,
+  state TEXT NOT NULL,
+  transcribe_operation TEXT,
+  transcript_uri TEXT,
+  conversation_name TEXT,
+  analysis_operation TEXT,
+  analysis_state TEXT,
+  error TEXT,
+  updated REAL
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS items_conversation_name ON items (conversation_name);
+"""
+
+_INSERT = 'INSERT OR IGNORE INTO items (source_uri, state) VALUES (?, ?)'
+# Unset fields keep their values. The error is always replaced, so that a step
+# that succeeds clears the error of an earlier attempt.
+_UPDATE = ('UPDATE items SET state = COALESCE(?, state), {}, error = ?, '
+           'updated = ? WHERE {} = ?').format(', '.join(
+               '{0} = COALESCE(?, {0})'.format(field) for field in _FIELDS),
+                                             '{}')
+
+# Queued to make the writer thread commit and report back, or exit.
+_FLUSH = object()
+_CLOSE = object()
+
+
+class Checkpoint(object):
+  """Records the progress of an import in a SQLite database.
+
+  Thread-safe. Usage:
+    with Checkpoint('import.db', resume=True) as checkpoint:
+      record = checkpoint.Get(uri)
+      checkpoint.Update(uri, checkpoint.UPLOADED, transcript_uri=...)
+  """
+
+  def __init__(self, path, resume=False, batch_size=1000,
+               flush_interval_secs=0.5):
+    """Opens the checkpoint.
+
+    Args:
+      path: The path of the database file.
+      resume: Whether to keep the records of an earlier import. Otherwise all
+        records are deleted.
+      batch_size: The maximum number of updates written in one transaction.
+      flush_interval_secs: The maximum time an update waits to be written.
+    """
+    self.path = path
+    self._batch_size = batch_size
+    self._flush_interval_secs = flush_interval_secs
+    self._local = threading.local()
+    self._connections = []
+    self._connections_lock = threading.Lock()
+
+    connection = self._Connect()
+    connection.executescript(_SCHEMA)
+    if not resume:
+      connection.execute('DELETE FROM items')
+    connection.commit()
+
+    self._updates = queue.Queue()
+    self._writer = threading.Thread(target=self._Write)
+    self._writer.daemon = True
+    self._writer.start()
+
+  def _Connect(self):
+    """Returns the connection of the calling thread."""
+    connection = getattr(self._local, 'connection', None)
+    if connection is None:
+      connection = sqlite3.connect(self.path, timeout=60,
+                                   check_same_thread=False)
+      # Readers don't block the writer, and commits don't wait for fsync.
+      connection.execute('PRAGMA journal_mode=WAL')
+      connection.execute('PRAGMA synchronous=NORMAL')
+      self._local.connection = connection
+      with self._connections_lock:
+        self._connections.append(connection)
+    return connection
+
+  def Get(self, source_uri):
+    """Returns the `Record` of a source file, or None if there is none.
+
+    Updates that are still queued are not visible.
+    """
+    row = self._Connect().execute(
+        'SELECT {} FROM items WHERE source_uri = ?'.format(', '.join(
+            Record._fields)), (source_uri,)).fetchone()
+    return Record(*row) if row else None
+
+  def List(self, states):
+    """Yields the `Record`s in any of the given states.
+
+    Args:
+      states: The states to list.
+    """
+    cursor = self._Connect().execute(
+        'SELECT {} FROM items WHERE state IN ({})'.format(
+            ', '.join(Record._fields), ', '.join('?' for _ in states)),
+        tuple(states))
+    for row in cursor:
+      yield Record(*row)
+
+  def CountByState(self):
+    """Returns a dict of the number of source files in every state."""
+    return dict(self._Connect().execute(
+        'SELECT state, COUNT(*) FROM items GROUP BY state').fetchall())
+
+  def Update(self, source_uri, state=None, error=None, **fields):
+    """Queues an update of a source file's record.
+
+    Args:
+      source_uri: The source file.
+      state: The new state, or None to keep the current one.
+      error: The error of the last step, or None if it succeeded.
+      **fields: New values for any of the other columns.
+    """
+    self._Queue(False, source_uri, state, error, fields)
+
+  def UpdateConversation(self, conversation_name, state=None, error=None,
+                         **fields):
+    """Like `Update`, for the source file of a conversation."""
+    self._Queue(True, conversation_name, state, error, fields)
+
+  def _Queue(self, by_conversation, key, state, error, fields):
+    unknown = set(fields) - set(_FIELDS)
+    if unknown:
+      raise ValueError('Unknown checkpoint fields: {}'.format(sorted(unknown)))
+    values = (state,) + tuple(fields.get(field) for field in _FIELDS) + (
+        error, time.time(), key)
+    self._updates.put((by_conversation, values))
+
+  def Flush(self):
+    """Blocks until every queued update is written."""
+    done = threading.Event()
+    self._updates.put((_FLUSH, done))
+    done.wait()
+
+  def Close(self):
+    """Writes queued updates and closes the database. Safe to call twice."""
+    if not self._writer.is_alive():
+      return
+    self._updates.put((_CLOSE, None))
+    self._writer.join()
+    with self._connections_lock:
+      for connection in self._connections:
+        connection.close()
+      self._connections = []
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *unused_exc_info):
+    self.Close()
+
+  def _Write(self):
+    """Writes queued updates in batches until closed."""
+    connection = sqlite3.connect(self.path, timeout=60)
+    connection.execute('PRAGMA synchronous=NORMAL')
+    update_by_uri = _UPDATE.format('source_uri')
+    update_by_conversation = _UPDATE.format('conversation_name')
+    closed = False
+    while not closed:
+      batch = [self._updates.get()]
+      deadline = time.time() + self._flush_interval_secs
+      while len(batch) < self._batch_size:
+        try:
+          batch.append(
+              self._updates.get(timeout=max(0, deadline - time.time())))
+        except queue.Empty:
+          break
+        if batch[-1][0] in (_FLUSH, _CLOSE):
+          break
+      flushes = []
+      with connection:
+        for by_conversation, values in batch:
+          if by_conversation is _FLUSH:
+            flushes.append(values)
+          elif by_conversation is _CLOSE:
+            closed = True
+          elif by_conversation:
+            connection.execute(update_by_conversation, values)
+          else:
+            connection.execute(_INSERT, (values[-1], PENDING))
+            connection.execute(update_by_uri, values)
+      for done in flushes:
+        done.set()
+    connection.close()
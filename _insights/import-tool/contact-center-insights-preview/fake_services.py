@@ -0,0 +1,1407 @@
+# Lint as: python3
+"""Local fakes of the Google Cloud services used by import_conversations.py.
+
+The fakes let the import tool run, and be benchmarked, without a GCP project.
+"""
+
+import base64
+import collections
+import datetime
+import hashlib
+import heapq
+import http.server
+import itertools
+import json
+import math
+import random
+import re
+import struct
+import threading
+import time
+import urllib.parse
+import zlib
+
+import google.api_core.exceptions
+import google.api_core.operation
+import google.auth.credentials
+from google.cloud.dlp_v2 import types as dlp_types
+from google.cloud.speech_v1p1beta1 import types as speech_types
+from google.longrunning import operations_pb2
+
+import audio_chunking
+import rate_limiter
+
+_PARENT = (r'^/(?P<version>[^/]+)/projects/(?P<project>[^/]+)/locations/'
+           r'(?P<location>[^/]+)')
+_CREATE_CONVERSATION_PATH = re.compile(_PARENT + r'/conversations$')
+_CREATE_ANALYSIS_PATH = re.compile(
+    _PARENT + r'/conversations/(?P<conversation>[^/]+)/analyses$')
+_OPERATION_PATH = re.compile(_PARENT + r'/operations/(?P<operation>[^/]+)$')
+_INGEST_PATH = re.compile(_PARENT + r'/conversations:ingest$')
+_BULK_ANALYZE_PATH = re.compile(_PARENT + r'/conversations:bulkAnalyze$')
+_LIST_CONVERSATIONS_PATH = re.compile(
+    _PARENT + r'/conversations\?(?P<query>.*)$')
+# One term of a conversation filter, e.g. `create_time>="2021-06-29T00:00:00Z"`.
+_FILTER_TERM = re.compile(
+    r'(?P<field>\w+)\s*(?P<op>>=|<=|>|<|=)\s*"(?P<value>[^"]*)"')
+_METADATA_TYPE = 'type.googleapis.com/google.cloud.contactcenterinsights.v1.{}'
+_MEDIUMS = {'PHONE_CALL': 1, 'CHAT': 2}
+
+
+def _TruncateToMicros(secs):
+  """Returns a time as it is formatted, without the rest of a microsecond.
+
+  Times that are stored must be truncated like this, since the formatted time
+  would otherwise be earlier than the stored one, and a filter on the
+  formatted time would not match.
+  """
+  return int(secs * 1e6) / 1e6
+
+
+def _FormatTimestamp(secs):
+  """Formats seconds since the epoch as an RFC 3339 UTC timestamp."""
+  return datetime.datetime.fromtimestamp(
+      _TruncateToMicros(secs), datetime.timezone.utc).strftime('%Y-%m-%dT%H:%M:%S.%fZ')
+
+
+def _ParseTimestamp(value):
+  """Parses an RFC 3339 UTC timestamp into seconds since the epoch."""
+  fmt = '%Y-%m-%dT%H:%M:%S.%fZ' if '.' in value else '%Y-%m-%dT%H:%M:%SZ'
+  return datetime.datetime.strptime(value, fmt).replace(
+      tzinfo=datetime.timezone.utc).timestamp()
+
+
+class LogNormalLatency(object):
+  """Latencies with a long tail, like those of real services."""
+
+  # The 99th percentile of the standard normal distribution.
+  _Z99 = 2.326
+
+  def __init__(self, median_secs, p99_secs):
+    """Initializes the distribution.
+
+    Args:
+      median_secs: The median latency.
+      p99_secs: The 99th percentile latency, at least the median.
+    """
+    self._mu = math.log(median_secs)
+    self._sigma = math.log(p99_secs / median_secs) / self._Z99
+
+  def Sample(self, rng):
+    return rng.lognormvariate(self._mu, self._sigma)
+
+
+def SampleLatency(latency, rng):
+  """Draws one latency.
+
+  Args:
+    latency: Seconds, a (min, max) range to draw from uniformly, or a
+      distribution with a `Sample(rng)` method, like `LogNormalLatency`.
+    rng: The `random.Random` to draw with.
+
+  Returns:
+    The latency in seconds.
+  """
+  if hasattr(latency, 'Sample'):
+    return latency.Sample(rng)
+  if isinstance(latency, (tuple, list)):
+    return rng.uniform(*latency)
+  return latency
+
+
+def ParseLatency(value):
+  """Parses a latency flag in milliseconds.
+
+  Args:
+    value: `20` for a fixed latency, `10-50` for a uniform range, or `20:200`
+      for a log-normal distribution with a median of 20 ms and a p99 of 200 ms.
+
+  Returns:
+    A latency for `SampleLatency`.
+  """
+  if ':' in value:
+    median, p99 = value.split(':')
+    return LogNormalLatency(float(median) / 1000.0, float(p99) / 1000.0)
+  if '-' in value.lstrip('-'):
+    low, high = value.split('-')
+    return (float(low) / 1000.0, float(high) / 1000.0)
+  return float(value) / 1000.0
+
+
+class FaultInjector(object):
+  """Decides which requests to a fake fail, and counts them.
+
+  Requests beyond the quota are throttled with status 429, and a random share
+  of the others fails with status 503, like transient backend errors.
+  """
+
+  def __init__(self, error_rate=0.0, quota_rate=0, seed=0):
+    """Initializes the injector.
+
+    Args:
+      error_rate: The share of requests that fail with status 503.
+      quota_rate: If set, requests beyond this many per second fail with
+        status 429. One second of burst, like Google Cloud quotas per second.
+      seed: Seed for the random errors.
+    """
+    self._error_rate = error_rate
+    self._quota = rate_limiter.TokenBucket(quota_rate) if quota_rate else None
+    self._rng = random.Random(seed)
+    self._lock = threading.Lock()
+    self.throttled = 0
+    self.errors = 0
+
+  def GetStatus(self):
+    """Returns the status of the next request, 200 unless it fails."""
+    if self._quota and self._quota.TryAcquire():
+      with self._lock:
+        self.throttled += 1
+      return 429
+    with self._lock:
+      if self._error_rate and self._rng.random() < self._error_rate:
+        self.errors += 1
+        return 503
+    return 200
+
+  def Check(self, what):
+    """Raises the `google.api_core` error of the next request, if it fails.
+
+    Args:
+      what: Describes the request, for the error message.
+
+    Raises:
+      google.api_core.exceptions.TooManyRequests: If the request is throttled.
+      google.api_core.exceptions.ServiceUnavailable: If the request fails.
+    """
+    status = self.GetStatus()
+    if status == 429:
+      raise google.api_core.exceptions.TooManyRequests(
+          'Quota exceeded for {}.'.format(what))
+    if status == 503:
+      raise google.api_core.exceptions.ServiceUnavailable(
+          'Injected error for {}.'.format(what))
+
+
+class FakeCredentials(google.auth.credentials.Credentials):
+  """Credentials that mint local tokens instead of calling OAuth servers."""
+
+  def __init__(self, lifetime=datetime.timedelta(hours=1)):
+    super(FakeCredentials, self).__init__()
+    self._lifetime = lifetime
+    self._tokens = itertools.count(1)
+
+  def refresh(self, request):
+    del request  # Unused.
+    self.token = 'fake-token-{}'.format(next(self._tokens))
+    self.expiry = datetime.datetime.utcnow() + self._lifetime
+
+
+class _InsightsHandler(http.server.BaseHTTPRequestHandler):
+  """Serves the subset of the Insights REST API that the import tool uses."""
+
+  # Keep connections alive like the real endpoint does, and send each response
+  # in one segment so that kept-alive connections don't hit delayed ACKs.
+  protocol_version = 'HTTP/1.1'
+  wbufsize = -1
+  disable_nagle_algorithm = True
+
+  def log_message(self, *args):
+    del args  # Unused. Request logging would dominate benchmark output.
+
+  def _ReadJson(self):
+    length = int(self.headers.get('Content-Length') or 0)
+    body = self.rfile.read(length) if length else b''
+    return json.loads(body) if body else {}
+
+  def _SendJson(self, status, body, headers=None):
+    data = json.dumps(body).encode('utf-8')
+    self.send_response(status)
+    self.send_header('Content-Type', 'application/json')
+    for name, value in (headers or {}).items():
+      self.send_header(name, value)
+    self.send_header('Content-Length', str(len(data)))
+    self.end_headers()
+    self.wfile.write(data)
+
+  def _Handle(self, method):
+    request = self._ReadJson() if method == 'POST' else {}
+    status, body = self.server.fake.Handle(method, self.path, request)
+    headers = None
+    if status == 429 and self.server.fake.retry_after_secs is not None:
+      headers = {'Retry-After': str(self.server.fake.retry_after_secs)}
+    self._SendJson(status, body, headers)
+
+  def do_GET(self):  # pylint: disable=invalid-name
+    self._Handle('GET')
+
+  def do_POST(self):  # pylint: disable=invalid-name
+    self._Handle('POST')
+
+
+class FakeInsightsServer(object):
+  """A local HTTP server that imitates the Insights REST API.
+
+  Usage:
+    with FakeInsightsServer(latency_secs=0.05) as fake:
+      ... pass fake.endpoint as `--insights_endpoint` ...
+  """
+
+  def __init__(self, latency_secs=0.0, analysis_secs=0.0,
+               analysis_failure_rate=0.0, host='127.0.0.1', port=0, seed=0,
+               quota_rate=0, retry_after_secs=None, error_rate=0.0,
+               keep_requests=True, ingest_sources=None,
+               bulk_secs_per_item=0.001):
+    """Initializes the fake.
+
+    Args:
+      latency_secs: Time taken to serve each request, as for `SampleLatency`.
+      analysis_secs: How long analyses take, as for `SampleLatency`.
+      analysis_failure_rate: The fraction of analyses that finish with an
+        error.
+      host: The interface to listen on.
+      port: The port to listen on. Zero picks a free port.
+      seed: Seed for the random analysis durations and failures.
+      quota_rate: If set, create conversation and create analysis requests
+        beyond this many per second, each, fail with status 429.
+      retry_after_secs: The `Retry-After` of throttled responses, if any.
+      error_rate: The share of create conversation and create analysis
+        requests that fail with status 503.
+      keep_requests: Whether to keep the request of every conversation, and
+        every operation after it was reported done. Imports of millions of
+        conversations need too much memory otherwise. Bulk ingest and listing
+        conversations need the requests.
+      ingest_sources: Returns the transcript uris under a GCS uri, for bulk
+        ingest requests. Without it, nothing is ingested.
+      bulk_secs_per_item: How long bulk ingest and bulk analyze operations
+        take per conversation, on top of one analysis for bulk analyze.
+    """
+    self._latency_secs = latency_secs
+    self._analysis_secs = analysis_secs
+    self._analysis_failure_rate = analysis_failure_rate
+    self._rng = random.Random(seed)
+    self._faults = {
+        kind: FaultInjector(error_rate, quota_rate, seed)
+        for kind in ('conversations', 'analyses')
+    }
+    self._keep_requests = keep_requests
+    self._ingest_sources = ingest_sources or (lambda unused_uri: [])
+    self._bulk_secs_per_item = bulk_secs_per_item
+    self.retry_after_secs = retry_after_secs
+    self._server = http.server.ThreadingHTTPServer((host, port),
+                                                   _InsightsHandler)
+    self._server.daemon_threads = True
+    self._server.fake = self
+    self._thread = None
+    self._lock = threading.Lock()
+    self._ids = itertools.count(1)
+    self.conversations = {}
+    # Maps operation names to (done time, error message or None).
+    self.operations = {}
+    # Maps the names of bulk operations to their metadata.
+    self._operation_metadata = {}
+    # Maps conversation names to their create times.
+    self._create_times = {}
+    # Maps conversation names to (analysis name, done time) of their latest
+    # successful analysis.
+    self._latest_analyses = {}
+    self.request_counts = {}
+
+  @property
+  def endpoint(self):
+    host, port = self._server.server_address[:2]
+    return 'http://{}:{}'.format(host, port)
+
+  def Start(self):
+    self._thread = threading.Thread(target=self._server.serve_forever)
+    self._thread.daemon = True
+    self._thread.start()
+    return self
+
+  def Stop(self):
+    self._server.shutdown()
+    self._server.server_close()
+
+  def __enter__(self):
+    return self.Start()
+
+  def __exit__(self, *unused_exc_info):
+    self.Stop()
+
+  def Handle(self, method, path, request):
+    """Serves one request.
+
+    Args:
+      method: The HTTP method.
+      path: The request path.
+      request: The parsed JSON body.
+
+    Returns:
+      A tuple of the HTTP status and the JSON response body.
+    """
+    kind = _RequestKind(path)
+    with self._lock:
+      key = '{} {}'.format(method, kind)
+      self.request_counts[key] = self.request_counts.get(key, 0) + 1
+    latency_secs = SampleLatency(self._latency_secs, self._rng)
+    if latency_secs:
+      time.sleep(latency_secs)
+    status = 200
+    if method == 'POST' and kind in self._faults:
+      status = self._faults[kind].GetStatus()
+    if status == 429:
+      with self._lock:
+        key = 'throttled {}'.format(kind)
+        self.request_counts[key] = self.request_counts.get(key, 0) + 1
+      return 429, {'error': {'code': 429, 'status': 'RESOURCE_EXHAUSTED',
+                             'message': 'Quota exceeded.'}}
+    if status == 503:
+      with self._lock:
+        key = 'failed {}'.format(kind)
+        self.request_counts[key] = self.request_counts.get(key, 0) + 1
+      return 503, {'error': {'code': 503, 'status': 'UNAVAILABLE',
+                             'message': 'Injected error.'}}
+
+    match = _CREATE_CONVERSATION_PATH.match(path)
+    if method == 'POST' and match:
+      return 200, {'name': self._CreateConversation(match, request)}
+    match = _CREATE_ANALYSIS_PATH.match(path)
+    if method == 'POST' and match:
+      return 200, {'name': self._CreateAnalysis(match)}
+    match = _OPERATION_PATH.match(path)
+    if method == 'GET' and match:
+      return self._GetOperation(path.split('/', 2)[2])
+    match = _INGEST_PATH.match(path)
+    if method == 'POST' and match:
+      return 200, {'name': self._Ingest(match, request)}
+    match = _BULK_ANALYZE_PATH.match(path)
+    if method == 'POST' and match:
+      return 200, {'name': self._BulkAnalyze(match, request)}
+    match = _LIST_CONVERSATIONS_PATH.match(path)
+    if method == 'GET' and match:
+      return self._ListConversations(match)
+    return 404, {'error': {'code': 404, 'message': path}}
+
+  def _CreateConversation(self, match, request):
+    with self._lock:
+      name = 'projects/{}/locations/{}/conversations/{}'.format(
+          match.group('project'), match.group('location'), next(self._ids))
+      self.conversations[name] = request if self._keep_requests else None
+      if self._keep_requests:
+        self._create_times[name] = _TruncateToMicros(time.time())
+    return name
+
+  def _CreateAnalysis(self, match):
+    with self._lock:
+      name = 'projects/{}/locations/{}/operations/{}'.format(
+          match.group('project'), match.group('location'), next(self._ids))
+      error = None
+      if self._rng.random() < self._analysis_failure_rate:
+        error = 'Injected analysis failure.'
+      done_time = time.time() + SampleLatency(self._analysis_secs, self._rng)
+      self.operations[name] = (done_time, error)
+      if self._keep_requests and not error:
+        conversation_name = (
+            'projects/{}/locations/{}/conversations/{}'.format(
+                match.group('project'), match.group('location'),
+                match.group('conversation')))
+        self._latest_analyses[conversation_name] = (
+            '{}/analyses/{}'.format(conversation_name, next(self._ids)),
+            done_time)
+    return name
+
+  def _Ingest(self, match, request):
+    """Creates a conversation for every transcript under a GCS uri."""
+    now = _TruncateToMicros(time.time())
+    medium = _MEDIUMS.get(
+        request.get('transcriptObjectConfig', {}).get('medium'))
+    agent_id = request.get('conversationConfig', {}).get('agentId')
+    count = 0
+    for transcript_uri in self._ingest_sources(
+        request['gcsSource']['bucketUri']):
+      conversation = {
+          'data_source': {
+              'gcs_source': {
+                  'transcript_uri': transcript_uri
+              }
+          },
+          'medium': medium
+      }
+      if agent_id:
+        conversation['agent_id'] = agent_id
+      with self._lock:
+        name = 'projects/{}/locations/{}/conversations/{}'.format(
+            match.group('project'), match.group('location'), next(self._ids))
+        self.conversations[name] = conversation
+        self._create_times[name] = now
+      count += 1
+    done_time = now + count * self._bulk_secs_per_item
+    metadata = {
+        '@type': _METADATA_TYPE.format('IngestConversationsMetadata'),
+        'createTime': _FormatTimestamp(now),
+        'endTime': _FormatTimestamp(done_time),
+        'request': request,
+        'ingestConversationsStats': {
+            'processedObjectCount': count,
+            'successfulIngestCount': count,
+            'failedIngestCount': 0,
+            'skippedObjectCount': 0,
+        },
+    }
+    return self._AddBulkOperation(match, done_time, metadata)
+
+  def _BulkAnalyze(self, match, request):
+    """Analyzes the conversations that match a filter."""
+    now = time.time()
+    names = [
+        name for name in self._MatchConversations(request.get('filter', ''))
+        if self._rng.random() * 100 < request.get('analysisPercentage', 100)
+    ]
+    done_time = now + SampleLatency(
+        self._analysis_secs, self._rng) + len(names) * self._bulk_secs_per_item
+    partial_errors = []
+    with self._lock:
+      for name in names:
+        if self._rng.random() < self._analysis_failure_rate:
+          partial_errors.append({
+              'code': 13,
+              'message': 'Injected analysis failure of {}.'.format(name)
+          })
+        else:
+          self._latest_analyses[name] = ('{}/analyses/{}'.format(
+              name, next(self._ids)), done_time)
+    metadata = {
+        '@type': _METADATA_TYPE.format('BulkAnalyzeConversationsMetadata'),
+        'createTime': _FormatTimestamp(now),
+        'endTime': _FormatTimestamp(done_time),
+        'request': request,
+        'totalRequestedAnalysesCount': len(names),
+        'completedAnalysesCount': len(names) - len(partial_errors),
+        'failedAnalysesCount': len(partial_errors),
+        'partialErrors': partial_errors,
+    }
+    return self._AddBulkOperation(match, done_time, metadata)
+
+  def _AddBulkOperation(self, match, done_time, metadata):
+    with self._lock:
+      name = 'projects/{}/locations/{}/operations/{}'.format(
+          match.group('project'), match.group('location'), next(self._ids))
+      self.operations[name] = (done_time, None)
+      self._operation_metadata[name] = metadata
+    return name
+
+  def _MatchConversations(self, conversation_filter):
+    """Returns the names of the conversations that match a filter.
+
+    Supports `create_time` and `agent_id` terms joined by `AND`.
+    """
+    terms = [(m.group('field'), m.group('op'), m.group('value'))
+             for m in _FILTER_TERM.finditer(conversation_filter)]
+    with self._lock:
+      conversations = list(self.conversations.items())
+    names = []
+    for name, request in conversations:
+      values = {
+          'create_time': self._create_times.get(name),
+          'agent_id': (request or {}).get('agent_id'),
+      }
+      matched = True
+      for field, op, value in terms:
+        actual = values.get(field)
+        if field == 'create_time':
+          value = _ParseTimestamp(value)
+        if actual is None or not {
+            '>=': actual >= value,
+            '<=': actual <= value,
+            '>': actual > value,
+            '<': actual < value,
+            '=': actual == value,
+        }[op]:
+          matched = False
+          break
+      if matched:
+        names.append(name)
+    return names
+
+  def _ListConversations(self, match):
+    query = urllib.parse.parse_qs(match.group('query'))
+    page_size = min(int(query.get('pageSize', ['100'])[0]), 1000)
+    offset = int(query.get('pageToken', ['0'])[0])
+    names = self._MatchConversations(query.get('filter', [''])[0])
+    now = time.time()
+    conversations = []
+    for name in names[offset:offset + page_size]:
+      with self._lock:
+        request = self.conversations.get(name) or {}
+        create_time = self._create_times.get(name, now)
+        latest_analysis = self._latest_analyses.get(name)
+      conversation = {
+          'name': name,
+          'createTime': _FormatTimestamp(create_time),
+          'dataSource': {
+              'gcsSource': {
+                  'transcriptUri': request.get('data_source', {}).get(
+                      'gcs_source', {}).get('transcript_uri')
+              }
+          },
+      }
+      if latest_analysis and latest_analysis[1] <= now:
+        conversation['latestAnalysis'] = {
+            'name': latest_analysis[0],
+            'createTime': _FormatTimestamp(latest_analysis[1]),
+        }
+      conversations.append(conversation)
+    body = {'conversations': conversations}
+    if offset + page_size < len(names):
+      body['nextPageToken'] = str(offset + page_size)
+    return 200, body
+
+  def _GetOperation(self, name):
+    with self._lock:
+      operation = self.operations.get(name)
+      if (operation and not self._keep_requests and
+          time.time() >= operation[0]):
+        del self.operations[name]
+    if not operation:
+      return 404, {'error': {'code': 404, 'message': name}}
+    done_time, error = operation
+    body = {'name': name, 'done': time.time() >= done_time}
+    if name in self._operation_metadata:
+      body['metadata'] = self._operation_metadata[name]
+    if body['done'] and error:
+      body['error'] = {'code': 13, 'message': error}
+    return 200, body
+
+
+def _RequestKind(path):
+  """Returns a label for the kind of request, for request counts."""
+  for kind, pattern in (('conversations', _CREATE_CONVERSATION_PATH),
+                        ('analyses', _CREATE_ANALYSIS_PATH),
+                        ('operations', _OPERATION_PATH),
+                        ('ingest', _INGEST_PATH),
+                        ('bulk_analyze', _BULK_ANALYZE_PATH),
+                        ('list', _LIST_CONVERSATIONS_PATH)):
+    if pattern.match(path):
+      return kind
+  return 'other'
+
+
+_WORDS = ('i', 'would', 'like', 'to', 'check', 'the', 'status', 'of', 'my',
+          'mortgage', 'application', 'please', 'can', 'you', 'help', 'me',
+          'with', 'a', 'refinance', 'rate', 'quote', 'thanks', 'for', 'calling',
+          'how', 'are', 'doing', 'today', 'account', 'number', 'payment')
+
+
+def SyntheticTranscriptResponse(duration_secs, words_per_minute=150, seed=0):
+  """Builds a two-channel speech response as Speech-to-text would return it.
+
+  Args:
+    duration_secs: The length of the transcribed call.
+    words_per_minute: Words spoken per minute, split across both channels.
+    seed: Seed for the random words.
+
+  Returns:
+    A `LongRunningRecognizeResponse` with word time offsets.
+  """
+  rng = random.Random(seed)
+  response = speech_types.LongRunningRecognizeResponse()
+  num_words = int(duration_secs * words_per_minute / 60)
+  secs_per_word = 60.0 / words_per_minute
+  offset = 0.0
+  while num_words > 0:
+    utterance_words = min(num_words, rng.randint(4, 30))
+    num_words -= utterance_words
+    result = response.results.add()
+    result.channel_tag = rng.randint(1, 2)
+    result.language_code = 'en-us'
+    alternative = result.alternatives.add()
+    alternative.confidence = rng.uniform(0.7, 1.0)
+    words = []
+    for _ in range(utterance_words):
+      word = alternative.words.add()
+      word.word = rng.choice(_WORDS)
+      words.append(word.word)
+      word.start_time.seconds = int(offset)
+      word.start_time.nanos = int(offset % 1 * 1e9)
+      offset += secs_per_word
+      word.end_time.seconds = int(offset)
+      word.end_time.nanos = int(offset % 1 * 1e9)
+    alternative.transcript = ' '.join(words)
+  return response
+
+
+def SyntheticAudioFile(container, sample_rate_hertz=8000, channels=2,
+                       bits_per_sample=16, size=64 * 1024):
+  """Builds an audio file with a valid header and silent content.
+
+  Args:
+    container: `WAV`, `WAV_MULAW`, `FLAC`, `OGG_OPUS`, `OGG_VORBIS` or `MP3`.
+    sample_rate_hertz: The sample rate in the header.
+    channels: The channel count in the header.
+    bits_per_sample: The bits per sample in WAV and FLAC headers.
+    size: The size of the file. The content after the header is zeros.
+
+  Returns:
+    The file, as bytes.
+  """
+  if container in ('WAV', 'WAV_MULAW'):
+    audio_format = 7 if container == 'WAV_MULAW' else 1
+    block_align = channels * bits_per_sample // 8
+    header = (b'RIFF' + struct.pack('<I', size - 8) + b'WAVE' +
+              b'LIST' + struct.pack('<I', 26) + b'INFOISFT' +
+              struct.pack('<I', 14) + b'Lavf58.29.100\x00' +
+              b'fmt ' + struct.pack('<IHHIIHH', 16, audio_format, channels,
+                                    sample_rate_hertz,
+                                    sample_rate_hertz * block_align,
+                                    block_align, bits_per_sample) +
+              b'data' + struct.pack('<I', size - 78))
+  elif container == 'FLAC':
+    # STREAMINFO: block sizes, frame sizes, then rate, channels and bits.
+    packed = ((sample_rate_hertz << 44) | ((channels - 1) << 41) |
+              ((bits_per_sample - 1) << 36))
+    header = (b'fLaC' + bytes([0x80, 0, 0, 34]) +
+              struct.pack('>HH', 4096, 4096) + b'\x00' * 6 +
+              struct.pack('>Q', packed) + b'\x00' * 16)
+  elif container in ('OGG_OPUS', 'OGG_VORBIS'):
+    if container == 'OGG_OPUS':
+      packet = (b'OpusHead' + struct.pack('<BBHIhB', 1, channels, 312,
+                                          sample_rate_hertz, 0, 0))
+    else:
+      packet = (b'\x01vorbis' + struct.pack('<IBI', 0, channels,
+                                            sample_rate_hertz) + b'\x00' * 14)
+    header = (b'OggS' + b'\x00\x02' + b'\x00' * 20 + bytes([1, len(packet)]) +
+              packet)
+  elif container == 'MP3':
+    header = b'\xff\xfb\x90\x64'
+  else:
+    raise ValueError('Unknown container `{}`.'.format(container))
+  return header + b'\x00' * (size - len(header))
+
+
+def _MakeCrc16Table():
+  table = []
+  for byte in range(256):
+    crc = byte << 8
+    for _ in range(8):
+      crc = ((crc << 1) ^ 0x8005 if crc & 0x8000 else crc << 1) & 0xFFFF
+    table.append(crc)
+  return table
+
+
+# CRC-16 of FLAC frames, polynomial 0x8005.
+_CRC16_TABLE = _MakeCrc16Table()
+
+
+def _Crc16(data):
+  crc = 0
+  table = _CRC16_TABLE
+  for byte in data:
+    crc = ((crc << 8) & 0xFFFF) ^ table[(crc >> 8) ^ byte]
+  return crc
+
+
+def _FlacFrame(frame_number, channels, noise):
+  """Builds a 16 bit FLAC frame of 4096 samples per channel.
+
+  Args:
+    frame_number: The number of the frame in the stream.
+    channels: The channel count.
+    noise: Random bytes for the samples of every channel, or None for digital
+      silence.
+  """
+  number = frame_number
+  if number < 0x80:
+    coded = bytes([number])
+  else:
+    # UTF-8 coding, as in FLAC frame headers.
+    tail = []
+    while not tail or number >= 0x40 >> len(tail):
+      tail.insert(0, 0x80 | (number & 0x3F))
+      number >>= 6
+    lead = (0xFF00 >> (len(tail) + 1)) & 0xFF
+    coded = bytes([lead | number] + tail)
+  # Block size code 12 is 4096 samples, and the sample rate is in STREAMINFO.
+  header = (b'\xff\xf8' + bytes([12 << 4, ((channels - 1) << 4) | (4 << 1)]) +
+            coded)
+  header += bytes([audio_chunking._Crc8(header)])  # pylint: disable=protected-access
+  if noise is None:
+    # A constant subframe of zeros for every channel.
+    subframes = b'\x00\x00\x00' * channels
+  else:
+    # A verbatim subframe for every channel.
+    size = 2 * 4096
+    subframes = b''.join(b'\x02' + noise[channel * size:(channel + 1) * size]
+                         for channel in range(channels))
+  frame = header + subframes
+  return frame + struct.pack('>H', _Crc16(frame))
+
+
+def _RandomBytes(rng, size):
+  """Returns `size` random bytes, like `Random.randbytes` of Python 3.9."""
+  if not size:
+    return b''
+  return rng.getrandbits(8 * size).to_bytes(size, 'little')
+
+
+def WriteSyntheticCall(path, container, duration_secs, sample_rate_hertz=8000,
+                       channels=2, seed=0):
+  """Writes a recording of speech, as loud noise, and pauses, as silence.
+
+  Utterances of 2 to 15 seconds alternate with pauses of 0.5 to 3 seconds,
+  so that quiet points can be found in the file.
+
+  Args:
+    path: The file to write.
+    container: `WAV` for 16 bit PCM, or `FLAC`.
+    duration_secs: The length of the recording, rounded up to a FLAC frame.
+    sample_rate_hertz: The sample rate.
+    channels: The channel count.
+    seed: Seed for the utterance lengths and the noise.
+  """
+  rng = random.Random(seed)
+  block_align = 2 * channels
+  frame_samples = 4096
+  total = -(-int(duration_secs * sample_rate_hertz) // frame_samples) * (
+      frame_samples)
+  # The loudness of every sample range, as (end sample, is speech).
+  ranges = []
+  position, speech = 0, True
+  while position < total:
+    length = rng.uniform(2, 15) if speech else rng.uniform(0.5, 3)
+    position = min(total, position + int(length * sample_rate_hertz))
+    ranges.append((position, speech))
+    speech = not speech
+  with open(path, 'wb') as f:
+    if container == 'WAV':
+      size = total * block_align
+      f.write(b'RIFF' + struct.pack('<I', 36 + size) + b'WAVE' + b'fmt ' +
+              struct.pack('<IHHIIHH', 16, 1, channels, sample_rate_hertz,
+                          sample_rate_hertz * block_align, block_align, 16) +
+              b'data' + struct.pack('<I', size))
+      start = 0
+      for end, speech in ranges:
+        size = (end - start) * block_align
+        f.write(_RandomBytes(rng, size) if speech else bytes(size))
+        start = end
+    elif container == 'FLAC':
+      packed = ((sample_rate_hertz << 44) | ((channels - 1) << 41) |
+                (15 << 36) | total)
+      f.write(b'fLaC' + bytes([0x80, 0, 0, 34]) +
+              struct.pack('>HH', frame_samples, frame_samples) +
+              b'\x00' * 6 + struct.pack('>Q', packed) + b'\x00' * 16)
+      index = 0
+      for frame_number in range(total // frame_samples):
+        start = frame_number * frame_samples
+        while ranges[index][0] <= start:
+          index += 1
+        # Frames that are entirely in a pause are silent.
+        silent = not ranges[index][1] and ranges[index][0] >= (
+            start + frame_samples)
+        noise = None if silent else _RandomBytes(
+            rng, frame_samples * block_align)
+        f.write(_FlacFrame(frame_number, channels, noise))
+    else:
+      raise ValueError('Unknown container `{}`.'.format(container))
+
+
+class FakeBlob(object):
+  """An in-memory stand-in for `google.cloud.storage.Blob`."""
+
+  # Size of the reads used to consume uploads, like a socket send buffer.
+  _READ_SIZE = 1024 * 1024
+
+  def __init__(self, bucket, name, chunk_size=None, size=None, md5_hash=None,
+               generation=None, updated=None):
+    self.bucket = bucket
+    self.name = name
+    self.chunk_size = chunk_size
+    self.size = size
+    self.md5_hash = md5_hash
+    self.crc32c = None
+    self.generation = generation
+    self.updated = updated
+
+  def upload_from_file(self, file_obj, rewind=False, size=None,
+                       content_type=None, **unused_kwargs):
+    del content_type  # Unused.
+    self.bucket.client.CheckUpload(self.name)
+    if rewind:
+      file_obj.seek(0)
+    digest = hashlib.md5()
+    total = 0
+    parts = []
+    read_size = self.chunk_size or self._READ_SIZE
+    while size is None or total < size:
+      data = file_obj.read(
+          read_size if size is None else min(read_size, size - total))
+      if not data:
+        break
+      digest.update(data)
+      total += len(data)
+      if self.bucket.client.keep_data:
+        parts.append(data)
+    self.md5_hash = base64.b64encode(digest.digest()).decode('ascii')
+    self.size = total
+    self.bucket.client.Store(self.bucket.name, self.name, b''.join(parts),
+                             total, self.md5_hash)
+    if self.bucket.client.upload_bytes_per_sec:
+      time.sleep(total / float(self.bucket.client.upload_bytes_per_sec))
+
+  def upload_from_filename(self, filename, content_type=None, **unused_kwargs):
+    with open(filename, 'rb') as f:
+      self.upload_from_file(f, content_type=content_type)
+
+  def download_as_string(self, start=None, end=None, **unused_kwargs):
+    data = self.bucket.client.Load(self.bucket.name, self.name)
+    if data is None:
+      raise google.api_core.exceptions.NotFound('gs://{}/{}'.format(
+          self.bucket.name, self.name))
+    # Like HTTP ranges, `end` is inclusive.
+    data = data[start or 0:None if end is None else end + 1]
+    self.bucket.client.CountDownload(len(data))
+    return data
+
+  def download_to_filename(self, filename, **unused_kwargs):
+    with open(filename, 'wb') as f:
+      f.write(self.download_as_string())
+
+  def compose(self, sources, **unused_kwargs):
+    # Composite objects have a crc32c hash, but no md5 hash.
+    self.size, self.crc32c = self.bucket.client.Compose(
+        self.bucket.name, self.name, [source.name for source in sources])
+    self.md5_hash = None
+
+  def delete(self, **unused_kwargs):
+    self.bucket.client.Delete(self.bucket.name, self.name)
+
+  def upload_from_string(self, data, content_type=None, **unused_kwargs):
+    self.bucket.client.CheckUpload(self.name)
+    if isinstance(data, str):
+      data = data.encode('utf-8')
+    self.bucket.client.Store(self.bucket.name, self.name,
+                             data if self.bucket.client.keep_data else b'',
+                             len(data), hashlib.md5(data).hexdigest())
+
+
+class FakeBucket(object):
+  """An in-memory stand-in for `google.cloud.storage.Bucket`."""
+
+  def __init__(self, client, name):
+    self.client = client
+    self.name = name
+
+  def blob(self, blob_name, chunk_size=None, **unused_kwargs):
+    return FakeBlob(self, blob_name, chunk_size)
+
+
+class FakeStorageClient(object):
+  """An in-memory stand-in for `google.cloud.storage.Client`.
+
+  Thread-safe, so one instance can be shared by every worker thread.
+  """
+
+  def __init__(self, keep_data=True, list_latency_secs=0.0,
+               list_page_size=1000, download_latency_secs=0.0,
+               upload_bytes_per_sec=0, upload_latency_secs=0.0,
+               error_rate=0.0, quota_rate=0, seed=0, notifications=None):
+    """Initializes the fake.
+
+    Args:
+      keep_data: Whether to keep uploaded bytes. Otherwise only the size and
+        md5 hash of every object are kept.
+      list_latency_secs: Time taken to serve each page of a listing.
+      list_page_size: The number of objects in each page of a listing.
+      download_latency_secs: Time taken to serve each download.
+      upload_bytes_per_sec: The bandwidth of each upload, like the throughput
+        of a single connection. Zero for no limit.
+      upload_latency_secs: Time taken to start each upload, as for
+        `SampleLatency`.
+      error_rate: The share of uploads that fail with `ServiceUnavailable`.
+      quota_rate: If set, uploads beyond this many per second fail with
+        `TooManyRequests`.
+      seed: Seed for the random latencies and errors.
+      notifications: A `FakeSubscriberClient` that receives an
+        `OBJECT_FINALIZE` notification for every new object, or None.
+    """
+    self.faults = FaultInjector(error_rate, quota_rate, seed)
+    self._rng = random.Random(seed)
+    self._notifications = notifications
+    self._generations = itertools.count(1)
+    self.upload_latency_secs = upload_latency_secs
+    self.keep_data = keep_data
+    self.list_latency_secs = list_latency_secs
+    self.list_page_size = list_page_size
+    self.download_latency_secs = download_latency_secs
+    self.upload_bytes_per_sec = upload_bytes_per_sec
+    self.downloads = 0
+    self.bytes_downloaded = 0
+    # Maps bucket names to (number of objects, name format, size).
+    self._synthetic = {}
+    self._lock = threading.Lock()
+    # Maps (bucket, name) to a dict of `data`, `size`, `md5_hash`,
+    # `generation` and `updated`.
+    self.objects = {}
+    self.bytes_uploaded = 0
+
+  def bucket(self, bucket_name):
+    return FakeBucket(self, bucket_name)
+
+  def CheckUpload(self, blob_name):
+    """Waits for the upload latency, and raises the injected error, if any."""
+    latency_secs = SampleLatency(self.upload_latency_secs, self._rng)
+    if latency_secs:
+      time.sleep(latency_secs)
+    self.faults.Check('upload of {}'.format(blob_name))
+
+  def _NewObject(self, bucket_name, blob_name, data, size, md5_hash):
+    """Stores an object. Requires the lock."""
+    item = {
+        'data': data,
+        'size': size,
+        'md5_hash': md5_hash,
+        'generation': next(self._generations),
+        'updated': datetime.datetime.now(datetime.timezone.utc),
+    }
+    self.objects[(bucket_name, blob_name)] = item
+    return item
+
+  def _Notify(self, bucket_name, blob_name, item):
+    """Publishes the notification of a new object, if there are any."""
+    if not self._notifications:
+      return
+    metadata = {
+        'bucket': bucket_name,
+        'name': blob_name,
+        'generation': str(item['generation']),
+        'size': str(item['size']),
+        'updated': _FormatTimestamp(item['updated'].timestamp()),
+    }
+    if item['md5_hash']:
+      metadata['md5Hash'] = item['md5_hash']
+    self._notifications.Publish({
+        'eventType': 'OBJECT_FINALIZE',
+        'payloadFormat': 'JSON_API_V1',
+        'bucketId': bucket_name,
+        'objectId': blob_name,
+        'objectGeneration': str(item['generation']),
+    }, json.dumps(metadata).encode('utf-8'))
+
+  def Store(self, bucket_name, blob_name, data, size, md5_hash):
+    with self._lock:
+      item = self._NewObject(bucket_name, blob_name, data, size, md5_hash)
+      self.bytes_uploaded += size
+    self._Notify(bucket_name, blob_name, item)
+
+  def Load(self, bucket_name, blob_name):
+    """Returns the data of an object, or None if it does not exist."""
+    with self._lock:
+      item = self.objects.get((bucket_name, blob_name))
+    return item['data'] if item else None
+
+  def Compose(self, bucket_name, blob_name, source_names):
+    """Concatenates objects into a new object.
+
+    Returns:
+      The size of the new object, and a base64 checksum that stands in for its
+      crc32c hash.
+
+    Raises:
+      google.api_core.exceptions.NotFound: If a source object does not exist.
+    """
+    with self._lock:
+      items = []
+      for source_name in source_names:
+        item = self.objects.get((bucket_name, source_name))
+        if item is None:
+          raise google.api_core.exceptions.NotFound('gs://{}/{}'.format(
+              bucket_name, source_name))
+        items.append(item)
+      data = b''.join(item['data'] for item in items)
+      size = sum(item['size'] for item in items)
+      crc32c = base64.b64encode(struct.pack('>I', zlib.crc32(
+          data) if self.keep_data else size)).decode('ascii')
+      item = self._NewObject(bucket_name, blob_name, data, size, None)
+    self._Notify(bucket_name, blob_name, item)
+    return size, crc32c
+
+  def Delete(self, bucket_name, blob_name):
+    """Deletes an object, or raises `NotFound` if it does not exist."""
+    with self._lock:
+      if self.objects.pop((bucket_name, blob_name), None) is None:
+        raise google.api_core.exceptions.NotFound('gs://{}/{}'.format(
+            bucket_name, blob_name))
+
+  def CountDownload(self, size):
+    """Counts a download, and waits for the download latency."""
+    with self._lock:
+      self.downloads += 1
+      self.bytes_downloaded += size
+    if self.download_latency_secs:
+      time.sleep(self.download_latency_secs)
+
+  def AddSyntheticObjects(self, bucket_name, num_objects,
+                          name_format='object-{:07d}', size=1024):
+    """Adds objects that are listed, but never stored.
+
+    Lets listings of millions of objects be benchmarked without keeping them
+    in memory. The md5 hash of every object is the hash of its name.
+
+    Args:
+      bucket_name: The bucket to add the objects to.
+      num_objects: The number of objects.
+      name_format: Formats the index of an object into its name. Names must
+        sort in index order, e.g. by zero-padding the index.
+      size: The size of every object.
+    """
+    self._synthetic[bucket_name] = (num_objects, name_format, size)
+
+  def list_blobs(self, bucket_or_name, max_results=None, prefix=None,
+                 **unused_kwargs):
+    bucket_name = getattr(bucket_or_name, 'name', bucket_or_name)
+    return _FakeBlobIterator(self, bucket_name, max_results, prefix)
+
+  def _ListNames(self, bucket_name, start_offset):
+    """Yields (name, size, md5 hash, generation, updated) for a bucket, in name
+    order."""
+    with self._lock:
+      stored = sorted((name, item['size'], item['md5_hash'],
+                       item['generation'], item['updated'])
+                      for (bucket, name), item in self.objects.items()
+                      if bucket == bucket_name and name >= start_offset)
+    num_objects, name_format, size = self._synthetic.get(
+        bucket_name, (0, '', 0))
+    # Binary search for the first synthetic object at or after the offset.
+    low, high = 0, num_objects
+    while low < high:
+      middle = (low + high) // 2
+      if name_format.format(middle) < start_offset:
+        low = middle + 1
+      else:
+        high = middle
+    synthetic = ((name, size, _GetSyntheticHash(name), 1, _SYNTHETIC_UPDATED)
+                 for name in (name_format.format(i)
+                              for i in range(low, num_objects)))
+    return heapq.merge(stored, synthetic)
+
+
+# The update time of synthetic objects.
+_SYNTHETIC_UPDATED = datetime.datetime(2020, 1, 1, tzinfo=datetime.timezone.utc)
+
+
+def _GetSyntheticHash(name):
+  return base64.b64encode(hashlib.md5(name.encode('utf-8')).digest()).decode(
+      'ascii')
+
+
+class _FakeBlobIterator(object):
+  """Imitates the page iterator returned by `Client.list_blobs`."""
+
+  def __init__(self, client, bucket_name, max_results, prefix):
+    self._client = client
+    self._bucket = FakeBucket(client, bucket_name)
+    self._max_results = max_results
+    self._prefix = prefix or ''
+    self.extra_params = {}
+    self.num_pages = 0
+
+  def __iter__(self):
+    start_offset = max(self.extra_params.get('startOffset', ''), self._prefix)
+    names = self._client._ListNames(self._bucket.name, start_offset)  # pylint: disable=protected-access
+    names = itertools.takewhile(lambda entry: entry[0].startswith(self._prefix),
+                                names)
+    if self._max_results is not None:
+      names = itertools.islice(names, self._max_results)
+    while True:
+      page = [
+          FakeBlob(self._bucket, name, size=size, md5_hash=md5_hash,
+                   generation=generation, updated=updated)
+          for name, size, md5_hash, generation, updated in itertools.islice(
+              names, self._client.list_page_size)
+      ]
+      if not page:
+        return
+      if self._client.list_latency_secs:
+        time.sleep(self._client.list_latency_secs)
+      self.num_pages += 1
+      for blob in page:
+        yield blob
+
+
+# Imitate the messages of `pubsub_v1.SubscriberClient.pull`.
+_PubsubMessage = collections.namedtuple(
+    '_PubsubMessage', ['message_id', 'attributes', 'data', 'publish_time'])
+_ReceivedMessage = collections.namedtuple('_ReceivedMessage',
+                                          ['ack_id', 'message'])
+_PullResponse = collections.namedtuple('_PullResponse', ['received_messages'])
+
+
+def _CheckSubscription(request):
+  """Raises if a Pub/Sub request has no subscription."""
+  if not isinstance(request, dict) or not request.get('subscription'):
+    raise TypeError('Expected a request dict with a subscription, got '
+                    '`{!r}`.'.format(request))
+
+
+class FakeSubscriberClient(object):
+  """A stand-in for `pubsub_v1.SubscriberClient`, with a single subscription.
+
+  Published messages are delivered to pulls in order. Messages that are not
+  acknowledged within the ack deadline are delivered again, and some messages
+  can be delivered twice, like Pub/Sub's at least once delivery.
+  """
+
+  def __init__(self, ack_deadline_secs=10.0, duplicate_rate=0.0, seed=0):
+    """Initializes the fake.
+
+    Args:
+      ack_deadline_secs: How long a pulled message may go unacknowledged before
+        it is delivered again.
+      duplicate_rate: The share of messages that are delivered twice.
+      seed: Seed for the duplicates.
+    """
+    self._ack_deadline_secs = ack_deadline_secs
+    self._duplicate_rate = duplicate_rate
+    self._rng = random.Random(seed)
+    self._condition = threading.Condition()
+    self._ids = itertools.count(1)
+    self._pending = collections.deque()
+    # Maps the ack ids of pulled messages to their deadlines and messages.
+    self._outstanding = {}
+    self.published = 0
+    self.pulls = 0
+    self.acknowledged = 0
+    self.redelivered = 0
+
+  def Publish(self, attributes, data=b''):
+    """Publishes a message to the subscription."""
+    with self._condition:
+      self.published += 1
+      message = _PubsubMessage(
+          str(next(self._ids)), dict(attributes), data, time.time())
+      self._pending.append(message)
+      if self._rng.random() < self._duplicate_rate:
+        self._pending.append(message)
+      self._condition.notify_all()
+
+  def _Redeliver(self, now):
+    """Makes the expired outstanding messages pending again."""
+    for ack_id, (deadline, message) in list(self._outstanding.items()):
+      if deadline <= now:
+        del self._outstanding[ack_id]
+        self._pending.append(message)
+        self.redelivered += 1
+
+  def pull(self, request, *, timeout=None, retry=None, metadata=()):
+    """Waits up to `timeout` seconds for messages, and returns them.
+
+    Like google-cloud-pubsub 2.x, only takes the request as a dict, so that
+    callers cannot rely on the positional arguments of 1.x.
+    """
+    del retry, metadata  # Unused.
+    max_messages = request['max_messages']
+    return_immediately = request.get('return_immediately', False)
+    _CheckSubscription(request)
+    deadline = time.time() + (timeout or 0)
+    with self._condition:
+      self.pulls += 1
+      while True:
+        now = time.time()
+        self._Redeliver(now)
+        if self._pending or return_immediately or now >= deadline:
+          break
+        next_expiry = min(
+            [expiry for expiry, _ in self._outstanding.values()] + [deadline])
+        self._condition.wait(max(0.0, next_expiry - now))
+      received = []
+      while self._pending and len(received) < max_messages:
+        message = self._pending.popleft()
+        ack_id = 'ack-{}'.format(next(self._ids))
+        self._outstanding[ack_id] = (now + self._ack_deadline_secs, message)
+        received.append(_ReceivedMessage(ack_id, message))
+    return _PullResponse(received)
+
+  def acknowledge(self, request, *, timeout=None, retry=None, metadata=()):
+    del timeout, retry, metadata  # Unused.
+    _CheckSubscription(request)
+    with self._condition:
+      for ack_id in request['ack_ids']:
+        if self._outstanding.pop(ack_id, None):
+          self.acknowledged += 1
+
+
+class _FakeOperationsClient(object):
+  """Serves the operations of a `FakeSpeechClient`."""
+
+  def __init__(self, speech_client):
+    self._speech_client = speech_client
+
+  def get_operation(self, name, retry=None, **unused_kwargs):
+    del retry  # Unused.
+    return self._speech_client.GetOperation(name)
+
+  def cancel_operation(self, name, **unused_kwargs):
+    del name  # Unused.
+
+
+class _FakeSpeechTransport(object):
+
+  def __init__(self, speech_client):
+    self._operations_client = _FakeOperationsClient(speech_client)
+
+
+class FakeSpeechClient(object):
+  """A stand-in for `speech_v1p1beta1.SpeechClient`.
+
+  Every long running recognize operation finishes after a random duration with
+  a synthetic transcript of its own. Operations are real `google.api_core` operations, so
+  they can also be looked up by name through `transport._operations_client`.
+  """
+
+  def __init__(self, transcribe_secs=0.0, call_secs=60, latency_secs=0.0,
+               seed=0, error_rate=0.0, quota_rate=0, realtime_factor=0,
+               audio_secs=None):
+    """Initializes the fake.
+
+    Args:
+      transcribe_secs: How long transcriptions take, as for `SampleLatency`.
+      call_secs: The length of the transcribed calls.
+      latency_secs: Time taken to schedule each transcription, as for
+        `SampleLatency`.
+      seed: Seed for the random durations.
+      error_rate: The share of transcription requests that fail with
+        `ServiceUnavailable`.
+      quota_rate: If set, transcription requests beyond this many per second
+        fail with `TooManyRequests`.
+      realtime_factor: If set, transcriptions also take the length of their
+        audio divided by this factor, like the real service. The length of
+        inline WAV and FLAC content is read from the content.
+      audio_secs: Returns the length of the audio at a uri. Without it, or for
+        content that cannot be read, `call_secs` is used.
+    """
+    self.faults = FaultInjector(error_rate, quota_rate, seed)
+    self._realtime_factor = realtime_factor
+    self._audio_secs = audio_secs
+    self._transcribe_secs = transcribe_secs
+    self._latency_secs = latency_secs
+    self._rng = random.Random(seed)
+    self._lock = threading.Lock()
+    self._ids = itertools.count(1)
+    self._call_secs = call_secs
+    self._seed = seed
+    self.transport = _FakeSpeechTransport(self)
+    # Maps operation names to their done times and audio lengths.
+    self.operations = {}
+    self.requests = 0
+    self.polls = 0
+    self.bytes_received = 0
+
+  def _GetAudioSecs(self, audio):
+    if audio.get('content'):
+      return audio_chunking.GetDurationSecs(
+          audio['content']) or self._call_secs
+    if self._audio_secs:
+      return self._audio_secs(audio['uri'])
+    return self._call_secs
+
+  def long_running_recognize(self, config, audio, **unused_kwargs):
+    del config  # Unused.
+    latency_secs = SampleLatency(self._latency_secs, self._rng)
+    if latency_secs:
+      time.sleep(latency_secs)
+    self.faults.Check('long_running_recognize')
+    audio_secs = self._GetAudioSecs(audio)
+    transcribe_secs = SampleLatency(self._transcribe_secs, self._rng)
+    if self._realtime_factor:
+      transcribe_secs += audio_secs / float(self._realtime_factor)
+    with self._lock:
+      self.requests += 1
+      self.bytes_received += len(audio.get('content') or b'')
+      name = str(next(self._ids))
+      self.operations[name] = (time.time() + transcribe_secs, audio_secs)
+    return google.api_core.operation.from_gapic(
+        operations_pb2.Operation(name=name),
+        self.transport._operations_client,  # pylint: disable=protected-access
+        speech_types.LongRunningRecognizeResponse,
+        metadata_type=speech_types.LongRunningRecognizeMetadata)
+
+  def GetOperation(self, name):
+    """Returns the `Operation` proto for an operation name."""
+    with self._lock:
+      self.polls += 1
+      entry = self.operations.get(name)
+    if entry is None:
+      raise google.api_core.exceptions.NotFound(name)
+    done_time, audio_secs = entry
+    operation = operations_pb2.Operation(name=name)
+    if time.time() >= done_time:
+      operation.done = True
+      operation.response.Pack(
+          SyntheticTranscriptResponse(audio_secs,
+                                      seed='{}-{}'.format(self._seed, name)))
+    return operation
+
+
+# Simple stand-ins for the DLP info types that the import tool redacts.
+_FAKE_PII = re.compile(r'[\w.+-]+@[\w-]+\.[\w.]+|\b\d[\d -]{6,}\d\b')
+
+
+class FakeDlpClient(object):
+  """A stand-in for `google.cloud.dlp.DlpServiceClient`.
+
+  Masks email addresses and long digit sequences with `*`, in text and table
+  items.
+  """
+
+  def __init__(self, latency_secs=0.0, bytes_per_sec=0, error_rate=0.0,
+               quota_rate=0, seed=0):
+    """Initializes the fake.
+
+    Args:
+      latency_secs: Time taken to serve each request, as for `SampleLatency`.
+      bytes_per_sec: Inspection speed, which adds time for large requests.
+        Zero for no limit.
+      error_rate: The share of requests that fail with `ServiceUnavailable`.
+      quota_rate: If set, requests beyond this many per second fail with
+        `TooManyRequests`.
+      seed: Seed for the random latencies and errors.
+    """
+    self.faults = FaultInjector(error_rate, quota_rate, seed)
+    self._rng = random.Random(seed)
+    self._latency_secs = latency_secs
+    self._bytes_per_sec = bytes_per_sec
+    self._lock = threading.Lock()
+    self.requests = 0
+    self.bytes_inspected = 0
+
+  def project_path(self, project):
+    return 'projects/{}'.format(project)
+
+  def deidentify_content(self, parent, inspect_config=None,
+                         deidentify_config=None, item=None, **unused_kwargs):
+    del parent, inspect_config, deidentify_config  # Unused.
+    if 'table' in item:
+      values = [row['values'][0]['string_value'] for row in item['table']['rows']]
+    else:
+      values = [item['value']]
+    size = sum(len(value) for value in values)
+    with self._lock:
+      self.requests += 1
+      self.bytes_inspected += size
+    delay = SampleLatency(self._latency_secs, self._rng)
+    if self._bytes_per_sec:
+      delay += size / float(self._bytes_per_sec)
+    if delay:
+      time.sleep(delay)
+    self.faults.Check('deidentify_content')
+    masked = [
+        _FAKE_PII.sub(lambda m: '*' * len(m.group(0)), value)
+        for value in values
+    ]
+    response = dlp_types.DeidentifyContentResponse()
+    if 'table' in item:
+      response.item.table.headers.add().name = (
+          item['table']['headers'][0]['name'])
+      for value in masked:
+        response.item.table.rows.add().values.add().string_value = value
+    else:
+      response.item.value = masked[0]
+    return response
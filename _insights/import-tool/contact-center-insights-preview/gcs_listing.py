@@ -0,0 +1,133 @@
+# Lint as: python3
+"""Lazy, filtered listing of the objects in a GCS bucket.
+
+Listing used to collect every object of a bucket into a list before any import
+work started. `ListObjects` instead yields objects as soon as each page of the
+listing arrives, asks GCS for only the fields the import tool needs, and lets
+GCS apply the prefix and start offset server-side.
+"""
+
+import argparse
+import collections
+import fnmatch
+
+# An object in GCS, as returned by `ListObjects`.
+GcsObject = collections.namedtuple(
+    'GcsObject',
+    ['uri', 'name', 'size', 'md5_hash', 'crc32c', 'generation', 'updated'])
+
+# Only the fields in `GcsObject` are requested, which shrinks listing pages.
+_FIELDS = 'items(name,size,md5Hash,crc32c,generation,updated),nextPageToken'
+
+_GLOB_CHARS = '*?['
+
+
+def ParseSuffixes(value):
+  """Parses a comma separated list of object name suffixes, e.g. `.wav,.flac`.
+
+  Args:
+    value: The suffixes string.
+
+  Returns:
+    A tuple of suffixes, suitable for `str.endswith`.
+
+  Raises:
+    argparse.ArgumentTypeError: If no suffix is given.
+  """
+  suffixes = tuple(s.strip() for s in value.split(',') if s.strip())
+  if not suffixes:
+    raise argparse.ArgumentTypeError(
+        'Invalid suffixes `{}`: expected e.g. `.wav,.flac`.'.format(value))
+  return suffixes
+
+
+def GetGlobPrefix(pattern):
+  """Returns the literal part of a glob pattern before its first wildcard.
+
+  Args:
+    pattern: A glob pattern, e.g. `calls/2021-*/*.wav`.
+
+  Returns:
+    The literal prefix, e.g. `calls/2021-`.
+  """
+  for i, char in enumerate(pattern):
+    if char in _GLOB_CHARS:
+      return pattern[:i]
+  return pattern
+
+
+def _GetServerPrefix(prefix, glob):
+  """Returns the narrowest prefix that GCS can filter on."""
+  prefix = prefix or ''
+  if glob:
+    glob_prefix = GetGlobPrefix(glob)
+    if glob_prefix.startswith(prefix):
+      prefix = glob_prefix
+  return prefix or None
+
+
+def Matches(name, prefix=None, glob=None, suffixes=None, start_offset=None):
+  """Returns whether an object name passes the listing filters.
+
+  Directory placeholders, whose names end in a slash, never do.
+
+  Args:
+    name: The object name.
+    prefix: The prefix the name must start with, if any.
+    glob: The `fnmatch` pattern the name must match, if any.
+    suffixes: The suffixes the name must end with one of, if any.
+    start_offset: The name must sort at or after this name, if set.
+  """
+  if name.endswith('/'):
+    return False
+  if prefix and not name.startswith(prefix):
+    return False
+  if start_offset and name < start_offset:
+    return False
+  if suffixes and not name.endswith(tuple(suffixes)):
+    return False
+  if glob and not fnmatch.fnmatchcase(name, glob):
+    return False
+  return True
+
+
+def ListObjects(storage_client, bucket, prefix=None, glob=None, suffixes=None,
+                start_offset=None, max_items=None):
+  """Lists the objects in a bucket, one page at a time.
+
+  Directory placeholders, whose names end in a slash, are skipped.
+
+  Args:
+    storage_client: The `google.cloud.storage.Client` to list with.
+    bucket: The name of the bucket.
+    prefix: Only list objects whose names start with this prefix.
+    glob: Only list objects whose full names match this `fnmatch` pattern. `*`
+      also matches slashes.
+    suffixes: Only list objects whose names end with one of these suffixes.
+    start_offset: Only list objects whose names are lexicographically equal to
+      or after this name, e.g. to continue an interrupted import.
+    max_items: Stop after this many matching objects. None for no limit.
+
+  Yields:
+    A `GcsObject` for every matching object, in lexicographic name order.
+  """
+  if max_items is not None and max_items <= 0:
+    return
+  blobs = storage_client.list_blobs(
+      bucket, prefix=_GetServerPrefix(prefix, glob), fields=_FIELDS)
+  if start_offset:
+    # Not exposed by this version of the storage library, but passed through
+    # to the JSON API as is.
+    blobs.extra_params['startOffset'] = start_offset
+  num_items = 0
+  for blob in blobs:
+    name = blob.name
+    # Checked again in case the server ignores any of the filters. Blobs
+    # ending in slashes are actually directory paths.
+    if not Matches(name, prefix, glob, suffixes, start_offset):
+      continue
+    yield GcsObject('gs://{}/{}'.format(bucket, name), name, blob.size,
+                    blob.md5_hash, blob.crc32c, blob.generation, blob.updated)
+    num_items += 1
+    if max_items is not None and num_items >= max_items:
+      return
@@ -5,21 +5,41 @@ Accepts either a local audio file or a GCS bucket of source audio files.
 In the latter case, assumes that every file has the same audio properties.
 
 Transcripts will be uploaded to the specified destination GCS bucket, and they
-will be named with the same basename as the corresponding audio file.
+will be named like the corresponding audio file, including its folders.
 
 For every audio file, a corresponding conversation will be created in Insights.
 Additionally, conditional on the `--analyze` flag, each conversation will also
 be analyzed a single time. This allows the user to observe the results of
 analysis after the script completes.
 
-TODO(b/149255107): Add test coverage.
+`fake_services.py` has local fakes of every service the tool calls, and
+`bench.py` runs the tool against them, e.g. `python3 bench.py pipeline`, and
+`import_conversations_test.py` tests it against them.
 """
 
 import argparse
+import asyncio
+import atexit
+import collections
+import concurrent.futures
+import datetime
+import functools
+import hashlib
+import heapq
+import io
+import itertools
+import json
 import os
+import random
+import sys
+import tempfile
+import threading
 import time
+import urllib.parse
 import requests
+import requests.adapters
 
+import google.api_core.operation
 import google.auth
 from google.auth import impersonated_credentials
 import google.auth.transport.requests
@@ -27,6 +47,39 @@ from google.cloud import speech_v1p1beta1
 from google.cloud import storage
 import google.cloud.dlp
 from google.cloud.speech_v1p1beta1 import enums
+from urllib3.util import retry
+
+import audio_chunking
+import audio_probe
+import checkpoint as checkpoint_lib
+import gcs_listing
+import local_upload
+import metrics
+import pii_filter
+import pipeline
+import rate_limiter
+import redaction
+import result_cache
+import sharding
+import transcript_writer
+import watch
+
+# The results file of sharded imports, if `--results_file` is not set.
+_DEFAULT_RESULTS_FILE = 'import_results.json'
+
+# How transcripts are redacted, see `_Redact`.
+_REDACT_DLP = 'dlp'
+_REDACT_PREFILTER = 'prefilter'
+_REDACT_LOCAL = 'local'
+
+
+def _ParseBool(value):
+  """Parses a boolean flag value, e.g. `true` or `0`."""
+  if value.lower() in ('true', 't', 'yes', '1'):
+    return True
+  if value.lower() in ('false', 'f', 'no', '0'):
+    return False
+  raise argparse.ArgumentTypeError('Not a boolean: `{}`.'.format(value))
 
 
 def _ParseArgs():
@@ -39,6 +92,12 @@ def _ParseArgs():
   source_group.add_argument(
       '--source_local_audio_path',
       help=('Path to a local audio file to process as input.'))
+  source_group.add_argument(
+      '--source_local_audio_dir',
+      help=('Path to a local directory containing audio files to process as '
+            'input, including subdirectories. Files are uploaded to '
+            '`--dest_gcs_bucket` under their relative names, and each file is '
+            'transcribed as soon as it is uploaded.'))
   source_group.add_argument(
       '--source_audio_gcs_bucket',
       help=(
@@ -54,6 +113,132 @@ def _ParseArgs():
       help=(
           'Path to a GCS bucket containing chat transcripts to process as input.'))
 
+  parser.add_argument(
+      '--prefix',
+      help=('Only import files from the source bucket whose names start with '
+            'this prefix, e.g. `calls/2021/`.'))
+  parser.add_argument(
+      '--glob',
+      help=('Only import files from the source bucket or directory whose names '
+            'match this glob pattern, e.g. `calls/*/*.wav`. `*` also matches '
+            '`/`.'))
+  parser.add_argument(
+      '--suffix',
+      type=gcs_listing.ParseSuffixes,
+      help=('Only import files from the source bucket or directory whose names '
+            'end with one of these comma separated suffixes, e.g. '
+            '`.wav,.flac`.'))
+  parser.add_argument(
+      '--start_offset',
+      help=('Only import files from the source bucket whose names sort at or '
+            'after this name, e.g. to continue an interrupted import.'))
+  parser.add_argument(
+      '--max_items',
+      type=int,
+      help=('Maximum number of files to import from the source bucket or '
+            'directory.'))
+  parser.add_argument(
+      '--bulk',
+      action='store_true',
+      help=('Import transcripts with one Insights bulk ingest request for the '
+            'bucket, or `--prefix`, and analyze them with one bulk analyze '
+            'request, instead of two requests per conversation. Falls back to '
+            'one conversation at a time for audio sources, with `--glob`, '
+            '`--suffix`, `--start_offset`, `--max_items`, `--num_shards` or '
+            '`--resume`, or if the bulk ingest request fails.'))
+  parser.add_argument(
+      '--watch',
+      action='store_true',
+      help=('Keep running, and import every new audio file in '
+            '`--source_audio_gcs_bucket` as soon as it is uploaded, filtered '
+            'with `--prefix`, `--glob` and `--suffix`. Files that existed '
+            'before are not imported. Uses the notifications of '
+            '`--watch_subscription`, or else lists the bucket every '
+            '`--watch_interval_secs`. Stops after `--max_items` files, if '
+            'set.'))
+  parser.add_argument(
+      '--watch_subscription',
+      help=('Pub/Sub subscription to the `OBJECT_FINALIZE` notifications of '
+            'the source bucket, e.g. `projects/PROJECT/subscriptions/NAME`. '
+            'Watchers that share it split the new files between them. Uses the '
+            'emulator at `PUBSUB_EMULATOR_HOST` if set. Requires the '
+            '`google-cloud-pubsub` package, version 1.1 or later.'))
+  parser.add_argument(
+      '--watch_interval_secs',
+      default=10.0,
+      type=float,
+      help=('Seconds between listings of the source bucket in `--watch` mode '
+            'without `--watch_subscription`. Default 10.'))
+  parser.add_argument(
+      '--watch_since',
+      help=('Also import files updated since this time in `--watch` mode, '
+            'e.g. `2021-06-01T12:00:00Z`, to catch up after the watcher was '
+            'stopped. Default: the start of the watch.'))
+  parser.add_argument(
+      '--watch_sorted_names',
+      action='store_true',
+      help=('New files in the source bucket always have names that sort after '
+            'older ones, e.g. because they start with the upload time. '
+            'Listings in `--watch` mode then start at the newest name, or at '
+            '`--start_offset` at first, so they cost the same however many '
+            'files the bucket holds.'))
+  parser.add_argument(
+      '--num_shards',
+      default=1,
+      type=int,
+      help=('Split the source files into this many shards by a stable hash of '
+            'their names, and only import the files of `--shard_index`, so '
+            'that several processes or machines can import one source without '
+            'duplicates. Every shard lists the whole source, and `--max_items` '
+            'applies before sharding. Default 1.'))
+  parser.add_argument(
+      '--shard_index',
+      default=0,
+      type=int,
+      help=('The shard to import, from 0 to `--num_shards` - 1. Its '
+            'checkpoint and results file get the shard in their names, e.g. '
+            '`import_checkpoint-00002-of-00008.db`.'))
+  parser.add_argument(
+      '--local_shards',
+      default=0,
+      type=int,
+      help=('Run this many shards as local processes with the other flags, '
+            'then merge their results files into `--results_file`.'))
+  parser.add_argument(
+      '--results_file',
+      help=('If set, the created conversations, analysis results and metrics '
+            'summary are written to this JSON file. Sharded imports always '
+            'write one per shard, `import_results.json` by default. Merge them '
+            'with `python3 sharding.py merge`.'))
+  parser.add_argument(
+      '--checkpoint_db',
+      help=('Path of a SQLite database that records the progress of every '
+            'source file, so that an interrupted import can be resumed with '
+            '`--resume`. Use one per import, since an import that does not '
+            'resume clears it. Disabled by default.'))
+  parser.add_argument(
+      '--resume',
+      action='store_true',
+      help=('Continue the import recorded in `--checkpoint_db`: skip finished '
+            'steps and poll operations that were already started. Otherwise '
+            'the checkpoint is cleared first. Requires `--checkpoint_db`.'))
+  parser.add_argument(
+      '--cache_dir',
+      help=('A local directory in which to cache transcription and redaction '
+            'results by the hash of their input, so that importing the same '
+            'audio again skips Speech-to-text and DLP. With `--redact`, only '
+            'redacted transcriptions are cached. Disabled by default.'))
+  parser.add_argument(
+      '--cache_max_gb',
+      default=5.0,
+      type=float,
+      help=('Maximum size of `--cache_dir`. The least recently used results '
+            'are evicted first. Default 5.'))
+  parser.add_argument(
+      '--cache_gcs_uri',
+      help=('A GCS prefix, e.g. `gs://bucket/cache/`, in which to cache '
+            'results in addition to `--cache_dir`, e.g. to share them between '
+            'machines.'))
   parser.add_argument(
       '--dest_gcs_bucket',
       help=('Name of the GCS bucket that will hold resulting transcript files. '
@@ -68,14 +253,178 @@ def _ParseArgs():
             'Otherwise, the gcloud default credential will be used.'))
   parser.add_argument(
       '--redact', default=False, help=('Whether to redact the transcripts.'))
+  parser.add_argument(
+      '--redact_mode',
+      default=_REDACT_DLP,
+      choices=[_REDACT_DLP, _REDACT_PREFILTER, _REDACT_LOCAL],
+      help=('How to redact transcripts. `dlp` sends every utterance to DLP. '
+            '`prefilter` scans utterances locally first and only sends the '
+            'ones with PII candidates to DLP. `local` masks the local '
+            'candidates without calling DLP. Local scanning does not detect '
+            'last names or spelled out numbers. Default `dlp`.'))
+  parser.add_argument(
+      '--pii_processes',
+      default=0,
+      type=int,
+      help=('Number of processes that scan utterances for PII candidates in '
+            'the `prefilter` and `local` redact modes. Default 0, one per '
+            'CPU.'))
+  parser.add_argument(
+      '--transcript_format',
+      default=transcript_writer.TEXT,
+      choices=transcript_writer.FORMATS,
+      help=('Format of the transcripts of audio files. `text` is the protobuf '
+            'text format of the Speech-to-text response, `json` its compact '
+            'JSON form and `entries` the format of chat transcripts, with one '
+            'entry per result. Default `text`.'))
+  parser.add_argument(
+      '--agent_channel',
+      default=2,
+      type=int,
+      help=('Audio channel of the agent, for `--transcript_format=entries`. '
+            'Other channels are customers. Default 2.'))
   parser.add_argument(
       '--analyze',
       default=True,
-      help=('Whether to analyze imported conversations. Default true.'))
+      type=_ParseBool,
+      help=('Whether to analyze imported conversations, `true` or `false`. '
+            'Default true.'))
   parser.add_argument(
       '--insights_endpoint',
       default='contactcenterinsights.googleapis.com',
-      help=('Name for the Insights endpoint to call'))
+      help=('Name for the Insights endpoint to call. May be prefixed with '
+            '`http://` or `https://`, e.g. to call a local fake.'))
+  parser.add_argument(
+      '--insights_workers',
+      default=8,
+      type=int,
+      help=('Number of conversations to create concurrently. Default 8.'))
+  parser.add_argument(
+      '--insights_rate',
+      default='1/s',
+      type=rate_limiter.ParseRate,
+      help=('Maximum rate of Insights create conversation requests, as '
+            'requests per second (`10/s`) or per minute (`600/m`). The rate '
+            'is cut by 30%% whenever Insights throttles requests, and grows '
+            'back while they succeed. Zero disables rate limiting until '
+            'Insights throttles. Default `1/s`.'))
+  parser.add_argument(
+      '--transcribe_concurrency',
+      default=20,
+      type=int,
+      help=('Maximum number of audio files being transcribed at the same '
+            'time. Default 20.'))
+  parser.add_argument(
+      '--speech_rate',
+      default='0.5/s',
+      type=rate_limiter.ParseRate,
+      help=('Maximum rate of Speech-to-text long running recognize requests. '
+            'Default `0.5/s`.'))
+  parser.add_argument(
+      '--redact_concurrency',
+      default=4,
+      type=int,
+      help=('Maximum number of concurrent DLP redaction requests. Default 4.'))
+  parser.add_argument(
+      '--upload_concurrency',
+      default=8,
+      type=int,
+      help=('Maximum number of concurrent transcript uploads. Default 8.'))
+  parser.add_argument(
+      '--analysis_concurrency',
+      default=20,
+      type=int,
+      help=('Maximum number of audio conversations being analyzed at the same '
+            'time. Default 20.'))
+  parser.add_argument(
+      '--analysis_rate',
+      default='0.5/s',
+      type=rate_limiter.ParseRate,
+      help=('Maximum rate of Insights create analysis requests, as requests '
+            'per second (`1/s`) or per minute (`30/m`). Default `0.5/s`.'))
+  parser.add_argument(
+      '--analysis_max_wait_secs',
+      default=3600,
+      type=int,
+      help=('How long to wait for analyses to finish. Analyses still running '
+            'after that are reported as timed out. Zero waits forever. '
+            'Default 3600.'))
+  parser.add_argument(
+      '--http_pool_size',
+      default=16,
+      type=int,
+      help=('Maximum number of kept-alive connections to the Insights '
+            'endpoint. Should be at least `--insights_workers`. Default 16.'))
+  parser.add_argument(
+      '--http_max_retries',
+      default=3,
+      type=int,
+      help=('Number of times to retry failed connections to the Insights '
+            'endpoint. Default 3.'))
+  parser.add_argument(
+      '--max_attempts',
+      default=5,
+      type=int,
+      help=('Number of times a call to Speech-to-text, DLP, GCS or Insights is '
+            'made before its file is reported as failed, when the service '
+            'throttles it or fails transiently. Retries wait with jittered '
+            'exponential backoff, and at least as long as `Retry-After`. '
+            'Default 5.'))
+  parser.add_argument(
+      '--retry_max_secs',
+      default=60.0,
+      type=float,
+      help=('Maximum delay between retries of a call. Default 60.'))
+  parser.add_argument(
+      '--metrics_file',
+      help=('If set, the latency, in-flight, error, retry and byte counts of '
+            'the calls to every service are written to this file in the '
+            'OpenMetrics text format every `--metrics_interval_secs`, e.g. '
+            'for the node_exporter textfile collector.'))
+  parser.add_argument(
+      '--metrics_port',
+      type=int,
+      help=('If set, the same metrics are served over HTTP on this port for '
+            'Prometheus to scrape while the import runs.'))
+  parser.add_argument(
+      '--metrics_interval_secs',
+      default=10.0,
+      type=float,
+      help=('How often `--metrics_file` is rewritten. Default 10.'))
+  parser.add_argument(
+      '--metrics_summary',
+      help=('If set, a JSON summary of the calls to every service, with '
+            'latency percentiles, is written to this file at the end of the '
+            'import. The summary is printed either way.'))
+  parser.add_argument(
+      '--upload_chunk_size_mb',
+      default=0,
+      type=int,
+      help=('If set, transcripts and local audio files are uploaded as '
+            'resumable uploads in chunks of this many MiB. Otherwise files up '
+            'to 8 MiB are uploaded in one request. Transcripts are encoded in '
+            'memory before they are uploaded, without a temporary file. This '
+            'is not faster than a temporary file, since encoding takes most '
+            'of the time, but it writes nothing to the working directory.'))
+  parser.add_argument(
+      '--audio_upload_concurrency',
+      default=8,
+      type=int,
+      help=('Maximum number of local audio files being uploaded at the same '
+            'time. Default 8.'))
+  parser.add_argument(
+      '--composite_upload_threshold_mb',
+      default=150,
+      type=int,
+      help=('Local audio files of at least this many MiB are uploaded as '
+            'parallel composite uploads: in parts, at the same time, that are '
+            'then composed into one object. Zero disables composite uploads. '
+            'Default 150.'))
+  parser.add_argument(
+      '--composite_upload_part_mb',
+      default=32,
+      type=int,
+      help=('Size of the parts of composite uploads, in MiB. Default 32.'))
   parser.add_argument(
       '--language_code',
       default='en-US',
@@ -83,14 +432,45 @@ def _ParseArgs():
   parser.add_argument(
       '--encoding',
       default='LINEAR16',
-      help=('Encoding for all imported data.'))
+      help=('Encoding for imported audio whose header is not recognized, or '
+            'for all imported audio with `--skip_audio_probe`.'))
   parser.add_argument(
       '--sample_rate_hertz',
       default=0,
       type=int,
       help=(
           'Sample rate. If left out, Speech-to-text may infer it depending on '
-          'the encoding.'))
+          'the encoding. Like `--encoding`, only used for audio whose header '
+          'is not recognized.'))
+  parser.add_argument(
+      '--skip_audio_probe',
+      action='store_true',
+      help=('Do not read the headers of WAV, FLAC and Ogg Opus audio files to '
+            'detect their encoding, sample rate and channel count. Use '
+            '`--encoding` and `--sample_rate_hertz` for every file instead, '
+            'as two channels.'))
+  parser.add_argument(
+      '--probe_concurrency',
+      default=32,
+      type=int,
+      help=('Maximum number of audio file headers being read at the same '
+            'time. Default 32.'))
+  parser.add_argument(
+      '--audio_segment_secs',
+      default=0,
+      type=float,
+      help=('Split WAV (16 bit PCM) and FLAC files longer than this many '
+            'seconds at quiet points, and transcribe the segments '
+            'concurrently. Segments stay below the 10 MB limit of inline '
+            'audio. Files are downloaded first, unless they are local. '
+            'Default 0, which transcribes every file whole. Requires the '
+            'audio probe.'))
+  parser.add_argument(
+      '--audio_segment_overlap_secs',
+      default=1.0,
+      type=float,
+      help=('Seconds of audio that neighbouring segments share, so that '
+            'words at a split are recognized whole. Default 1.'))
   parser.add_argument(
       '--insights_api_version',
       default='v1',
@@ -100,44 +480,39 @@ def _ParseArgs():
       help=(
           'Agent identifier to attach to the created Insights conversations.'))
 
-  return parser.parse_args()
-
-
-def _UploadFileToGcs(bucket_name, source_file_name, destination_blob_name,
-                     project_id, impersonated_service_account):
-  """Uploads a local audio file to GCS.
-
-  Args:
-    bucket_name: The name of the GCS bucket that will hold the file
-    source_file_name: The name of the source file
-    destination_blob_name: The name of the blob that will be uploaded to GCS.
-    project_id: The project ID (not number) to use.
-    impersonated_service_account: The service account to impersonate.
-  """
+  pargs = parser.parse_args()
+  if pargs.num_shards < 1 or not 0 <= pargs.shard_index < pargs.num_shards:
+    parser.error('--shard_index must be between 0 and --num_shards - 1.')
+  if pargs.resume and not pargs.checkpoint_db:
+    parser.error('--resume requires --checkpoint_db.')
+  if pargs.watch:
+    if not pargs.source_audio_gcs_bucket:
+      parser.error('--watch requires --source_audio_gcs_bucket.')
+    if pargs.num_shards > 1 or pargs.local_shards:
+      parser.error('--watch does not support shards. Share a '
+                   '--watch_subscription between watchers instead.')
+    if pargs.watch_since:
+      try:
+        watch.ParseTime(pargs.watch_since)
+      except ValueError:
+        parser.error('Invalid --watch_since `{}`.'.format(pargs.watch_since))
+  return pargs
 
-  storage_client = storage.Client(
-      project=project_id,
-      credentials=_GetClientCredentials(impersonated_service_account))
-  bucket = storage_client.bucket(bucket_name)
-  blob = bucket.blob(destination_blob_name)
-  blob.upload_from_filename(source_file_name)
 
-
-def _TranscribeAsync(storage_uri, encoding, language_code, sample_rate_hertz,
-                     impersonated_service_account):
-  """Transcribe long audio file from Cloud Storage.
+def _GetRecognitionConfig(encoding, language_code, sample_rate_hertz,
+                          audio_channel_count=2):
+  """Returns the recognition config for Speech-to-text.
 
   Args:
-    storage_uri: URI for audio file in Cloud Storage, e.g. gs://[BUCKET]/[FILE]
     encoding: The encoding to use for transcription
     language_code: The language code to use for transcription
     sample_rate_hertz: The sample rate of the audio
-    impersonated_service_account: The service account to impersonate.
+    audio_channel_count: The number of channels in the audio. Every channel is
+      recognized separately.
 
   Returns:
-    The transcription operation, which can be polled until done.
+    The config, as a dict.
   """
-
   encoding_map = {
       'LINEAR16':
           enums.RecognitionConfig.AudioEncoding.LINEAR16,
@@ -145,6 +520,8 @@ def _TranscribeAsync(storage_uri, encoding, language_code, sample_rate_hertz,
           enums.RecognitionConfig.AudioEncoding.MP3,
       'FLAC':
           enums.RecognitionConfig.AudioEncoding.FLAC,
+      'MULAW':
+          enums.RecognitionConfig.AudioEncoding.MULAW,
       'AMR':
           enums.RecognitionConfig.AudioEncoding.AMR,
       'AMR_WB':
@@ -155,54 +532,57 @@ def _TranscribeAsync(storage_uri, encoding, language_code, sample_rate_hertz,
           enums.RecognitionConfig.AudioEncoding.SPEEX_WITH_HEADER_BYTE
   }
 
-  # The recognition configuration. Assumes the audio is a two-channel phone
-  # call.
+  # The recognition configuration. Assumes the audio is a phone call.
   config = {
       'language_code': language_code,
       'encoding': encoding_map[encoding],
       'model': 'phone_call',
-      'audio_channel_count': 2,
+      'audio_channel_count': audio_channel_count,
       'use_enhanced': True,
-      'enable_separate_recognition_per_channel': True,
+      'enable_separate_recognition_per_channel': audio_channel_count > 1,
       'enable_automatic_punctuation': True,
       'enable_word_time_offsets': True
   }
 
   if sample_rate_hertz > 0:
     config['sample_rate_hertz'] = sample_rate_hertz
-
-  client = speech_v1p1beta1.SpeechClient(
-      credentials=_GetClientCredentials(impersonated_service_account))
-  audio = {'uri': storage_uri}
-  try:
-    operation = client.long_running_recognize(config, audio)
-    return operation
-  except (google.api_core.exceptions.GoogleAPIError) as e:
-    print('Error `{}` when scheduling async transcription for storage uri {}'
-          .format(e, storage_uri))
-    return None
+  return config
 
 
-def _Redact(transcript_response, project_id, impersonated_service_account):
-  """Redacts a transcript response.
+def _TranscribeAsync(storage_uri, encoding, language_code, sample_rate_hertz,
+                     impersonated_service_account, audio_channel_count=2,
+                     content=None):
+  """Transcribe long audio file from Cloud Storage.
 
   Args:
-    transcript_response: The response from transcription.
-    project_id: The project ID (not number) to use for redaction.
+    storage_uri: URI for audio file in Cloud Storage, e.g. gs://[BUCKET]/[FILE]
+    encoding: The encoding to use for transcription
+    language_code: The language code to use for transcription
+    sample_rate_hertz: The sample rate of the audio
     impersonated_service_account: The service account to impersonate.
+    audio_channel_count: The number of channels in the audio.
+    content: The audio itself, e.g. a segment of the file at `storage_uri`, to
+      send instead of the uri.
 
   Returns:
-    The response from transcription.
-  """
-  dlp = google.cloud.dlp_v2.DlpServiceClient(
-      project=project_id,
-      credentials=_GetClientCredentials(impersonated_service_account))
-  project_path = dlp.project_path(project_id)
+    The transcription operation, which can be polled until done.
 
-  # The list of types to redact. Making this too aggressive can damage word time
-  # offsets. Eventually, a better solution could be determined than sending the
-  # entire STT response to DLP so that only the transcript parts would be
-  # potentially redacted.
+  Raises:
+    google.api_core.exceptions.GoogleAPICallError: If the transcription could
+      not be scheduled.
+  """
+  config = _GetRecognitionConfig(encoding, language_code, sample_rate_hertz,
+                                 audio_channel_count)
+  client = _CLIENTS.GetSpeechClient(impersonated_service_account)
+  audio = {'content': content} if content else {'uri': storage_uri}
+  with _METRICS.Call('speech', 'long_running_recognize') as call:
+    call.AddBytes(sent=len(content or b''))
+    return client.long_running_recognize(config, audio)
+
+
+def _GetRedactionConfigs():
+  """Returns the DLP inspect and deidentify configs, as dicts."""
+  # The list of types to redact.
   info_types = [
       'LAST_NAME', 'EMAIL_ADDRESS', 'CREDIT_CARD_NUMBER', 'DATE_OF_BIRTH',
       'PHONE_NUMBER', 'STREET_ADDRESS'
@@ -228,35 +608,161 @@ def _Redact(transcript_response, project_id, impersonated_service_account):
       }
   }
 
-  item = {'value': str(transcript_response)}
-  response = dlp.deidentify_content(
-      project_path,
-      inspect_config=inspect_config,
-      deidentify_config=deidentify_config,
-      item=item,
-  )
-  return response.item.value
+  return inspect_config, deidentify_config
+
+
+def _Redact(transcript_response, project_id, impersonated_service_account,
+            cache=None, pii_scanner=None, redact_mode=_REDACT_DLP):
+  """Redacts a transcript response.
+
+  Only the transcripts are sent to DLP, in requests shared with concurrent
+  redactions. Words are masked like their transcripts, and time offsets are
+  kept.
+
+  Args:
+    transcript_response: The response from transcription.
+    project_id: The project ID (not number) to use for redaction.
+    impersonated_service_account: The service account to impersonate.
+    cache: A `result_cache.ResultCache` of redacted transcripts, or None.
+    pii_scanner: The `pii_filter.Scanner` to find PII candidates with. Required
+      unless `redact_mode` is `dlp`.
+    redact_mode: `dlp` to send every transcript to DLP, `prefilter` to only
+      send the transcripts with local PII candidates, or `local` to mask the
+      local candidates without DLP.
+
+  Returns:
+    The response from transcription, redacted in place.
+  """
+  transcripts = redaction.GetTranscripts(transcript_response)
+  if redact_mode == _REDACT_LOCAL:
+    redacted = [
+        pii_filter.MaskPii(transcript, matches) for transcript, matches in zip(
+            transcripts, pii_scanner.FindAll(transcripts))
+    ]
+    return redaction.ApplyRedactions(transcript_response, redacted)
+
+  if cache:
+    config = list(_GetRedactionConfigs())
+    if redact_mode != _REDACT_DLP:
+      config.append(redact_mode)
+    key = result_cache.MakeKey(
+        'dlp',
+        hashlib.sha256(json.dumps(transcripts).encode('utf-8')).hexdigest(),
+        config)
+    cached = cache.Get('dlp', key)
+    if cached is not None:
+      return redaction.ApplyRedactions(transcript_response,
+                                       json.loads(cached.decode('utf-8')))
+
+  redactor = _GetRedactor(project_id, impersonated_service_account)
+  if redact_mode == _REDACT_PREFILTER:
+    # Transcripts without PII candidates are kept as is.
+    redacted = list(transcripts)
+    indices = [
+        i for i, matches in enumerate(pii_scanner.FindAll(transcripts))
+        if matches
+    ]
+    if indices:
+      for i, text in zip(
+          indices, redactor.RedactTexts([transcripts[i] for i in indices])):
+        redacted[i] = text
+  else:
+    redacted = redactor.RedactTexts(transcripts)
+  if cache:
+    cache.Put('dlp', key, json.dumps(redacted).encode('utf-8'))
+  return redaction.ApplyRedactions(transcript_response, redacted)
+
+
+_REDACTORS = {}
+_REDACTORS_LOCK = threading.Lock()
+
+
+def _GetRedactor(project_id, impersonated_service_account):
+  """Returns the `redaction.Redactor` shared by all threads.
+
+  Args:
+    project_id: The project ID (not number) to use for redaction.
+    impersonated_service_account: The service account to impersonate.
+
+  Returns:
+    The redactor.
+  """
+  key = (project_id, impersonated_service_account)
+  with _REDACTORS_LOCK:
+    if key not in _REDACTORS:
+      inspect_config, deidentify_config = _GetRedactionConfigs()
+      _REDACTORS[key] = redaction.Redactor(
+          lambda: _CLIENTS.GetDlpClient(project_id,
+                                        impersonated_service_account),
+          project_id, inspect_config, deidentify_config, registry=_METRICS,
+          limiter=_GetLimiter('dlp', 0))
+    return _REDACTORS[key]
 
 
 def _UploadTranscript(transcript_response, bucket, transcript_file_name,
-                      project_id, impersonated_service_account):
+                      project_id, impersonated_service_account,
+                      chunk_size=None, transcript_format=transcript_writer.TEXT,
+                      agent_channel=2):
   """Uploads an audio file transcript to GCS.
 
+  The transcript is uploaded straight from memory, without a temporary file,
+  so concurrent callbacks can upload safely from any working directory. This
+  is not faster than a temporary file, since encoding the transcript takes
+  most of the time, see `bench.py transcript_upload`.
+
   Args:
     transcript_response: The response from transcription.
     bucket: The bucket that will hold the transcript
     transcript_file_name: The name of the file that will be uploaded.
     project_id: The project ID (not number) to use for redaction.
     impersonated_service_account: The service account to impersonate.
+    chunk_size: If set, the transcript is sent as a resumable upload in chunks
+      of this many bytes, which must be a multiple of 256 KiB.
+    transcript_format: One of the `transcript_writer.FORMATS`.
+    agent_channel: The audio channel of the agent, for the `entries` format.
+  """
+  transcript, size = _TranscriptToBuffer(transcript_response, transcript_format,
+                                         agent_channel)
+  storage_client = _CLIENTS.GetStorageClient(project_id,
+                                             impersonated_service_account)
+  blob = storage_client.bucket(bucket).blob(
+      transcript_file_name, chunk_size=chunk_size)
+  with _METRICS.Call('gcs', 'upload_transcript') as call:
+    blob.upload_from_file(
+        transcript,
+        size=size,
+        content_type=transcript_writer.CONTENT_TYPES[transcript_format])
+    call.AddBytes(sent=size)
+
+
+def _TranscriptToBuffer(transcript_response,
+                        transcript_format=transcript_writer.TEXT,
+                        agent_channel=2):
+  """Encodes a transcript into an in-memory buffer.
+
+  Args:
+    transcript_response: The response from transcription, or its redacted text.
+    transcript_format: One of the `transcript_writer.FORMATS`. Ignored for
+      redacted text.
+    agent_channel: The audio channel of the agent, for the `entries` format.
+
+  Returns:
+    A tuple of the buffer, positioned at the start, and its size in bytes.
   """
-  # Use an identifier that is unique across transcriptions to prevent a race.
-  tmp_file = 'tmp-{}-{}'.format(bucket, transcript_file_name)
-  f = open(tmp_file, 'w')
-  f.write(str(transcript_response))
-  f.close()
-  _UploadFileToGcs(bucket, tmp_file, transcript_file_name, project_id,
-                   impersonated_service_account)
-  os.remove(tmp_file)
+  buf = io.BytesIO()
+  if isinstance(transcript_response, str):
+    buf.write(transcript_response.encode('utf-8'))
+  elif (transcript_format != transcript_writer.TEXT or
+        [f.name for f, _ in transcript_response.ListFields()] == ['results']):
+    # Written one result at a time, so that the whole transcript is never held
+    # as one large string next to its encoding.
+    transcript_writer.WriteTranscript(transcript_response, buf,
+                                      transcript_format, agent_channel)
+  else:
+    buf.write(str(transcript_response).encode('utf-8'))
+  size = buf.tell()
+  buf.seek(0)
+  return buf, size
 
 
 def _CreateInsightsConversation(endpoint, api_version, project,
@@ -278,14 +784,10 @@ def _CreateInsightsConversation(endpoint, api_version, project,
   Returns:
     The conversation ID of the created conversation.
   """
-  oauth_token = _GetOauthToken(impersonated_service_account)
-  url = ('https://{}/{}/projects/{}/locations/us-central1/'
-         'conversations').format(endpoint, api_version, project)
-  headers = {
-      'charset': 'utf-8',
-      'Content-type': 'application/json',
-      'Authorization': 'Bearer {}'.format(oauth_token)
-  }
+  url = _GetInsightsUrl(
+      endpoint, api_version,
+      'projects/{}/locations/us-central1/conversations'.format(project))
+  headers = _GetInsightsHeaders(impersonated_service_account)
   data = {
       'data_source': {
           'gcs_source': {
@@ -300,13 +802,67 @@ def _CreateInsightsConversation(endpoint, api_version, project,
   if medium:
     data['medium'] = medium
 
-  r = requests.post(url, headers=headers, json=data)
-  if r.status_code == requests.codes.ok:
-    print('Successfully created conversation for transcript uri `{}` '
-          'and audio uri `{}`.'.format(gcs_transcript_uri, gcs_audio_uri))
-    return r.json()['name']
-  else:
+  r = _SendInsightsRequest('create_conversation', 'POST', url, headers, data)
+  print('Successfully created conversation for transcript uri `{}` '
+        'and audio uri `{}`.'.format(gcs_transcript_uri, gcs_audio_uri))
+  return r.json()['name']
+
+
+def _SendInsightsRequest(method_name, http_method, url, headers, data=None):
+  """Sends a request to Insights, and records its latency and size.
+
+  Args:
+    method_name: The name of the Insights method, for the metrics.
+    http_method: The HTTP method, e.g. `POST`.
+    url: The URL of the request.
+    headers: The headers of the request.
+    data: The JSON body of the request, if any.
+
+  Returns:
+    The `requests.Response`.
+
+  Raises:
+    requests.exceptions.HTTPError: If the response has an error status.
+  """
+  with _METRICS.Call('insights', method_name) as call:
+    r = _CLIENTS.GetInsightsSession().request(
+        http_method, url, headers=headers, json=data)
+    call.AddBytes(len(r.request.body or b''), len(r.content))
     r.raise_for_status()
+  return r
+
+
+def _GetInsightsHeaders(impersonated_service_account):
+  """Returns the headers for an Insights REST request.
+
+  Args:
+    impersonated_service_account: The service account to impersonate.
+
+  Returns:
+    The headers, including a current OAuth token.
+  """
+  return {
+      'charset': 'utf-8',
+      'Content-type': 'application/json',
+      'Authorization': 'Bearer {}'.format(
+          _GetOauthToken(impersonated_service_account))
+  }
+
+
+def _GetInsightsUrl(endpoint, api_version, path):
+  """Returns the URL for an Insights REST resource.
+
+  Args:
+    endpoint: The Insights endpoint. Uses https unless a scheme is given.
+    api_version: The Insights API version to use.
+    path: The resource path, e.g. `projects/p/locations/l/conversations`.
+
+  Returns:
+    The URL.
+  """
+  if not endpoint.startswith(('http://', 'https://')):
+    endpoint = 'https://{}'.format(endpoint)
+  return '{}/{}/{}'.format(endpoint, api_version, path)
 
 
 def _GetGcsUri(bucket, object_name):
@@ -322,31 +878,91 @@ def _GetGcsUri(bucket, object_name):
   return 'gs://{}/{}'.format(bucket, object_name)
 
 
-def _GetGcsUris(bucket, project_id, impersonated_service_account):
-  """Returns a list of GCS uris for files in a bucket.
+def _GetGcsObjects(bucket, project_id, impersonated_service_account,
+                   prefix=None, glob=None, suffixes=None, start_offset=None,
+                   max_items=None):
+  """Yields the files in a bucket, as the listing arrives.
 
   Args:
     bucket: The GCS bucket.
     project_id: The project ID (not number) to use.
     impersonated_service_account: The service account to impersonate.
+    prefix: Only list files whose names start with this prefix.
+    glob: Only list files whose names match this glob pattern.
+    suffixes: Only list files whose names end with one of these suffixes.
+    start_offset: Only list files whose names sort at or after this name.
+    max_items: The maximum number of files to yield. None for no limit.
+
+  Returns:
+    A generator of `gcs_listing.GcsObject`s.
+  """
+  storage_client = _CLIENTS.GetStorageClient(project_id,
+                                             impersonated_service_account)
+  return gcs_listing.ListObjects(storage_client, bucket, prefix, glob,
+                                 suffixes, start_offset, max_items)
+
+
+def _GetWatcher(pargs):
+  """Returns the watcher of the new objects of the source audio bucket.
+
+  Args:
+    pargs: The parsed arguments, with `--watch`.
 
   Returns:
+    A `watch.PubSubWatcher` with `--watch_subscription`, or else a
+    `watch.PollingWatcher`.
+  """
+  bucket = pargs.source_audio_gcs_bucket
+  if pargs.watch_subscription:
+    return watch.PubSubWatcher(
+        _CLIENTS.GetSubscriberClient(pargs.impersonated_service_account),
+        pargs.watch_subscription, bucket, pargs.prefix, pargs.glob,
+        pargs.suffix)
+  since = watch.ParseTime(pargs.watch_since) if pargs.watch_since else None
+  return watch.PollingWatcher(
+      lambda: _CLIENTS.GetStorageClient(pargs.project_id,
+                                        pargs.impersonated_service_account),
+      bucket, pargs.prefix, pargs.glob, pargs.suffix,
+      pargs.watch_interval_secs, since,
+      sorted_names=pargs.watch_sorted_names, start_offset=pargs.start_offset)
+
+
+def _FormatWatcherStats(watcher):
+  """Formats the counts of a watcher."""
+  if isinstance(watcher, watch.PubSubWatcher):
+    return ('Watched `{}` pulls with `{}` notifications, `{}` of them '
+            'duplicates.'.format(watcher.pulls, watcher.messages,
+                                 watcher.duplicates))
+  return 'Watched `{}` listings of `{}` objects.'.format(
+      watcher.listings, watcher.objects_listed)
+
+
+def _GetGcsUris(bucket, project_id, impersonated_service_account,
+                prefix=None, glob=None, suffixes=None, start_offset=None,
+                max_items=None):
+  """Yields the GCS uris for files in a bucket, as the listing arrives.
+
+  Args:
+    bucket: The GCS bucket.
+    project_id: The project ID (not number) to use.
+    impersonated_service_account: The service account to impersonate.
+    prefix: Only list files whose names start with this prefix.
+    glob: Only list files whose names match this glob pattern.
+    suffixes: Only list files whose names end with one of these suffixes.
+    start_offset: Only list files whose names sort at or after this name.
+    max_items: The maximum number of uris to yield. None for no limit.
+
+  Yields:
     The GCS uris.
   """
-  uris = []
-  storage_client = storage.Client(
-      project=project_id,
-      credentials=_GetClientCredentials(impersonated_service_account))
-  blobs = storage_client.list_blobs(bucket)
-  for blob in blobs:
-    # Blobs ending in slashes are actually directory paths.
-    if not blob.name.endswith('/'):
-      uris.append(_GetGcsUri(bucket, blob.name))
-  return uris
+  for gcs_object in _GetGcsObjects(bucket, project_id,
+                                   impersonated_service_account, prefix, glob,
+                                   suffixes, start_offset, max_items):
+    yield gcs_object.uri
 
 
-def _GetClientCredentials(impersonated_service_account):
-  """Gets client credentials for GCP requests.
+def _BuildClientCredentials(impersonated_service_account):
+  """Builds client credentials for GCP requests.
 
   If an account to impersonate is provided, then it will
   be used rather than the default. Otherwise, default gcloud
@@ -375,10 +991,101 @@ def _GetClientCredentials(impersonated_service_account):
   return target_credentials
 
 
+class _CredentialProvider(object):
+  """Shares one credential, and its OAuth token, across threads.
+
+  `GetToken` refreshes the token only when it is missing or about to expire,
+  under a lock, so concurrent workers never refresh a token that another
+  worker just refreshed. Refreshes requested by the client libraries, e.g.
+  after a 401, always refresh, and are only counted and serialized.
+  """
+
+  # Refresh tokens this long before they expire, so that a token is never
+  # handed out just before it becomes invalid.
+  _REFRESH_MARGIN = datetime.timedelta(minutes=5)
+
+  def __init__(self, credentials):
+    self._credentials = credentials
+    self._lock = threading.RLock()
+    self._request = google.auth.transport.requests.Request()
+    self.refresh_count = 0
+
+    refresh = credentials.refresh
+
+    def _Refresh(request):
+      with self._lock:
+        refresh(request)
+        self.refresh_count += 1
+
+    credentials.refresh = _Refresh
+
+  @property
+  def credentials(self):
+    return self._credentials
+
+  def _NeedsRefresh(self):
+    if not self._credentials.token:
+      return True
+    expiry = self._credentials.expiry
+    return bool(
+        expiry and expiry - datetime.datetime.utcnow() < self._REFRESH_MARGIN)
+
+  def GetToken(self):
+    """Returns an OAuth token, refreshing it first if it is about to expire."""
+    with self._lock:
+      if self._NeedsRefresh():
+        self._credentials.refresh(self._request)
+      return self._credentials.token
+
+
+_CREDENTIAL_PROVIDERS = {}
+_CREDENTIAL_PROVIDERS_LOCK = threading.Lock()
+
+
+def _GetCredentialProvider(impersonated_service_account):
+  """Returns the process-wide credential provider for an account.
+
+  Args:
+    impersonated_service_account: The service account to impersonate.
+
+  Returns:
+    The credential provider.
+  """
+  with _CREDENTIAL_PROVIDERS_LOCK:
+    provider = _CREDENTIAL_PROVIDERS.get(impersonated_service_account)
+    if not provider:
+      provider = _CredentialProvider(
+          _BuildClientCredentials(impersonated_service_account))
+      _CREDENTIAL_PROVIDERS[impersonated_service_account] = provider
+    return provider
+
+
+def _GetTokenRefreshCount():
+  """Returns the number of OAuth token refreshes performed by this process."""
+  with _CREDENTIAL_PROVIDERS_LOCK:
+    return sum(provider.refresh_count
+               for provider in _CREDENTIAL_PROVIDERS.values())
+
+
+def _GetClientCredentials(impersonated_service_account):
+  """Gets client credentials for GCP requests.
+
+  The credentials are created once per process and shared by all clients.
+
+  Args:
+    impersonated_service_account: The service account to impersonate.
+
+  Returns:
+    A credential for requests to GCP.
+  """
+  return _GetCredentialProvider(impersonated_service_account).credentials
+
+
 def _GetOauthToken(impersonated_service_account):
   """Gets an oauth token to use for HTTP requests to GCP.
 
-  Assumes usage of Gcloud credentials.
+  Assumes usage of Gcloud credentials. The token is cached and only refreshed
+  when it is about to expire.
 
   Args:
     impersonated_service_account: The service account to impersonate.
@@ -386,84 +1093,260 @@ def _GetOauthToken(impersonated_service_account):
   Returns:
     The oauth token.
   """
-  creds = _GetClientCredentials(impersonated_service_account)
-  auth_req = google.auth.transport.requests.Request()
-  creds.refresh(auth_req)
-  return creds.token
+  return _GetCredentialProvider(impersonated_service_account).GetToken()
+
+
+def _BuildStorageClient(project_id, impersonated_service_account):
+  return storage.Client(
+      project=project_id,
+      credentials=_GetClientCredentials(impersonated_service_account))
+
+
+def _BuildSpeechClient(project_id, impersonated_service_account):
+  del project_id  # Unused.
+  return speech_v1p1beta1.SpeechClient(
+      credentials=_GetClientCredentials(impersonated_service_account))
+
+
+def _BuildDlpClient(project_id, impersonated_service_account):
+  del project_id  # Unused. The project is part of every DLP request instead.
+  return google.cloud.dlp_v2.DlpServiceClient(
+      credentials=_GetClientCredentials(impersonated_service_account))
+
+
+def _BuildSubscriberClient(project_id, impersonated_service_account):
+  del project_id  # Unused. The project is part of the subscription name.
+  # Only needed by `--watch_subscription`.
+  from google.cloud import pubsub_v1  # pylint: disable=g-import-not-at-top
+  return pubsub_v1.SubscriberClient(
+      credentials=_GetClientCredentials(impersonated_service_account))
 
 
-def _GetTranscribeAsyncCallback(project_id, dest_bucket, audio_uri,
-                                insights_endpoint,
-                                api_version,
-                                should_redact, agent_id,
-                                conversation_names,
-                                impersonated_service_account):
-  """A callback for asynchronous transcription.
+class _CountingRetry(retry.Retry):
+  """Counts every retry of an Insights request in the metrics."""
+
+  def increment(self, *args, **kwargs):  # pylint: disable=arguments-differ
+    new_retry = super(_CountingRetry, self).increment(*args, **kwargs)
+    call = _METRICS.CurrentCall()
+    if call:
+      call.AddRetry()
+    return new_retry
+
+
+class _ClientRegistry(object):
+  """Builds every API client once and reuses it for all requests.
+
+  The gRPC clients (Speech, DLP and Pub/Sub) are thread-safe, so a single instance is
+  shared by the whole process. The Storage client wraps a `requests.Session`,
+  which is not thread-safe, so one is built per thread. Insights REST calls go
+  through one pooled session whose connections are kept alive.
+  """
+
+  def __init__(self):
+    self._lock = threading.Lock()
+    self._shared = {}
+    self._local = threading.local()
+    self._factories = {
+        'storage': _BuildStorageClient,
+        'speech': _BuildSpeechClient,
+        'dlp': _BuildDlpClient,
+        'subscriber': _BuildSubscriberClient,
+    }
+    self.http_pool_size = 16
+    self.http_max_retries = 3
+
+  def SetFactory(self, kind, factory):
+    """Overrides how a kind of client is built, e.g. to use a local fake.
+
+    Args:
+      kind: One of `storage`, `speech`, `dlp` or `subscriber`.
+      factory: A function of (project_id, impersonated_service_account) that
+        returns the client.
+    """
+    self._factories[kind] = factory
+    self.Reset()
+
+  def Reset(self):
+    """Drops all cached clients so that they are built again on next use."""
+    with self._lock:
+      self._shared = {}
+    self._local = threading.local()
+
+  def _GetShared(self, key, build):
+    with self._lock:
+      client = self._shared.get(key)
+      if client is None:
+        client = build()
+        self._shared[key] = client
+      return client
+
+  def _GetPerThread(self, key, build):
+    clients = getattr(self._local, 'clients', None)
+    if clients is None:
+      clients = self._local.clients = {}
+    client = clients.get(key)
+    if client is None:
+      client = clients[key] = build()
+    return client
+
+  def GetStorageClient(self, project_id, impersonated_service_account):
+    return self._GetPerThread(
+        ('storage', project_id, impersonated_service_account),
+        lambda: self._factories['storage'](project_id,
+                                           impersonated_service_account))
+
+  def GetSpeechClient(self, impersonated_service_account):
+    return self._GetShared(
+        ('speech', impersonated_service_account),
+        lambda: self._factories['speech'](None, impersonated_service_account))
+
+  def GetDlpClient(self, project_id, impersonated_service_account):
+    return self._GetShared(
+        ('dlp', project_id, impersonated_service_account),
+        lambda: self._factories['dlp'](project_id,
+                                       impersonated_service_account))
+
+  def GetSubscriberClient(self, impersonated_service_account):
+    return self._GetShared(
+        ('subscriber', impersonated_service_account),
+        lambda: self._factories['subscriber'](None,
+                                              impersonated_service_account))
+
+  def GetInsightsSession(self):
+    """Returns the pooled HTTP session for Insights REST calls."""
+    return self._GetShared(('insights',), self._BuildInsightsSession)
+
+  def _BuildInsightsSession(self):
+    # Connection errors are retried for every method. Server errors are only
+    # retried for GET, since retrying a POST could create duplicates.
+    max_retries = _CountingRetry(
+        total=self.http_max_retries,
+        backoff_factor=0.5,
+        status_forcelist=(500, 502, 503, 504),
+        method_whitelist=frozenset(['GET']),
+        raise_on_status=False)
+    adapter = requests.adapters.HTTPAdapter(
+        pool_connections=1,
+        pool_maxsize=self.http_pool_size,
+        max_retries=max_retries)
+    session = requests.Session()
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+_CLIENTS = _ClientRegistry()
+
+# Latencies, errors and bytes of all calls to remote services.
+_METRICS = metrics.Registry()
+
+# Retries of throttled and transient failures of calls to remote services.
+_RETRY_POLICY = rate_limiter.RetryPolicy(
+    retryable_errors=(requests.exceptions.ConnectionError,
+                      requests.exceptions.Timeout))
+
+# Retries of the POSTs that create conversations and analyses. A server error
+# or a timeout after the request was sent may still have created the resource,
+# and a retry would create a duplicate. These are only retried when Insights
+# throttled the request, or when no connection was made.
+_CREATE_RETRY_POLICY = rate_limiter.RetryPolicy(
+    retryable_errors=(requests.exceptions.ConnectTimeout,),
+    retryable_statuses=frozenset([429]))
+
+_LIMITERS = {}
+_LIMITERS_LOCK = threading.Lock()
+
+
+def _GetLimiter(quota, rate):
+  """Returns the adaptive rate limiter shared by all calls under a quota.
 
   Args:
-    project_id: The GCP project ID (not number) to hold the Insights
-      conversation object.
-    dest_bucket: The destination GCS bucket for the transcript file.
-    audio_uri: The uri of the audio file that was transcribed.
-    insights_endpoint: The endpoint for the Insights API.
-    api_version: The Insights API version to use.
-    should_redact: Whether to redact the transcription before saving.
-    agent_id: An agent identifier to attach to the conversations.
-    conversation_names: The list of conversation IDs created.
-    impersonated_service_account: The service account to impersonate.
+    quota: The quota, e.g. `speech` or `insights_analysis`.
+    rate: The initial and maximum requests per second. Zero for no limit until
+      the service throttles. A limiter with another rate is replaced.
 
   Returns:
-    The callback for asynchronous transcription.
+    The `rate_limiter.AdaptiveRateLimiter`.
   """
+  with _LIMITERS_LOCK:
+    limiter = _LIMITERS.get(quota)
+    if limiter is None or limiter.max_rate != rate:
+      limiter = _LIMITERS[quota] = rate_limiter.AdaptiveRateLimiter(rate)
+    return limiter
 
-  def Callback(future):
-    try:
-      response = future.result()
-    except google.api_core.exceptions.GoogleAPICallError as e:
-      print(
-          'Error `{}`: failed to transcribe audio uri `{}` with operation `{}` and '
-          'error `{}`.'.format(e, audio_uri, future.operation.name,
-                               future.exception()))
-      return
 
-    try:
-      if should_redact:
-        response = _Redact(response, project_id, impersonated_service_account)
-    except google.api_core.exceptions.GoogleAPICallError as e:
-      print('Error `{}`: failed to redact transcription from audio uri `{}`.'
-            .format(e, audio_uri))
-      return
+def _FormatLimiterStats():
+  """Returns the rates and throttled calls of every limiter, as a table."""
+  lines = ['{:<18} {:>10} {:>10} {:>10} {:>9}'.format(
+      'quota', 'max rate', 'lowest', 'final', 'throttled')]
+  with _LIMITERS_LOCK:
+    for quota, limiter in sorted(_LIMITERS.items()):
+      lines.append('{:<18} {:>10.2f} {:>10.2f} {:>10.2f} {:>9}'.format(
+          quota, limiter.max_rate, limiter.min_rate_seen, limiter.rate,
+          limiter.throttled))
+  return '\n'.join(lines)
 
-    try:
-      transcript_name = '{}.txt'.format(
-          os.path.basename(os.path.splitext(audio_uri)[0]))
-      _UploadTranscript(response, dest_bucket, transcript_name, project_id,
-                        impersonated_service_account)
-    except google.api_core.exceptions.GoogleAPICallError as e:
-      print('Error `{}`: failed to upload transcription from audio uri `{}`.'
-            .format(e, audio_uri))
-      return
 
-    try:
-      transcript_uri = _GetGcsUri(dest_bucket, transcript_name)
-      conversation_name = _CreateInsightsConversation(
-          insights_endpoint, api_version, project_id, audio_uri, transcript_uri,
-          agent_id, impersonated_service_account)
-      # Note: Appending to a python list is thread-safe, hence no lock.
-      conversation_names.append(conversation_name)
+def _RetryReporter(service, method, description):
+  """Returns the `on_retry` callback for retries of a call.
 
-    except requests.exceptions.HTTPError as e:
-      print('Error `{}`: failed to create insights conversation from audio uri '
-            '{} and transcript uri `{}`.'.format(e, audio_uri, transcript_uri))
+  Args:
+    service: The service, for the metrics.
+    method: The method of the service, for the metrics.
+    description: What is retried, e.g. `transcription of audio uri x`.
+  """
+
+  def _OnRetry(error, attempt, delay):
+    _METRICS.AddRetry(service, method)
+    print('Error `{}`: retrying {} in {:.1f}s, attempt {} of {}.'.format(
+        error, description, delay, attempt + 1, _RETRY_POLICY.max_attempts))
+
+  return _OnRetry
+
+
+def _RunConcurrently(fn, items, num_workers):
+  """Runs `fn` over `items` on a pool of worker threads.
+
+  At most a few items per worker are in flight at any time, so `items` may be
+  an arbitrarily large iterable.
+
+  Args:
+    fn: The function to call with each item.
+    items: The items to process.
+    num_workers: The number of worker threads.
+
+  Yields:
+    The result of `fn` for every item, in completion order.
+  """
+  max_in_flight = max(1, num_workers) * 2
+  items = iter(items)
+  with concurrent.futures.ThreadPoolExecutor(
+      max_workers=max(1, num_workers)) as executor:
+    in_flight = set()
+    for item in items:
+      in_flight.add(executor.submit(fn, item))
+      if len(in_flight) >= max_in_flight:
+        done, in_flight = concurrent.futures.wait(
+            in_flight, return_when=concurrent.futures.FIRST_COMPLETED)
+        for future in done:
+          yield future.result()
+    for future in concurrent.futures.as_completed(in_flight):
+      yield future.result()
 
-  return Callback
 
 def _ImportConversationsFromTranscript(transcript_uris, project_id, medium,
                                      insights_endpoint, api_version,
                                      should_redact, agent_id,
-                                     impersonated_service_account):
+                                     impersonated_service_account,
+                                     num_workers=1, insights_rate=1.0,
+                                     checkpoint=None):
   """Create conversations in Insights for a list of transcript uris.
 
+  Conversations are created by `num_workers` concurrent workers that share an
+  adaptive rate limiter, so the request rate stays at, but never above,
+  `insights_rate`, and drops while Insights throttles. Throttled and transient
+  failures are retried.
+
   Args:
     transcript_uris: The transcript uris for which conversations should be created.
     project_id: The project ID (not number) to use for redaction and Insights.
@@ -473,31 +1356,272 @@ def _ImportConversationsFromTranscript(transcript_uris, project_id, medium,
     should_redact: Whether to redact transcriptions with DLP.
     agent_id: An agent identifier to attach to the conversations.
     impersonated_service_account: The service account to impersonate.
+    num_workers: The number of conversations to create concurrently.
+    insights_rate: The maximum create requests per second. Zero for no limit.
+    checkpoint: The `checkpoint.Checkpoint` to record progress in, or None.
+      Transcripts that already have a conversation are skipped.
 
   Returns:
     A list of conversations IDs for the created conversations.
   """
-  conversation_names = []
-  for transcript_uri in transcript_uris:
-    conversation_name = _CreateInsightsConversation(
-	insights_endpoint, api_version, project_id, None, transcript_uri,
-    agent_id, impersonated_service_account, medium)
-    conversation_names.append(conversation_name)
+  # Shared by all workers to avoid exceeding Insights quota.
+  limiter = _GetLimiter('insights', insights_rate)
+
+  def _Import(transcript_uri):
+    if checkpoint:
+      record = checkpoint.Get(transcript_uri)
+      if record and record.conversation_name:
+        return None
+    try:
+      conversation_name = _CREATE_RETRY_POLICY.Call(
+          functools.partial(_CreateInsightsConversation, insights_endpoint,
+                            api_version, project_id, None, transcript_uri,
+                            agent_id, impersonated_service_account, medium),
+          limiter,
+          _RetryReporter(
+              'insights', 'create_conversation',
+              'conversation for transcript uri `{}`'.format(transcript_uri)))
+    except requests.exceptions.RequestException as e:
+      print('Error `{}`: failed to create insights conversation from '
+            'transcript uri `{}`.'.format(e, transcript_uri))
+      if checkpoint:
+        checkpoint.Update(transcript_uri, error=str(e))
+      return None
+    if checkpoint:
+      checkpoint.Update(transcript_uri, checkpoint_lib.CREATED,
+                        transcript_uri=transcript_uri,
+                        conversation_name=conversation_name)
+    return conversation_name
 
-    # Sleep to avoid exceeding Insights quota.
-    time.sleep(1)
+  conversation_names = []
+  for conversation_name in _RunConcurrently(_Import, transcript_uris,
+                                            num_workers):
+    if conversation_name:
+      conversation_names.append(conversation_name)
 
   return conversation_names
 
+# Concurrency and rate limits for the stages of the audio import pipeline.
+# Rates are in requests per second, and zero means no limit. The source is read
+# `source_batch_size` items at a time; 1 passes every item on as soon as it
+# arrives, e.g. when watching a bucket.
+_PipelineLimits = collections.namedtuple(
+    '_PipelineLimits', [
+        'transcribe_concurrency', 'speech_rate', 'redact_concurrency',
+        'upload_concurrency', 'create_concurrency', 'insights_rate',
+        'analyze_concurrency', 'analysis_rate', 'analysis_max_wait_secs',
+        'poll_initial_secs', 'poll_max_secs', 'probe_concurrency',
+        'audio_upload_concurrency', 'source_batch_size'
+    ],
+    defaults=(20, 0.5, 4, 8, 8, 1.0, 20, 0.5, 3600, 5.0, 60.0, 32, 8, 100))
+
+
+class _AudioImport(object):
+  """The state of one audio file as it moves through the import pipeline."""
+
+  def __init__(self, audio_uri, record=None, content_hash=None,
+               local_file=None):
+    """Initializes the state.
+
+    Args:
+      audio_uri: The audio file.
+      record: The `checkpoint.Record` of an earlier import of the file, if any.
+      content_hash: The md5 or crc32c hash of the audio file, if known.
+      local_file: The `local_upload.LocalFile` that is uploaded to the audio
+        uri, if any.
+    """
+    self.audio_uri = audio_uri
+    self.content_hash = content_hash
+    self.local_file = local_file
+    # Whether the local file still needs to be uploaded.
+    self.needs_upload = bool(local_file) and not (
+        record and record.state != checkpoint_lib.PENDING)
+    # The `audio_probe.AudioInfo` of the file, if it was recognized.
+    self.audio_info = None
+    # The transcription response, or its redacted text. Dropped once uploaded.
+    self.transcript = None
+    # The key under which the transcript is cached, if any.
+    self.cache_key = None
+    # Whether the transcript came from the cache already redacted.
+    self.redacted = False
+    self.transcribe_operation = record and record.transcribe_operation
+    self.transcript_uri = record and record.transcript_uri
+    self.conversation_name = record and record.conversation_name
+    self.analysis_operation = record and record.analysis_operation
+    self.analysis_result = None
+
+  def __str__(self):
+    return self.audio_uri
+
+
+def _GetTranscribeOperation(operation_name, impersonated_service_account):
+  """Looks up a transcription operation that was started earlier.
+
+  Args:
+    operation_name: The name of the operation.
+    impersonated_service_account: The service account to impersonate.
+
+  Returns:
+    The transcription operation, which can be polled until done.
+  """
+  client = _CLIENTS.GetSpeechClient(impersonated_service_account)
+  operations_client = client.transport._operations_client  # pylint: disable=protected-access
+  with _METRICS.Call('speech', 'get_operation'):
+    operation = operations_client.get_operation(operation_name)
+  return google.api_core.operation.from_gapic(
+      operation, operations_client,
+      speech_v1p1beta1.types.LongRunningRecognizeResponse,
+      metadata_type=speech_v1p1beta1.types.LongRunningRecognizeMetadata)
+
+
+def _IsTranscribeOperationDone(operation):
+  """Polls a transcription operation, and records the poll in the metrics.
+
+  Args:
+    operation: The transcription operation.
+
+  Returns:
+    Whether the operation is done.
+  """
+  with _METRICS.Call('speech', 'get_operation'):
+    return operation.done()
+
+
+def _UploadAudioFile(uploader, local_file):
+  """Uploads a local audio file, and records the upload in the metrics.
+
+  Args:
+    uploader: The `local_upload.Uploader`.
+    local_file: The `local_upload.LocalFile` to upload.
+
+  Returns:
+    The hash of the uploaded object.
+  """
+  with _METRICS.Call('gcs', 'upload_audio') as call:
+    content_hash = uploader.Upload(local_file)
+    call.AddBytes(sent=local_file.size)
+  return content_hash
+
+
+def _DownloadAudio(audio_uri, project_id, impersonated_service_account):
+  """Downloads an audio file from Cloud Storage to a temporary file.
+
+  Args:
+    audio_uri: The `gs://` uri of the file.
+    project_id: The project ID (not number) to use for the download.
+    impersonated_service_account: The service account to impersonate.
+
+  Returns:
+    The path of the temporary file, which the caller removes.
+  """
+  bucket, _, name = audio_uri[len('gs://'):].partition('/')
+  storage_client = _CLIENTS.GetStorageClient(project_id,
+                                             impersonated_service_account)
+  blob = storage_client.bucket(bucket).blob(name)
+  fd, path = tempfile.mkstemp(suffix=os.path.splitext(name)[1])
+  os.close(fd)
+  try:
+    with _METRICS.Call('gcs', 'download_audio') as call:
+      blob.download_to_filename(path)
+      call.AddBytes(received=os.path.getsize(path))
+  except:
+    os.remove(path)
+    raise
+  return path
+
+
+def _GetPendingAudioImports(audio_uris, checkpoint, analyze, uploader=None):
+  """Yields an `_AudioImport` for every audio uri that is not done yet.
+
+  Args:
+    audio_uris: The audio uris, `gcs_listing.GcsObject`s or
+      `local_upload.LocalFile`s.
+    checkpoint: The `checkpoint.Checkpoint` of earlier imports, or None.
+    analyze: Whether conversations are analyzed, i.e. whether created
+      conversations still have work left.
+    uploader: The `local_upload.Uploader` that determines the uris of local
+      files.
+  """
+  finished_states = (checkpoint_lib.DONE,) if analyze else (
+      checkpoint_lib.CREATED, checkpoint_lib.ANALYZING, checkpoint_lib.DONE)
+  num_skipped = 0
+  for audio_uri in audio_uris:
+    content_hash = None
+    local_file = None
+    if isinstance(audio_uri, gcs_listing.GcsObject):
+      content_hash = audio_uri.md5_hash or audio_uri.crc32c
+      audio_uri = audio_uri.uri
+    elif isinstance(audio_uri, local_upload.LocalFile):
+      local_file = audio_uri
+      audio_uri = uploader.GetUri(local_file)
+    record = checkpoint.Get(audio_uri) if checkpoint else None
+    if record and record.state in finished_states:
+      num_skipped += 1
+      continue
+    yield _AudioImport(audio_uri, record, content_hash, local_file)
+  if num_skipped:
+    print('Skipped `{}` audio files that were imported earlier.'.format(
+        num_skipped))
+
+
+def _GetTranscriptName(item, transcript_format):
+  """Returns the object name of the transcript of an audio file.
+
+  Transcripts keep the folders of their audio files, relative to the source
+  directory for local files, so that files with the same name in different
+  folders do not overwrite each other's transcript.
+
+  Args:
+    item: The `_AudioImport` of the audio file.
+    transcript_format: One of the `transcript_writer.FORMATS`.
+  """
+  if item.local_file:
+    name = item.local_file.name
+  else:
+    name = item.audio_uri[len('gs://'):].partition('/')[2]
+  return os.path.splitext(name)[0] + transcript_writer.EXTENSIONS[
+      transcript_format]
+
+
 def _ImportConversationsFromAudio(audio_uris, encoding, language_code,
                                      sample_rate_hertz, project_id, dest_bucket,
                                      insights_endpoint, api_version,
                                      should_redact, agent_id,
-                                     impersonated_service_account):
+                                     impersonated_service_account,
+                                     upload_chunk_size=None, analyze=True,
+                                     limits=None, checkpoint=None,
+                                     cache=None, pii_scanner=None,
+                                     redact_mode=_REDACT_DLP,
+                                     transcript_format=transcript_writer.TEXT,
+                                     agent_channel=2, prober=None,
+                                     uploader=None, segment_secs=0,
+                                     segment_overlap_secs=1.0):
   """Create conversations in Insights for a list of audio uris.
 
+  Audio files flow through an asyncio pipeline of stages: transcribe, redact
+  (optional), upload, create conversation and analyze (optional). Every stage
+  has its own concurrency limit and a bounded input queue, so memory use stays
+  flat however many audio uris there are.
+
+  With a checkpoint, the progress of every audio file is recorded, and steps
+  that an earlier import finished are skipped. Transcription and analysis
+  operations that an earlier import started are polled rather than started
+  again.
+
+  With a cache, transcription and redaction results are looked up by the hash
+  of their input, and a hit skips the call to Speech-to-text or DLP. With
+  `should_redact`, transcriptions are only cached once redacted, and a hit
+  also skips redaction.
+
+  With `segment_secs`, WAV and FLAC files longer than that are split at quiet
+  points into overlapping segments, which are transcribed concurrently and
+  stitched into one transcript. Segment operations are not checkpointed, so a
+  resumed import transcribes such files again.
+
   Args:
-    audio_uris: The audio uris for which conversations should be created.
+    audio_uris: The audio uris for which conversations should be created, or
+      their `gcs_listing.GcsObject`s, whose hashes enable caching of their
+      transcriptions. May be any iterable, which is consumed lazily.
     encoding: The language encoding for Speech-to-text.
     language_code: The language code for Speech-to-text.
     sample_rate_hertz: The sample rate of the audios.
@@ -509,145 +1633,1119 @@ def _ImportConversationsFromAudio(audio_uris, encoding, language_code,
     should_redact: Whether to redact transcriptions with DLP.
     agent_id: An agent identifier to attach to the conversations.
     impersonated_service_account: The service account to impersonate.
+    upload_chunk_size: The chunk size for resumable transcript uploads, or None
+      to let the storage library decide.
+    analyze: Whether to analyze every created conversation.
+    limits: The `_PipelineLimits` for the stages. Uses the defaults if None.
+    checkpoint: The `checkpoint.Checkpoint` to record progress in, or None.
+    cache: The `result_cache.ResultCache` of transcription and redaction
+      results, or None.
+    pii_scanner: The `pii_filter.Scanner` for the `prefilter` and `local`
+      redact modes.
+    redact_mode: How to redact transcriptions, as in `_Redact`.
+    transcript_format: The format of uploaded transcripts, one of the
+      `transcript_writer.FORMATS`.
+    agent_channel: The audio channel of the agent, for the `entries` format.
+    prober: The `audio_probe.Prober` that detects the encoding, sample rate
+      and channel count of every file. Without one, or for files it does not
+      recognize, `encoding` and `sample_rate_hertz` are used, as two channels.
+    uploader: The `local_upload.Uploader` for `local_upload.LocalFile`s in
+      `audio_uris`. Required if there are any.
+    segment_secs: The longest segment of a WAV or FLAC file to transcribe on
+      its own, or 0 to transcribe every file whole.
+    segment_overlap_secs: How much audio neighbouring segments share.
 
   Returns:
-    A list of conversations IDs for the created conversations.
+    A tuple of the list of conversation IDs for the created conversations, and
+    the list of `_AnalysisResult`s, which is empty unless `analyze` is set.
   """
+  limits = limits or _PipelineLimits()
   conversation_names = []
-  operations = []
-  for audio_uri in audio_uris:
-    operation = _TranscribeAsync(audio_uri, encoding, language_code,
-                                 sample_rate_hertz,
-                                 impersonated_service_account)
+  analysis_results = []
+  # Limiters shared by all workers of a stage, to avoid exceeding quotas.
+  speech_limiter = _GetLimiter('speech', limits.speech_rate)
+  gcs_limiter = _GetLimiter('gcs', 0)
+  insights_limiter = _GetLimiter('insights', limits.insights_rate)
+  analysis_limiter = _GetLimiter('insights_analysis', limits.analysis_rate)
+  executor = concurrent.futures.ThreadPoolExecutor(
+      max_workers=(limits.audio_upload_concurrency + limits.probe_concurrency +
+                   limits.transcribe_concurrency +
+                   limits.redact_concurrency +
+                   limits.upload_concurrency + limits.create_concurrency +
+                   limits.analyze_concurrency))
+
+  async def _Blocking(fn, *args):
+    """Runs a blocking client call on the executor."""
+    return await asyncio.get_event_loop().run_in_executor(
+        executor, functools.partial(fn, *args))
+
+  def _Checkpoint(item, state=None, error=None, **fields):
+    if checkpoint:
+      checkpoint.Update(item.audio_uri, state, error, **fields)
+
+  async def _UploadAudio(item):
+    if not item.needs_upload:
+      return item
+    try:
+      item.content_hash = await _RETRY_POLICY.CallAsync(
+          lambda: _Blocking(_UploadAudioFile, uploader, item.local_file),
+          gcs_limiter,
+          _RetryReporter(
+              'gcs', 'upload_audio',
+              'upload of local audio file `{}`'.format(item.local_file.path)))
+    except (OSError, google.api_core.exceptions.GoogleAPICallError) as e:
+      print('Error `{}`: failed to upload local audio file `{}`.'.format(
+          e, item.local_file.path))
+      _Checkpoint(item, error=str(e))
+      return None
+    return item
+
+  async def _Probe(item):
+    if item.transcript_uri or item.transcribe_operation:
+      return item
+    try:
+      item.audio_info = await _Blocking(
+          prober.Probe, item.audio_uri, item.content_hash,
+          item.local_file and item.local_file.path)
+    except audio_probe.UnsupportedAudioError as e:
+      print('Error `{}`: skipping audio uri `{}`.'.format(e, item.audio_uri))
+      _Checkpoint(item, error=str(e))
+      return None
+    except (OSError, google.api_core.exceptions.GoogleAPICallError) as e:
+      # Transcribed with the default config instead.
+      print('Error `{}`: failed to read the header of audio uri `{}`.'.format(
+          e, item.audio_uri))
+    return item
+
+  async def _TranscribeSegment(item, path, segment, item_encoding,
+                               item_sample_rate_hertz, audio_channel_count):
+    content = await _Blocking(audio_chunking.ReadSegment, path, segment)
+    operation = await _RETRY_POLICY.CallAsync(
+        functools.partial(_Blocking, _TranscribeAsync, item.audio_uri,
+                          item_encoding, language_code, item_sample_rate_hertz,
+                          impersonated_service_account, audio_channel_count,
+                          content),
+        speech_limiter,
+        _RetryReporter(
+            'speech', 'long_running_recognize',
+            'transcription of audio uri `{}` at {:.1f}s'.format(
+                item.audio_uri, segment.offset_secs)))
+    del content  # Not kept while polling.
+    attempt = 0
+    while not await _Blocking(_IsTranscribeOperationDone, operation):
+      await asyncio.sleep(
+          _GetPollDelay(attempt, limits.poll_initial_secs,
+                        limits.poll_max_secs))
+      attempt += 1
+    response = operation.result()
+    _METRICS.AddBytes('speech', 'get_operation', received=response.ByteSize())
+    return response
+
+  async def _TranscribeInSegments(item, item_encoding, item_sample_rate_hertz,
+                                  audio_channel_count):
+    """Returns the stitched transcript of a long file, or None if it is short.
+    """
+    path = item.local_file and item.local_file.path
+    temp_path = None
+    if not path:
+      temp_path = await _RETRY_POLICY.CallAsync(
+          lambda: _Blocking(_DownloadAudio, item.audio_uri, project_id,
+                            impersonated_service_account),
+          gcs_limiter,
+          _RetryReporter(
+              'gcs', 'download_audio',
+              'download of audio uri `{}`'.format(item.audio_uri)))
+      path = temp_path
+    try:
+      segments = await _Blocking(audio_chunking.PlanSegments, path,
+                                 segment_secs, segment_overlap_secs)
+      if not segments:
+        return None
+      responses = await asyncio.gather(
+          *[
+              _TranscribeSegment(item, path, segment, item_encoding,
+                                 item_sample_rate_hertz, audio_channel_count)
+              for segment in segments
+          ],
+          return_exceptions=True)
+    finally:
+      if temp_path:
+        os.remove(temp_path)
+    for response in responses:
+      if isinstance(response, Exception):
+        raise response
+    return audio_chunking.StitchResponses(segments, responses)
+
+  async def _CacheTranscript(item):
+    if item.cache_key:
+      await _Blocking(cache.Put, 'speech', item.cache_key,
+                      item.transcript.SerializeToString())
+
+  async def _Transcribe(item):
+    if item.transcript_uri:
+      return item
+    item_encoding, item_sample_rate_hertz, audio_channel_count = (
+        encoding, sample_rate_hertz, 2)
+    if item.audio_info:
+      item_encoding, item_sample_rate_hertz, audio_channel_count = (
+          item.audio_info.encoding, item.audio_info.sample_rate_hertz,
+          item.audio_info.audio_channel_count)
+    recognition_config = _GetRecognitionConfig(item_encoding, language_code,
+                                               item_sample_rate_hertz,
+                                               audio_channel_count)
+    segmented = bool(segment_secs and item.audio_info and
+                     item.audio_info.encoding in
+                     audio_chunking.SUPPORTED_ENCODINGS)
+    if cache and item.content_hash:
+      # Stitched transcripts differ slightly from whole ones.
+      config = ([recognition_config, segment_secs, segment_overlap_secs]
+                if segmented else recognition_config)
+      if should_redact:
+        # Only redacted transcripts are cached, so that no PII is kept.
+        config = [config, list(_GetRedactionConfigs()), redact_mode]
+      item.cache_key = result_cache.MakeKey('speech', item.content_hash,
+                                            config)
+      cached = await _Blocking(cache.Get, 'speech', item.cache_key)
+      if cached is not None:
+        item.transcript = (
+            speech_v1p1beta1.types.LongRunningRecognizeResponse.FromString(
+                cached))
+        item.redacted = should_redact
+        _Checkpoint(item, checkpoint_lib.TRANSCRIBED)
+        return item
+    if segmented and not item.transcribe_operation:
+      try:
+        item.transcript = await _TranscribeInSegments(item, item_encoding,
+                                                      item_sample_rate_hertz,
+                                                      audio_channel_count)
+      except (OSError, google.api_core.exceptions.GoogleAPICallError) as e:
+        print('Error `{}`: failed to transcribe segments of audio uri `{}`.'
+              .format(e, item.audio_uri))
+        _Checkpoint(item, checkpoint_lib.PENDING, error=str(e))
+        return None
+      if item.transcript:
+        if not should_redact:
+          await _CacheTranscript(item)
+        _Checkpoint(item, checkpoint_lib.TRANSCRIBED)
+        return item
+    if item.transcribe_operation:
+      try:
+        operation = await _Blocking(_GetTranscribeOperation,
+                                    item.transcribe_operation,
+                                    impersonated_service_account)
+      except google.api_core.exceptions.GoogleAPICallError as e:
+        print('Error `{}`: failed to resume transcription of audio uri `{}` '
+              'with operation `{}`.'.format(e, item.audio_uri,
+                                            item.transcribe_operation))
+        operation = None
+    else:
+      operation = None
     if not operation:
-      continue
+      try:
+        operation = await _RETRY_POLICY.CallAsync(
+            lambda: _Blocking(_TranscribeAsync, item.audio_uri, item_encoding,
+                              language_code, item_sample_rate_hertz,
+                              impersonated_service_account,
+                              audio_channel_count),
+            speech_limiter,
+            _RetryReporter(
+                'speech', 'long_running_recognize',
+                'transcription of audio uri `{}`'.format(item.audio_uri)))
+      except google.api_core.exceptions.GoogleAPICallError as e:
+        print('Error `{}` when scheduling async transcription for storage uri '
+              '{}'.format(e, item.audio_uri))
+        _Checkpoint(item, error='Failed to schedule transcription.')
+        return None
+      _Checkpoint(item, checkpoint_lib.TRANSCRIBING,
+                  transcribe_operation=operation.operation.name)
+    attempt = 0
+    while not await _Blocking(_IsTranscribeOperationDone, operation):
+      await asyncio.sleep(
+          _GetPollDelay(attempt, limits.poll_initial_secs,
+                        limits.poll_max_secs))
+      attempt += 1
+    try:
+      item.transcript = operation.result()
+      _METRICS.AddBytes('speech', 'get_operation',
+                        received=item.transcript.ByteSize())
+    except google.api_core.exceptions.GoogleAPICallError as e:
+      print('Error `{}`: failed to transcribe audio uri `{}` with operation '
+            '`{}`.'.format(e, item.audio_uri, operation.operation.name))
+      # Transcribe again next time, rather than resume a failed operation.
+      _Checkpoint(item, checkpoint_lib.PENDING, error=str(e))
+      return None
+    if not should_redact:
+      await _CacheTranscript(item)
+    _Checkpoint(item, checkpoint_lib.TRANSCRIBED)
+    return item
+
+  async def _RedactTranscript(item):
+    if item.transcript_uri or item.redacted:
+      return item
+    try:
+      # DLP requests are shared by concurrent redactions, so the redactor
+      # limits them itself.
+      item.transcript = await _RETRY_POLICY.CallAsync(
+          lambda: _Blocking(_Redact, item.transcript, project_id,
+                            impersonated_service_account, cache, pii_scanner,
+                            redact_mode),
+          on_retry=_RetryReporter(
+              'dlp', 'deidentify_content',
+              'redaction of audio uri `{}`'.format(item.audio_uri)))
+    except google.api_core.exceptions.GoogleAPICallError as e:
+      print('Error `{}`: failed to redact transcription from audio uri `{}`.'
+            .format(e, item.audio_uri))
+      _Checkpoint(item, error=str(e))
+      return None
+    await _CacheTranscript(item)
+    _Checkpoint(item, checkpoint_lib.REDACTED)
+    return item
+
+  async def _Upload(item):
+    if item.transcript_uri:
+      return item
+    try:
+      transcript_name = _GetTranscriptName(item, transcript_format)
+      await _RETRY_POLICY.CallAsync(
+          lambda: _Blocking(_UploadTranscript, item.transcript, dest_bucket,
+                            transcript_name, project_id,
+                            impersonated_service_account, upload_chunk_size,
+                            transcript_format, agent_channel),
+          gcs_limiter,
+          _RetryReporter(
+              'gcs', 'upload_transcript',
+              'upload of transcript `{}`'.format(transcript_name)))
+    except google.api_core.exceptions.GoogleAPICallError as e:
+      print('Error `{}`: failed to upload transcription from audio uri `{}`.'
+            .format(e, item.audio_uri))
+      _Checkpoint(item, error=str(e))
+      return None
+    item.transcript = None
+    item.transcript_uri = _GetGcsUri(dest_bucket, transcript_name)
+    _Checkpoint(item, checkpoint_lib.UPLOADED,
+                transcript_uri=item.transcript_uri)
+    return item
+
+  async def _Create(item):
+    if item.conversation_name:
+      return item
+    try:
+      item.conversation_name = await _CREATE_RETRY_POLICY.CallAsync(
+          lambda: _Blocking(_CreateInsightsConversation, insights_endpoint,
+                            api_version, project_id, item.audio_uri,
+                            item.transcript_uri, agent_id,
+                            impersonated_service_account),
+          insights_limiter,
+          _RetryReporter(
+              'insights', 'create_conversation',
+              'conversation for audio uri `{}`'.format(item.audio_uri)))
+    except requests.exceptions.RequestException as e:
+      print('Error `{}`: failed to create insights conversation from audio uri '
+            '{} and transcript uri `{}`.'.format(e, item.audio_uri,
+                                                 item.transcript_uri))
+      _Checkpoint(item, error=str(e))
+      return None
+    conversation_names.append(item.conversation_name)
+    _Checkpoint(item, checkpoint_lib.CREATED,
+                conversation_name=item.conversation_name)
+    return item
+
+  async def _Analyze(item):
+    analysis_operation = item.analysis_operation
+    if not analysis_operation:
+      try:
+        analysis_operation = await _CREATE_RETRY_POLICY.CallAsync(
+            lambda: _Blocking(_CreateAnalysis, item.conversation_name,
+                              insights_endpoint, api_version,
+                              impersonated_service_account),
+            analysis_limiter,
+            _RetryReporter(
+                'insights', 'create_analysis',
+                'analysis of conversation `{}`'.format(
+                    item.conversation_name)))
+        error = None
+      except requests.exceptions.RequestException as e:
+        print('Error `{}`: failed to create analysis for conversation `{}`.'
+              .format(e, item.conversation_name))
+        error = str(e)
+      if analysis_operation:
+        _Checkpoint(item, checkpoint_lib.ANALYZING,
+                    analysis_operation=analysis_operation)
+    if not analysis_operation:
+      item.analysis_result = _AnalysisResult(item.conversation_name, None,
+                                             _ANALYSIS_CREATE_FAILED, error)
+      _Checkpoint(item, error=error)
+    else:
+      deadline = time.time() + limits.analysis_max_wait_secs
+      attempt = 0
+      while True:
+        await asyncio.sleep(
+            _GetPollDelay(attempt, limits.poll_initial_secs,
+                          limits.poll_max_secs))
+        attempt += 1
+        done, error = await _Blocking(_PollAnalysis, analysis_operation,
+                                      insights_endpoint, api_version,
+                                      impersonated_service_account)
+        if done:
+          item.analysis_result = _AnalysisResult(
+              item.conversation_name, analysis_operation,
+              _ANALYSIS_FAILED if error else _ANALYSIS_SUCCEEDED, error)
+          _Checkpoint(item, checkpoint_lib.DONE, error=error,
+                      analysis_state=item.analysis_result.state)
+          break
+        if limits.analysis_max_wait_secs and time.time() >= deadline:
+          # Stays in the analyzing state, so that a resumed import polls again.
+          item.analysis_result = _AnalysisResult(
+              item.conversation_name, analysis_operation, _ANALYSIS_TIMED_OUT,
+              'Not done after {} seconds.'.format(
+                  limits.analysis_max_wait_secs))
+          break
+    analysis_results.append(item.analysis_result)
+    return item
+
+  stages = []
+  if uploader:
+    stages.append(
+        pipeline.Stage('upload_audio', _UploadAudio,
+                       limits.audio_upload_concurrency))
+  if prober:
+    stages.append(pipeline.Stage('probe', _Probe, limits.probe_concurrency))
+  stages.append(
+      pipeline.Stage('transcribe', _Transcribe, limits.transcribe_concurrency))
+  if should_redact:
+    stages.append(
+        pipeline.Stage('redact', _RedactTranscript, limits.redact_concurrency))
+  stages.append(pipeline.Stage('upload', _Upload, limits.upload_concurrency))
+  stages.append(pipeline.Stage('create', _Create, limits.create_concurrency))
+  if analyze:
+    stages.append(
+        pipeline.Stage('analyze', _Analyze, limits.analyze_concurrency))
+
+  import_pipeline = pipeline.Pipeline(
+      stages, source_batch_size=limits.source_batch_size)
+  with executor:
+    stats = asyncio.run(
+        import_pipeline.Run(
+            _GetPendingAudioImports(audio_uris, checkpoint, analyze,
+                                    uploader)))
+  print(pipeline.FormatStats(stats))
+
+  return conversation_names, analysis_results
+
+
+# The outcome of analyzing one conversation. `state` is one of the `_ANALYSIS_*`
+# constants below, and `error` describes why the analysis did not succeed.
+_AnalysisResult = collections.namedtuple(
+    '_AnalysisResult',
+    ['conversation_name', 'operation_name', 'state', 'error'])
+
+_ANALYSIS_SUCCEEDED = 'SUCCEEDED'
+_ANALYSIS_FAILED = 'FAILED'
+_ANALYSIS_CREATE_FAILED = 'CREATE_FAILED'
+_ANALYSIS_TIMED_OUT = 'TIMED_OUT'
+
+
+def _GetPollDelay(attempt, initial_secs, max_secs):
+  """Returns the jittered exponential backoff delay before the next poll.
 
-    operation.add_done_callback(
-        _GetTranscribeAsyncCallback(project_id, dest_bucket, audio_uri,
-                                    insights_endpoint, api_version, should_redact,
-                                    agent_id,
-                                    conversation_names,
-                                    impersonated_service_account))
-    operations.append(operation)
-
-    # Sleep to avoid exceeding Speech-to-text quota.
-    time.sleep(2)
-
-  num_operations = len(operations)
-  print('Successfully scheduled `{}` transcription operations.'.format(
-      num_operations))
-  while operations:
-    operations = [operation for operation in operations if not operation.done()]
-    if not operations:
-      break
+  Args:
+    attempt: The number of polls made so far.
+    initial_secs: The delay before the first poll.
+    max_secs: The cap on the delay, before jitter.
 
-    print('Still waiting for `{}` transcription operations to complete'.format(
-        len(operations)))
-    # Sleep to avoid exceeding Speech-to-text quota.
-    time.sleep(5)
+  Returns:
+    The delay in seconds.
+  """
+  delay = min(max_secs, initial_secs * 2**min(attempt, 32))
+  # Jitter spreads out the polls of operations started at the same time.
+  return delay * random.uniform(0.5, 1.5)
 
-  print('Finished waiting for all `{}` transcription operations.'.format(
-      num_operations))
 
-  return conversation_names
+def _CreateAnalysis(conversation_name, insights_endpoint, api_version,
+                    impersonated_service_account):
+  """Starts analysis of a conversation, once.
+
+  Args:
+    conversation_name: The conversation to analyze.
+    insights_endpoint: The Insights endpoint to call.
+    api_version: The Insights API version to use.
+    impersonated_service_account: The service account to impersonate.
+
+  Returns:
+    The name of the analysis operation.
+
+  Raises:
+    requests.exceptions.RequestException: If the analysis was not started.
+  """
+  url = _GetInsightsUrl(insights_endpoint, api_version,
+                        '{}/analyses'.format(conversation_name))
+  r = _SendInsightsRequest('create_analysis', 'POST', url,
+                           _GetInsightsHeaders(impersonated_service_account))
+  print('Started analysis for conversation `{}`'.format(conversation_name))
+  return r.json()['name']
+
+
+def _StartAnalysis(conversation_name, insights_endpoint, api_version,
+                   impersonated_service_account, limiter=None):
+  """Starts analysis of a conversation, retrying throttled requests.
+
+  Args:
+    conversation_name: The conversation to analyze.
+    insights_endpoint: The Insights endpoint to call.
+    api_version: The Insights API version to use.
+    impersonated_service_account: The service account to impersonate.
+    limiter: The rate limiter of create analysis requests, if any.
+
+  Returns:
+    A tuple of the analysis operation name, or None if the analysis could not
+    be started, and an error message.
+  """
+  try:
+    return _CREATE_RETRY_POLICY.Call(
+        functools.partial(_CreateAnalysis, conversation_name,
+                          insights_endpoint, api_version,
+                          impersonated_service_account),
+        limiter,
+        _RetryReporter(
+            'insights', 'create_analysis',
+            'analysis of conversation `{}`'.format(conversation_name))), None
+  except requests.exceptions.RequestException as e:
+    print('Error `{}`: failed to create analysis for conversation `{}`.'.format(
+        e, conversation_name))
+    return None, str(e)
+
+
+def _PollAnalysis(analysis_operation, insights_endpoint, api_version,
+                  impersonated_service_account):
+  """Polls an analysis operation once.
+
+  Args:
+    analysis_operation: The name of the analysis operation.
+    insights_endpoint: The Insights endpoint to call.
+    api_version: The Insights API version to use.
+    impersonated_service_account: The service account to impersonate.
+
+  Returns:
+    A tuple of whether the operation is done, and its error message, if any.
+    Failures to poll are reported as not done.
+  """
+  try:
+    url = _GetInsightsUrl(insights_endpoint, api_version, analysis_operation)
+    # The token is cached, but may be refreshed during long waits.
+    r = _SendInsightsRequest(
+        'get_analysis_operation', 'GET', url,
+        _GetInsightsHeaders(impersonated_service_account))
+    json = r.json()
+    if json.get('done'):
+      return True, json['error'].get('message') if 'error' in json else None
+  except (requests.exceptions.RequestException, ValueError) as e:
+    # Includes connection errors, timeouts and responses that are not JSON.
+    print('Error `{}`: failed to poll analysis operation `{}`.'.format(
+        e, analysis_operation))
+  return False, None
 
 
-# TODO(b/149255107): Have a max wait time and return successful IDs.
 def _AnalyzeConversations(conversation_names, insights_endpoint,
                           api_version,
-                          impersonated_service_account):
+                          impersonated_service_account,
+                          num_workers=1, analysis_rate=0.5,
+                          max_wait_secs=3600, poll_initial_secs=2.0,
+                          poll_max_secs=60.0, analysis_operations=None,
+                          checkpoint=None):
   """Analyzes the provided list of conversations.
 
+  Analyses are started by `num_workers` concurrent workers under a shared rate
+  limit. Only operations that are still pending are polled, each with its own
+  exponential backoff, so the total wait grows with the slowest analysis
+  rather than with the number of conversations.
+
   Args:
     conversation_names: The list of conversations to analyze.
     insights_endpoint: The Insights endpoint to call.
     api_version: The Insights API version to use.
     impersonated_service_account: The service account to impersonate.
+    num_workers: The number of concurrent requests to Insights.
+    analysis_rate: The maximum create analysis requests per second. Zero for
+      no limit.
+    max_wait_secs: How long to wait for analyses to finish once they are all
+      started. Zero waits forever.
+    poll_initial_secs: The delay before an operation is first polled.
+    poll_max_secs: The cap on the delay between polls of an operation.
+    analysis_operations: Maps conversation names to analysis operations that
+      were started earlier and are polled rather than started again.
+    checkpoint: The `checkpoint.Checkpoint` to record progress in, or None.
+
+  Returns:
+    An `_AnalysisResult` for every conversation.
+  """
+  # Shared by all workers to avoid exceeding Create Analysis quota in Insights.
+  limiter = _GetLimiter('insights_analysis', analysis_rate)
+
+  def _Start(conversation_name):
+    analysis_operation, error = _StartAnalysis(conversation_name,
+                                               insights_endpoint, api_version,
+                                               impersonated_service_account,
+                                               limiter)
+    if checkpoint and analysis_operation:
+      checkpoint.UpdateConversation(conversation_name, checkpoint_lib.ANALYZING,
+                                    analysis_operation=analysis_operation)
+    elif checkpoint:
+      checkpoint.UpdateConversation(conversation_name, error=error)
+    return conversation_name, analysis_operation, error
+
+  def _Poll(pending_operation):
+    unused_poll_time, attempt, analysis_operation, conversation_name = (
+        pending_operation)
+    done, error = _PollAnalysis(analysis_operation, insights_endpoint,
+                                api_version, impersonated_service_account)
+    if done:
+      result = _AnalysisResult(
+          conversation_name, analysis_operation,
+          _ANALYSIS_FAILED if error else _ANALYSIS_SUCCEEDED, error)
+      if checkpoint:
+        checkpoint.UpdateConversation(conversation_name, checkpoint_lib.DONE,
+                                      error=error, analysis_state=result.state)
+      return result
+    next_poll_time = time.time() + _GetPollDelay(
+        attempt + 1, poll_initial_secs, poll_max_secs)
+    return (next_poll_time, attempt + 1, analysis_operation, conversation_name)
+
+  results = []
+  # A heap of (next poll time, attempt, operation name, conversation name).
+  pending = [(time.time(), 0, analysis_operation, conversation_name)
+             for conversation_name, analysis_operation in (
+                 analysis_operations or {}).items()]
+  heapq.heapify(pending)
+  for conversation_name, analysis_operation, error in _RunConcurrently(
+      _Start, conversation_names, num_workers):
+    if analysis_operation:
+      heapq.heappush(pending,
+                     (time.time() + _GetPollDelay(0, poll_initial_secs,
+                                                  poll_max_secs), 0,
+                      analysis_operation, conversation_name))
+    else:
+      results.append(
+          _AnalysisResult(conversation_name, None, _ANALYSIS_CREATE_FAILED,
+                          error))
+  print('Successfully scheduled `{}` analysis operations.'.format(len(pending)))
+
+  deadline = time.time() + max_wait_secs if max_wait_secs else None
+  while pending:
+    now = time.time()
+    if deadline and now >= deadline:
+      break
+    if pending[0][0] > now:
+      wait = pending[0][0] - now
+      if deadline:
+        wait = min(wait, deadline - now)
+      time.sleep(wait)
+      continue
+
+    due = []
+    while pending and pending[0][0] <= now:
+      due.append(heapq.heappop(pending))
+    for polled in _RunConcurrently(_Poll, due, num_workers):
+      if isinstance(polled, _AnalysisResult):
+        results.append(polled)
+      else:
+        heapq.heappush(pending, polled)
+    print('Still waiting for `{}` analysis operations to complete.'.format(
+        len(pending)))
+
+  for unused_poll_time, unused_attempt, analysis_operation, conversation_name in (
+      pending):
+    results.append(
+        _AnalysisResult(conversation_name, analysis_operation,
+                        _ANALYSIS_TIMED_OUT,
+                        'Not done after {} seconds.'.format(max_wait_secs)))
+
+  succeeded = sum(1 for result in results
+                  if result.state == _ANALYSIS_SUCCEEDED)
+  print('`{}` of `{}` analysis operations have succeeded.'.format(
+      succeeded, len(results)))
+  return results
+
+
+# The Insights names of the `--source_*_transcript_gcs_bucket` mediums.
+_MEDIUM_NAMES = {1: 'PHONE_CALL', 2: 'CHAT'}
+
+
+def _StartInsightsOperation(method_name, insights_endpoint, api_version, path,
+                            data, impersonated_service_account):
+  """Sends a request that starts a long running operation in Insights.
+
+  Args:
+    method_name: The name of the Insights method, for the metrics.
+    insights_endpoint: The Insights endpoint to call.
+    api_version: The Insights API version to use.
+    path: The resource path of the request.
+    data: The JSON body of the request.
+    impersonated_service_account: The service account to impersonate.
+
+  Returns:
+    The name of the operation.
+
+  Raises:
+    requests.exceptions.RequestException: If the operation was not started.
   """
-  analysis_operations = []
-  oauth_token = _GetOauthToken(impersonated_service_account)
-  headers = {
-      'charset': 'utf-8',
-      'Content-type': 'application/json',
-      'Authorization': 'Bearer {}'.format(oauth_token)
-  }
+  url = _GetInsightsUrl(insights_endpoint, api_version, path)
+  r = _SendInsightsRequest(method_name, 'POST', url,
+                           _GetInsightsHeaders(impersonated_service_account),
+                           data)
+  return r.json()['name']
 
-  for conversation_name in conversation_names:
+
+def _WaitForInsightsOperation(operation_name, insights_endpoint, api_version,
+                              impersonated_service_account, max_wait_secs,
+                              poll_initial_secs, poll_max_secs):
+  """Polls an Insights operation with backoff until it is done.
+
+  Args:
+    operation_name: The name of the operation.
+    insights_endpoint: The Insights endpoint to call.
+    api_version: The Insights API version to use.
+    impersonated_service_account: The service account to impersonate.
+    max_wait_secs: How long to wait. Zero waits forever.
+    poll_initial_secs: The delay before the operation is first polled.
+    poll_max_secs: The cap on the delay between polls.
+
+  Returns:
+    The operation as JSON, or None if it was not done in time.
+  """
+  url = _GetInsightsUrl(insights_endpoint, api_version, operation_name)
+  deadline = time.time() + max_wait_secs if max_wait_secs else None
+  attempt = 0
+  while True:
+    delay = _GetPollDelay(attempt, poll_initial_secs, poll_max_secs)
+    if deadline and time.time() + delay > deadline:
+      delay = max(0, deadline - time.time())
+    time.sleep(delay)
+    attempt += 1
     try:
-      url = 'https://{}/{}/{}/analyses'.format(insights_endpoint, api_version,
-                                                     conversation_name)
-      r = requests.post(url, headers=headers)
-      print('Started analysis for conversation `{}`'.format(conversation_name))
-      # Sleep to avoid exceeding Create Analysis quota in Insights.
-      time.sleep(2)
+      operation = _SendInsightsRequest(
+          'get_bulk_operation', 'GET', url,
+          _GetInsightsHeaders(impersonated_service_account)).json()
+      if operation.get('done'):
+        return operation
+    except (requests.exceptions.RequestException, ValueError) as e:
+      # The operation keeps running, so poll again until the deadline.
+      print('Error `{}`: failed to poll operation `{}`.'.format(
+          e, operation_name))
+    if deadline and time.time() >= deadline:
+      return None
+
+
+def _ListConversations(insights_endpoint, api_version, project,
+                       conversation_filter, impersonated_service_account,
+                       page_size=1000):
+  """Yields the Insights conversations that match a filter, page by page.
 
-      if r.status_code == requests.codes.ok:
-        analysis_operations.append(r.json()['name'])
+  Args:
+    insights_endpoint: The Insights endpoint to call.
+    api_version: The Insights API version to use.
+    project: The project of the conversations.
+    conversation_filter: The Insights filter, e.g. `agent_id="007"`.
+    impersonated_service_account: The service account to impersonate.
+    page_size: The number of conversations per request.
+
+  Raises:
+    requests.exceptions.RequestException: If a page could not be listed.
+  """
+  path = 'projects/{}/locations/us-central1/conversations'.format(project)
+  params = {'filter': conversation_filter, 'pageSize': page_size}
+  while True:
+    url = '{}?{}'.format(
+        _GetInsightsUrl(insights_endpoint, api_version, path),
+        urllib.parse.urlencode(params))
+    page = _SendInsightsRequest(
+        'list_conversations', 'GET', url,
+        _GetInsightsHeaders(impersonated_service_account)).json()
+    for conversation in page.get('conversations', []):
+      yield conversation
+    if not page.get('nextPageToken'):
+      return
+    params['pageToken'] = page['nextPageToken']
+
+
+def _PrintPartialErrors(metadata, description):
+  for error in metadata.get('partialErrors', []):
+    print('Error `{}`: {}.'.format(error.get('message'), description))
 
-      else:
-        r.raise_for_status()
-    except requests.exceptions.HTTPError as e:
-      print(
-          'Error `{}`: failed to create analysis for conversation `{}`.'.format(
-              e, conversation_name))
-  print('Successfully scheduled `{}` analysis operations: {}'.format(
-      len(analysis_operations), analysis_operations))
-
-  finished_operations = []
-  while len(finished_operations) < len(analysis_operations):
-    for analysis_operation in analysis_operations:
-      try:
-        url = 'https://{}/{}/{}'.format(insights_endpoint,
-                                        api_version,
-                                        analysis_operation)
-        r = requests.get(url, headers=headers)
-        if r.status_code == requests.codes.ok:
-          json = r.json()
-          if 'done' in json and json['done']:
-            finished_operations.append(analysis_operation)
-        else:
-          r.raise_for_status()
-      except requests.exceptions.HTTPError as e:
-        print('Error `{}`: failed to poll analysis operation `{}`.'.format(
-            e, analysis_operation))
-      time.sleep(1)
-    time.sleep(5)
 
-  print('All `{}` analysis operations have finished.'.format(
-      len(analysis_operations)))
+def _ImportConversationsInBulk(gcs_uri, project_id, medium, insights_endpoint,
+                               api_version, agent_id,
+                               impersonated_service_account, analyze=True,
+                               num_workers=1, analysis_rate=0.5,
+                               max_wait_secs=3600, poll_initial_secs=5.0,
+                               poll_max_secs=60.0, checkpoint=None):
+  """Imports every transcript under a GCS uri with one ingest request.
+
+  Creates the conversations with one `conversations:ingest` request, and
+  analyzes them with one `conversations:bulkAnalyze` request, instead of two
+  requests per conversation. The conversations of the ingest are found by
+  listing the conversations created while it ran, with the same agent id, and
+  keeping those with a transcript under `gcs_uri`. If other conversations
+  were created during the ingest, a bulk analysis would analyze them too, so
+  the ingested conversations are then analyzed one at a time instead.
+
+  Args:
+    gcs_uri: The bucket or folder of the transcripts, e.g. `gs://b/chats/`.
+    project_id: The project ID (not number) to use for Insights.
+    medium: The medium (1 for voice, 2 for chat).
+    insights_endpoint: The Insights endpoint to call.
+    api_version: The Insights API version to use.
+    agent_id: An agent identifier to attach to the conversations.
+    impersonated_service_account: The service account to impersonate.
+    analyze: Whether to analyze the conversations.
+    num_workers: The number of concurrent requests to Insights, if the
+      conversations are analyzed one at a time.
+    analysis_rate: The maximum create analysis requests per second, if the
+      conversations are analyzed one at a time.
+    max_wait_secs: How long to wait for each of the operations.
+    poll_initial_secs: The delay before an operation is first polled.
+    poll_max_secs: The cap on the delay between polls of an operation.
+    checkpoint: The `checkpoint.Checkpoint` to record progress in, or None.
+
+  Returns:
+    A tuple of the names of the created conversations, and an
+    `_AnalysisResult` for every conversation if they were analyzed.
+
+  Raises:
+    requests.exceptions.RequestException: If the ingest request failed, e.g.
+      because the API version has no bulk ingest. Nothing was imported then.
+  """
+  parent = 'projects/{}/locations/us-central1'.format(project_id)
+  data = {
+      'gcsSource': {
+          'bucketUri': gcs_uri
+      },
+      'transcriptObjectConfig': {
+          'medium': _MEDIUM_NAMES[medium]
+      }
+  }
+  if agent_id:
+    data['conversationConfig'] = {'agentId': agent_id}
+  ingest_operation = _StartInsightsOperation(
+      'ingest_conversations', insights_endpoint, api_version,
+      '{}/conversations:ingest'.format(parent), data,
+      impersonated_service_account)
+  print('Started ingest operation `{}` for `{}`.'.format(
+      ingest_operation, gcs_uri))
+  operation = _WaitForInsightsOperation(
+      ingest_operation, insights_endpoint, api_version,
+      impersonated_service_account, max_wait_secs, poll_initial_secs,
+      poll_max_secs)
+  if not operation:
+    print('Error: ingest operation `{}` is not done after {} seconds.'.format(
+        ingest_operation, max_wait_secs))
+    return [], []
+  metadata = operation.get('metadata', {})
+  _PrintPartialErrors(metadata, 'failed to ingest a transcript')
+  if 'error' in operation:
+    print('Error `{}`: ingest operation `{}` failed.'.format(
+        operation['error'].get('message'), ingest_operation))
+    return [], []
+  print('Ingest stats: {}'.format(metadata.get('ingestConversationsStats')))
+
+  # Server times, so that clock skew does not matter. No conversation can be
+  # created in the window once the ingest is done, so the listing below shows
+  # every conversation that a bulk analysis with this filter would analyze.
+  conversation_filter = 'create_time>="{}" AND create_time<="{}"'.format(
+      metadata['createTime'], metadata['endTime'])
+  if agent_id:
+    conversation_filter += ' AND agent_id="{}"'.format(agent_id)
+  conversation_names = []
+  num_other = 0
+  for conversation in _ListConversations(insights_endpoint, api_version,
+                                         project_id, conversation_filter,
+                                         impersonated_service_account):
+    transcript_uri = conversation.get('dataSource', {}).get(
+        'gcsSource', {}).get('transcriptUri')
+    if not transcript_uri or not transcript_uri.startswith(gcs_uri):
+      num_other += 1
+      continue
+    conversation_names.append(conversation['name'])
+    if checkpoint:
+      checkpoint.Update(transcript_uri, checkpoint_lib.CREATED,
+                        transcript_uri=transcript_uri,
+                        conversation_name=conversation['name'])
+  print('Ingested `{}` conversations.'.format(len(conversation_names)))
+  if not analyze or not conversation_names:
+    return conversation_names, []
+  if num_other:
+    # A bulk analysis would also analyze, and bill, conversations that other
+    # clients created during the ingest.
+    print('`{}` other conversations were created during the ingest, analyzing '
+          'the ingested conversations one at a time.'.format(num_other))
+    return conversation_names, _AnalyzeConversations(
+        conversation_names, insights_endpoint, api_version,
+        impersonated_service_account, num_workers, analysis_rate,
+        max_wait_secs, poll_initial_secs, poll_max_secs, checkpoint=checkpoint)
+
+  analysis_operation = _StartInsightsOperation(
+      'bulk_analyze_conversations', insights_endpoint, api_version,
+      '{}/conversations:bulkAnalyze'.format(parent), {
+          'filter': conversation_filter,
+          'analysisPercentage': 100
+      }, impersonated_service_account)
+  print('Started bulk analysis operation `{}`.'.format(analysis_operation))
+  operation = _WaitForInsightsOperation(
+      analysis_operation, insights_endpoint, api_version,
+      impersonated_service_account, max_wait_secs, poll_initial_secs,
+      poll_max_secs)
+  analyzed = set()
+  if operation:
+    metadata = operation.get('metadata', {})
+    _PrintPartialErrors(metadata, 'failed to analyze a conversation')
+    analyzed = {
+        conversation['name']
+        for conversation in _ListConversations(
+            insights_endpoint, api_version, project_id, conversation_filter,
+            impersonated_service_account)
+        if conversation.get('latestAnalysis')
+    }
+  results = []
+  for conversation_name in conversation_names:
+    if conversation_name in analyzed:
+      result = _AnalysisResult(conversation_name, analysis_operation,
+                               _ANALYSIS_SUCCEEDED, None)
+    elif not operation:
+      result = _AnalysisResult(
+          conversation_name, analysis_operation, _ANALYSIS_TIMED_OUT,
+          'Not done after {} seconds.'.format(max_wait_secs))
+    else:
+      result = _AnalysisResult(
+          conversation_name, analysis_operation, _ANALYSIS_FAILED,
+          operation.get('error', {}).get('message') or
+          'Not analyzed by the bulk analysis.')
+    results.append(result)
+    if checkpoint:
+      checkpoint.UpdateConversation(conversation_name, checkpoint_lib.DONE,
+                                    error=result.error,
+                                    analysis_state=result.state)
+  succeeded = sum(1 for result in results
+                  if result.state == _ANALYSIS_SUCCEEDED)
+  print('`{}` of `{}` conversations were analyzed.'.format(
+      succeeded, len(results)))
+  return conversation_names, results
+
+
+def _GetShardKey(source):
+  """Returns the name by which a source file is assigned to a shard."""
+  if isinstance(source, gcs_listing.GcsObject):
+    return source.uri
+  if isinstance(source, local_upload.LocalFile):
+    return source.name
+  return source
+
+
+def _LaunchLocalShards(pargs):
+  """Runs the shards of an import as local processes, and merges results.
+
+  Args:
+    pargs: The parsed arguments, with `local_shards` set.
+
+  Returns:
+    Whether every shard succeeded.
+  """
+  num_shards = pargs.local_shards
+  exit_codes = sharding.LaunchLocal(sys.argv, num_shards, '--local_shards')
+  results_file = pargs.results_file or _DEFAULT_RESULTS_FILE
+  paths = [
+      sharding.GetShardPath(results_file, shard_index, num_shards)
+      for shard_index in range(num_shards)
+  ]
+  merged = sharding.MergeResults([path for path in paths
+                                  if os.path.exists(path)])
+  merged['num_shards'] = num_shards
+  merged['missing_shards'] = sorted(
+      set(range(num_shards)) - set(merged['shards']))
+  print(sharding.FormatMergedResults(merged))
+  with open(results_file, 'w') as f:
+    json.dump(merged, f)
+  for shard_index, exit_code in enumerate(exit_codes):
+    if exit_code:
+      print('Error: shard `{}` exited with status `{}`.'.format(
+          shard_index, exit_code))
+  return not any(exit_codes)
+
+
+def _TryImportConversationsInBulk(pargs, transcript_bucket, medium,
+                                  checkpoint):
+  """Imports a transcript bucket in bulk, if the flags allow it.
+
+  Args:
+    pargs: The parsed arguments.
+    transcript_bucket: The bucket of the transcripts.
+    medium: The medium (1 for voice, 2 for chat).
+    checkpoint: The `checkpoint.Checkpoint` to record progress in, or None.
+
+  Returns:
+    The result of `_ImportConversationsInBulk`, or None to import one
+    conversation at a time instead.
+  """
+  unsupported = [
+      flag for flag, value in (
+          ('--glob', pargs.glob), ('--suffix', pargs.suffix),
+          ('--start_offset', pargs.start_offset),
+          ('--max_items', pargs.max_items),
+          ('--num_shards', pargs.num_shards > 1), ('--resume', pargs.resume))
+      if value
+  ]
+  if unsupported:
+    print('Bulk ingest does not support {}, importing one conversation at '
+          'a time.'.format(', '.join(unsupported)))
+    return None
+  try:
+    return _ImportConversationsInBulk(
+        _GetGcsUri(transcript_bucket, pargs.prefix or ''), pargs.project_id,
+        medium, pargs.insights_endpoint, pargs.insights_api_version,
+        pargs.agent_id, pargs.impersonated_service_account,
+        analyze=pargs.analyze, num_workers=pargs.insights_workers,
+        analysis_rate=pargs.analysis_rate,
+        max_wait_secs=pargs.analysis_max_wait_secs, checkpoint=checkpoint)
+  except requests.exceptions.RequestException as e:
+    print('Error `{}`: bulk ingest failed, importing one conversation at a '
+          'time.'.format(e))
+    return None
 
 
 def main():
   pargs = _ParseArgs()
+  if pargs.local_shards:
+    if not _LaunchLocalShards(pargs):
+      sys.exit(1)
+    return
+  if pargs.num_shards > 1 and pargs.checkpoint_db:
+    # SQLite is not shared between processes or machines.
+    pargs.checkpoint_db = sharding.GetShardPath(
+        pargs.checkpoint_db, pargs.shard_index, pargs.num_shards)
   project_id = pargs.project_id
   impersonated_service_account = pargs.impersonated_service_account
   insights_endpoint = pargs.insights_endpoint
   api_version = pargs.insights_api_version
   should_redact = pargs.redact
   agent_id = pargs.agent_id
-
-  if pargs.source_local_audio_path or pargs.source_audio_gcs_bucket:
+  _CLIENTS.http_pool_size = pargs.http_pool_size
+  _CLIENTS.http_max_retries = pargs.http_max_retries
+  for policy in (_RETRY_POLICY, _CREATE_RETRY_POLICY):
+    policy.max_attempts = max(1, pargs.max_attempts)
+    policy.max_secs = pargs.retry_max_secs
+  if pargs.metrics_file or pargs.metrics_port is not None:
+    exporter = metrics.Exporter(_METRICS, pargs.metrics_file,
+                                pargs.metrics_port, pargs.metrics_interval_secs)
+    atexit.register(exporter.Close)
+  cache_backends = []
+  if pargs.cache_dir:
+    cache_backends.append(
+        result_cache.DiskCache(pargs.cache_dir,
+                               int(pargs.cache_max_gb * 1024**3)))
+  if pargs.cache_gcs_uri:
+    cache_backends.append(
+        result_cache.GcsCache(
+            lambda: _CLIENTS.GetStorageClient(project_id,
+                                              impersonated_service_account),
+            pargs.cache_gcs_uri))
+  cache = result_cache.ResultCache(cache_backends) if cache_backends else None
+  pii_scanner = None
+  if should_redact and pargs.redact_mode != _REDACT_DLP:
+    pii_scanner = pii_filter.Scanner(pargs.pii_processes or None)
+    atexit.register(pii_scanner.Close)
+  checkpoint = None
+  if pargs.checkpoint_db:
+    checkpoint = checkpoint_lib.Checkpoint(pargs.checkpoint_db, pargs.resume)
+    # Also writes the queued updates when the import is interrupted.
+    atexit.register(checkpoint.Close)
+    if pargs.resume:
+      print('Resuming from checkpoint `{}`: {}'.format(
+          pargs.checkpoint_db, checkpoint.CountByState()))
+
+  if (pargs.source_local_audio_path or pargs.source_local_audio_dir or
+      pargs.source_audio_gcs_bucket):
     # Inputs are audio files.
     dest_bucket = pargs.dest_gcs_bucket
 
+    prober = None
+    watcher = None
+    if not pargs.skip_audio_probe:
+      prober = audio_probe.Prober(
+          lambda: _CLIENTS.GetStorageClient(project_id,
+                                            impersonated_service_account),
+          cache)
+    uploader = None
+    if pargs.source_local_audio_path or pargs.source_local_audio_dir:
+      uploader = local_upload.Uploader(
+          lambda: _CLIENTS.GetStorageClient(project_id,
+                                            impersonated_service_account),
+          dest_bucket,
+          chunk_size=pargs.upload_chunk_size_mb * 1024 * 1024 or None,
+          composite_threshold=pargs.composite_upload_threshold_mb * 1024 * 1024,
+          part_size=pargs.composite_upload_part_mb * 1024 * 1024,
+          part_workers=pargs.audio_upload_concurrency)
+      atexit.register(uploader.Close)
     if pargs.source_local_audio_path:
       source_local_audio_path = pargs.source_local_audio_path
-      source_audio_base_name = os.path.basename(source_local_audio_path)
-      _UploadFileToGcs(dest_bucket, source_local_audio_path,
-		       source_audio_base_name, project_id,
-		       impersonated_service_account)
-      audio_uris = [_GetGcsUri(dest_bucket, source_audio_base_name)]
+      audio_uris = [
+          local_upload.LocalFile(source_local_audio_path,
+                                 os.path.basename(source_local_audio_path),
+                                 os.path.getsize(source_local_audio_path))
+      ]
+    elif pargs.source_local_audio_dir:
+      audio_uris = local_upload.ListLocalFiles(pargs.source_local_audio_dir,
+                                               pargs.glob, pargs.suffix,
+                                               pargs.max_items)
+    elif pargs.watch:
+      watcher = _GetWatcher(pargs)
+      audio_uris = watcher.Watch(pargs.max_items)
+      if checkpoint and pargs.resume:
+        # Files that an earlier watch received, but did not finish.
+        unfinished = [
+            record.source_uri for record in checkpoint.List([
+                checkpoint_lib.PENDING, checkpoint_lib.TRANSCRIBING,
+                checkpoint_lib.TRANSCRIBED, checkpoint_lib.REDACTED,
+                checkpoint_lib.UPLOADED, checkpoint_lib.CREATED,
+                checkpoint_lib.ANALYZING
+            ])
+        ]
+        audio_uris = itertools.chain(unfinished, audio_uris)
+      print('Watching `gs://{}` for new audio files.'.format(
+          pargs.source_audio_gcs_bucket))
     elif pargs.source_audio_gcs_bucket:
-      audio_uris = _GetGcsUris(pargs.source_audio_gcs_bucket, project_id,
-			       impersonated_service_account)
+      audio_uris = _GetGcsObjects(pargs.source_audio_gcs_bucket, project_id,
+			       impersonated_service_account, pargs.prefix,
+			       pargs.glob, pargs.suffix, pargs.start_offset,
+			       pargs.max_items)
+    audio_uris = sharding.FilterShard(audio_uris, pargs.num_shards,
+                                      pargs.shard_index, _GetShardKey)
     encoding = pargs.encoding
     language_code = pargs.language_code
     sample_rate_hertz = pargs.sample_rate_hertz
 
-    conversation_names = _ImportConversationsFromAudio(
+    limits = _PipelineLimits(
+        transcribe_concurrency=pargs.transcribe_concurrency,
+        speech_rate=pargs.speech_rate,
+        redact_concurrency=pargs.redact_concurrency,
+        upload_concurrency=pargs.upload_concurrency,
+        create_concurrency=pargs.insights_workers,
+        insights_rate=pargs.insights_rate,
+        analyze_concurrency=pargs.analysis_concurrency,
+        analysis_rate=pargs.analysis_rate,
+        analysis_max_wait_secs=pargs.analysis_max_wait_secs,
+        probe_concurrency=pargs.probe_concurrency,
+        audio_upload_concurrency=pargs.audio_upload_concurrency,
+        source_batch_size=1 if pargs.watch else 100)
+    conversation_names, analysis_results = _ImportConversationsFromAudio(
 	audio_uris, encoding, language_code, sample_rate_hertz, project_id,
 	dest_bucket, insights_endpoint, api_version, should_redact, agent_id,
-	impersonated_service_account)
+	impersonated_service_account,
+	pargs.upload_chunk_size_mb * 1024 * 1024 or None, pargs.analyze, limits,
+	checkpoint, cache, pii_scanner, pargs.redact_mode,
+	pargs.transcript_format, pargs.agent_channel, prober, uploader,
+	pargs.audio_segment_secs, pargs.audio_segment_overlap_secs)
+    print('Created `{}` conversation IDs: {}'.format(
+        len(conversation_names), conversation_names))
+    if watcher:
+      print(_FormatWatcherStats(watcher))
   else:
     # Inputs are transcript files.
     if pargs.source_voice_transcript_gcs_bucket:
@@ -656,19 +2754,69 @@ def main():
     else:
       transcript_bucket = pargs.source_chat_transcript_gcs_bucket
       medium = 2
-    transcript_uris = _GetGcsUris(transcript_bucket, project_id,
-			     impersonated_service_account)
-    conversation_names = _ImportConversationsFromTranscript(
-      transcript_uris, project_id, medium, insights_endpoint,
-      api_version, should_redact, agent_id,
-      impersonated_service_account)
-
-  print('Created `{}` conversation IDs: {}'.format(
-      len(conversation_names), conversation_names))
-
-  print('Starting analysis for conversations.')
-  _AnalyzeConversations(conversation_names, insights_endpoint,
-                        api_version, impersonated_service_account)
+    # Conversations from an earlier import that still need analysis.
+    resumed_conversation_names = []
+    resumed_operations = {}
+    if checkpoint and pargs.resume:
+      for record in checkpoint.List(
+          [checkpoint_lib.CREATED, checkpoint_lib.ANALYZING]):
+        if record.analysis_operation:
+          resumed_operations[record.conversation_name] = (
+              record.analysis_operation)
+        else:
+          resumed_conversation_names.append(record.conversation_name)
+    bulk_results = None
+    if pargs.bulk:
+      bulk_results = _TryImportConversationsInBulk(
+          pargs, transcript_bucket, medium, checkpoint)
+    if bulk_results:
+      conversation_names, analysis_results = bulk_results
+    else:
+      transcript_uris = _GetGcsUris(transcript_bucket, project_id,
+                                    impersonated_service_account,
+                                    pargs.prefix, pargs.glob, pargs.suffix,
+                                    pargs.start_offset, pargs.max_items)
+      transcript_uris = sharding.FilterShard(
+          transcript_uris, pargs.num_shards, pargs.shard_index)
+      conversation_names = _ImportConversationsFromTranscript(
+        transcript_uris, project_id, medium, insights_endpoint,
+        api_version, should_redact, agent_id,
+        impersonated_service_account, pargs.insights_workers,
+        pargs.insights_rate, checkpoint)
+      print('Created `{}` conversation IDs: {}'.format(
+          len(conversation_names), conversation_names))
+
+      analysis_results = []
+      if pargs.analyze:
+        print('Starting analysis for conversations.')
+        analysis_results = _AnalyzeConversations(
+            conversation_names + resumed_conversation_names, insights_endpoint,
+            api_version, impersonated_service_account, pargs.insights_workers,
+            pargs.analysis_rate, pargs.analysis_max_wait_secs,
+            analysis_operations=resumed_operations, checkpoint=checkpoint)
+
+  for state, count in sorted(
+      collections.Counter(result.state for result in analysis_results).items()):
+    print('Analysis `{}`: `{}` conversations.'.format(state, count))
+
+  print('Refreshed OAuth tokens `{}` times.'.format(_GetTokenRefreshCount()))
+  print(_METRICS.FormatSummary())
+  print(_FormatLimiterStats())
+  if pargs.metrics_summary:
+    _METRICS.WriteSummary(pargs.metrics_summary)
+  results_file = pargs.results_file
+  if pargs.num_shards > 1:
+    results_file = sharding.GetShardPath(
+        results_file or _DEFAULT_RESULTS_FILE, pargs.shard_index,
+        pargs.num_shards)
+  if results_file:
+    sharding.WriteResults(results_file, pargs.shard_index, pargs.num_shards,
+                          conversation_names, analysis_results,
+                          _METRICS.Summary())
+  if cache:
+    print(cache.FormatStats())
+  if pii_scanner:
+    print(pii_scanner.FormatStats(pargs.redact_mode == _REDACT_PREFILTER))
 
 
 if __name__ == '__main__':
@@ -0,0 +1,347 @@
+# Lint as: python3
+"""Tests for import_conversations.py against the fakes of fake_services.py.
+
+Run with `python3 -m pytest import_conversations_test.py`.
+"""
+
+import contextlib
+import io
+import re
+import sys
+
+import google.api_core.exceptions
+from google.cloud import speech_v1p1beta1
+import pytest
+import requests
+
+import checkpoint as checkpoint_lib
+import fake_services
+import import_conversations
+
+# pylint: disable=protected-access
+
+_PROJECT = 'test-project'
+_BUCKET = 'test-bucket'
+
+
+@pytest.fixture(autouse=True)
+def _Fakes():
+  """Uses fake credentials and clients, and forgets limiters between tests."""
+  ic = import_conversations
+  providers = dict(ic._CREDENTIAL_PROVIDERS)
+  ic._CREDENTIAL_PROVIDERS[None] = ic._CredentialProvider(
+      fake_services.FakeCredentials())
+  ic._LIMITERS.clear()
+  with contextlib.redirect_stdout(io.StringIO()):
+    yield
+  ic._CREDENTIAL_PROVIDERS.clear()
+  ic._CREDENTIAL_PROVIDERS.update(providers)
+  ic._LIMITERS.clear()
+
+
+def _TranscriptUris(prefix, count):
+  return ['gs://{}/{}{:03d}.json'.format(_BUCKET, prefix, i)
+          for i in range(count)]
+
+
+def _Limits():
+  return import_conversations._PipelineLimits(
+      speech_rate=0, insights_rate=0, analysis_rate=0, poll_initial_secs=0.05,
+      poll_max_secs=0.2)
+
+
+def _ImportAudio(audio_uris, fake, checkpoint=None):
+  return import_conversations._ImportConversationsFromAudio(
+      audio_uris, 'FLAC', 'en-US', 0, _PROJECT, _BUCKET, fake.endpoint, 'v1',
+      False, None, None, None, True, _Limits(), checkpoint)
+
+
+class _FailingStorageClient(fake_services.FakeStorageClient):
+  """Fails the uploads of the transcripts of some audio files."""
+
+  def __init__(self, failing_names):
+    super(_FailingStorageClient, self).__init__(keep_data=False)
+    self._failing_names = failing_names
+
+  def CheckUpload(self, blob_name):
+    if blob_name in self._failing_names:
+      raise google.api_core.exceptions.Forbidden(
+          'Injected failure for {}.'.format(blob_name))
+    super(_FailingStorageClient, self).CheckUpload(blob_name)
+
+
+@pytest.fixture
+def clients():
+  """Fakes Speech, DLP and GCS, and returns the fake Speech client."""
+  registry = import_conversations._CLIENTS
+  speech = fake_services.FakeSpeechClient(transcribe_secs=0.05)
+  dlp = fake_services.FakeDlpClient()
+  storage = fake_services.FakeStorageClient(keep_data=False)
+  registry.SetFactory('speech', lambda *unused: speech)
+  registry.SetFactory('dlp', lambda *unused: dlp)
+  registry.SetFactory('storage', lambda *unused: storage)
+  yield speech
+  registry.Reset()
+
+
+def testImportConversationsFromTranscript():
+  transcript_uris = _TranscriptUris('chats/', 20)
+  with fake_services.FakeInsightsServer(analysis_secs=0.05) as fake:
+    names = import_conversations._ImportConversationsFromTranscript(
+        transcript_uris, _PROJECT, 2, fake.endpoint, 'v1', False, 'agent-1',
+        None, num_workers=4, insights_rate=0)
+    results = import_conversations._AnalyzeConversations(
+        names, fake.endpoint, 'v1', None, num_workers=4, analysis_rate=0,
+        poll_initial_secs=0.05, poll_max_secs=0.2)
+  assert sorted(names) == sorted(fake.conversations)
+  assert sorted(
+      conversation['data_source']['gcs_source']['transcript_uri']
+      for conversation in fake.conversations.values()) == transcript_uris
+  assert all(conversation['agent_id'] == 'agent-1'
+             for conversation in fake.conversations.values())
+  assert [result.state for result in results] == (
+      [import_conversations._ANALYSIS_SUCCEEDED] * 20)
+
+
+def testImportConversationsFromTranscriptDoesNotRetryServerErrors():
+  transcript_uris = _TranscriptUris('chats/', 50)
+  with fake_services.FakeInsightsServer(error_rate=0.2) as fake:
+    names = import_conversations._ImportConversationsFromTranscript(
+        transcript_uris, _PROJECT, 2, fake.endpoint, 'v1', False, None, None,
+        num_workers=4, insights_rate=0)
+  # A retry after a 503 could create a duplicate conversation.
+  assert len(names) == len(fake.conversations) < 50
+  assert fake.request_counts['failed conversations'] == 50 - len(names)
+
+
+def testResumeTranscriptImportSkipsCreatedConversations(tmp_path):
+  transcript_uris = _TranscriptUris('chats/', 10)
+  db_path = str(tmp_path / 'checkpoint.db')
+  with fake_services.FakeInsightsServer() as fake:
+    with checkpoint_lib.Checkpoint(db_path) as checkpoint:
+      first = import_conversations._ImportConversationsFromTranscript(
+          transcript_uris[:4], _PROJECT, 2, fake.endpoint, 'v1', False, None,
+          None, insights_rate=0, checkpoint=checkpoint)
+    with checkpoint_lib.Checkpoint(db_path, resume=True) as checkpoint:
+      second = import_conversations._ImportConversationsFromTranscript(
+          transcript_uris, _PROJECT, 2, fake.endpoint, 'v1', False, None, None,
+          insights_rate=0, checkpoint=checkpoint)
+  assert len(first) == 4
+  assert len(second) == 6
+  assert sorted(first + second) == sorted(fake.conversations)
+
+
+def testResumeAudioImportFinishesFailedFiles(clients, tmp_path):
+  audio_uris = ['gs://{}/audio-{}.flac'.format(_BUCKET, i) for i in range(8)]
+  db_path = str(tmp_path / 'checkpoint.db')
+  registry = import_conversations._CLIENTS
+  failing = _FailingStorageClient(
+      {'audio-{}.txt'.format(i) for i in range(0, 8, 2)})
+  with fake_services.FakeInsightsServer(analysis_secs=0.05) as fake:
+    registry.SetFactory('storage', lambda *unused: failing)
+    with checkpoint_lib.Checkpoint(db_path) as checkpoint:
+      first, _ = _ImportAudio(audio_uris, fake, checkpoint)
+    requests_before_resume = clients.requests
+    registry.SetFactory(
+        'storage', lambda *unused: fake_services.FakeStorageClient(
+            keep_data=False))
+    with checkpoint_lib.Checkpoint(db_path, resume=True) as checkpoint:
+      second, results = _ImportAudio(audio_uris, fake, checkpoint)
+  with checkpoint_lib.Checkpoint(db_path, resume=True) as checkpoint:
+    states = checkpoint.CountByState()
+  assert len(first) == 4
+  assert len(second) == 4
+  # Every audio file has one conversation, and finished files were not
+  # transcribed again.
+  assert sorted(first + second) == sorted(fake.conversations)
+  assert clients.requests - requests_before_resume <= 4
+  assert states == {checkpoint_lib.DONE: 8}
+  assert sorted(result.conversation_name for result in results) == (
+      sorted(second))
+
+
+class _MaskingDlpClient(fake_services.FakeDlpClient):
+  """Masks every letter, so that redacted transcripts are easy to tell."""
+
+  def deidentify_content(self, *args, **kwargs):
+    response = super(_MaskingDlpClient, self).deidentify_content(
+        *args, **kwargs)
+    for row in response.item.table.rows:
+      row.values[0].string_value = re.sub(
+          '[a-zA-Z]', '*', row.values[0].string_value)
+    return response
+
+
+class _MemoryCache(object):
+  """A `result_cache` backend that keeps values in a dict."""
+
+  def __init__(self):
+    self.values = {}
+
+  def Get(self, key):
+    return self.values.get(key)
+
+  def Put(self, key, value):
+    self.values[key] = value
+
+
+def testCacheKeepsOnlyRedactedTranscripts(clients):
+  registry = import_conversations._CLIENTS
+  dlp = _MaskingDlpClient()
+  storage = fake_services.FakeStorageClient(keep_data=False)
+  storage.AddSyntheticObjects(_BUCKET, 4, 'audio-{}.flac')
+  registry.SetFactory('dlp', lambda *unused: dlp)
+  registry.SetFactory('storage', lambda *unused: storage)
+  backend = _MemoryCache()
+  counts = []
+  with fake_services.FakeInsightsServer() as fake:
+    for unused_run in range(2):
+      requests_before = clients.requests, dlp.requests
+      import_conversations._ImportConversationsFromAudio(
+          import_conversations._GetGcsObjects(_BUCKET, _PROJECT, None),
+          'FLAC', 'en-US', 0, _PROJECT, 'transcripts', fake.endpoint, 'v1',
+          True, None, None, None, False, _Limits(), None,
+          import_conversations.result_cache.ResultCache([backend]))
+      counts.append((clients.requests - requests_before[0],
+                     dlp.requests - requests_before[1]))
+  # DLP results are JSON lists, and transcripts serialized responses.
+  responses = [
+      speech_v1p1beta1.types.LongRunningRecognizeResponse.FromString(value)
+      for value in backend.values.values() if not value.startswith(b'[')
+  ]
+  transcripts = [
+      alternative.transcript for response in responses
+      for result in response.results for alternative in result.alternatives
+  ]
+  assert len(responses) == 4
+  assert transcripts and all(
+      not re.search('[a-zA-Z]', transcript) for transcript in transcripts)
+  # The second import neither transcribes nor redacts again.
+  assert counts[0][0] == 4 and counts[1] == (0, 0)
+
+
+class _FakeResponse(object):
+  """A response with a JSON body, or with a body that is not JSON."""
+
+  def __init__(self, body=None):
+    self._body = body
+
+  def json(self):
+    if self._body is None:
+      raise ValueError('Expecting value: line 1 column 1 (char 0)')
+    return self._body
+
+
+def _FlakyRequests(*errors):
+  """Returns a `_SendInsightsRequest` that fails with `errors` first.
+
+  A None error is a response that is not JSON.
+  """
+  errors = list(errors)
+
+  def Send(*unused_args, **unused_kwargs):
+    if not errors:
+      return _FakeResponse({'done': True})
+    error = errors.pop(0)
+    if error is None:
+      return _FakeResponse()
+    raise error
+
+  return Send
+
+
+def testPollAnalysisReportsFailuresAsNotDone(monkeypatch):
+  ic = import_conversations
+  monkeypatch.setattr(
+      ic, '_SendInsightsRequest',
+      _FlakyRequests(requests.exceptions.ConnectionError('reset'),
+                     requests.exceptions.Timeout('timed out'), None))
+  polls = [ic._PollAnalysis('operations/1', 'localhost', 'v1', None)
+           for _ in range(4)]
+  assert polls == [(False, None)] * 3 + [(True, None)]
+
+
+def testWaitForInsightsOperationKeepsPollingAfterFailures(monkeypatch):
+  ic = import_conversations
+  monkeypatch.setattr(
+      ic, '_SendInsightsRequest',
+      _FlakyRequests(requests.exceptions.ConnectionError('reset'), None))
+  assert ic._WaitForInsightsOperation(
+      'operations/1', 'localhost', 'v1', None, max_wait_secs=10,
+      poll_initial_secs=0, poll_max_secs=0) == {'done': True}
+
+
+def testTranscriptNamesKeepFolders():
+  ic = import_conversations
+  items = [
+      ic._AudioImport(
+          'gs://{}/uploads/{}'.format(_BUCKET, name),
+          local_file=ic.local_upload.LocalFile('/calls/' + name, name, 1))
+      for name in ('a/x.wav', 'b/x.wav')
+  ] + [ic._AudioImport('gs://{}/c/x.flac'.format(_BUCKET))]
+  assert [
+      ic._GetTranscriptName(item, ic.transcript_writer.TEXT) for item in items
+  ] == ['a/x.txt', 'b/x.txt', 'c/x.txt']
+
+
+def _BulkServer(transcript_uris, **kwargs):
+  return fake_services.FakeInsightsServer(
+      analysis_secs=0.05,
+      ingest_sources=lambda uri: [u for u in transcript_uris
+                                  if u.startswith(uri)],
+      **kwargs)
+
+
+def _ImportInBulk(fake, gcs_uri, **kwargs):
+  return import_conversations._ImportConversationsInBulk(
+      gcs_uri, _PROJECT, 2, fake.endpoint, 'v1', None, None,
+      poll_initial_secs=0.05, poll_max_secs=0.2, **kwargs)
+
+
+def testImportConversationsInBulk():
+  transcript_uris = _TranscriptUris('chats/', 30)
+  with _BulkServer(transcript_uris) as fake:
+    names, results = _ImportInBulk(fake, 'gs://{}/chats/'.format(_BUCKET))
+  assert sorted(names) == sorted(fake.conversations)
+  assert len(names) == 30
+  assert all(result.state == import_conversations._ANALYSIS_SUCCEEDED
+             for result in results)
+  assert fake.request_counts['POST ingest'] == 1
+  assert fake.request_counts['POST bulk_analyze'] == 1
+  assert 'POST conversations' not in fake.request_counts
+
+
+def testImportConversationsInBulkWithoutAnalysis():
+  transcript_uris = _TranscriptUris('chats/', 5)
+  with _BulkServer(transcript_uris) as fake:
+    names, results = _ImportInBulk(
+        fake, 'gs://{}/chats/'.format(_BUCKET), analyze=False)
+  assert len(names) == 5
+  assert results == []
+  assert 'POST bulk_analyze' not in fake.request_counts
+  assert 'POST analyses' not in fake.request_counts
+
+
+def testImportConversationsInBulkDoesNotAnalyzeOtherConversations():
+  # The ingest of `chats/` also creates a conversation of another client.
+  transcript_uris = _TranscriptUris('chats/', 5) + ['gs://other/chat.json']
+  with fake_services.FakeInsightsServer(
+      analysis_secs=0.05,
+      ingest_sources=lambda unused_uri: transcript_uris) as fake:
+    names, results = _ImportInBulk(
+        fake, 'gs://{}/chats/'.format(_BUCKET), analysis_rate=0)
+  other = [
+      name for name, conversation in fake.conversations.items()
+      if not conversation['data_source']['gcs_source'][
+          'transcript_uri'].startswith('gs://{}/'.format(_BUCKET))
+  ]
+  assert len(names) == 5 and other[0] not in names
+  assert sorted(result.conversation_name for result in results) == (
+      sorted(names))
+  assert 'POST bulk_analyze' not in fake.request_counts
+  assert fake.request_counts['POST analyses'] == 5
+  assert other[0] not in fake._latest_analyses
+
+
+if __name__ == '__main__':
+  sys.exit(pytest.main([__file__]))
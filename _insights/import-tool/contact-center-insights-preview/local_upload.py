@@ -0,0 +1,201 @@
+# Lint as: python3
+"""Lists local audio files and uploads them to GCS concurrently.
+
+`--source_local_audio_path` used to upload a single file synchronously before
+the import started. Directories of recordings are instead listed lazily, and
+every file is uploaded by its own pipeline worker, so that its transcription
+starts as soon as its upload completes. Large files are uploaded as parallel
+composite uploads: their parts are uploaded concurrently as temporary objects,
+then composed into the final object and deleted.
+"""
+
+import collections
+import concurrent.futures
+import fnmatch
+import os
+import threading
+import uuid
+
+# A local file to import, with its name relative to the listed directory.
+LocalFile = collections.namedtuple('LocalFile', ['path', 'name', 'size'])
+
+DEFAULT_COMPOSITE_THRESHOLD_BYTES = 150 * 1024 * 1024
+DEFAULT_PART_BYTES = 32 * 1024 * 1024
+# GCS composes at most 32 objects in one request.
+_MAX_PARTS = 32
+
+
+def ListLocalFiles(directory, glob=None, suffixes=None, max_items=None):
+  """Lists the files under a directory, recursively.
+
+  Args:
+    directory: The directory to list.
+    glob: Only list files whose names relative to the directory, with `/`
+      separators, match this `fnmatch` pattern. `*` also matches slashes.
+    suffixes: Only list files whose names end with one of these suffixes.
+    max_items: Stop after this many matching files. None for no limit.
+
+  Yields:
+    A `LocalFile` for every matching file, in name order.
+  """
+  num_items = 0
+  for root, dirs, files in os.walk(directory):
+    # Sorted in place, so that directories are walked in name order too.
+    dirs.sort()
+    relative_root = os.path.relpath(root, directory)
+    for file_name in sorted(files):
+      if relative_root == '.':
+        name = file_name
+      else:
+        name = '/'.join(relative_root.split(os.sep) + [file_name])
+      if suffixes and not name.endswith(tuple(suffixes)):
+        continue
+      if glob and not fnmatch.fnmatchcase(name, glob):
+        continue
+      path = os.path.join(root, file_name)
+      yield LocalFile(path, name, os.path.getsize(path))
+      num_items += 1
+      if max_items is not None and num_items >= max_items:
+        return
+
+
+class _FileRange(object):
+  """A file object limited to a range of an open file.
+
+  Resumable uploads read their stream to the end, so each part of a composite
+  upload must end where the part does.
+  """
+
+  def __init__(self, f, offset, size):
+    self._file = f
+    self._offset = offset
+    self._end = offset + size
+    f.seek(offset)
+
+  def read(self, size=-1):
+    remaining = max(0, self._end - self._file.tell())
+    if size is None or size < 0 or size > remaining:
+      size = remaining
+    return self._file.read(size)
+
+  def tell(self):
+    return self._file.tell() - self._offset
+
+  def seek(self, position, whence=0):
+    if whence == 0:
+      position += self._offset
+    elif whence == 1:
+      position += self._file.tell()
+    else:
+      position += self._end
+    self._file.seek(position)
+    return self.tell()
+
+
+class Uploader(object):
+  """Uploads local files to a bucket, composing large files from parts.
+
+  Thread-safe. Counts the files and bytes uploaded.
+  """
+
+  def __init__(self, get_storage_client, bucket, prefix='', chunk_size=None,
+               composite_threshold=DEFAULT_COMPOSITE_THRESHOLD_BYTES,
+               part_size=DEFAULT_PART_BYTES, part_workers=8):
+    """Initializes the uploader.
+
+    Args:
+      get_storage_client: Returns the `google.cloud.storage.Client` to use in
+        the calling thread.
+      bucket: The name of the destination bucket.
+      prefix: Prepended to the names of the uploaded objects.
+      chunk_size: If set, files are sent as resumable uploads in chunks of
+        this many bytes, which must be a multiple of 256 KiB.
+      composite_threshold: Files of at least this many bytes are uploaded in
+        parts. Zero disables composite uploads.
+      part_size: The size of the parts of composite uploads. Increased for
+        files with more than 32 parts.
+      part_workers: The number of parts uploaded at the same time, shared by
+        all composite uploads.
+    """
+    self._get_storage_client = get_storage_client
+    self._bucket = bucket
+    self._prefix = prefix
+    self._chunk_size = chunk_size
+    self._composite_threshold = composite_threshold
+    self._part_size = part_size
+    self._part_executor = concurrent.futures.ThreadPoolExecutor(
+        max_workers=part_workers)
+    self._lock = threading.Lock()
+    self.files = 0
+    self.composite_files = 0
+    self.bytes_uploaded = 0
+
+  def GetUri(self, local_file):
+    """Returns the `gs://` uri that a file is uploaded to."""
+    return 'gs://{}/{}{}'.format(self._bucket, self._prefix, local_file.name)
+
+  def Upload(self, local_file):
+    """Uploads a file.
+
+    Args:
+      local_file: The `LocalFile` to upload.
+
+    Returns:
+      The hash of the uploaded object: its md5, or its crc32c for composite
+      objects, which have no md5.
+
+    Raises:
+      google.api_core.exceptions.GoogleAPICallError: If the upload failed.
+    """
+    name = self._prefix + local_file.name
+    if (self._composite_threshold and
+        local_file.size >= self._composite_threshold):
+      blob = self._UploadComposite(local_file.path, local_file.size, name)
+      composite = True
+    else:
+      blob = self._get_storage_client().bucket(self._bucket).blob(
+          name, chunk_size=self._chunk_size)
+      with open(local_file.path, 'rb') as f:
+        blob.upload_from_file(f, size=local_file.size)
+      composite = False
+    with self._lock:
+      self.files += 1
+      self.composite_files += composite
+      self.bytes_uploaded += local_file.size
+    return blob.md5_hash or blob.crc32c
+
+  def _UploadPart(self, path, offset, size, name):
+    blob = self._get_storage_client().bucket(self._bucket).blob(
+        name, chunk_size=self._chunk_size)
+    with open(path, 'rb') as f:
+      blob.upload_from_file(_FileRange(f, offset, size), size=size)
+    return blob
+
+  def _UploadComposite(self, path, size, name):
+    """Uploads the parts of a file concurrently, then composes them."""
+    part_size = max(self._part_size, -(-size // _MAX_PARTS))
+    # Unique, so that concurrent imports of the same file don't collide.
+    part_prefix = '{}.part-{}-'.format(name, uuid.uuid4().hex[:8])
+    futures = [
+        self._part_executor.submit(self._UploadPart, path, offset,
+                                   min(part_size, size - offset),
+                                   '{}{:02d}'.format(part_prefix, i))
+        for i, offset in enumerate(range(0, size, part_size))
+    ]
+    parts = []
+    try:
+      for future in futures:
+        parts.append(future.result())
+      blob = self._get_storage_client().bucket(self._bucket).blob(name)
+      blob.compose(parts)
+    finally:
+      for future in futures[len(parts):]:
+        future.cancel()
+        if not future.cancelled() and not future.exception():
+          parts.append(future.result())
+      for part in parts:
+        part.delete()
+    return blob
+
+  def Close(self):
+    self._part_executor.shutdown()
@@ -0,0 +1,388 @@
+# Lint as: python3
+"""Latency, error and throughput metrics for the calls to remote services.
+
+The import tool used to report progress only through per-item messages, so a
+slow import did not show whether Speech-to-text, DLP, GCS or Insights was the
+bottleneck. Every remote call now goes through `Registry.Call`, which records,
+per service and method, a latency histogram, the number of calls in flight,
+errors by code, retries and the bytes sent and received.
+
+The metrics are exported in the OpenMetrics text format to a file that is
+rewritten periodically, or served over HTTP for Prometheus to scrape, and are
+summarized as JSON at the end of the import.
+
+Recording a call takes two clock reads and a few short critical sections, a
+few microseconds, which is negligible next to the milliseconds of a remote
+call.
+"""
+
+import bisect
+import http.server
+import json
+import os
+import threading
+import time
+
+# Upper bounds of the latency histogram buckets, in seconds. Long running
+# operations are polled, so single calls rarely take more than a minute.
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+                   10.0, 30.0, 60.0)
+
+CONTENT_TYPE = 'application/openmetrics-text; version=1.0.0; charset=utf-8'
+
+_PREFIX = 'ccai_import'
+
+
+def _ErrorCode(error):
+  """Returns a short label for an error: its HTTP status, or its type."""
+  code = getattr(error, 'code', None)
+  if code is None:
+    response = getattr(error, 'response', None)
+    code = getattr(response, 'status_code', None)
+  if isinstance(code, int):
+    return str(code)
+  return type(error).__name__
+
+
+class _Series(object):
+  """The metrics of one method of one service. Guarded by the registry lock."""
+
+  def __init__(self, service, method, num_buckets):
+    self.service = service
+    self.method = method
+    self.in_flight = 0
+    self.count = 0
+    self.sum_secs = 0.0
+    self.max_secs = 0.0
+    # One count per bucket, plus one for latencies above the largest bound.
+    self.buckets = [0] * (num_buckets + 1)
+    self.errors = {}
+    self.retries = 0
+    self.bytes_sent = 0
+    self.bytes_received = 0
+
+
+class _Call(object):
+  """Times one remote call. Returned by `Registry.Call`."""
+
+  __slots__ = ('_registry', '_series', '_start')
+
+  def __init__(self, registry, series):
+    self._registry = registry
+    self._series = series
+    self._start = None
+
+  def __enter__(self):
+    registry = self._registry
+    with registry._lock:  # pylint: disable=protected-access
+      self._series.in_flight += 1
+    registry._local.call = self  # pylint: disable=protected-access
+    self._start = time.perf_counter()
+    return self
+
+  def __exit__(self, exc_type, exc, unused_tb):
+    elapsed = time.perf_counter() - self._start
+    registry = self._registry
+    registry._local.call = None  # pylint: disable=protected-access
+    registry._Record(self._series, elapsed, exc)  # pylint: disable=protected-access
+    return False
+
+  def AddBytes(self, sent=0, received=0):
+    """Counts the bytes of the request and of the response."""
+    with self._registry._lock:  # pylint: disable=protected-access
+      self._series.bytes_sent += sent
+      self._series.bytes_received += received
+
+  def AddRetry(self):
+    """Counts a retry of the call, e.g. by the HTTP library."""
+    with self._registry._lock:  # pylint: disable=protected-access
+      self._series.retries += 1
+
+
+class Registry(object):
+  """Collects the metrics of remote calls. Thread-safe."""
+
+  def __init__(self, buckets=DEFAULT_BUCKETS):
+    """Initializes the registry.
+
+    Args:
+      buckets: The upper bounds of the latency histogram buckets, in seconds,
+        in increasing order.
+    """
+    self._buckets = tuple(buckets)
+    self._lock = threading.Lock()
+    self._series = {}
+    self._local = threading.local()
+    self._start = time.time()
+
+  def _GetSeries(self, service, method):
+    series = self._series.get((service, method))
+    if series is None:
+      with self._lock:
+        series = self._series.setdefault(
+            (service, method),
+            _Series(service, method, len(self._buckets)))
+    return series
+
+  def Call(self, service, method):
+    """Returns a context manager that times one call to a remote service.
+
+    An exception raised inside the context is counted as an error of the
+    call, and then propagates.
+
+    Args:
+      service: The service, e.g. `speech`.
+      method: The method of the service, e.g. `long_running_recognize`.
+
+    Returns:
+      The context manager, whose value can count the bytes transferred.
+    """
+    return _Call(self, self._GetSeries(service, method))
+
+  def CurrentCall(self):
+    """Returns the call that the calling thread is in, or None."""
+    return getattr(self._local, 'call', None)
+
+  def AddBytes(self, service, method, sent=0, received=0):
+    """Counts bytes transferred outside of a timed call."""
+    series = self._GetSeries(service, method)
+    with self._lock:
+      series.bytes_sent += sent
+      series.bytes_received += received
+
+  def AddRetry(self, service, method):
+    """Counts a retry of a call to a remote service."""
+    series = self._GetSeries(service, method)
+    with self._lock:
+      series.retries += 1
+
+  def _Record(self, series, elapsed, error):
+    index = bisect.bisect_left(self._buckets, elapsed)
+    with self._lock:
+      series.in_flight -= 1
+      series.count += 1
+      series.sum_secs += elapsed
+      if elapsed > series.max_secs:
+        series.max_secs = elapsed
+      series.buckets[index] += 1
+      if error is not None:
+        code = _ErrorCode(error)
+        series.errors[code] = series.errors.get(code, 0) + 1
+
+  def _Snapshot(self):
+    """Returns copies of all series, taken under the lock."""
+    with self._lock:
+      snapshot = []
+      for key in sorted(self._series):
+        series = self._series[key]
+        copy = _Series(series.service, series.method, len(self._buckets))
+        copy.__dict__.update(series.__dict__)
+        copy.buckets = list(series.buckets)
+        copy.errors = dict(series.errors)
+        snapshot.append(copy)
+      return snapshot
+
+  def _Percentile(self, series, fraction):
+    """Estimates a latency percentile from the histogram buckets.
+
+    Interpolates linearly within the bucket that holds the percentile, like
+    Prometheus' `histogram_quantile`, and caps the estimate at the largest
+    latency seen.
+    """
+    if not series.count:
+      return 0.0
+    rank = fraction * series.count
+    cumulative = 0
+    for i, count in enumerate(series.buckets):
+      if count and cumulative + count >= rank:
+        lower = self._buckets[i - 1] if i else 0.0
+        upper = (self._buckets[i] if i < len(self._buckets) else
+                 series.max_secs)
+        estimate = lower + (upper - lower) * (rank - cumulative) / count
+        return min(estimate, series.max_secs)
+      cumulative += count
+    return series.max_secs
+
+  def FormatOpenMetrics(self):
+    """Returns all metrics in the OpenMetrics text format."""
+    snapshot = self._Snapshot()
+    latency = '{}_call_latency_seconds'.format(_PREFIX)
+    in_flight = '{}_calls_in_flight'.format(_PREFIX)
+    errors = '{}_call_errors'.format(_PREFIX)
+    retries = '{}_call_retries'.format(_PREFIX)
+    transferred = '{}_transferred_bytes'.format(_PREFIX)
+    lines = [
+        '# TYPE {} histogram'.format(latency),
+        '# UNIT {} seconds'.format(latency),
+        '# HELP {} Latency of calls to remote services.'.format(latency),
+    ]
+    for series in snapshot:
+      labels = 'service="{}",method="{}"'.format(series.service, series.method)
+      cumulative = 0
+      for bound, count in zip(self._buckets + ('+Inf',), series.buckets):
+        cumulative += count
+        lines.append('{}_bucket{{{},le="{}"}} {}'.format(
+            latency, labels, bound, cumulative))
+      lines.append('{}_count{{{}}} {}'.format(latency, labels, series.count))
+      lines.append('{}_sum{{{}}} {!r}'.format(latency, labels,
+                                               series.sum_secs))
+    lines += [
+        '# TYPE {} gauge'.format(in_flight),
+        '# HELP {} Calls to remote services that have not returned.'.format(
+            in_flight),
+    ]
+    for series in snapshot:
+      lines.append('{}{{service="{}",method="{}"}} {}'.format(
+          in_flight, series.service, series.method, series.in_flight))
+    lines += [
+        '# TYPE {} counter'.format(errors),
+        '# HELP {} Failed calls, by HTTP status or error type.'.format(errors),
+    ]
+    for series in snapshot:
+      for code, count in sorted(series.errors.items()):
+        lines.append('{}_total{{service="{}",method="{}",code="{}"}} {}'.format(
+            errors, series.service, series.method, code, count))
+    lines += [
+        '# TYPE {} counter'.format(retries),
+        '# HELP {} Retried calls.'.format(retries),
+    ]
+    for series in snapshot:
+      lines.append('{}_total{{service="{}",method="{}"}} {}'.format(
+          retries, series.service, series.method, series.retries))
+    lines += [
+        '# TYPE {} counter'.format(transferred),
+        '# UNIT {} bytes'.format(transferred),
+        '# HELP {} Bytes sent to and received from remote services.'.format(
+            transferred),
+    ]
+    for series in snapshot:
+      for direction, count in (('sent', series.bytes_sent),
+                               ('received', series.bytes_received)):
+        lines.append(
+            '{}_total{{service="{}",method="{}",direction="{}"}} {}'.format(
+                transferred, series.service, series.method, direction, count))
+    lines.append('# EOF')
+    return '\n'.join(lines) + '\n'
+
+  def Summary(self):
+    """Returns the metrics of every method as a JSON serializable dict."""
+    elapsed = time.time() - self._start
+    calls = []
+    for series in self._Snapshot():
+      calls.append({
+          'service': series.service,
+          'method': series.method,
+          'calls': series.count,
+          'calls_per_sec': series.count / elapsed if elapsed else 0.0,
+          'errors': sum(series.errors.values()),
+          'errors_by_code': series.errors,
+          'retries': series.retries,
+          'in_flight': series.in_flight,
+          'mean_secs': series.sum_secs / series.count if series.count else 0.0,
+          'p50_secs': self._Percentile(series, 0.5),
+          'p90_secs': self._Percentile(series, 0.9),
+          'p99_secs': self._Percentile(series, 0.99),
+          'max_secs': series.max_secs,
+          'bytes_sent': series.bytes_sent,
+          'bytes_received': series.bytes_received,
+      })
+    return {'elapsed_secs': elapsed, 'calls': calls}
+
+  def WriteSummary(self, path):
+    """Writes the summary to a JSON file."""
+    with open(path, 'w') as f:
+      json.dump(self.Summary(), f, indent=2, sort_keys=True)
+
+  def FormatSummary(self):
+    """Formats the summary as a table."""
+    lines = ['{:<9} {:<22} {:>7} {:>7} {:>7} {:>8} {:>8} {:>8} {:>9}'.format(
+        'service', 'method', 'calls', 'errors', 'retries', 'p50', 'p99',
+        'max', 'MiB')]
+    for row in self.Summary()['calls']:
+      lines.append(
+          '{:<9} {:<22} {:>7} {:>7} {:>7} {:>7.3f}s {:>7.3f}s {:>7.3f}s '
+          '{:>9.2f}'.format(
+              row['service'], row['method'], row['calls'], row['errors'],
+              row['retries'], row['p50_secs'], row['p99_secs'],
+              row['max_secs'],
+              (row['bytes_sent'] + row['bytes_received']) / 1024.0 / 1024.0))
+    return '\n'.join(lines)
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+  """Serves the metrics of the server's registry at any path."""
+
+  def do_GET(self):  # pylint: disable=invalid-name
+    body = self.server.registry.FormatOpenMetrics().encode('utf-8')
+    self.send_response(200)
+    self.send_header('Content-Type', CONTENT_TYPE)
+    self.send_header('Content-Length', str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+  def log_message(self, *args):
+    del args  # Scrapes are not logged.
+
+
+class Exporter(object):
+  """Exports the metrics of a registry while the import runs.
+
+  The file is replaced atomically, so a reader never sees a partial write, for
+  example node_exporter's textfile collector.
+  """
+
+  def __init__(self, registry, path=None, port=None, interval_secs=10.0):
+    """Starts exporting.
+
+    Args:
+      registry: The `Registry` to export.
+      path: If set, the file to write the metrics to every `interval_secs`
+        and when the exporter is closed.
+      port: If set, the port on which to serve the metrics over HTTP.
+      interval_secs: How often to write the file.
+    """
+    self._registry = registry
+    self._path = path
+    self._interval_secs = interval_secs
+    self._stop = threading.Event()
+    self._threads = []
+    self._server = None
+    if port is not None:
+      self._server = http.server.ThreadingHTTPServer(('', port), _Handler)
+      self._server.daemon_threads = True
+      self._server.registry = registry
+      self._threads.append(
+          threading.Thread(target=self._server.serve_forever, daemon=True))
+    if path:
+      self._threads.append(threading.Thread(target=self._Run, daemon=True))
+    for thread in self._threads:
+      thread.start()
+
+  @property
+  def port(self):
+    """The port the metrics are served on, or None."""
+    return self._server.server_address[1] if self._server else None
+
+  def _Run(self):
+    while not self._stop.wait(self._interval_secs):
+      self.WriteFile()
+
+  def WriteFile(self):
+    """Writes the metrics to the file now."""
+    temp_path = '{}.tmp'.format(self._path)
+    with open(temp_path, 'w') as f:
+      f.write(self._registry.FormatOpenMetrics())
+    os.replace(temp_path, self._path)
+
+  def Close(self):
+    """Stops exporting, and writes the file one last time."""
+    if self._stop.is_set():
+      return
+    self._stop.set()
+    if self._server:
+      self._server.shutdown()
+      self._server.server_close()
+    for thread in self._threads:
+      thread.join()
+    if self._path:
+      self.WriteFile()
@@ -0,0 +1,252 @@
+# Lint as: python3
+"""Local detection of PII candidates in transcripts, without calling DLP.
+
+Covers patterns for the info types that the import tool redacts with DLP,
+except `LAST_NAME`: email addresses, credit card numbers (with a Luhn check),
+phone numbers, dates of birth and street addresses. All patterns are compiled
+into one expression, so every text is scanned once, and texts without a digit
+or an `@` are skipped without running it.
+
+Used either as a prefilter, so that only texts with candidates are sent to DLP,
+or to mask candidates locally. Numbers that are spelled out in words are not
+detected.
+"""
+
+import concurrent.futures
+import multiprocessing
+import os
+import re
+import threading
+import time
+
+EMAIL_ADDRESS = 'EMAIL_ADDRESS'
+CREDIT_CARD_NUMBER = 'CREDIT_CARD_NUMBER'
+PHONE_NUMBER = 'PHONE_NUMBER'
+DATE_OF_BIRTH = 'DATE_OF_BIRTH'
+STREET_ADDRESS = 'STREET_ADDRESS'
+
+_MONTH = (r'(?:jan(?:uary)?|feb(?:ruary)?|mar(?:ch)?|apr(?:il)?|may|june?|'
+          r'july?|aug(?:ust)?|sep(?:t(?:ember)?)?|oct(?:ober)?|nov(?:ember)?|'
+          r'dec(?:ember)?)')
+_STREET_SUFFIX = (r'(?:street|st|avenue|ave|road|rd|boulevard|blvd|lane|ln|'
+                  r'drive|dr|court|ct|way|place|pl|terrace|ter|parkway|pkwy|'
+                  r'circle|cir|highway|hwy)')
+
+_PATTERNS = (
+    (EMAIL_ADDRESS, r'[A-Za-z0-9._%+-]+@[A-Za-z0-9-]+(?:\.[A-Za-z0-9-]+)*'
+     r'\.[A-Za-z]{2,}'),
+    # 13 to 19 digits, optionally grouped by spaces or dashes.
+    (CREDIT_CARD_NUMBER, r'(?<!\d)\d(?:[ -]?\d){12,18}(?!\d)'),
+    (PHONE_NUMBER, r'(?<![\d+])(?:\+?1[ .-]?)?(?:\(\d{3}\)|\d{3})[ .-]?\d{3}'
+     r'[ .-]?\d{4}(?!\d)|\+\d{1,3}(?:[ .-]?\d{2,4}){2,5}(?!\d)'),
+    (DATE_OF_BIRTH, r'(?<!\d)(?:\d{1,2}[/.-]\d{1,2}[/.-](?:19|20)?\d{2}|'
+     r'(?:19|20)\d{2}-\d{1,2}-\d{1,2})(?!\d)|(?i:\b' + _MONTH +
+     r'\.? \d{1,2}(?:st|nd|rd|th)?,? (?:19|20)\d{2}\b|\b\d{1,2}(?:st|nd|rd|th)?'
+     r' (?:of )?' + _MONTH + r',? (?:19|20)\d{2}\b)'),
+    (STREET_ADDRESS, r'(?i:\b\d{1,6}(?: [a-z]+){1,4} ' + _STREET_SUFFIX +
+     r'\b\.?)'),
+)
+
+
+def _Compile(patterns):
+  # Every pattern is a named group of one alternation, tried in order.
+  return re.compile('|'.join(
+      '(?P<{}>{})'.format(info_type, pattern) for info_type, pattern in patterns))
+
+
+_PII = _Compile(_PATTERNS)
+# Tried where a card number candidate fails the Luhn check, e.g. at two phone
+# numbers in a row.
+_PII_WITHOUT_CARDS = _Compile(
+    [(info_type, pattern) for info_type, pattern in _PATTERNS
+     if info_type != CREDIT_CARD_NUMBER])
+# Every pattern needs one of these characters.
+_TRIGGER = re.compile(r'[\d@]')
+
+
+def IsLuhnValid(digits):
+  """Returns whether a string of digits passes the Luhn checksum."""
+  total = 0
+  for i, digit in enumerate(reversed(digits)):
+    value = ord(digit) - 48
+    if i % 2:
+      value *= 2
+      if value > 9:
+        value -= 9
+    total += value
+  return total % 10 == 0
+
+
+def FindPii(text):
+  """Finds PII candidates in a text.
+
+  Args:
+    text: The text to scan.
+
+  Returns:
+    A list of (info type, start, end) tuples, in order.
+  """
+  if not _TRIGGER.search(text):
+    return []
+  matches = []
+  position = 0
+  while True:
+    match = _PII.search(text, position)
+    if not match:
+      return matches
+    if match.lastgroup == CREDIT_CARD_NUMBER and not IsLuhnValid(
+        re.sub(r'\D', '', match.group())):
+      start = match.start()
+      match = _PII_WITHOUT_CARDS.match(text, start)
+      if not match:
+        position = start + 1
+        continue
+    matches.append((match.lastgroup, match.start(), match.end()))
+    position = match.end()
+
+
+def MaskPii(text, matches, masking_character='*'):
+  """Masks the PII candidates found in a text, like DLP character masking.
+
+  Args:
+    text: The text.
+    matches: The matches that `FindPii` returned for the text.
+    masking_character: The character to replace PII with.
+
+  Returns:
+    The masked text, of the same length.
+  """
+  if not matches:
+    return text
+  parts = []
+  position = 0
+  for unused_info_type, start, end in matches:
+    parts.append(text[position:start])
+    parts.append(masking_character * (end - start))
+    position = end
+  parts.append(text[position:])
+  return ''.join(parts)
+
+
+def _FindPiiInTexts(texts):
+  return [FindPii(text) for text in texts]
+
+
+class Scanner(object):
+  """Finds PII candidates in batches of texts, on all CPU cores.
+
+  Also counts the texts and bytes scanned, for `FormatStats`.
+  """
+
+  def __init__(self, processes=None, chunk_bytes=256 * 1024):
+    """Initializes the scanner.
+
+    Args:
+      processes: The number of processes to scan with, at most the number of
+        CPUs, which is the default. With one, texts are scanned in the calling
+        thread.
+      chunk_bytes: The approximate size of the texts scanned by one process at
+        a time. Batches smaller than two chunks are scanned in the calling
+        thread, since sending them to other processes takes longer than
+        scanning them.
+    """
+    cpus = os.cpu_count() or 1
+    self.processes = min(processes or cpus, cpus)
+    self._chunk_bytes = chunk_bytes
+    self._pool = None
+    self._lock = threading.Lock()
+    self.batches = 0
+    self.batches_with_pii = 0
+    self.texts = 0
+    self.texts_with_pii = 0
+    self.bytes_scanned = 0
+    self.bytes_with_pii = 0
+    self.scan_secs = 0.0
+
+  def _GetPool(self):
+    with self._lock:
+      if self._pool is None:
+        # Spawned rather than forked, since the parent has gRPC threads.
+        self._pool = concurrent.futures.ProcessPoolExecutor(
+            max_workers=self.processes,
+            mp_context=multiprocessing.get_context('spawn'))
+      return self._pool
+
+  def FindAll(self, texts):
+    """Finds the PII candidates in texts.
+
+    Args:
+      texts: A list of texts, typically the utterances of one conversation.
+
+    Returns:
+      A list with the `FindPii` matches of every text.
+    """
+    start = time.time()
+    sizes = [len(text) for text in texts]
+    total = sum(sizes)
+    if self.processes > 1 and total >= 2 * self._chunk_bytes:
+      # At least one chunk per process, and few enough to keep them all busy.
+      chunk_bytes = max(self._chunk_bytes, total // (self.processes * 4))
+      chunks = []
+      chunk_start = 0
+      chunk_size = 0
+      for i, size in enumerate(sizes):
+        chunk_size += size
+        if chunk_size >= chunk_bytes:
+          chunks.append(texts[chunk_start:i + 1])
+          chunk_start = i + 1
+          chunk_size = 0
+      if chunk_start < len(texts):
+        chunks.append(texts[chunk_start:])
+      matches = [
+          text_matches
+          for chunk_matches in self._GetPool().map(_FindPiiInTexts, chunks)
+          for text_matches in chunk_matches
+      ]
+    else:
+      matches = _FindPiiInTexts(texts)
+    elapsed = time.time() - start
+
+    with self._lock:
+      self.batches += 1
+      self.texts += len(texts)
+      self.bytes_scanned += total
+      self.scan_secs += elapsed
+      num_with_pii = 0
+      for size, text_matches in zip(sizes, matches):
+        if text_matches:
+          num_with_pii += 1
+          self.bytes_with_pii += size
+      self.texts_with_pii += num_with_pii
+      self.batches_with_pii += bool(num_with_pii)
+    return matches
+
+  def FormatStats(self, prefilter=True):
+    """Returns a summary of what was scanned, how fast, and not sent to DLP.
+
+    DLP requests are shared by concurrent conversations, so texts that are not
+    sent do not always save a request. `bench.py pii` compares the requests
+    with those of the `dlp` redact mode.
+
+    Args:
+      prefilter: Whether texts with candidates were sent to DLP, rather than
+        masked locally.
+    """
+    with self._lock:
+      mb = self.bytes_scanned / 1024.0 / 1024.0
+      stats = ('PII scan: scanned `{:.1f}` MB at `{:.1f}` MB/s. `{}` of `{}` '
+               'utterances had candidates, and `{}` of `{}` conversations had '
+               'none.'.format(
+                   mb, mb / self.scan_secs if self.scan_secs else 0.0,
+                   self.texts_with_pii, self.texts,
+                   self.batches - self.batches_with_pii, self.batches))
+      if prefilter:
+        stats += (' `{}` utterances and `{:.1f}` of `{:.1f}` MB were not sent '
+                  'to DLP.'.format(self.texts - self.texts_with_pii,
+                                   (self.bytes_scanned - self.bytes_with_pii) /
+                                   1024.0 / 1024.0, mb))
+      return stats
+
+  def Close(self):
+    if self._pool:
+      self._pool.shutdown()
@@ -0,0 +1,250 @@
+# Lint as: python3
+"""A staged asyncio pipeline with bounded queues between stages.
+
+Every stage runs a fixed number of workers that take items from the stage's
+input queue and put results on the next stage's queue. Queues are bounded, so
+a slow stage applies backpressure all the way back to the source, and memory
+use stays flat however many items the source yields.
+"""
+
+import asyncio
+import collections
+import itertools
+import math
+import time
+
+# Put on a queue once per worker to tell the workers to exit.
+_DONE = object()
+
+# Item latencies are counted in buckets that are this factor apart, so
+# percentiles are within 10% of the exact value, in constant memory.
+_BUCKET_FACTOR = 1.1
+# The upper bound of the lowest bucket.
+_MIN_BUCKET_SECS = 0.001
+
+
+class StageStats(object):
+  """Counts the items a stage processed and how long it was busy."""
+
+  def __init__(self, name):
+    self.name = name
+    self.items_in = 0
+    self.items_out = 0
+    self.errors = 0
+    self.busy_secs = 0.0
+    self.first_start = None
+    self.last_end = None
+    # Maps bucket indexes to the number of items with latencies in the bucket.
+    self._latency_buckets = collections.Counter()
+
+  def AddLatency(self, secs):
+    """Counts the time one item took in the stage."""
+    self.busy_secs += secs
+    index = 0
+    if secs > _MIN_BUCKET_SECS:
+      index = int(math.ceil(
+          math.log(secs / _MIN_BUCKET_SECS, _BUCKET_FACTOR)))
+    self._latency_buckets[index] += 1
+
+  def GetPercentile(self, fraction):
+    """Returns the upper bound of the bucket that holds a latency percentile.
+
+    Args:
+      fraction: The percentile, e.g. 0.99.
+
+    Returns:
+      The latency in seconds, or zero if no item was counted.
+    """
+    total = sum(self._latency_buckets.values())
+    count = 0
+    for index in sorted(self._latency_buckets):
+      count += self._latency_buckets[index]
+      if count >= fraction * total:
+        return _MIN_BUCKET_SECS * _BUCKET_FACTOR**index
+    return 0.0
+
+  @property
+  def elapsed_secs(self):
+    if self.first_start is None:
+      return 0.0
+    return (self.last_end or time.time()) - self.first_start
+
+  @property
+  def throughput(self):
+    """Items completed per second while the stage was active."""
+    elapsed = self.elapsed_secs
+    return self.items_out / elapsed if elapsed else 0.0
+
+  def ToDict(self):
+    return {
+        'stage': self.name,
+        'items_in': self.items_in,
+        'items_out': self.items_out,
+        'errors': self.errors,
+        'elapsed_secs': self.elapsed_secs,
+        'items_per_sec': self.throughput,
+        'mean_latency_secs': (
+            self.busy_secs / self.items_in if self.items_in else 0.0),
+        'p50_latency_secs': self.GetPercentile(0.5),
+        'p99_latency_secs': self.GetPercentile(0.99),
+    }
+
+
+class Stage(object):
+  """One step of a pipeline.
+
+  Attributes:
+    name: The name used in stats.
+    fn: An async function that takes an item and returns the item to pass on,
+      or None to drop it.
+    concurrency: The number of items processed at the same time.
+    queue_size: The capacity of the stage's input queue. Defaults to
+      `concurrency`.
+  """
+
+  def __init__(self, name, fn, concurrency=1, queue_size=None):
+    self.name = name
+    self.fn = fn
+    self.concurrency = max(1, concurrency)
+    self.queue_size = queue_size or self.concurrency
+
+
+class Pipeline(object):
+  """Runs items from a source through a list of stages."""
+
+  def __init__(self, stages, source_name='list', on_error=None,
+               source_batch_size=100):
+    """Initializes the pipeline.
+
+    Args:
+      stages: The `Stage`s, in order.
+      source_name: The name used in stats for reading from the source.
+      on_error: Called with (stage name, item, exception) when a stage raises.
+        By default, the error is printed. The item is dropped either way.
+      source_batch_size: The number of items read from a synchronous source
+        at a time.
+    """
+    self._stages = stages
+    self._on_error = on_error or _PrintError
+    self._source_batch_size = max(1, source_batch_size)
+    self.stats = [StageStats(source_name)] + [
+        StageStats(stage.name) for stage in stages
+    ]
+
+  async def Run(self, source):
+    """Runs every item of `source` through all stages.
+
+    Args:
+      source: An iterable or async iterable of items.
+
+    Returns:
+      The per-stage `StageStats`, starting with the source.
+    """
+    queues = [asyncio.Queue(maxsize=stage.queue_size) for stage in self._stages]
+    # Items that come out of the last stage are counted, but not kept.
+    queues.append(None)
+
+    tasks = [asyncio.ensure_future(self._Feed(source, queues[0]))]
+    for i in range(len(self._stages)):
+      tasks.append(asyncio.ensure_future(self._RunStage(i, queues)))
+    try:
+      await asyncio.gather(*tasks)
+    except BaseException:
+      for task in tasks:
+        task.cancel()
+      await asyncio.gather(*tasks, return_exceptions=True)
+      raise
+    return self.stats
+
+  async def _Feed(self, source, queue):
+    stats = self.stats[0]
+    stats.first_start = time.time()
+    if hasattr(source, '__aiter__'):
+      async for item in source:
+        stats.items_in += 1
+        await queue.put(item)
+        stats.items_out += 1
+    else:
+      # Read on another thread, so that a source that blocks, such as a paged
+      # GCS listing, does not stall the stages.
+      loop = asyncio.get_event_loop()
+      items = iter(source)
+      while True:
+        batch = await loop.run_in_executor(None, _NextBatch, items,
+                                           self._source_batch_size)
+        if not batch:
+          break
+        for item in batch:
+          stats.items_in += 1
+          await queue.put(item)
+          stats.items_out += 1
+    stats.last_end = time.time()
+    for _ in range(self._stages[0].concurrency if self._stages else 0):
+      await queue.put(_DONE)
+
+  async def _RunStage(self, index, queues):
+    stage = self._stages[index]
+    stats = self.stats[index + 1]
+    queue_out = queues[index + 1]
+    await asyncio.gather(*[
+        self._RunWorker(stage, stats, queues[index], queue_out)
+        for _ in range(stage.concurrency)
+    ])
+    stats.last_end = time.time()
+    if queue_out is not None:
+      for _ in range(self._stages[index + 1].concurrency):
+        await queue_out.put(_DONE)
+
+  async def _RunWorker(self, stage, stats, queue_in, queue_out):
+    while True:
+      item = await queue_in.get()
+      if item is _DONE:
+        return
+      stats.items_in += 1
+      start = time.time()
+      if stats.first_start is None:
+        stats.first_start = start
+      try:
+        result = await stage.fn(item)
+      except Exception as e:  # pylint: disable=broad-except
+        stats.errors += 1
+        self._on_error(stage.name, item, e)
+        result = None
+      finally:
+        stats.AddLatency(time.time() - start)
+      if result is None:
+        continue
+      stats.items_out += 1
+      if queue_out is not None:
+        await queue_out.put(result)
+
+
+def _NextBatch(items, batch_size):
+  """Returns up to `batch_size` items from an iterator."""
+  return list(itertools.islice(items, batch_size))
+
+
+def _PrintError(stage_name, item, error):
+  print('Error `{}`: stage `{}` failed for `{}`.'.format(error, stage_name,
+                                                         item))
+
+
+def FormatStats(stats):
+  """Formats per-stage stats as a table.
+
+  Args:
+    stats: A list of `StageStats`.
+
+  Returns:
+    The table, as a string.
+  """
+  lines = ['{:<12} {:>9} {:>9} {:>7} {:>10} {:>9} {:>9} {:>9}'.format(
+      'stage', 'in', 'out', 'errors', 'items/s', 'latency', 'p50', 'p99')]
+  for stage in stats:
+    row = stage.ToDict()
+    lines.append(
+        '{:<12} {:>9} {:>9} {:>7} {:>10.2f} {:>8.2f}s {:>8.2f}s {:>8.2f}s'
+        .format(row['stage'], row['items_in'], row['items_out'],
+                row['errors'], row['items_per_sec'], row['mean_latency_secs'],
+                row['p50_latency_secs'], row['p99_latency_secs']))
+  return '\n'.join(lines)
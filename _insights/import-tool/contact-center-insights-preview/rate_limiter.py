@@ -0,0 +1,426 @@
+# Lint as: python3
+"""Client-side rate limiting for calls to Google Cloud APIs.
+
+The import tool used to sleep a fixed amount of time after every request to
+stay below quota. A token bucket instead lets any number of workers share a
+single requests-per-second budget and keeps it full without exceeding it.
+
+Quotas are not always known up front, and are shared with other clients of the
+project. An `AdaptiveRateLimiter` adjusts its rate to the responses of the
+service: it grows additively while calls succeed and is cut by 30% when the
+service throttles, and it stops sending for as long as `Retry-After` asks.
+A `RetryPolicy` retries the throttled and transient failures of single calls
+with capped, jittered exponential backoff, so that they are not dropped.
+"""
+
+import argparse
+import asyncio
+import email.utils
+import random
+import threading
+import time
+
+# HTTP statuses of failures that may succeed when retried.
+RETRYABLE_STATUSES = frozenset([408, 429, 500, 502, 503, 504])
+# HTTP statuses with which services signal that the client is too fast.
+THROTTLED_STATUSES = frozenset([429, 503])
+
+_UNITS = {
+    's': 1.0,
+    'sec': 1.0,
+    'second': 1.0,
+    'm': 60.0,
+    'min': 60.0,
+    'minute': 60.0,
+}
+
+
+def ParseRate(value):
+  """Parses a rate such as `10`, `10/s` or `600/m` into requests per second.
+
+  A rate of zero means that requests are not rate limited.
+
+  Args:
+    value: The rate string. A bare number is interpreted as per second.
+
+  Returns:
+    The rate in requests per second.
+
+  Raises:
+    argparse.ArgumentTypeError: If the rate cannot be parsed.
+  """
+  amount, _, unit = str(value).strip().partition('/')
+  unit = unit.strip().lower() or 's'
+  try:
+    amount = float(amount)
+  except ValueError:
+    raise argparse.ArgumentTypeError(
+        'Invalid rate `{}`: expected a number of requests, e.g. `10/s`.'
+        .format(value))
+  if unit not in _UNITS:
+    raise argparse.ArgumentTypeError(
+        'Invalid rate `{}`: unit must be one of `s` or `m`.'.format(value))
+  if amount < 0:
+    raise argparse.ArgumentTypeError(
+        'Invalid rate `{}`: must not be negative.'.format(value))
+  return amount / _UNITS[unit]
+
+
+class TokenBucket(object):
+  """A thread-safe token bucket.
+
+  Tokens are added continuously at `rate` per second, up to `burst` tokens.
+  Every request takes one token and blocks until one is available, so the
+  long-run request rate never exceeds `rate` regardless of the number of
+  threads sharing the bucket.
+  """
+
+  def __init__(self, rate, burst=None, clock=time.monotonic, sleep=time.sleep):
+    """Initializes the bucket.
+
+    Args:
+      rate: Tokens added per second. Zero or None disables rate limiting.
+      burst: The maximum number of tokens that can accumulate. Defaults to one
+        second worth of tokens, and is always at least one.
+      clock: A monotonic clock returning seconds.
+      sleep: A function that sleeps for the given number of seconds.
+    """
+    self._rate = float(rate or 0)
+    self._burst = max(1.0, float(burst if burst else self._rate))
+    self._tokens = self._burst
+    self._clock = clock
+    self._sleep = sleep
+    self._last = clock()
+    self._lock = threading.Lock()
+
+  @property
+  def rate(self):
+    return self._rate
+
+  def _Refill(self, now):
+    self._tokens = min(self._burst,
+                       self._tokens + (now - self._last) * self._rate)
+    self._last = now
+
+  def TryAcquire(self, tokens=1):
+    """Takes tokens without blocking.
+
+    Args:
+      tokens: The number of tokens to take.
+
+    Returns:
+      Zero if the tokens were taken, otherwise the number of seconds until
+      enough tokens will be available.
+    """
+    if self._rate <= 0:
+      return 0
+    with self._lock:
+      self._Refill(self._clock())
+      if self._tokens >= tokens:
+        self._tokens -= tokens
+        return 0
+      return (tokens - self._tokens) / self._rate
+
+  def Acquire(self, tokens=1):
+    """Takes tokens, blocking until they are available.
+
+    Args:
+      tokens: The number of tokens to take.
+    """
+    while True:
+      wait = self.TryAcquire(tokens)
+      if not wait:
+        return
+      self._sleep(wait)
+
+  async def AcquireAsync(self, tokens=1):
+    """Takes tokens, yielding to the event loop until they are available.
+
+    Args:
+      tokens: The number of tokens to take.
+    """
+    while True:
+      wait = self.TryAcquire(tokens)
+      if not wait:
+        return
+      await asyncio.sleep(wait)
+
+
+def GetStatus(error):
+  """Returns the HTTP status of an API error, or None.
+
+  Args:
+    error: A `google.api_core.exceptions.GoogleAPICallError`, whose `code` is
+      the HTTP status also for gRPC calls, or a `requests` exception.
+  """
+  code = getattr(error, 'code', None)
+  if isinstance(code, int):
+    return code
+  status = getattr(getattr(error, 'response', None), 'status_code', None)
+  return status if isinstance(status, int) else None
+
+
+def GetRetryAfter(error, now=None):
+  """Returns the delay an error's `Retry-After` header asks for, or None.
+
+  Args:
+    error: An exception with the HTTP `response`, if any.
+    now: The current time in seconds since the epoch, for HTTP dates.
+
+  Returns:
+    The delay in seconds.
+  """
+  headers = getattr(getattr(error, 'response', None), 'headers', None)
+  value = headers.get('Retry-After') if headers else None
+  if not value:
+    return None
+  try:
+    return max(0.0, float(value))
+  except ValueError:
+    pass
+  try:
+    date = email.utils.parsedate_to_datetime(value)
+  except (TypeError, ValueError):
+    return None
+  return max(0.0, date.timestamp() - (time.time() if now is None else now))
+
+
+class AdaptiveRateLimiter(TokenBucket):
+  """A token bucket whose rate follows the throttling of the service.
+
+  The rate grows additively, by about `additive_increase` requests per second
+  every second, while calls succeed and callers wait for tokens, up to the
+  initial rate, and is multiplied
+  by `decrease_factor` when the service throttles. Above the rate at which it
+  last throttled, the rate grows ten times slower. Throttled responses within
+  a second of a cut are from requests sent at the old rate, so they cut the
+  rate only once. A `Retry-After` pauses all callers.
+
+  Without an initial rate, requests are not limited until the first throttled
+  response, which starts limiting at a fraction of the observed request rate.
+  """
+
+  _DECREASE_INTERVAL_SECS = 1.0
+
+  def __init__(self, rate, min_rate=0.05, additive_increase=None,
+               decrease_factor=0.7, clock=time.monotonic, sleep=time.sleep):
+    """Initializes the limiter.
+
+    Args:
+      rate: The initial and maximum requests per second. Zero or None for no
+        limit until the service throttles.
+      min_rate: The rate is never cut below this many requests per second.
+      additive_increase: How many requests per second the rate grows by every
+        second of successful calls. Defaults to 10% of `rate`, or without a
+        rate, of the rate when the service first throttled.
+      decrease_factor: The rate is multiplied by this when throttled.
+      clock: A monotonic clock returning seconds.
+      sleep: A function that sleeps for the given number of seconds.
+    """
+    super(AdaptiveRateLimiter, self).__init__(rate, clock=clock, sleep=sleep)
+    self._max_rate = self._rate
+    self._min_rate = min(min_rate, self._max_rate or min_rate)
+    self._additive_increase = additive_increase or self._max_rate * 0.1
+    self._decrease_factor = decrease_factor
+    self._paused_until = 0.0
+    self._last_decrease = None
+    self._throttled_rate = None
+    # Counts requests per second while the rate is not limited.
+    self._window_start = self._last
+    self._window_requests = 0
+    self._observed_rate = 0.0
+    self.throttled = 0
+    self.min_rate_seen = self._rate
+
+  @property
+  def max_rate(self):
+    return self._max_rate
+
+  def TryAcquire(self, tokens=1):
+    with self._lock:
+      now = self._clock()
+      if now < self._paused_until:
+        return self._paused_until - now
+      if self._rate <= 0:
+        if now - self._window_start >= 1.0:
+          self._observed_rate = self._window_requests / (
+              now - self._window_start)
+          self._window_start = now
+          self._window_requests = 0
+        self._window_requests += tokens
+        return 0
+      self._Refill(now)
+      if self._tokens >= tokens:
+        self._tokens -= tokens
+        return 0
+      return (tokens - self._tokens) / self._rate
+
+  def _SetRate(self, rate, now):
+    """Changes the rate. Holds the lock."""
+    self._Refill(now)
+    self._rate = rate
+    self._burst = max(1.0, rate)
+    self._tokens = min(self._tokens, self._burst)
+    self.min_rate_seen = min(self.min_rate_seen or rate, rate)
+
+  def OnSuccess(self):
+    """Reports a successful call, which grows the rate."""
+    with self._lock:
+      if self._rate <= 0 or self._rate == self._max_rate:
+        return
+      now = self._clock()
+      self._Refill(now)
+      if self._tokens >= 1:
+        # Callers are not waiting for the limiter, so a higher rate would not
+        # be tested by the service.
+        return
+      # Growing by this much per call grows the rate by `additive_increase`
+      # per second at the current rate.
+      increase = self._additive_increase / self._rate
+      if self._throttled_rate and self._rate >= self._throttled_rate:
+        increase /= 10
+      rate = self._rate + increase
+      if self._max_rate:
+        rate = min(rate, self._max_rate)
+      self._SetRate(rate, now)
+
+  def OnError(self, error):
+    """Reports a failed call, which cuts the rate if the service throttled.
+
+    Args:
+      error: The exception of the call.
+
+    Returns:
+      Whether the service throttled the call.
+    """
+    if GetStatus(error) not in THROTTLED_STATUSES:
+      return False
+    retry_after = GetRetryAfter(error)
+    with self._lock:
+      now = self._clock()
+      self.throttled += 1
+      if retry_after:
+        self._paused_until = max(self._paused_until, now + retry_after)
+        self._tokens = 0.0
+      if (self._last_decrease is not None and
+          now - self._last_decrease < self._DECREASE_INTERVAL_SECS):
+        return True
+      self._last_decrease = now
+      if self._rate > 0:
+        self._throttled_rate = self._rate
+        rate = self._rate * self._decrease_factor
+      else:
+        current = self._window_requests / max(1e-3, now - self._window_start)
+        observed = max(self._observed_rate, current, self._min_rate)
+        self._throttled_rate = observed
+        rate = observed * self._decrease_factor
+        self._additive_increase = self._additive_increase or observed * 0.1
+        self._tokens = 0.0
+        self._last = now
+      self._SetRate(max(self._min_rate, rate), now)
+    return True
+
+
+class RetryPolicy(object):
+  """Retries failed calls with capped, jittered exponential backoff.
+
+  Calls are retried when the service returned one of the
+  `retryable_statuses`, or raised one of the `retryable_errors`, such as
+  connection errors. A `Retry-After` delay is waited for at least.
+  """
+
+  def __init__(self, max_attempts=5, initial_secs=1.0, max_secs=60.0,
+               retryable_errors=(), retryable_statuses=RETRYABLE_STATUSES):
+    """Initializes the policy.
+
+    Args:
+      max_attempts: The number of calls made before giving up, including the
+        first.
+      initial_secs: The delay before the first retry, before jitter.
+      max_secs: The cap on the delay between retries.
+      retryable_errors: Exception types that are retried whatever their
+        status.
+      retryable_statuses: The HTTP statuses that are retried. Calls that are
+        not idempotent should only retry statuses with which the service
+        rejects a request without processing it, such as 429.
+    """
+    self.max_attempts = max_attempts
+    self.initial_secs = initial_secs
+    self.max_secs = max_secs
+    self.retryable_errors = tuple(retryable_errors)
+    self.retryable_statuses = frozenset(retryable_statuses)
+
+  def IsRetryable(self, error):
+    return (GetStatus(error) in self.retryable_statuses or
+            isinstance(error, self.retryable_errors))
+
+  def GetDelay(self, attempt, error=None):
+    """Returns the delay before retrying a call that failed `attempt` times."""
+    delay = self.initial_secs * 2**min(attempt - 1, 32)
+    delay = min(self.max_secs, delay * random.uniform(0.5, 1.5))
+    return max(delay, GetRetryAfter(error) or 0.0)
+
+  def _OnError(self, error, attempt, limiter, on_retry):
+    """Reports an error, and returns the delay before retrying, or raises."""
+    if isinstance(limiter, AdaptiveRateLimiter):
+      limiter.OnError(error)
+    if attempt >= self.max_attempts or not self.IsRetryable(error):
+      raise error
+    delay = self.GetDelay(attempt, error)
+    if on_retry:
+      on_retry(error, attempt, delay)
+    return delay
+
+  def Call(self, fn, limiter=None, on_retry=None):
+    """Calls a function until it succeeds, blocking between attempts.
+
+    Args:
+      fn: The function to call, without arguments.
+      limiter: The `TokenBucket` or `AdaptiveRateLimiter` to acquire a token
+        from before every attempt, and to report the outcomes to, if any.
+      on_retry: Called with (error, attempt, delay) before every retry.
+
+    Returns:
+      The result of `fn`.
+
+    Raises:
+      Exception: The error of the last attempt, if no attempt succeeded.
+    """
+    attempt = 0
+    while True:
+      attempt += 1
+      if limiter:
+        limiter.Acquire()
+      try:
+        result = fn()
+      except Exception as e:  # pylint: disable=broad-except
+        time.sleep(self._OnError(e, attempt, limiter, on_retry))
+        continue
+      if isinstance(limiter, AdaptiveRateLimiter):
+        limiter.OnSuccess()
+      return result
+
+  async def CallAsync(self, fn, limiter=None, on_retry=None):
+    """Like `Call`, but yields to the event loop while waiting.
+
+    Args:
+      fn: A function without arguments that returns an awaitable.
+      limiter: As in `Call`.
+      on_retry: As in `Call`.
+
+    Returns:
+      The result of the awaitable.
+    """
+    attempt = 0
+    while True:
+      attempt += 1
+      if limiter:
+        await limiter.AcquireAsync()
+      try:
+        result = await fn()
+      except Exception as e:  # pylint: disable=broad-except
+        await asyncio.sleep(self._OnError(e, attempt, limiter, on_retry))
+        continue
+      if isinstance(limiter, AdaptiveRateLimiter):
+        limiter.OnSuccess()
+      return result
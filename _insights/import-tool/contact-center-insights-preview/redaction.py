@@ -0,0 +1,257 @@
+# Lint as: python3
+"""Redacts the text of transcripts with DLP, many utterances per request.
+
+Redaction used to send the text dump of a whole Speech-to-text response to DLP,
+one request per conversation, including word time offsets and confidences that
+made payloads several times larger than the spoken text. Only the transcript
+strings are sent now, as rows of DLP table items that stay under the request
+size limits. Utterances of concurrent callers share requests.
+
+Masking keeps the length of the text, so redacted transcripts are mapped back
+onto the original results and words, and time offsets are unchanged.
+"""
+
+import collections
+import threading
+import time
+
+import metrics
+
+# DLP limits content requests to 0.5 MB and tables to 50,000 values. Stay
+# well below both.
+DEFAULT_MAX_REQUEST_BYTES = 400 * 1024
+DEFAULT_MAX_ROWS = 10000
+# Approximate encoding overhead of every table row.
+_ROW_OVERHEAD_BYTES = 16
+
+_HEADER = 'utterance'
+
+
+def GetTranscripts(transcript_response):
+  """Returns the transcript of every alternative of every result, in order."""
+  return [
+      alternative.transcript
+      for result in transcript_response.results
+      for alternative in result.alternatives
+  ]
+
+
+def ApplyRedactions(transcript_response, redacted_transcripts,
+                    masking_character='*'):
+  """Replaces the transcripts of a response with their redacted text.
+
+  The words of every alternative are masked where its transcript was, so that
+  their time offsets still apply. The response is changed in place, since
+  copying a long transcript costs more than redacting it.
+
+  Args:
+    transcript_response: The response from transcription.
+    redacted_transcripts: The redacted text of every transcript, in the order
+      of `GetTranscripts`.
+    masking_character: The character that DLP masks text with.
+
+  Returns:
+    The redacted response.
+  """
+  redacted_transcripts = iter(redacted_transcripts)
+  for result in transcript_response.results:
+    for alternative in result.alternatives:
+      redacted = next(redacted_transcripts)
+      if redacted != alternative.transcript:
+        _MaskWords(alternative, redacted, masking_character)
+        alternative.transcript = redacted
+  return transcript_response
+
+
+def _MaskWords(alternative, redacted, masking_character):
+  """Masks the words of an alternative like its redacted transcript."""
+  original = alternative.transcript
+  # Masking keeps the length unless DLP is configured otherwise.
+  same_length = len(redacted) == len(original)
+  redacted_tokens = None
+  position = 0
+  for word in alternative.words:
+    start = original.find(word.word, position) if same_length else -1
+    if start >= 0:
+      end = start + len(word.word)
+      word.word = redacted[start:end]
+      position = end
+      continue
+    # The word could not be located, so mask it unless it is in the redacted
+    # transcript as is.
+    if redacted_tokens is None:
+      redacted_tokens = set(redacted.split())
+    if word.word not in redacted_tokens:
+      word.word = masking_character * len(word.word)
+
+
+class _Job(object):
+  """The texts of one caller, and their redacted versions."""
+
+  def __init__(self, num_texts):
+    self.results = [None] * num_texts
+    self.remaining = num_texts
+    self.error = None
+
+
+# One text waiting to be sent, with its index in the job.
+_Entry = collections.namedtuple('_Entry',
+                                ['job', 'index', 'text', 'size', 'time'])
+
+
+class Redactor(object):
+  """Redacts texts with DLP table requests shared by concurrent callers.
+
+  Callers block in `RedactTexts`. While a request is not full, texts wait up
+  to `max_wait_secs` for texts of other callers; then one of the waiting
+  callers sends the request on behalf of all of them.
+  """
+
+  def __init__(self, get_dlp_client, project_id, inspect_config,
+               deidentify_config, max_request_bytes=DEFAULT_MAX_REQUEST_BYTES,
+               max_rows=DEFAULT_MAX_ROWS, max_wait_secs=0.05, registry=None,
+               limiter=None):
+    """Initializes the redactor.
+
+    Args:
+      get_dlp_client: Returns the `DlpServiceClient` to use.
+      project_id: The project ID (not number) to use for redaction.
+      inspect_config: The DLP inspect config.
+      deidentify_config: The DLP deidentify config.
+      max_request_bytes: The maximum size of the texts in one request.
+      max_rows: The maximum number of texts in one request.
+      max_wait_secs: How long texts wait for more texts to share a request.
+      registry: The `metrics.Registry` to record DLP requests in.
+      limiter: The `rate_limiter.AdaptiveRateLimiter` of DLP requests, if any.
+        Every request takes a token and reports whether DLP throttled it.
+    """
+    self._get_dlp_client = get_dlp_client
+    self._project_id = project_id
+    self._inspect_config = inspect_config
+    self._deidentify_config = deidentify_config
+    self._max_request_bytes = max_request_bytes
+    self._max_rows = max_rows
+    self._max_wait_secs = max_wait_secs
+    self._registry = registry or metrics.Registry()
+    self._limiter = limiter
+    self._condition = threading.Condition()
+    self._pending = collections.deque()
+    self._pending_bytes = 0
+    self.requests = 0
+    self.bytes_sent = 0
+
+  def RedactTexts(self, texts):
+    """Redacts texts.
+
+    Args:
+      texts: The texts to redact.
+
+    Returns:
+      The redacted texts, in order.
+
+    Raises:
+      google.api_core.exceptions.GoogleAPICallError: If a DLP request for any
+        of the texts failed.
+    """
+    job = _Job(len(texts))
+    now = time.time()
+    with self._condition:
+      for i, text in enumerate(texts):
+        if not text:
+          job.results[i] = text
+          job.remaining -= 1
+          continue
+        size = len(text.encode('utf-8')) + _ROW_OVERHEAD_BYTES
+        self._pending.append(_Entry(job, i, text, size, now))
+        self._pending_bytes += size
+      self._condition.notify_all()
+
+    while True:
+      with self._condition:
+        while job.remaining and not self._IsBatchReady():
+          if self._pending:
+            self._condition.wait(
+                max(0, self._pending[0].time + self._max_wait_secs -
+                    time.time()))
+          else:
+            # The remaining texts are being sent by other callers.
+            self._condition.wait()
+        if not job.remaining:
+          break
+        batch = self._TakeBatch()
+      self._Send(batch)
+
+    if job.error:
+      raise job.error
+    return job.results
+
+  def _IsBatchReady(self):
+    if not self._pending:
+      return False
+    return (self._pending_bytes >= self._max_request_bytes or
+            len(self._pending) >= self._max_rows or
+            time.time() >= self._pending[0].time + self._max_wait_secs)
+
+  def _TakeBatch(self):
+    """Takes the oldest texts that fit in one request. Holds the lock."""
+    batch = []
+    batch_bytes = 0
+    while self._pending and len(batch) < self._max_rows:
+      entry = self._pending[0]
+      if batch and batch_bytes + entry.size > self._max_request_bytes:
+        break
+      self._pending.popleft()
+      self._pending_bytes -= entry.size
+      batch_bytes += entry.size
+      batch.append(entry)
+    return batch
+
+  def _Send(self, batch):
+    """Redacts a batch of texts in one request, and completes their jobs."""
+    batch_bytes = sum(entry.size for entry in batch)
+    error = None
+    if self._limiter:
+      self._limiter.Acquire()
+    try:
+      with self._registry.Call('dlp', 'deidentify_content') as call:
+        redacted = self._Deidentify([entry.text for entry in batch])
+        # Masking keeps the length of the texts.
+        call.AddBytes(batch_bytes, batch_bytes)
+    except Exception as e:  # pylint: disable=broad-except
+      error = e
+    if self._limiter and error:
+      self._limiter.OnError(error)
+    elif self._limiter:
+      self._limiter.OnSuccess()
+    with self._condition:
+      self.requests += 1
+      self.bytes_sent += batch_bytes
+      for i, entry in enumerate(batch):
+        if error:
+          entry.job.error = error
+        else:
+          entry.job.results[entry.index] = redacted[i]
+        entry.job.remaining -= 1
+      self._condition.notify_all()
+
+  def _Deidentify(self, texts):
+    dlp = self._get_dlp_client()
+    item = {
+        'table': {
+            'headers': [{
+                'name': _HEADER
+            }],
+            'rows': [{
+                'values': [{
+                    'string_value': text
+                }]
+            } for text in texts]
+        }
+    }
+    response = dlp.deidentify_content(
+        dlp.project_path(self._project_id),
+        inspect_config=self._inspect_config,
+        deidentify_config=self._deidentify_config,
+        item=item,
+    )
+    return [row.values[0].string_value for row in response.item.table.rows]
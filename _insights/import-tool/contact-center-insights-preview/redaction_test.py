@@ -0,0 +1,100 @@
+# Lint as: python3
+"""Tests for redaction.py against the fake DLP of fake_services.py.
+
+Run with `python3 -m pytest redaction_test.py`.
+"""
+
+import concurrent.futures
+import sys
+
+import google.api_core.exceptions
+from google.cloud import speech_v1p1beta1
+import pytest
+
+import fake_services
+import redaction
+
+
+def _Response(*transcripts):
+  """Returns a response with a result per transcript, with a word per token."""
+  response = speech_v1p1beta1.types.LongRunningRecognizeResponse()
+  offset_nanos = 0
+  for transcript in transcripts:
+    alternative = response.results.add().alternatives.add()
+    alternative.transcript = transcript
+    for token in transcript.split():
+      word = alternative.words.add()
+      word.word = token
+      word.start_time.FromNanoseconds(offset_nanos)
+      offset_nanos += 300000000
+      word.end_time.FromNanoseconds(offset_nanos)
+  return response
+
+
+def _Words(response):
+  return [[word.word for word in result.alternatives[0].words]
+          for result in response.results]
+
+
+def _Redactor(dlp, **kwargs):
+  return redaction.Redactor(lambda: dlp, 'test-project', {}, {},
+                            max_wait_secs=0.01, **kwargs)
+
+
+def testApplyRedactionsMasksEveryWordOfAToken():
+  # The phone number is one PII token, spoken as three words.
+  response = _Response('call me at 555 867 5309 please', 'thanks')
+  offsets = [[word.start_time.ToNanoseconds()
+              for word in result.alternatives[0].words]
+             for result in response.results]
+  redacted = redaction.ApplyRedactions(
+      response, ['call me at ************ please', 'thanks'])
+  assert _Words(redacted) == [
+      ['call', 'me', 'at', '***', '***', '****', 'please'], ['thanks']]
+  assert redaction.GetTranscripts(redacted) == [
+      'call me at ************ please', 'thanks']
+  assert [[word.start_time.ToNanoseconds()
+           for word in result.alternatives[0].words]
+          for result in redacted.results] == offsets
+
+
+def testApplyRedactionsMasksTheRightOccurrenceOfAWord():
+  response = _Response('room 12 not 12')
+  redacted = redaction.ApplyRedactions(response, ['room 12 not **'])
+  assert _Words(redacted) == [['room', '12', 'not', '**']]
+
+
+def testApplyRedactionsMasksWordsMissingFromReplacedText():
+  # DLP replaced the token with its info type, so the lengths differ.
+  response = _Response('mail jane.doe@example.com now')
+  redacted = redaction.ApplyRedactions(response,
+                                       ['mail [EMAIL_ADDRESS] now'])
+  assert _Words(redacted) == [['mail', '*' * 20, 'now']]
+  assert redaction.GetTranscripts(redacted) == ['mail [EMAIL_ADDRESS] now']
+
+
+def testRedactorMapsSharedRequestsBackToTheirCallers():
+  dlp = fake_services.FakeDlpClient()
+  # Small requests, so that the texts of callers are split and shared.
+  redactor = _Redactor(dlp, max_request_bytes=200)
+  texts = [['caller {} line {} at 555 867 {:04d}'.format(caller, line, caller)
+            for line in range(10)] + ['']
+           for caller in range(8)]
+  with concurrent.futures.ThreadPoolExecutor(8) as pool:
+    results = list(pool.map(redactor.RedactTexts, texts))
+  assert results == [
+      ['caller {} line {} at ************'.format(caller, line)
+       for line in range(10)] + ['']
+      for caller in range(8)
+  ]
+  assert 1 < redactor.requests < 80
+
+
+def testRedactorRaisesTheErrorOfARequest():
+  dlp = fake_services.FakeDlpClient(error_rate=1.0)
+  with pytest.raises(google.api_core.exceptions.ServiceUnavailable):
+    _Redactor(dlp).RedactTexts(['555 867 5309'])
+
+
+if __name__ == '__main__':
+  sys.exit(pytest.main([__file__]))
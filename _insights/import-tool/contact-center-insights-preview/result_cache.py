@@ -0,0 +1,219 @@
+# Lint as: python3
+"""A content-addressed cache of transcription and redaction results.
+
+Importing the same audio again, e.g. into another project or with another
+agent ID, used to call Speech-to-text and DLP again for identical output.
+Results are instead cached under a key made of the hash of the input content
+and the config of the call, so a hit skips the remote call entirely.
+
+Backends are tried in order: typically a size-bounded local disk cache with
+LRU eviction, then an optional GCS prefix that can be shared between machines.
+"""
+
+import collections
+import hashlib
+import json
+import os
+import tempfile
+import threading
+
+import google.api_core.exceptions
+
+
+def MakeKey(namespace, content_hash, config):
+  """Returns the cache key for a result.
+
+  Args:
+    namespace: The kind of result, e.g. `speech` or `dlp`.
+    content_hash: A hash of the input content, such as the md5 or crc32c of a
+      GCS object.
+    config: A JSON serializable config of the call that produced the result.
+
+  Returns:
+    The key, as a hex string.
+  """
+  data = json.dumps([namespace, content_hash, config], sort_keys=True)
+  return hashlib.sha256(data.encode('utf-8')).hexdigest()
+
+
+class DiskCache(object):
+  """Caches values in files in a local directory, up to a total size.
+
+  The least recently used values are evicted first. File modification times
+  record use, so the order survives restarts.
+  """
+
+  def __init__(self, directory, max_bytes):
+    """Opens the cache, creating the directory if needed.
+
+    Args:
+      directory: The directory that holds the values.
+      max_bytes: The maximum total size of the values.
+    """
+    self._directory = directory
+    self._max_bytes = max_bytes
+    self._lock = threading.Lock()
+    # Maps keys to value sizes, least recently used first.
+    self._index = collections.OrderedDict()
+    self._total_bytes = 0
+    os.makedirs(directory, exist_ok=True)
+    entries = []
+    for shard in os.scandir(directory):
+      if not shard.is_dir():
+        continue
+      for entry in os.scandir(shard.path):
+        if entry.is_file() and not entry.name.startswith('.'):
+          stat = entry.stat()
+          entries.append((stat.st_mtime, entry.name, stat.st_size))
+    for unused_mtime, key, size in sorted(entries):
+      self._index[key] = size
+      self._total_bytes += size
+    with self._lock:
+      self._Evict()
+
+  def _GetPath(self, key):
+    return os.path.join(self._directory, key[:2], key)
+
+  def Get(self, key):
+    """Returns the value for a key, or None if it is not cached."""
+    with self._lock:
+      if key not in self._index:
+        return None
+      self._index.move_to_end(key)
+    path = self._GetPath(key)
+    try:
+      with open(path, 'rb') as f:
+        value = f.read()
+      os.utime(path)
+    except FileNotFoundError:
+      with self._lock:
+        self._total_bytes -= self._index.pop(key, 0)
+      return None
+    return value
+
+  def Put(self, key, value):
+    """Caches a value, evicting the least recently used values if needed."""
+    if len(value) > self._max_bytes:
+      return
+    path = self._GetPath(key)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # Written to a temporary file first, so readers never see partial values.
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.')
+    with os.fdopen(fd, 'wb') as f:
+      f.write(value)
+    os.replace(tmp_path, path)
+    with self._lock:
+      self._total_bytes += len(value) - self._index.pop(key, 0)
+      self._index[key] = len(value)
+      self._Evict()
+
+  def _Evict(self):
+    while self._total_bytes > self._max_bytes and self._index:
+      key, size = self._index.popitem(last=False)
+      self._total_bytes -= size
+      try:
+        os.remove(self._GetPath(key))
+      except FileNotFoundError:
+        pass
+
+
+class GcsCache(object):
+  """Caches values as objects under a GCS prefix."""
+
+  def __init__(self, get_storage_client, uri):
+    """Initializes the cache.
+
+    Args:
+      get_storage_client: Returns the `google.cloud.storage.Client` to use in
+        the calling thread.
+      uri: The prefix of the cached objects, e.g. `gs://bucket/cache/`.
+    """
+    if not uri.startswith('gs://'):
+      raise ValueError('Invalid GCS cache uri `{}`: must start with `gs://`.'
+                       .format(uri))
+    bucket, _, prefix = uri[len('gs://'):].partition('/')
+    if prefix and not prefix.endswith('/'):
+      prefix += '/'
+    self._get_storage_client = get_storage_client
+    self._bucket = bucket
+    self._prefix = prefix
+
+  def _GetBlob(self, key):
+    return self._get_storage_client().bucket(self._bucket).blob(self._prefix +
+                                                               key)
+
+  def Get(self, key):
+    """Returns the value for a key, or None if it is not cached."""
+    try:
+      return self._GetBlob(key).download_as_string()
+    except google.api_core.exceptions.NotFound:
+      return None
+
+  def Put(self, key, value):
+    """Caches a value."""
+    self._GetBlob(key).upload_from_string(
+        value, content_type='application/octet-stream')
+
+
+class ResultCache(object):
+  """Looks values up in a list of backends, and counts hits per namespace.
+
+  A value found in a later backend is also stored in the earlier ones. Errors
+  of a backend are printed and treated as misses, so that a broken cache never
+  fails an import.
+  """
+
+  def __init__(self, backends):
+    self._backends = backends
+    self._lock = threading.Lock()
+    # Maps namespaces to [hits, misses].
+    self._counts = collections.defaultdict(lambda: [0, 0])
+
+  def Get(self, namespace, key):
+    """Returns the cached value for a key, or None on a miss."""
+    for i, backend in enumerate(self._backends):
+      try:
+        value = backend.Get(key)
+      except (OSError, google.api_core.exceptions.GoogleAPIError) as e:
+        print('Error `{}`: failed to read `{}` from the cache.'.format(e, key))
+        continue
+      if value is not None:
+        for earlier_backend in self._backends[:i]:
+          self._PutIn(earlier_backend, key, value)
+        self._Count(namespace, 0)
+        return value
+    self._Count(namespace, 1)
+    return None
+
+  def Put(self, namespace, key, value):
+    """Caches a value in every backend."""
+    del namespace  # Unused. Namespaces are part of the keys.
+    for backend in self._backends:
+      self._PutIn(backend, key, value)
+
+  def _PutIn(self, backend, key, value):
+    try:
+      backend.Put(key, value)
+    except (OSError, google.api_core.exceptions.GoogleAPIError) as e:
+      print('Error `{}`: failed to write `{}` to the cache.'.format(e, key))
+
+  def _Count(self, namespace, index):
+    with self._lock:
+      self._counts[namespace][index] += 1
+
+  def GetStats(self):
+    """Returns a dict of namespaces to (hits, misses)."""
+    with self._lock:
+      return {
+          namespace: tuple(counts)
+          for namespace, counts in self._counts.items()
+      }
+
+  def FormatStats(self):
+    """Returns the hit rate of every namespace, one per line."""
+    lines = []
+    for namespace, (hits, misses) in sorted(self.GetStats().items()):
+      lines.append('Cache `{}`: `{}` hits, `{}` misses ({:.1f}% hit rate).'
+                   .format(namespace, hits, misses,
+                           100.0 * hits / ((hits + misses) or 1)))
+    return '\n'.join(lines)
@@ -0,0 +1,258 @@
+# Lint as: python3
+"""Splits the source files of an import between processes or machines.
+
+Every copy of the import tool used to import the whole source, so running
+several copies on one bucket doubled the cost and created duplicate
+conversations. With `--num_shards` and `--shard_index`, every copy still lists
+the whole source, but only imports the files whose names hash to its shard.
+The hash is stable across processes, machines and Python versions, so the
+shards are disjoint and together cover the source.
+
+Every shard writes its own checkpoint and results file. `MergeResults`
+combines the results files, and `python3 sharding.py merge` does the same from
+the command line.
+"""
+
+import argparse
+import collections
+import hashlib
+import json
+import os
+import subprocess
+import sys
+import threading
+
+
+def GetShard(name, num_shards):
+  """Returns the shard of a source file.
+
+  Args:
+    name: The name or uri of the file.
+    num_shards: The number of shards.
+
+  Returns:
+    The shard index, in [0, num_shards).
+  """
+  digest = hashlib.md5(name.encode('utf-8')).digest()
+  return int.from_bytes(digest[:8], 'big') % num_shards
+
+
+def FilterShard(items, num_shards, shard_index, key=str):
+  """Yields the items that belong to a shard.
+
+  Args:
+    items: The items, e.g. source uris. Consumed lazily.
+    num_shards: The number of shards. 1 yields every item.
+    shard_index: The shard to yield the items of.
+    key: Returns the name to hash for an item.
+  """
+  if num_shards <= 1:
+    yield from items
+    return
+  for item in items:
+    if GetShard(key(item), num_shards) == shard_index:
+      yield item
+
+
+def GetShardPath(path, shard_index, num_shards):
+  """Returns the path of a shard's own copy of a file.
+
+  Args:
+    path: The path for all shards, e.g. `import_results.json`.
+    shard_index: The shard.
+    num_shards: The number of shards.
+
+  Returns:
+    The path with the shard inserted before the extension, e.g.
+    `import_results-00001-of-00004.json`.
+  """
+  root, extension = os.path.splitext(path)
+  return '{}-{:05d}-of-{:05d}{}'.format(root, shard_index, num_shards,
+                                        extension)
+
+
+def WriteResults(path, shard_index, num_shards, conversation_names,
+                 analysis_results, metrics_summary=None):
+  """Writes the results of one shard as JSON.
+
+  Args:
+    path: The file to write.
+    shard_index: The shard.
+    num_shards: The number of shards.
+    conversation_names: The names of the created conversations.
+    analysis_results: The analysis results, as namedtuples.
+    metrics_summary: The `metrics.Registry.Summary` of the shard, if any.
+  """
+  results = {
+      'shard_index': shard_index,
+      'num_shards': num_shards,
+      'conversation_names': list(conversation_names),
+      'analysis_results': [result._asdict() for result in analysis_results],
+      'metrics': metrics_summary,
+  }
+  temp_path = '{}.tmp'.format(path)
+  with open(temp_path, 'w') as f:
+    json.dump(results, f)
+  os.replace(temp_path, path)
+
+
+# Per-method metrics that add up across shards.
+_SUMMED_METRICS = ('calls', 'errors', 'retries', 'bytes_sent',
+                   'bytes_received')
+
+
+def MergeResults(paths):
+  """Combines the results files of the shards of an import.
+
+  Args:
+    paths: The results files, one per shard.
+
+  Returns:
+    The merged results, as a dict like a single results file, with the
+    analysis states counted and the shards that are missing listed. Metrics
+    are summed, except for `max_secs`, which is the maximum over the shards.
+
+  Raises:
+    ValueError: If the files are from imports with different numbers of
+      shards, or two files are from the same shard.
+  """
+  merged = {
+      'conversation_names': [],
+      'analysis_results': [],
+      'analysis_states': {},
+      'shards': [],
+      'missing_shards': [],
+      'metrics': {'calls': []},
+  }
+  num_shards = None
+  calls = collections.OrderedDict()
+  for path in paths:
+    with open(path) as f:
+      results = json.load(f)
+    if num_shards is None:
+      num_shards = results['num_shards']
+    elif results['num_shards'] != num_shards:
+      raise ValueError('`{}` is from an import with {} shards, not {}.'.format(
+          path, results['num_shards'], num_shards))
+    if results['shard_index'] in merged['shards']:
+      raise ValueError('`{}` is the second results file of shard {}.'.format(
+          path, results['shard_index']))
+    merged['shards'].append(results['shard_index'])
+    merged['conversation_names'] += results['conversation_names']
+    merged['analysis_results'] += results['analysis_results']
+    for result in results['analysis_results']:
+      state = result['state']
+      merged['analysis_states'][state] = (
+          merged['analysis_states'].get(state, 0) + 1)
+    for row in (results.get('metrics') or {}).get('calls', []):
+      key = (row['service'], row['method'])
+      total = calls.setdefault(key, {
+          'service': row['service'],
+          'method': row['method'],
+          'max_secs': 0.0
+      })
+      for field in _SUMMED_METRICS:
+        total[field] = total.get(field, 0) + row[field]
+      total['max_secs'] = max(total['max_secs'], row['max_secs'])
+  merged['num_shards'] = num_shards
+  merged['shards'].sort()
+  merged['missing_shards'] = sorted(
+      set(range(num_shards or 0)) - set(merged['shards']))
+  merged['metrics']['calls'] = list(calls.values())
+  return merged
+
+
+def _StripFlag(argv, flag):
+  """Returns the arguments without a flag and its value."""
+  stripped = []
+  skip = False
+  for arg in argv:
+    if skip:
+      skip = False
+    elif arg == flag:
+      skip = True
+    elif not arg.startswith(flag + '='):
+      stripped.append(arg)
+  return stripped
+
+
+def _Forward(stream, prefix):
+  for line in iter(stream.readline, ''):
+    sys.stdout.write(prefix + line)
+    sys.stdout.flush()
+  stream.close()
+
+
+def LaunchLocal(argv, num_shards, launch_flag):
+  """Runs every shard of an import as a local process, and waits for them.
+
+  The output of every process is printed with its shard as prefix.
+
+  Args:
+    argv: The arguments of the launching process, including the script.
+    num_shards: The number of shards, and of processes.
+    launch_flag: The flag that asked for the launch, which is removed from the
+      arguments of the shards.
+
+  Returns:
+    The exit codes of the shards, by shard index.
+  """
+  args = [sys.executable] + _StripFlag(argv, launch_flag)
+  processes = []
+  threads = []
+  for shard_index in range(num_shards):
+    process = subprocess.Popen(
+        args + ['--num_shards', str(num_shards), '--shard_index',
+                str(shard_index)],
+        stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+        universal_newlines=True)
+    thread = threading.Thread(
+        target=_Forward,
+        args=(process.stdout, '[shard {}] '.format(shard_index)))
+    thread.start()
+    processes.append(process)
+    threads.append(thread)
+  exit_codes = [process.wait() for process in processes]
+  for thread in threads:
+    thread.join()
+  return exit_codes
+
+
+def FormatMergedResults(merged):
+  """Formats the counts of merged results."""
+  lines = ['Merged the results of shards {} of {}.'.format(
+      merged['shards'], merged['num_shards'])]
+  if merged['missing_shards']:
+    lines.append('Error: missing the results of shards {}.'.format(
+        merged['missing_shards']))
+  lines.append('Created `{}` conversations.'.format(
+      len(merged['conversation_names'])))
+  for state, count in sorted(merged['analysis_states'].items()):
+    lines.append('Analysis `{}`: `{}` conversations.'.format(state, count))
+  return '\n'.join(lines)
+
+
+def _ParseArgs():
+  parser = argparse.ArgumentParser(
+      description='Combines the results files of the shards of an import.')
+  subparsers = parser.add_subparsers(dest='command', required=True)
+  merge = subparsers.add_parser('merge', help='Merges results files.')
+  merge.add_argument('results_files', nargs='+',
+                     help='The results file of every shard.')
+  merge.add_argument('--output', help='Where to write the merged results.')
+  return parser.parse_args()
+
+
+def main():
+  pargs = _ParseArgs()
+  merged = MergeResults(pargs.results_files)
+  print(FormatMergedResults(merged))
+  if pargs.output:
+    with open(pargs.output, 'w') as f:
+      json.dump(merged, f)
+  if merged['missing_shards']:
+    sys.exit(1)
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,176 @@
+# Lint as: python3
+"""Writes Speech-to-text responses as transcript files for Insights.
+
+Transcripts used to be uploaded as `str()` of the response, the protobuf text
+format, which repeats field names on every line and is slow to produce. Two
+compact JSON formats are written instead, one result at a time into a binary
+stream, without an intermediate copy of the response:
+
+  * `json`, the JSON form of the Speech-to-text response that Insights reads
+    for voice conversations, without whitespace.
+  * `entries`, the `entries` / `user_id` / `start_timestamp_usec` / `role`
+    format of chat transcripts (see `_insights/example.json`), with one entry
+    per result.
+"""
+
+import json
+
+from google.protobuf import text_format
+
+TEXT = 'text'
+SPEECH_JSON = 'json'
+ENTRIES = 'entries'
+FORMATS = (TEXT, SPEECH_JSON, ENTRIES)
+
+EXTENSIONS = {TEXT: '.txt', SPEECH_JSON: '.json', ENTRIES: '.json'}
+CONTENT_TYPES = {
+    TEXT: 'text/plain',
+    SPEECH_JSON: 'application/json',
+    ENTRIES: 'application/json',
+}
+
+AGENT = 'AGENT'
+CUSTOMER = 'CUSTOMER'
+
+
+def _Quote(text):
+  return json.dumps(text, ensure_ascii=False)
+
+
+def _FormatDuration(duration):
+  """Formats a `Duration` like its JSON mapping, e.g. `1.200s`."""
+  nanos = duration.nanos
+  if not nanos:
+    return '{}s'.format(duration.seconds)
+  if nanos % 1000000 == 0:
+    return '{}.{:03d}s'.format(duration.seconds, nanos // 1000000)
+  if nanos % 1000 == 0:
+    return '{}.{:06d}s'.format(duration.seconds, nanos // 1000)
+  return '{}.{:09d}s'.format(duration.seconds, nanos)
+
+
+def _GetMicros(duration):
+  return duration.seconds * 1000000 + duration.nanos // 1000
+
+
+def WriteText(transcript_response, out):
+  """Writes a response in the protobuf text format, as `str()` would.
+
+  Args:
+    transcript_response: The `LongRunningRecognizeResponse`.
+    out: The binary stream to write to.
+  """
+  for result in transcript_response.results:
+    out.write('results {{\n{}}}\n'.format(
+        text_format.MessageToString(result, indent=2)).encode('utf-8'))
+
+
+def WriteSpeechJson(transcript_response, out):
+  """Writes a response as compact Speech-to-text JSON.
+
+  Fields are named and ordered like the JSON mapping of the response, and
+  default values are omitted. Confidences are rounded to four decimals.
+
+  Args:
+    transcript_response: The `LongRunningRecognizeResponse`.
+    out: The binary stream to write to.
+  """
+  out.write(b'{"results":[')
+  for i, result in enumerate(transcript_response.results):
+    parts = [',{"alternatives":[' if i else '{"alternatives":[']
+    for j, alternative in enumerate(result.alternatives):
+      if j:
+        parts.append(',')
+      parts.append('{"transcript":')
+      parts.append(_Quote(alternative.transcript))
+      if alternative.confidence:
+        parts.append(',"confidence":{}'.format(
+            round(alternative.confidence, 4)))
+      if alternative.words:
+        parts.append(',"words":[')
+        for k, word in enumerate(alternative.words):
+          parts.append('{}{{"startTime":"{}","endTime":"{}","word":{}'.format(
+              ',' if k else '', _FormatDuration(word.start_time),
+              _FormatDuration(word.end_time), _Quote(word.word)))
+          if word.confidence:
+            parts.append(',"confidence":{}'.format(round(word.confidence, 4)))
+          if word.speaker_tag:
+            parts.append(',"speakerTag":{}'.format(word.speaker_tag))
+          parts.append('}')
+        parts.append(']')
+      parts.append('}')
+    parts.append(']')
+    if result.channel_tag:
+      parts.append(',"channelTag":{}'.format(result.channel_tag))
+    if result.language_code:
+      parts.append(',"languageCode":{}'.format(_Quote(result.language_code)))
+    parts.append('}')
+    out.write(''.join(parts).encode('utf-8'))
+  out.write(b']}')
+
+
+def WriteEntries(transcript_response, out, agent_channel=2):
+  """Writes a response in the `entries` format of chat transcripts.
+
+  Every result becomes one entry with the transcript of its first
+  alternative. Its start time is that of its first word, or the end of the
+  previous result if it has no words, and entries are ordered by start time,
+  since results of different channels may be grouped by channel.
+
+  Args:
+    transcript_response: The `LongRunningRecognizeResponse`.
+    out: The binary stream to write to.
+    agent_channel: The audio channel of the agent. Other channels are
+      customers, and `user_id` is the channel. Mono audio, without channel
+      tags, is attributed to a customer on channel 1.
+  """
+  starts = []
+  previous_end = 0
+  for i, result in enumerate(transcript_response.results):
+    if not result.alternatives:
+      continue
+    words = result.alternatives[0].words
+    if words:
+      start = _GetMicros(words[0].start_time)
+      previous_end = _GetMicros(words[-1].end_time)
+    else:
+      start = previous_end
+    starts.append((start, i))
+  starts.sort()
+
+  results = transcript_response.results
+  out.write(b'{"entries":[')
+  for j, (start, i) in enumerate(starts):
+    result = results[i]
+    channel = result.channel_tag or 1
+    out.write('{}{{"text":{},"user_id":{},"start_timestamp_usec":{},'
+              '"role":"{}"}}'.format(
+                  ',' if j else '', _Quote(result.alternatives[0].transcript),
+                  channel, start,
+                  AGENT if channel == agent_channel else CUSTOMER).encode(
+                      'utf-8'))
+  out.write(b']}')
+
+
+def WriteTranscript(transcript_response, out, transcript_format=TEXT,
+                    agent_channel=2):
+  """Writes a response in one of the `FORMATS`.
+
+  Args:
+    transcript_response: The `LongRunningRecognizeResponse`.
+    out: The binary stream to write to.
+    transcript_format: One of the `FORMATS`.
+    agent_channel: The audio channel of the agent, for `ENTRIES`.
+
+  Raises:
+    ValueError: If the format is unknown.
+  """
+  if transcript_format == TEXT:
+    WriteText(transcript_response, out)
+  elif transcript_format == SPEECH_JSON:
+    WriteSpeechJson(transcript_response, out)
+  elif transcript_format == ENTRIES:
+    WriteEntries(transcript_response, out, agent_channel)
+  else:
+    raise ValueError('Unknown transcript format `{}`: expected one of {}.'
+                     .format(transcript_format, FORMATS))
@@ -0,0 +1,310 @@
+# Lint as: python3
+"""Watches a bucket for new objects, for continuous imports.
+
+Importing new recordings used to mean running the import tool over the whole
+bucket again, listing every object and skipping the ones that were already
+imported. A watcher instead yields only the objects that were created since it
+started, for as long as it runs, and the import pipeline transcribes each of
+them as soon as it arrives.
+
+`PubSubWatcher` receives the bucket's object change notifications from a
+Pub/Sub subscription, so new objects arrive within seconds and nothing is
+listed. `PollingWatcher` lists the bucket every few seconds instead, and keeps a
+high-water mark of the update times it has seen. With names that sort in
+upload order, e.g. `calls/2021-06-01T12:00:00-...`, it only lists the names
+from the newest one on, which keeps the cost of every listing constant.
+"""
+
+import collections
+import datetime
+import json
+import threading
+import time
+
+import google.api_core.exceptions
+
+import gcs_listing
+
+# The notification event of a new object, or of a new generation of one.
+_OBJECT_FINALIZE = 'OBJECT_FINALIZE'
+# The notification payload that holds the object's metadata as JSON.
+_JSON_API_V1 = 'JSON_API_V1'
+
+
+def ParseTime(value):
+  """Returns seconds since the epoch for an RFC 3339 time or a datetime.
+
+  Args:
+    value: e.g. `2021-06-01T12:00:00.123Z`, as in object metadata, a timezone
+      aware `datetime.datetime`, as in listings, or None.
+
+  Returns:
+    The seconds since the epoch, or None if `value` is None.
+
+  Raises:
+    ValueError: If the time cannot be parsed.
+  """
+  if value is None:
+    return None
+  if isinstance(value, datetime.datetime):
+    return value.timestamp()
+  value = value.strip()
+  if value.endswith('Z') or value.endswith('z'):
+    value = value[:-1] + '+00:00'
+  if '.' in value:
+    # Fractions of a second may have any number of digits; keeps 6.
+    head, _, tail = value.partition('.')
+    digits = len(tail) - len(tail.lstrip('0123456789'))
+    value = '{}.{:0<6.6}{}'.format(head, tail[:digits], tail[digits:])
+  parsed = datetime.datetime.fromisoformat(value)
+  if parsed.tzinfo is None:
+    parsed = parsed.replace(tzinfo=datetime.timezone.utc)
+  return parsed.timestamp()
+
+
+class _RecentKeys(object):
+  """Remembers the most recent keys, to drop duplicates in constant memory."""
+
+  def __init__(self, max_keys):
+    self._max_keys = max_keys
+    self._keys = collections.OrderedDict()
+
+  def Add(self, key):
+    """Adds a key, and returns whether it is new."""
+    if key in self._keys:
+      self._keys.move_to_end(key)
+      return False
+    self._keys[key] = None
+    if len(self._keys) > self._max_keys:
+      self._keys.popitem(last=False)
+    return True
+
+
+def ParseNotification(attributes, data, bucket):
+  """Returns the object of a GCS notification, or None for other events.
+
+  Args:
+    attributes: The attributes of the Pub/Sub message.
+    data: The payload of the message, the object metadata as JSON if the
+      notification's payload format is `JSON_API_V1`.
+    bucket: The watched bucket. Notifications of other buckets are ignored.
+
+  Returns:
+    A `gcs_listing.GcsObject`, with the hashes and size only if the payload
+    holds them, or None if the message is not about a new object in `bucket`.
+  """
+  attributes = dict(attributes)
+  if (attributes.get('eventType') != _OBJECT_FINALIZE or
+      attributes.get('bucketId') != bucket):
+    return None
+  name = attributes.get('objectId')
+  if not name:
+    return None
+  metadata = {}
+  if attributes.get('payloadFormat') == _JSON_API_V1 and data:
+    try:
+      metadata = json.loads(data.decode('utf-8'))
+    except ValueError:
+      # The attributes are enough to import the object.
+      metadata = {}
+  size = metadata.get('size')
+  generation = attributes.get('objectGeneration') or metadata.get('generation')
+  return gcs_listing.GcsObject('gs://{}/{}'.format(bucket, name), name,
+                               int(size) if size is not None else None,
+                               metadata.get('md5Hash'), metadata.get('crc32c'),
+                               int(generation) if generation else None,
+                               metadata.get('updated'))
+
+
+class PubSubWatcher(object):
+  """Yields new objects of a bucket from its Pub/Sub notifications.
+
+  The bucket needs a notification config that publishes `OBJECT_FINALIZE`
+  events to a topic, e.g. `gsutil notification create -t TOPIC -f json
+  -e OBJECT_FINALIZE gs://BUCKET`, and the watcher pulls from a subscription
+  of that topic. Messages are acknowledged once all objects of a pull were
+  yielded, so objects that were never handed to the import are delivered
+  again. Duplicate deliveries of recent objects are dropped. Several watchers
+  may share a subscription, and Pub/Sub then splits the objects between them.
+  """
+
+  def __init__(self, subscriber, subscription, bucket, prefix=None, glob=None,
+               suffixes=None, max_messages=100, pull_timeout_secs=10.0,
+               max_recent=100000):
+    """Initializes the watcher.
+
+    Args:
+      subscriber: The `pubsub_v1.SubscriberClient` to pull with.
+      subscription: The subscription, e.g.
+        `projects/PROJECT/subscriptions/SUBSCRIPTION`.
+      bucket: The watched bucket.
+      prefix: Only yield objects whose names start with this prefix.
+      glob: Only yield objects whose names match this `fnmatch` pattern.
+      suffixes: Only yield objects whose names end with one of these suffixes.
+      max_messages: The most messages to pull at a time.
+      pull_timeout_secs: How long a pull waits for messages.
+      max_recent: The number of recent objects remembered to drop duplicates.
+    """
+    self._subscriber = subscriber
+    self._subscription = subscription
+    self._bucket = bucket
+    self._filters = (prefix, glob, suffixes)
+    self._max_messages = max_messages
+    self._pull_timeout_secs = pull_timeout_secs
+    self._recent = _RecentKeys(max_recent)
+    self._stopped = threading.Event()
+    self.pulls = 0
+    self.messages = 0
+    self.duplicates = 0
+
+  def Stop(self):
+    """Makes `Watch` return after its current pull."""
+    self._stopped.set()
+
+  def Watch(self, max_items=None):
+    """Yields `gcs_listing.GcsObject`s as they are created.
+
+    Args:
+      max_items: Return after this many objects. None to watch until `Stop`.
+    """
+    num_items = 0
+    while not self._stopped.is_set():
+      try:
+        # The request form works with google-cloud-pubsub 1.x and 2.x.
+        response = self._subscriber.pull(
+            request={
+                'subscription': self._subscription,
+                'max_messages': self._max_messages,
+            },
+            timeout=self._pull_timeout_secs)
+      except google.api_core.exceptions.DeadlineExceeded:
+        # No messages within the timeout.
+        continue
+      self.pulls += 1
+      ack_ids = []
+      for received in response.received_messages:
+        self.messages += 1
+        ack_ids.append(received.ack_id)
+        gcs_object = ParseNotification(received.message.attributes,
+                                       received.message.data, self._bucket)
+        if not gcs_object or not gcs_listing.Matches(gcs_object.name,
+                                                     *self._filters):
+          continue
+        if not self._recent.Add((gcs_object.name, gcs_object.generation)):
+          self.duplicates += 1
+          continue
+        yield gcs_object
+        num_items += 1
+        if max_items is not None and num_items >= max_items:
+          # The rest of the pull is not acknowledged, and delivered again.
+          break
+      if ack_ids:
+        self._subscriber.acknowledge(request={
+            'subscription': self._subscription,
+            'ack_ids': ack_ids,
+        })
+      if max_items is not None and num_items >= max_items:
+        return
+
+
+class PollingWatcher(object):
+  """Yields new objects of a bucket by listing it every few seconds.
+
+  Objects are new if they were updated at or after the start time, and were
+  not yielded before. Listings may return an object after one that was
+  updated later, so objects updated up to `skew_secs` before the newest one
+  seen are still considered, and dropped if they were yielded already.
+  """
+
+  def __init__(self, get_storage_client, bucket, prefix=None, glob=None,
+               suffixes=None, interval_secs=10.0, since=None, skew_secs=60.0,
+               sorted_names=False, start_offset=None):
+    """Initializes the watcher.
+
+    Args:
+      get_storage_client: Returns the `google.cloud.storage.Client` to use in
+        the calling thread.
+      bucket: The watched bucket.
+      prefix: Only yield objects whose names start with this prefix.
+      glob: Only yield objects whose names match this `fnmatch` pattern.
+      suffixes: Only yield objects whose names end with one of these suffixes.
+      interval_secs: The time between the starts of two listings.
+      since: Seconds since the epoch. Objects updated earlier are not yielded.
+        None for the time the watcher was created.
+      skew_secs: How much earlier than the newest object seen a new object may
+        have been updated.
+      sorted_names: Whether new objects always have names that sort after
+        those of older objects. Every listing then starts at the newest
+        name, instead of listing the whole bucket or prefix.
+      start_offset: With `sorted_names`, the name the first listing starts at,
+        e.g. one from around the start time. By default, the first listing
+        covers the whole bucket or prefix.
+    """
+    self._get_storage_client = get_storage_client
+    self._bucket = bucket
+    self._prefix = prefix
+    self._glob = glob
+    self._suffixes = suffixes
+    self._interval_secs = interval_secs
+    self._since = time.time() if since is None else since
+    # The update time of the newest object seen.
+    self._newest = self._since
+    self._skew_secs = skew_secs
+    self._sorted_names = sorted_names
+    self._last_name = start_offset if sorted_names else None
+    # Maps the (name, generation) of the objects updated since the cutoff to
+    # their update times.
+    self._recent = {}
+    self._stopped = threading.Event()
+    self.listings = 0
+    self.objects_listed = 0
+
+  def Stop(self):
+    """Makes `Watch` return after its current listing."""
+    self._stopped.set()
+
+  def _GetCutoff(self):
+    """Returns the update time before which objects are not new."""
+    return max(self._since, self._newest - self._skew_secs)
+
+  def _Poll(self):
+    """Yields the new objects of one listing."""
+    cutoff = self._GetCutoff()
+    self.listings += 1
+    for gcs_object in gcs_listing.ListObjects(
+        self._get_storage_client(), self._bucket, self._prefix, self._glob,
+        self._suffixes, self._last_name):
+      self.objects_listed += 1
+      if self._sorted_names and gcs_object.name > (self._last_name or ''):
+        self._last_name = gcs_object.name
+      updated = ParseTime(gcs_object.updated)
+      if updated is None or updated < cutoff:
+        continue
+      key = (gcs_object.name, gcs_object.generation)
+      if key in self._recent:
+        continue
+      self._newest = max(self._newest, updated)
+      self._recent[key] = updated
+      yield gcs_object
+    cutoff = self._GetCutoff()
+    self._recent = {
+        key: updated
+        for key, updated in self._recent.items()
+        if updated >= cutoff
+    }
+
+  def Watch(self, max_items=None):
+    """Yields `gcs_listing.GcsObject`s as they are created.
+
+    Args:
+      max_items: Return after this many objects. None to watch until `Stop`.
+    """
+    num_items = 0
+    while not self._stopped.is_set():
+      start = time.time()
+      for gcs_object in self._Poll():
+        yield gcs_object
+        num_items += 1
+        if max_items is not None and num_items >= max_items:
+          return
+      self._stopped.wait(max(0.0, start + self._interval_secs - time.time()))
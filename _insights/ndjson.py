@@ -1,8 +1,929 @@
+"""Converts JSON arrays of records to newline delimited JSON for BigQuery.
+
+The input is parsed incrementally, one array element at a time, so memory use
+does not depend on the size of the input. Files that are already a stream of
+JSON values, such as NDJSON, are accepted too. The input can be a file or
+stdin, and gzip compressed input is detected automatically.
+
+Records can be validated against a BigQuery schema such as `bq_schema.json`
+while they are converted, and written either to one output or to size bounded
+shards that worker processes write in parallel.
+
+Examples:
+
+    python3 ndjson.py ../bq_import.json -o bq_import.ndjson
+    gunzip -c export.json.gz | python3 ndjson.py - --schema ../bq_schema.json \
+        --shard_dir shards --max_shard_mb 256 --gzip --processes 8
+    python3 ndjson.py --benchmark_mb 4096
+"""
+
+import argparse
+import gzip
+import io
 import json
+import multiprocessing
+import os
+import queue
+import re
+import resource
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+DEFAULT_MAX_SHARD_BYTES = 256 * 1024 * 1024
+DEFAULT_BATCH_CHARS = 1024 * 1024
+DEFAULT_READ_CHARS = 1024 * 1024
+
+ON_INVALID_ERROR = 'error'
+ON_INVALID_SKIP = 'skip'
+ON_INVALID_KEEP = 'keep'
+ON_INVALID = (ON_INVALID_ERROR, ON_INVALID_SKIP, ON_INVALID_KEEP)
+
+# Invalid records that are reported in detail, per process.
+_MAX_REPORTED_ERRORS = 10
+_GZIP_MAGIC = b'\x1f\x8b'
+_WHITESPACE = re.compile(r'[ \t\n\r]*')
+_ENCODER = json.JSONEncoder(ensure_ascii=False, separators=(',', ':'))
+
+
+class Stats:
+    """Counts what a conversion read and wrote."""
+
+    def __init__(self):
+        self.records = 0
+        self.invalid = 0
+        self.chars_read = 0
+        self.bytes_written = 0
+        self.shards = []
+        self.errors = []
+
+    def add(self, other):
+        self.records += other.records
+        self.invalid += other.invalid
+        self.chars_read += other.chars_read
+        self.bytes_written += other.bytes_written
+        self.shards.extend(other.shards)
+        self.errors.extend(other.errors)
+
+
+# Schema validation
+
+_TIMESTAMP = re.compile(
+    r'\d{4}-\d{1,2}-\d{1,2}(?:[T ]\d{1,2}:\d{1,2}(?::\d{1,2}(?:\.\d{1,9})?)?)?'
+    r'(?: ?(?:Z|UTC|[+-]\d{1,2}(?::?\d{2})?))?$')
+_DATE = re.compile(r'\d{4}-\d{1,2}-\d{1,2}$')
+_TIME = re.compile(r'\d{1,2}:\d{1,2}(?::\d{1,2}(?:\.\d{1,9})?)?$')
+_DATETIME = re.compile(
+    r'\d{4}-\d{1,2}-\d{1,2}(?:[T ]\d{1,2}:\d{1,2}(?::\d{1,2}(?:\.\d{1,9})?)?)?$')
+_INTEGER = re.compile(r'[+-]?\d+$')
+_NUMBER = re.compile(r'[+-]?(?:\d+\.?\d*|\.\d+)(?:[eE][+-]?\d+)?$')
+
+
+def _check_string(value):
+    return isinstance(value, str)
+
+
+def _check_integer(value):
+    if isinstance(value, str):
+        return bool(_INTEGER.match(value))
+    return isinstance(value, int) and not isinstance(value, bool)
+
+
+def _check_float(value):
+    if isinstance(value, str):
+        return bool(_NUMBER.match(value)) or value in ('NaN', 'Infinity',
+                                                      '-Infinity')
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+def _check_boolean(value):
+    return isinstance(value, bool) or value in ('true', 'false', 'TRUE',
+                                                'FALSE', 'True', 'False')
+
+
+def _check_timestamp(value):
+    if isinstance(value, str):
+        return bool(_TIMESTAMP.match(value))
+    # Seconds since the epoch.
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+def _regex_checker(pattern):
+    return lambda value: isinstance(value, str) and bool(pattern.match(value))
+
+
+_CHECKERS = {
+    'STRING': _check_string,
+    'BYTES': _check_string,
+    'INTEGER': _check_integer,
+    'INT64': _check_integer,
+    'FLOAT': _check_float,
+    'FLOAT64': _check_float,
+    'NUMERIC': _check_float,
+    'BIGNUMERIC': _check_float,
+    'BOOLEAN': _check_boolean,
+    'BOOL': _check_boolean,
+    'TIMESTAMP': _check_timestamp,
+    'DATE': _regex_checker(_DATE),
+    'TIME': _regex_checker(_TIME),
+    'DATETIME': _regex_checker(_DATETIME),
+    'GEOGRAPHY': _check_string,
+    'JSON': lambda value: True,
+}
+_FAST_TYPES = {
+    'STRING': (str,),
+    'BYTES': (str,),
+    'INTEGER': (int,),
+    'INT64': (int,),
+    'FLOAT': (float, int),
+    'FLOAT64': (float, int),
+    'NUMERIC': (float, int),
+    'BIGNUMERIC': (float, int),
+    'BOOLEAN': (bool,),
+    'BOOL': (bool,),
+    'TIMESTAMP': (float, int),
+    'GEOGRAPHY': (str,),
+}
+
+
+# Types whose empty or blank string values are nulls, as in `columnar.py`.
+_BLANK_IS_NULL_TYPES = frozenset([
+    'INTEGER', 'INT64', 'FLOAT', 'FLOAT64', 'NUMERIC', 'BIGNUMERIC', 'BOOLEAN',
+    'BOOL', 'TIMESTAMP'
+])
+
+
+def _is_blank(value):
+    return isinstance(value, str) and not value.strip()
+
+
+class Validator:
+    """Validates records against a BigQuery schema, like a JSON load would.
+
+    Checks that required fields are set, that values have the type of their
+    field and that records have no fields missing from the schema. Values are
+    not converted, except that `null_blanks` replaces the empty strings of
+    numeric, boolean and timestamp fields with nulls, which is how the logs
+    store missing numbers.
+    """
+
+    def __init__(self, fields):
+        """Compiles a schema.
+
+        Args:
+            fields: The fields of the schema, as in `bq_schema.json`.
+        """
+        self._fields = [self._compile(field) for field in fields]
+        self._names = frozenset(field[0] for field in self._fields)
+        self._blank_is_null = tuple(
+            name for name, field_type, mode, _, _ in self._fields
+            if field_type in _BLANK_IS_NULL_TYPES and mode != 'REPEATED')
+
+    def _compile(self, field):
+        field_type = field.get('type', 'STRING').upper()
+        mode = field.get('mode', 'NULLABLE').upper()
+        if field_type in ('RECORD', 'STRUCT'):
+            nested = Validator(field.get('fields', []))
+            check = lambda value: isinstance(value, dict) and not nested.errors(
+                value)
+        elif field_type in _CHECKERS:
+            check = _CHECKERS[field_type]
+        else:
+            raise ValueError('Unsupported type `{}` of field `{}`.'.format(
+                field_type, field['name']))
+        # Values of these types are valid without calling `check`.
+        fast_types = () if mode == 'REPEATED' else _FAST_TYPES.get(
+            field_type, ())
+        return field['name'], field_type, mode, fast_types, check
+
+    def errors(self, record):
+        """Returns a list of messages for what is wrong with a record."""
+        if not isinstance(record, dict):
+            return ['expected an object, got {}'.format(type(record).__name__)]
+        errors = []
+        get = record.get
+        for name, field_type, mode, fast_types, check in self._fields:
+            value = get(name)
+            if type(value) in fast_types:
+                continue
+            if value is None or (_is_blank(value) and
+                                 field_type in _BLANK_IS_NULL_TYPES and
+                                 mode != 'REPEATED'):
+                if mode == 'REQUIRED':
+                    errors.append('missing required field {}'.format(name))
+            elif mode == 'REPEATED':
+                if not isinstance(value, list):
+                    errors.append('{} is not an array'.format(name))
+                elif not all(item is not None and check(item)
+                             for item in value):
+                    errors.append('{} has an element that is not a {}'.format(
+                        name, field_type))
+            elif not check(value):
+                errors.append('{} is not a {}: {}'.format(
+                    name, field_type, json.dumps(value)[:80]))
+        if not self._names.issuperset(record):
+            unknown = record.keys() - self._names
+            errors.append('unknown fields {}'.format(', '.join(sorted(unknown))))
+        return errors
+
+
+    def null_blanks(self, record):
+        """Replaces blank strings with nulls where they stand for nulls.
+
+        Args:
+            record: A record, changed in place.
+
+        Returns:
+            The record.
+        """
+        if isinstance(record, dict):
+            for name in self._blank_is_null:
+                if _is_blank(record.get(name)):
+                    record[name] = None
+        return record
+
+
+def load_schema(path):
+    """Loads the fields of a BigQuery schema file, such as `bq_schema.json`."""
+    with open(path) as f:
+        schema = json.load(f)
+    if isinstance(schema, dict):
+        schema = schema.get('schema', schema).get('fields', [])
+    return schema
+
+
+# Incremental parsing
+
+def open_input(source):
+    """Opens a file, or stdin for `-`, as text, decompressing gzip input.
+
+    Args:
+        source: A path, `-`, or a binary file object.
+
+    Returns:
+        A text file object.
+    """
+    if source == '-':
+        raw = sys.stdin.buffer
+    elif isinstance(source, str):
+        raw = open(source, 'rb')
+    else:
+        raw = source
+    if not hasattr(raw, 'peek'):
+        raw = io.BufferedReader(raw)
+    if raw.peek(2)[:2] == _GZIP_MAGIC:
+        raw = gzip.GzipFile(fileobj=raw, mode='rb')
+    return io.TextIOWrapper(raw, encoding='utf-8')
+
+
+def iter_values(stream, read_chars=DEFAULT_READ_CHARS):
+    """Parses the elements of a JSON array one at a time.
+
+    A stream that does not start with `[` is parsed as a sequence of JSON
+    values, such as NDJSON.
+
+    Args:
+        stream: A text file object.
+        read_chars: The number of characters to read at a time.
+
+    Yields:
+        (value, text) tuples, where text is the JSON source of the value.
+
+    Raises:
+        ValueError: If the input is not valid JSON.
+    """
+    decoder = json.JSONDecoder()
+    buffer = ''
+    eof = False
+    while not eof and not buffer.strip():
+        chunk = stream.read(read_chars)
+        eof = not chunk
+        buffer += chunk
+    position = _WHITESPACE.match(buffer).end()
+    # The number of characters before the buffer, for error messages.
+    offset = 0
+    in_array = buffer[position:position + 1] == '['
+    if in_array:
+        position = _WHITESPACE.match(buffer, position + 1).end()
+    expect_value = True
+    first = True
+    while True:
+        if position >= len(buffer) - 1 and not eof:
+            # Keeps the tail, and reads at least as much as is kept, so that
+            # large values are not parsed again for every read.
+            chunk = stream.read(max(read_chars, len(buffer) - position))
+            eof = not chunk
+            offset += position
+            buffer = buffer[position:] + chunk
+            position = _WHITESPACE.match(buffer).end()
+            continue
+        if position >= len(buffer):
+            if in_array:
+                raise ValueError('Unterminated array at character {}.'.format(
+                    offset + position))
+            return
+        char = buffer[position]
+        if in_array and char == ']' and (first or not expect_value):
+            rest = buffer[position + 1:] + ('' if eof else
+                                            stream.read(read_chars))
+            if rest.strip():
+                raise ValueError(
+                    'Extra data after the array at character {}.'.format(
+                        offset + position + 1))
+            return
+        if in_array and not expect_value:
+            if char != ',':
+                raise ValueError('Expected `,` or `]` at character {}.'.format(
+                    offset + position))
+            position = _WHITESPACE.match(buffer, position + 1).end()
+            expect_value = True
+            continue
+        try:
+            value, end = decoder.raw_decode(buffer, position)
+        except json.JSONDecodeError as e:
+            # Only errors at the end of the buffer may be caused by a value
+            # that continues in the next chunk.
+            if eof or not (e.msg.startswith('Unterminated string') or
+                           e.pos >= len(buffer) - 6):
+                raise ValueError('Invalid JSON at character {}: {}'.format(
+                    offset + e.pos, e.msg))
+            chunk = stream.read(max(read_chars, len(buffer) - position))
+            eof = not chunk
+            offset += position
+            buffer = buffer[position:] + chunk
+            position = 0
+            continue
+        if end == len(buffer) and not eof and buffer[end - 1] not in '}]"':
+            # A number or literal may continue in the next chunk.
+            chunk = stream.read(read_chars)
+            eof = not chunk
+            offset += position
+            buffer = buffer[position:] + chunk
+            position = 0
+            continue
+        yield value, buffer[position:end]
+        first = False
+        expect_value = False
+        position = _WHITESPACE.match(buffer, end).end()
+        if not in_array:
+            expect_value = True
+
+
+# Writing
+
+class _ShardWriter:
+    """Writes lines to numbered files of at most `max_bytes` each."""
+
+    def __init__(self, directory, prefix, max_bytes, compress):
+        self._directory = directory
+        self._prefix = prefix
+        self._max_bytes = max_bytes
+        self._compress = compress
+        self._file = None
+        self._size = 0
+        self.paths = []
+
+    def write(self, data):
+        if self._file is not None and self._size + len(data) > self._max_bytes:
+            self.close()
+        if self._file is None:
+            path = os.path.join(self._directory, '{}-{:05d}.ndjson{}'.format(
+                self._prefix, len(self.paths), '.gz' if self._compress else ''))
+            self._file = (gzip.open(path, 'wb', compresslevel=6)
+                          if self._compress else open(path, 'wb'))
+            self._size = 0
+            self.paths.append(path)
+        self._file.write(data)
+        self._size += len(data)
+
+    def write_lines(self, data):
+        """Writes whole lines, splitting them over shards if they don't fit."""
+        if self._size + len(data) <= self._max_bytes or not self._max_bytes:
+            self.write(data)
+            return
+        start = 0
+        while start < len(data):
+            room = self._max_bytes - self._size if self._file else self._max_bytes
+            end = data.rfind(b'\n', start, start + room) + 1
+            if end <= start:
+                if self._file is not None and self._size:
+                    self.close()
+                    continue
+                # A single line longer than a shard.
+                end = data.index(b'\n', start) + 1
+            self.write(data[start:end])
+            start = end
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+class _Converter:
+    """Validates and encodes records, one batch at a time."""
+
+    def __init__(self, schema, on_invalid):
+        self._validator = Validator(schema) if schema else None
+        self._on_invalid = on_invalid
+        self.stats = Stats()
+
+    def convert(self, values, first_index):
+        """Returns the NDJSON encoding of values, and whether all were valid."""
+        lines = []
+        valid = True
+        for i, value in enumerate(values):
+            if self._validator:
+                errors = self._validator.errors(value)
+                if errors:
+                    valid = False
+                    self.stats.invalid += 1
+                    if len(self.stats.errors) < _MAX_REPORTED_ERRORS:
+                        self.stats.errors.append(
+                            (first_index + i, '; '.join(errors)))
+                    if self._on_invalid != ON_INVALID_KEEP:
+                        continue
+                value = self._validator.null_blanks(value)
+            lines.append(_ENCODER.encode(value))
+        self.stats.records += len(values)
+        if not lines:
+            return b'', valid
+        return ('\n'.join(lines) + '\n').encode('utf-8'), valid
+
+
+def _worker(worker_index, batches, results, options):
+    """Converts batches of record texts in a worker process.
+
+    Writes its own shards if `shard_dir` is set, and otherwise sends the
+    encoded batches back in `results`, to be written in order.
+    """
+    converter = _Converter(options['schema'], options['on_invalid'])
+    writer = None
+    if options['shard_dir']:
+        writer = _ShardWriter(
+            options['shard_dir'],
+            '{}-{:03d}'.format(options['shard_prefix'], worker_index),
+            options['max_shard_bytes'], options['compress'])
+    failure = None
+    while True:
+        batch = batches.get()
+        if batch is None:
+            break
+        if failure:
+            continue
+        batch_index, first_index, texts = batch
+        try:
+            data, valid = converter.convert([json.loads(text) for text in texts],
+                                            first_index)
+            if writer:
+                writer.write_lines(data)
+                converter.stats.bytes_written += len(data)
+                data = None
+            results.put(('batch', batch_index, data, valid))
+        except Exception as e:  # pylint: disable=broad-except
+            # Drains the remaining batches, so that the reader does not block.
+            failure = '{}: {}'.format(type(e).__name__, e)
+            results.put(('failed', batch_index, failure, False))
+    if writer:
+        writer.close()
+        converter.stats.shards = writer.paths
+    # As a dict, since the class of a spawned `__main__` can't be unpickled.
+    results.put(('done', worker_index, vars(converter.stats), None))
+
+
+def _open_output(output, compress):
+    if output == '-':
+        return sys.stdout.buffer, False
+    if isinstance(output, str):
+        if compress:
+            return gzip.open(output, 'wb', compresslevel=6), True
+        return open(output, 'wb'), True
+    return output, False
+
+
+def convert(source, output=None, shard_dir=None,
+            max_shard_bytes=DEFAULT_MAX_SHARD_BYTES, schema=None,
+            on_invalid=ON_INVALID_ERROR, processes=1, compress=False,
+            shard_prefix='part', batch_chars=DEFAULT_BATCH_CHARS):
+    """Converts a JSON array of records to NDJSON.
+
+    Args:
+        source: A path, `-` for stdin, or a binary file object. Gzip input is
+            detected automatically.
+        output: A path, `-` for stdout, or a binary file object, to write all
+            records to, in order. Ignored if `shard_dir` is set.
+        shard_dir: A directory to write shards of at most `max_shard_bytes`
+            (uncompressed) to. With several processes, every process writes
+            its own shards, and records are not in input order.
+        max_shard_bytes: The maximum size of a shard. Lines longer than this
+            get a shard of their own.
+        schema: The fields of a BigQuery schema to validate records against,
+            e.g. from `load_schema`. None to skip validation.
+        on_invalid: What to do with invalid records. `error` stops the
+            conversion, `skip` leaves them out and `keep` writes them anyway.
+            Either way, they are counted.
+        processes: The number of processes to validate, encode and write
+            records with. The calling process always parses the input.
+        compress: Whether to gzip the output.
+        shard_prefix: The start of the names of the shards.
+        batch_chars: The approximate amount of input sent to a process at a
+            time.
+
+    Returns:
+        The `Stats` of the conversion.
+
+    Raises:
+        ValueError: If the input is not valid JSON, or a record is invalid and
+            `on_invalid` is `error`.
+    """
+    if on_invalid not in ON_INVALID:
+        raise ValueError('Unknown on_invalid `{}`: expected one of {}.'.format(
+            on_invalid, ON_INVALID))
+    if shard_dir:
+        os.makedirs(shard_dir, exist_ok=True)
+    elif output is None:
+        raise ValueError('Either an output or a shard directory is required.')
+    stream = open_input(source)
+    owned = isinstance(source, str) and source != '-'
+    try:
+        if processes > 1:
+            return _convert_in_processes(
+                stream, output, shard_dir, max_shard_bytes, schema, on_invalid,
+                processes, compress, shard_prefix, batch_chars)
+        return _convert_in_process(stream, output, shard_dir, max_shard_bytes,
+                                   schema, on_invalid, compress, shard_prefix,
+                                   batch_chars)
+    finally:
+        if owned:
+            stream.close()
+        else:
+            # Leaves the caller's file, or stdin, open.
+            stream.detach()
+
+
+def _raise_invalid(stats):
+    index, message = stats.errors[0]
+    raise ValueError('Record {} is invalid: {}'.format(index, message))
+
+
+def _convert_in_process(stream, output, shard_dir, max_shard_bytes, schema,
+                        on_invalid, compress, shard_prefix, batch_chars):
+    converter = _Converter(schema, on_invalid)
+    stats = converter.stats
+    if shard_dir:
+        writer = _ShardWriter(shard_dir, shard_prefix, max_shard_bytes,
+                              compress)
+        out, close = None, False
+    else:
+        writer = None
+        out, close = _open_output(output, compress)
+    values = []
+    chars = 0
+    try:
+        for value, text in iter_values(stream):
+            values.append(value)
+            chars += len(text)
+            if chars < batch_chars:
+                continue
+            stats.chars_read += chars
+            _write_batch(converter, values, writer, out, on_invalid)
+            values = []
+            chars = 0
+        stats.chars_read += chars
+        _write_batch(converter, values, writer, out, on_invalid)
+    finally:
+        if writer:
+            writer.close()
+            stats.shards = writer.paths
+        elif close:
+            out.close()
+        else:
+            out.flush()
+    return stats
+
+
+def _write_batch(converter, values, writer, out, on_invalid):
+    data, valid = converter.convert(values, converter.stats.records)
+    if not valid and on_invalid == ON_INVALID_ERROR:
+        _raise_invalid(converter.stats)
+    if writer:
+        writer.write_lines(data)
+    else:
+        out.write(data)
+    converter.stats.bytes_written += len(data)
+
+
+def _convert_in_processes(stream, output, shard_dir, max_shard_bytes, schema,
+                          on_invalid, processes, compress, shard_prefix,
+                          batch_chars):
+    # Spawned rather than forked, so that the workers don't inherit the
+    # parser's buffers.
+    context = multiprocessing.get_context('spawn')
+    # Bounded, so that memory use stays constant if the workers fall behind.
+    batches = context.Queue(maxsize=processes * 4)
+    results = context.Queue()
+    options = {
+        'schema': schema,
+        'on_invalid': on_invalid,
+        'shard_dir': shard_dir,
+        'shard_prefix': shard_prefix,
+        'max_shard_bytes': max_shard_bytes,
+        'compress': compress,
+    }
+    workers = [
+        context.Process(target=_worker, args=(i, batches, results, options),
+                        daemon=True)
+        for i in range(processes)
+    ]
+    for worker in workers:
+        worker.start()
+
+    stats = Stats()
+    stop = threading.Event()
+    failures = []
+    if shard_dir:
+        out, close = None, False
+    else:
+        out, close = _open_output(output, compress)
+
+    def collect():
+        """Writes batches in order, and collects the stats of the workers."""
+        pending = {}
+        next_batch = 0
+        done = set()
+        while len(done) < processes:
+            try:
+                kind, index, data, valid = results.get(timeout=1)
+            except queue.Empty:
+                for i, worker in enumerate(workers):
+                    if worker.exitcode and i not in done:
+                        failures.append('exit code {}'.format(worker.exitcode))
+                        stop.set()
+                        done.add(i)
+                continue
+            if kind == 'done':
+                worker_stats = Stats()
+                vars(worker_stats).update(data)
+                stats.add(worker_stats)
+                done.add(index)
+                continue
+            if kind == 'failed':
+                failures.append(data)
+                stop.set()
+                continue
+            if not valid and on_invalid == ON_INVALID_ERROR:
+                stop.set()
+            if shard_dir:
+                continue
+            pending[index] = data
+            while next_batch in pending:
+                data = pending.pop(next_batch)
+                if not stop.is_set():
+                    out.write(data)
+                    stats.bytes_written += len(data)
+                next_batch += 1
+
+    collector = threading.Thread(target=collect)
+    collector.start()
+    batch_index = 0
+    first_index = 0
+    texts = []
+    chars = 0
+    try:
+        for unused_value, text in iter_values(stream):
+            if stop.is_set():
+                break
+            texts.append(text)
+            chars += len(text)
+            if chars < batch_chars:
+                continue
+            _put(batches, (batch_index, first_index, texts), workers, stop)
+            stats.chars_read += chars
+            batch_index += 1
+            first_index += len(texts)
+            texts = []
+            chars = 0
+        if texts and not stop.is_set():
+            _put(batches, (batch_index, first_index, texts), workers, stop)
+            stats.chars_read += chars
+    finally:
+        for unused_worker in workers:
+            _put(batches, None, workers)
+        collector.join()
+        for worker in workers:
+            worker.join()
+        if close:
+            out.close()
+        elif out:
+            out.flush()
+    if failures:
+        raise RuntimeError('A worker failed: {}'.format(failures[0]))
+    stats.errors.sort()
+    if stats.invalid and on_invalid == ON_INVALID_ERROR:
+        _raise_invalid(stats)
+    stats.shards.sort()
+    return stats
+
+
+def _put(batches, batch, workers, stop=None):
+    """Queues a batch, unless the conversion stopped or all workers died."""
+    while not (stop and stop.is_set()):
+        try:
+            batches.put(batch, timeout=0.1)
+            return
+        except queue.Full:
+            if not any(worker.is_alive() for worker in workers):
+                return
+
+
+# Benchmark
+
+def _synthetic_record(index):
+    """Returns a record like those in `bq_import.json`."""
+    session = '{:08x}-efa9-4319-8043-{:012x}'.format(index & 0xFFFFFFFF, index)
+    platform = ('web', 'sms', 'phone', 'ads')[index % 4]
+    return {
+        'SESSION_ID': session,
+        'SESSION_PATH': 'projects/ccai-360/agent/sessions/' + session,
+        'PLATFORM': platform,
+        'LANGUAGE_CODE': 'en',
+        'DATE_TIME': '2021-09-{:02d}T{:02d}:{:02d}:{:02d}.505Z'.format(
+            index % 28 + 1, index % 24, index % 60, (index * 7) % 60),
+        'QUERY': 'What is the difference between being prequalified and '
+                 'preapproved for loan {}?'.format(index),
+        'TEXT_RESPONSE': 'A quick consultation with a G-Mortgages consultant, '
+                         'about your income, assets and down payment is all it '
+                         'takes to get prequalified. ' * (1 + index % 3),
+        'RESPONSE_MESSAGES': "[{'platform':'PLATFORM_UNSPECIFIED','text':"
+                             "{'text':['A quick consultation with a "
+                             "G-Mortgages consultant.']},'message':'text'}]",
+        'SPEECH_TRANSCRIPT': None,
+        'SPEECH_CONFIDENCE': None if platform != 'phone' else 0.92,
+        'SENTIMENT_SCORE': (index % 21 - 10) / 10.0,
+        'SENTIMENT_MAGNITUDE': (index % 11) / 10.0,
+        'INTENT_DETECTION_DISPLAYNAME': 'Sup: Prequalified vs preapproved',
+        'INTENT_DETECTION_NAME': 'projects/ccai-360/agent/intents/'
+                                 '2c5fd4a1-8a3e-4a52-9a8b-0b9f{:08x}'.format(
+                                     index % 97),
+        'INTENT_DETECTION_CONFIDENCE': 0.5 + (index % 50) / 100.0,
+        'INTENT_DETECTION_PARAMETERS': "{'action':'QUESTION'}",
+        'INTENT_DETECTION_IS_FALLBACK': index % 10 == 0,
+        'INTENT_DETECTION_IS_END': False,
+        'INTENT_DETECTION_IS_LIVE_AGENT': False,
+        'FUNNEL_STEP': 'SUPPLEMENTAL',
+        'USER_UID': 'r9f7irzTAmMrhXt1y49o6DqyZAk{}'.format(index % 7),
+        'USER_COUNTRY': ('NL', 'USA', 'IT')[index % 3],
+        'TOOL': 'v2beta1',
+        'VERTICAL': 'fsi',
+    }
+
+
+def write_synthetic_input(path, target_bytes, compress=False):
+    """Writes an indented JSON array of synthetic records, like bq_import.json.
+
+    Returns:
+        The number of records written.
+    """
+    # Formats a pool of records once, and varies only their ids afterwards.
+    pool = [json.dumps(_synthetic_record(i), indent=4) for i in range(1000)]
+    raw = gzip.open(path, 'wb', compresslevel=1) if compress else open(path,
+                                                                      'wb')
+    written = 0
+    count = 0
+    with raw:
+        raw.write(b'[\n')
+        while written < target_bytes:
+            parts = []
+            for i in range(1000):
+                text = pool[i].replace(
+                    '-efa9-', '-{:04x}-'.format(count // 1000 & 0xFFFF), 2)
+                parts.append(text)
+                count += 1
+            data = (',\n' if written else '').encode() + ',\n'.join(
+                parts).encode('utf-8')
+            raw.write(data)
+            written += len(data)
+        raw.write(b'\n]\n')
+    return count
+
+
+def _peak_rss_mb(who):
+    # Kilobytes on Linux.
+    return resource.getrusage(who).ru_maxrss / 1024.0
+
+
+def _benchmark(args):
+    directory = tempfile.mkdtemp(prefix='ndjson-bench-')
+    try:
+        path = os.path.join(directory, 'input.json' +
+                            ('.gz' if args.benchmark_gzip_input else ''))
+        start = time.time()
+        count = write_synthetic_input(path, args.benchmark_mb * 1024 * 1024,
+                                      args.benchmark_gzip_input)
+        size = os.path.getsize(path)
+        print('Generated {} records, {:.0f} MB, in {:.1f}s.'.format(
+            count, size / 1e6, time.time() - start))
+        schema = load_schema(args.schema) if args.schema else None
+        processes = sorted({1, args.processes})
+        print('{:<10} {:<7} {:>9} {:>8} {:>9} {:>8}'.format(
+            'processes', 'output', 'seconds', 'MB/s', 'records/s', 'shards'))
+        for num_processes in processes:
+            for sharded in (False, True):
+                out_dir = os.path.join(directory, 'out')
+                start = time.time()
+                stats = convert(
+                    path,
+                    output=None if sharded else os.path.join(directory,
+                                                             'out.ndjson'),
+                    shard_dir=out_dir if sharded else None,
+                    max_shard_bytes=int(args.max_shard_mb * 1024 * 1024),
+                    schema=schema, on_invalid=args.on_invalid,
+                    processes=num_processes, compress=args.gzip)
+                elapsed = time.time() - start
+                print('{:<10} {:<7} {:>9.1f} {:>8.1f} {:>9.0f} {:>8}'.format(
+                    num_processes, 'shards' if sharded else 'file', elapsed,
+                    size / 1e6 / elapsed, stats.records / elapsed,
+                    len(stats.shards) if sharded else '-'))
+                shutil.rmtree(out_dir, ignore_errors=True)
+                if not sharded:
+                    os.remove(os.path.join(directory, 'out.ndjson'))
+        print('Peak memory: {:.0f} MB in this process, {:.0f} MB in a '
+              'worker.'.format(_peak_rss_mb(resource.RUSAGE_SELF),
+                               _peak_rss_mb(resource.RUSAGE_CHILDREN)))
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+def _parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument(
+        'input', nargs='?',
+        help='The JSON array to convert, optionally gzipped, or `-` for stdin.')
+    parser.add_argument(
+        '-o', '--output', default='-',
+        help='The NDJSON file to write, or `-` for stdout (the default).')
+    parser.add_argument(
+        '--shard_dir',
+        help='Write shards to this directory instead of one output.')
+    parser.add_argument(
+        '--max_shard_mb', type=float, default=256,
+        help='The maximum uncompressed size of a shard, e.g. 0.5.')
+    parser.add_argument('--shard_prefix', default='part',
+                        help='The start of the names of the shards.')
+    parser.add_argument('--gzip', action='store_true',
+                        help='Compress the output with gzip.')
+    parser.add_argument(
+        '--schema',
+        help='A BigQuery schema, such as `bq_schema.json`, to validate records '
+        'against.')
+    parser.add_argument(
+        '--on_invalid', choices=ON_INVALID, default=ON_INVALID_ERROR,
+        help='Whether to stop at, skip or keep records that do not match the '
+        'schema.')
+    parser.add_argument(
+        '--processes', type=int, default=1,
+        help='The number of processes that validate and write records. With '
+        'shards, every process writes its own, so records are not in input '
+        'order.')
+    parser.add_argument(
+        '--benchmark_mb', type=int,
+        help='Instead of converting, measure the throughput on a synthetic '
+        'array of this many MB, with 1 and `--processes` processes.')
+    parser.add_argument('--benchmark_gzip_input', action='store_true',
+                        help='Gzip the synthetic input of the benchmark.')
+    args = parser.parse_args()
+    if not args.input and not args.benchmark_mb:
+        parser.error('an input, or --benchmark_mb, is required')
+    return args
+
+
+def main():
+    args = _parse_args()
+    if args.benchmark_mb:
+        _benchmark(args)
+        return
+    start = time.time()
+    try:
+        stats = convert(
+            args.input, output=args.output, shard_dir=args.shard_dir,
+            max_shard_bytes=int(args.max_shard_mb * 1024 * 1024),
+            schema=load_schema(args.schema) if args.schema else None,
+            on_invalid=args.on_invalid, processes=args.processes,
+            compress=args.gzip, shard_prefix=args.shard_prefix)
+    except ValueError as e:
+        sys.exit('Error: {}'.format(e))
+    elapsed = time.time() - start
+    for index, message in stats.errors:
+        print('Invalid record {}: {}'.format(index, message), file=sys.stderr)
+    print('Converted {} records ({} invalid), {:.1f} MB in {:.1f}s, {:.1f} '
+          'MB/s{}.'.format(stats.records, stats.invalid,
+                           stats.chars_read / 1e6, elapsed,
+                           stats.chars_read / 1e6 / elapsed if elapsed else 0,
+                           ', {} shards'.format(len(stats.shards))
+                           if stats.shards else ''), file=sys.stderr)
+
 
-with open("data-generation/full-omni-flow.json", "r") as read_file:
-    data = json.load(read_file)
-result = [json.dumps(record) for record in data]
-with open('nd-proceesed.json', 'w') as obj:
-    for i in result:
-        obj.write(i+'\n')
\ No newline at end of file
+if __name__ == '__main__':
+    main()